@@ -846,20 +846,13 @@ def print_gene_hierarchy(gene_hierarchy):
 #    pp = pprint.PrettyPrinter(indent=4)
 #    pp.pprint(gene_hierarchy)
 
-def load_genes_from_gff(gff_filename):
+def iter_genes_from_gff(gff_filename):
     """
-    Load all records for a set of genes from a given GFF file.
-    Parse each gene into a Gene object.
+    Yield (gene ID, Gene object, gene hierarchy) for each gene of a
+    given GFF file, reading the file one gene at a time (see
+    gff_utils.iter_gff_genes.)
     """
-    gff_db = GFFDatabase(gff_filename)
-    # dictionary mapping gene IDs to the list of all their relevant records
-    gff_genes = {}
-
-    num_genes = 0
-
-    for gene in gff_db.genes:
-	gene_records, gene_hierarchy = gff_db.get_genes_records([gene.get_id()])
-
+    for gene, gene_records, gene_hierarchy in iter_gff_genes(gff_filename):
         # Record the gene's GFF record
         gene_label = gene.get_id()
 
@@ -876,8 +869,23 @@ def load_genes_from_gff(gff_filename):
         if gene_obj == None:
             print "Cannot make gene out of %s" %(gene_label)
             continue
-        gff_genes[gene.get_id()] = {'gene_object': gene_obj,
-                                    'hierarchy': gene_hierarchy}
+        yield gene_label, gene_obj, gene_hierarchy
+
+
+def load_genes_from_gff(gff_filename):
+    """
+    Load all records for a set of genes from a given GFF file.
+    Parse each gene into a Gene object.
+    """
+    # dictionary mapping gene IDs to the list of all their relevant records
+    gff_genes = {}
+
+    num_genes = 0
+
+    for gene_label, gene_obj, gene_hierarchy in \
+        iter_genes_from_gff(gff_filename):
+        gff_genes[gene_label] = {'gene_object': gene_obj,
+                                 'hierarchy': gene_hierarchy}
 
         if (num_genes % 5000) == 0:
             print "Through %d genes..." %(num_genes)
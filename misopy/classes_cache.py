@@ -0,0 +1,179 @@
+##
+## On-disk cache of the read classes of genes
+##
+## The sampler only needs the read classes of a gene (the distinct
+## columns of its read to isoform match matrix) and the number of
+## reads in each class, not the reads themselves. The classes are
+## cached, so that rerunning MISO on the same BAM file (e.g. with
+## other sampler settings) does not fetch the reads from the BAM file
+## and match them to the isoforms again.
+##
+## The classes are kept in samples stores (see samples_store): the
+## class templates as the samples (classes x isoforms) and the class
+## counts as the log scores. There is one directory per BAM file,
+## read length and overhang, and in it one record per gene and
+## version of its index file.
+##
+import os
+import json
+import hashlib
+
+from numpy import *
+
+import misopy.samples_store as samples_store
+import misopy.gene_index as gene_index
+
+## Bump this when the classes computed for the same reads change
+CACHE_VERSION = 1
+
+## Checksums of BAM files, by filename
+CHECKSUMS_FILENAME = "bam_checksums.json"
+
+bam_checksums = {}
+
+
+def file_md5(filename, block_size=1 << 20):
+    """
+    Return the MD5 checksum of a file.
+    """
+    md5 = hashlib.md5()
+    f = open(filename, "rb")
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        md5.update(block)
+    f.close()
+    return md5.hexdigest()
+
+
+def get_bam_stamp(bam_filename):
+    """
+    Return the size and modification time of a file.
+    """
+    st = os.stat(bam_filename)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def set_bam_checksum(bam_filename, checksum):
+    """
+    Record the checksum of a BAM file that was computed elsewhere,
+    e.g. by the parent of worker processes, so that the workers do
+    not all read the BAM file to compute it.
+    """
+    bam_filename = os.path.abspath(bam_filename)
+    bam_checksums[bam_filename] = (get_bam_stamp(bam_filename), checksum)
+
+
+def get_bam_checksum(cache_dir, bam_filename):
+    """
+    Return the checksum of a BAM file. Checksumming a BAM file reads
+    all of it, so the checksum is kept in the cache directory and
+    only recomputed if the size or modification time of the file
+    changed.
+    """
+    bam_filename = os.path.abspath(bam_filename)
+    stamp = get_bam_stamp(bam_filename)
+    if bam_filename in bam_checksums and \
+       bam_checksums[bam_filename][0] == stamp:
+        return bam_checksums[bam_filename][1]
+    checksums_filename = os.path.join(cache_dir, CHECKSUMS_FILENAME)
+    checksums = {}
+    if os.path.isfile(checksums_filename):
+        try:
+            checksums = json.load(open(checksums_filename))
+        except ValueError:
+            # Written by two processes at once, start over
+            checksums = {}
+    if bam_filename in checksums and \
+       checksums[bam_filename][0] == stamp:
+        checksum = str(checksums[bam_filename][1])
+    else:
+        print "Computing checksum of %s..." %(bam_filename)
+        checksum = file_md5(bam_filename)
+        checksums[bam_filename] = [stamp, checksum]
+        # Write the checksums to a temporary file first, so that other
+        # processes never read a partially written file
+        tmp_filename = "%s.%d" %(checksums_filename, os.getpid())
+        json.dump(checksums, open(tmp_filename, "w"))
+        os.rename(tmp_filename, checksums_filename)
+    bam_checksums[bam_filename] = (stamp, checksum)
+    return checksum
+
+
+def get_cache_key(bam_checksum, read_len, overhang_len):
+    return "v%d.%s.%d.%d" %(CACHE_VERSION, bam_checksum, read_len,
+                            overhang_len)
+
+
+class ClassesCache:
+    """
+    The read classes of the genes of a BAM file, with the given
+    read length and overhang.
+    """
+    def __init__(self, cache_dir, bam_filename, read_len, overhang_len):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.bam_checksum = get_bam_checksum(cache_dir, bam_filename)
+        self.read_len = read_len
+        self.overhang_len = overhang_len
+        self.dirname = os.path.join(cache_dir,
+                                    get_cache_key(self.bam_checksum,
+                                                  read_len, overhang_len))
+        if not os.path.isdir(self.dirname):
+            try:
+                os.makedirs(self.dirname)
+            except OSError:
+                # Created by another process meanwhile
+                pass
+        # Checksums of the gene index files
+        self.index_checksums = {}
+
+    def get_record_name(self, gene_id, gff_index_filename):
+        """
+        Return the name of a gene's record. It includes the checksum
+        of the gene's index file (or of the gene's records in a gene
+        index), so that the classes are recomputed if the gene is
+        reindexed.
+        """
+        if gene_index.is_gene_index(gff_index_filename):
+            gff_genes = gene_index.get_gene_index(gff_index_filename)
+            return "%s.%s" %(gene_id, gff_genes.get_gene_checksum(gene_id))
+        if gff_index_filename not in self.index_checksums:
+            self.index_checksums[gff_index_filename] = \
+                file_md5(gff_index_filename)
+        return "%s.%s" %(gene_id, self.index_checksums[gff_index_filename])
+
+    def get(self, gene_id, gff_index_filename):
+        """
+        Return the class templates (classes x isoforms), class counts
+        and number of raw reads of a gene, or None if the gene is not
+        in the cache.
+        """
+        record_name = self.get_record_name(gene_id, gff_index_filename)
+        samples_path = samples_store.find_event(self.dirname, record_name)
+        if samples_path == None:
+            return None
+        header, templates, counts = \
+            samples_store.read_samples(samples_path)
+        num_raw_reads = json.loads(header)["num_raw_reads"]
+        return tuple([tuple(t) for t in templates.astype(float)]), \
+               tuple(counts), num_raw_reads
+
+    def put(self, gene_id, gff_index_filename, class_templates,
+            class_counts, num_raw_reads):
+        """
+        Add the read classes of a gene, as returned by the sampler.
+        """
+        num_classes = len(class_counts)
+        if num_classes == 0:
+            return
+        record_name = self.get_record_name(gene_id, gff_index_filename)
+        header = json.dumps({"gene_id": gene_id,
+                             "bam_checksum": self.bam_checksum,
+                             "read_len": self.read_len,
+                             "overhang_len": self.overhang_len,
+                             "num_raw_reads": num_raw_reads})
+        templates = array(class_templates, dtype=float)
+        samples_store.write_samples(self.dirname, record_name, header,
+                                    templates, array(class_counts, dtype=float))
@@ -1,5 +1,8 @@
 from scipy import *
 from numpy import *
+import numpy
+
+from collections import defaultdict
 
 def format_credible_intervals(event_name, samples,
                               confidence_level=0.95):
@@ -43,10 +46,10 @@ def compute_credible_intervals(samples, confidence_level=.95):
     # compute the lower bound of the interval
     # the lower bound is the (alpha/2)*n-th smallest sample, where n is the
     # number of samples
-    lower_bound_indx = round((alpha/2)*num_samples) - 1
+    lower_bound_indx = int(round((alpha/2)*num_samples)) - 1
     # the upper bound is the (1-alpha/2)*n nth smallest sample, where n is
     # the number of samples
-    upper_bound_indx = round((1-alpha/2)*num_samples) - 1
+    upper_bound_indx = int(round((1-alpha/2)*num_samples)) - 1
     assert(lower_bound_indx > 0)
     assert(upper_bound_indx > 0)
     # sort samples along first axis
@@ -70,3 +73,59 @@ def compute_multi_iso_credible_intervals(multi_iso_samples,
         
     return credible_intervals
         
+
+
+def compute_batch_credible_intervals(samples, confidence_level=0.95):
+    """
+    Compute the credible intervals of many events at once, the same
+    way as compute_credible_intervals.
+
+    Assumes that samples is an events x samples x isoforms array.
+    Returns the lower and upper bounds, each an events x isoforms
+    array.
+    """
+    num_events, num_samples, num_isoforms = shape(samples)
+    alpha = 1 - confidence_level
+    lower_bound_indx = int(round((alpha/2)*num_samples)) - 1
+    upper_bound_indx = int(round((1-alpha/2)*num_samples)) - 1
+    assert(lower_bound_indx > 0)
+    assert(upper_bound_indx > 0)
+    # Only the two order statistics are needed, not a full sort
+    bounds = numpy.partition(samples, [lower_bound_indx, upper_bound_indx],
+                             axis=1)
+    return bounds[:, lower_bound_indx, :], bounds[:, upper_bound_indx, :]
+
+
+def format_batch_credible_intervals(event_names, samples_list,
+                                    confidence_level=0.95):
+    """
+    Return the print-able credible intervals of many events, like
+    format_credible_intervals returns for each event.
+
+    Events with the same number of samples and isoforms are stacked
+    and their intervals and posterior means computed together.
+    The samples are not modified.
+    """
+    events_by_shape = defaultdict(list)
+    for event_num, samples in enumerate(samples_list):
+        events_by_shape[shape(samples)].append(event_num)
+    output_fields = [None] * len(event_names)
+    for (num_samples, num_isoforms), event_nums in events_by_shape.iteritems():
+        samples = array([samples_list[event_num] for event_num in event_nums])
+        ci_low, ci_high = compute_batch_credible_intervals(samples,
+                                                           confidence_level=confidence_level)
+        posterior_means = mean(samples, 1)
+        for n, event_num in enumerate(event_nums):
+            event_name = event_names[event_num]
+            if num_isoforms > 2:
+                output_fields[event_num] = \
+                    [event_name,
+                     ",".join(["%.2f" %(val) for val in posterior_means[n]]),
+                     ",".join(["%.2f" %(val) for val in ci_low[n]]),
+                     ",".join(["%.2f" %(val) for val in ci_high[n]])]
+            else:
+                output_fields[event_num] = [event_name,
+                                            "%.2f" %(posterior_means[n][0]),
+                                            "%.2f" %(ci_low[n][0]),
+                                            "%.2f" %(ci_high[n][0])]
+    return output_fields
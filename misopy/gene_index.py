@@ -0,0 +1,644 @@
+##
+## Single-file, memory-mapped index of the genes of a GFF file
+##
+## The pickled index (see index_gff.serialize_genes) has a pickle file
+## per gene, in a directory per chromosome, so finding the genes of an
+## annotation means listing and unpickling every file. The gene index
+## keeps all genes of a GFF file in one file, which is memory-mapped:
+## the gene directory is read without decoding any gene, and a gene's
+## records are only decoded when the gene is looked up.
+##
+## File layout (little-endian):
+##
+##   file header:  magic, version, number of genes, records and
+##                 chromosomes, offsets of the genes, records, strings,
+##                 chromosomes and regions
+##   genes:        the gene directory, sorted by gene ID: offsets of the
+##                 gene ID, chromosome and compressed ID strings, the
+##                 gene's transcription start and end, and its rows in
+##                 the records table
+##   records:      the GFF records of the genes (gene, mRNAs, exons and
+##                 CDSs), a row each: kind, parent row, start, end and
+##                 the offset of the rest of the record (seqid, source,
+##                 type, score, strand, phase and attributes) as text
+##   strings:      the text of gene IDs, chromosomes and records
+##   chromosomes:  the chromosomes, sorted by name, and their rows in
+##                 the regions table
+##   regions:      the genes' transcription start and end, sorted by
+##                 chromosome and start; each chromosome's regions are
+##                 an implicit interval tree (see make_interval_tree),
+##                 the spatial index searched by GeneIndex.query_region
+##
+import os
+import mmap
+import struct
+import hashlib
+
+from collections import defaultdict
+from urllib import quote as url_quote, unquote as url_unquote
+
+from numpy import *
+
+import misopy
+import misopy.gff_utils as gff_utils
+import misopy.Gene as gene_utils
+
+INDEX_FILENAME = "genes.miso_index"
+INDEX_MAGIC = "MISOIDX1"
+INDEX_VERSION = 3
+
+## magic, version, number of genes, records and chromosomes, offsets
+## of the genes, records, strings, chromosomes and regions
+FILE_HEADER = struct.Struct("<8sIQQQQQQQQ")
+
+GENE_DTYPE = dtype([("id_offset", "<i8"), ("id_len", "<i8"),
+                    ("chrom_offset", "<i8"), ("chrom_len", "<i8"),
+                    ("compressed_offset", "<i8"), ("compressed_len", "<i8"),
+                    ("start", "<i8"), ("end", "<i8"),
+                    ("first_record", "<i8"), ("num_records", "<i8")])
+
+RECORD_DTYPE = dtype([("kind", "<i4"), ("parent", "<i4"),
+                      ("start", "<i8"), ("end", "<i8"),
+                      ("text_offset", "<i8"), ("text_len", "<i8")])
+
+CHROM_DTYPE = dtype([("name_offset", "<i8"), ("name_len", "<i8"),
+                     ("first_region", "<i8"), ("num_regions", "<i8")])
+
+REGION_DTYPE = dtype([("start", "<i8"), ("end", "<i8"),
+                      ("max_end", "<i8"), ("gene", "<i8")])
+
+## Subtrees of the interval tree of at most this many levels are
+## scanned rather than descended (see GeneIndex.query_region)
+SCAN_TREE_LEVEL = 3
+
+## Kinds of records
+GENE_RECORD, MRNA_RECORD, EXON_RECORD, CDS_RECORD = range(4)
+
+## Open gene indexes of this process, by filename
+gene_indexes = {}
+
+
+def pad8(n):
+    return (n + 7) & ~7
+
+
+def is_gene_index(index_filename):
+    """
+    Return True if the filename is a gene index (and not e.g. a
+    pickled gene.)
+    """
+    return index_filename.endswith(INDEX_FILENAME)
+
+
+def find_gene_index(indexed_gff_dir):
+    """
+    Return the gene index of an indexed GFF directory, or None if the
+    directory holds a pickled index.
+    """
+    if is_gene_index(indexed_gff_dir) and os.path.isfile(indexed_gff_dir):
+        return os.path.abspath(indexed_gff_dir)
+    index_filename = os.path.join(indexed_gff_dir, INDEX_FILENAME)
+    if os.path.isfile(index_filename):
+        return os.path.abspath(index_filename)
+    return None
+
+
+def format_record_text(rec):
+    """
+    Return the fields of a GFF record other than its coordinates as
+    text. Attribute order is not kept.
+    """
+    score = rec.score
+    if score != None:
+        # repr keeps all digits of the score
+        score = repr(score)
+    attributes = ";".join(["%s=%s" %(url_quote(tag),
+                                     ",".join([url_quote(value) \
+                                               for value in values]))
+                           for tag, values in rec.attributes.iteritems()])
+    return "\t".join([url_quote(rec.seqid),
+                      url_quote(rec.source),
+                      url_quote(rec.type),
+                      gff_utils.format_maybe_empty(score),
+                      gff_utils.format_maybe_empty(rec.strand),
+                      gff_utils.format_maybe_empty(rec.phase),
+                      attributes])
+
+
+def parse_record_text(text, start, end):
+    """
+    Make a GFF record from its coordinates and text (see
+    format_record_text.)
+    """
+    seqid, source, rec_type, score, strand, phase, attr_text = \
+        text.split("\t")
+    # The attributes are written as in GFF3, so they are decoded the
+    # same way, when used
+    return gff_utils.GFF(seqid=url_unquote(seqid),
+                         source=url_unquote(source),
+                         type=url_unquote(rec_type),
+                         start=start,
+                         end=end,
+                         score=gff_utils.parse_maybe_empty(score, float),
+                         strand=gff_utils.parse_maybe_empty(strand),
+                         phase=gff_utils.parse_maybe_empty(phase, int),
+                         attributes_text=attr_text)
+
+
+def get_gene_records(gene_id, gene_info):
+    """
+    Return the records of a gene as (kind, parent row, record)
+    triples, in the order they are written to the index: the gene,
+    then each mRNA followed by its exons and their CDSs. The mRNAs
+    come in the order of the gene's isoforms, so that the gene object
+    is made the same way when the gene is read back.
+    """
+    gene_hierarchy = gene_info['hierarchy'][gene_id]
+    mRNAs = gene_hierarchy['mRNAs']
+    # Transcripts in the order of the gene's parts
+    mRNA_ids = []
+    for part in gene_info['gene_object'].parts:
+        mRNA_id = part.parent_rec.get_id()
+        if mRNA_id not in mRNA_ids:
+            mRNA_ids.append(mRNA_id)
+    mRNA_ids.extend(sorted([mRNA_id for mRNA_id in mRNAs \
+                            if mRNA_id not in mRNA_ids]))
+    by_coords = lambda recs: sorted(recs, key=lambda rec: (rec.start, rec.end,
+                                                           rec.get_id()))
+    records = [(GENE_RECORD, -1, gene_hierarchy['gene'])]
+    for mRNA_id in mRNA_ids:
+        mRNA_info = mRNAs[mRNA_id]
+        mRNA_row = len(records)
+        records.append((MRNA_RECORD, 0, mRNA_info['record']))
+        exons = mRNA_info['exons']
+        for exon_rec in by_coords([exons[exon_id]['record'] \
+                                   for exon_id in exons]):
+            exon_row = len(records)
+            records.append((EXON_RECORD, mRNA_row, exon_rec))
+            cdss = exons[exon_rec.get_id()].get('cdss', {})
+            for cds_rec in by_coords([cdss[cds_id]['record'] \
+                                      for cds_id in cdss]):
+                records.append((CDS_RECORD, exon_row, cds_rec))
+    return records
+
+
+def make_interval_tree(regions):
+    """
+    Set the max_end of regions sorted by start, so that they form an
+    implicit interval tree: the regions are the nodes of a binary
+    tree laid out in order, as in a sorted array searched by binary
+    search. Leaves are at the even rows; the nodes of level k are at
+    the rows whose k lowest bits are set and bit k is clear, and the
+    root is at row 2^K - 1 for the largest K with 2^K <= len(regions).
+    Each node's max_end is the largest end of its subtree.
+
+    This is the layout of Heng Li's cgranges: queries descend only
+    into subtrees that can overlap the region, so they take
+    logarithmic time plus the number of genes found, however long
+    the genes are.
+    """
+    n = len(regions)
+    if n == 0:
+        return
+    max_end = regions["end"].copy()
+    # The largest end of the last, incomplete subtree of each level
+    last_row = (n - 1) & ~1
+    last = max_end[last_row]
+    k = 1
+    while (1 << k) <= n:
+        x = 1 << (k - 1)
+        rows = arange((x << 1) - 1, n, x << 2)
+        left_max = max_end[rows - x]
+        right_max = where(rows + x < n, max_end[minimum(rows + x, n - 1)],
+                          last)
+        max_end[rows] = maximum(max_end[rows], maximum(left_max, right_max))
+        if (last_row >> k) & 1:
+            last_row -= x
+        else:
+            last_row += x
+        if last_row < n and max_end[last_row] > last:
+            last = max_end[last_row]
+        k += 1
+    regions["max_end"] = max_end
+
+
+def make_regions(genes, gene_chroms):
+    """
+    Make the chromosomes and regions tables of a gene directory,
+    given the chromosome of each gene.
+    """
+    genes_by_chrom = defaultdict(list)
+    for n, chrom in enumerate(gene_chroms):
+        genes_by_chrom[chrom].append(n)
+    chroms = zeros(len(genes_by_chrom), dtype=CHROM_DTYPE)
+    regions = zeros(len(genes), dtype=REGION_DTYPE)
+    first_region = 0
+    for c, chrom in enumerate(sorted(genes_by_chrom.keys())):
+        rows = sorted(genes_by_chrom[chrom],
+                      key=lambda n: (genes[n]["start"], genes[n]["end"], n))
+        chrom_regions = regions[first_region:first_region + len(rows)]
+        chrom_regions["gene"] = rows
+        chrom_regions["start"] = genes["start"][rows]
+        chrom_regions["end"] = genes["end"][rows]
+        make_interval_tree(chrom_regions)
+        # The name is the chromosome string of the chromosome's genes
+        chroms[c]["name_offset"] = genes[rows[0]]["chrom_offset"]
+        chroms[c]["name_len"] = genes[rows[0]]["chrom_len"]
+        chroms[c]["first_region"] = first_region
+        chroms[c]["num_regions"] = len(rows)
+        first_region += len(rows)
+    return chroms, regions
+
+
+def pack_gene(gene_id, gene_info):
+    """
+    Pack a gene for the index: return its ID, chromosome, row of the
+    gene directory, rows of the records table and strings. The offsets
+    in the rows are relative to the gene's own records and strings.
+    """
+    strings = []
+    # Length of the strings so far
+    strings_len = [0]
+
+    def add_string(s):
+        offset = strings_len[0]
+        strings.append(s)
+        strings_len[0] += len(s)
+        return offset, len(s)
+
+    chrom = gene_info['gene_object'].chrom
+    id_offset, id_len = add_string(gene_id)
+    chrom_offset, chrom_len = add_string(chrom)
+    if 'compressed_id' in gene_info:
+        compressed_offset, compressed_len = \
+            add_string(gene_info['compressed_id'])
+    else:
+        compressed_offset, compressed_len = -1, 0
+    start, end = \
+        gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
+    records = []
+    for kind, parent, rec in get_gene_records(gene_id, gene_info):
+        text_offset, text_len = add_string(format_record_text(rec))
+        records.append((kind, parent, rec.start, rec.end,
+                        text_offset, text_len))
+    gene = (id_offset, id_len, chrom_offset, chrom_len, compressed_offset,
+            compressed_len, start, end, 0, len(records))
+    return gene_id, chrom, gene, array(records, dtype=RECORD_DTYPE), \
+           "".join(strings)
+
+
+def write_gene_index(gff_genes, index_filename):
+    """
+    Write genes to a gene index file. gff_genes maps gene IDs to gene
+    information, as returned by Gene.load_genes_from_gff, or is an
+    iterator of (gene ID, gene information) pairs, so that the genes
+    of a GFF file can be indexed as they are read. The gene
+    information may have the gene's 'compressed_id'.
+    """
+    if hasattr(gff_genes, "iteritems"):
+        gff_genes = gff_genes.iteritems()
+    write_packed_genes([pack_gene(gene_id, gene_info) \
+                        for gene_id, gene_info in gff_genes],
+                       index_filename)
+
+
+def merge_gene_indexes(index_filenames, index_filename):
+    """
+    Merge gene index files into one. The result is the same as
+    indexing all of their genes at once.
+    """
+    packed_genes = []
+    for part_filename in index_filenames:
+        packed_genes.extend(GeneIndex(part_filename).iter_packed_genes())
+    write_packed_genes(packed_genes, index_filename)
+
+
+def write_packed_genes(packed_genes, index_filename):
+    """
+    Write packed genes (see pack_gene) to a gene index file. The genes
+    are laid out in order of their IDs, whatever order they are given
+    in, so that the same genes always give the same file.
+    """
+    packed_genes = sorted(packed_genes, key=lambda packed_gene: packed_gene[0])
+    genes = array([packed_gene[2] for packed_gene in packed_genes],
+                  dtype=GENE_DTYPE)
+    gene_chroms = [packed_gene[1] for packed_gene in packed_genes]
+    gene_records = [packed_gene[3] for packed_gene in packed_genes]
+    strings = [packed_gene[4] for packed_gene in packed_genes]
+    # Make the offsets of each gene absolute
+    string_offsets = cumsum([0] + [len(s) for s in strings])
+    genes["first_record"] = cumsum([0] + [len(records) \
+                                          for records in gene_records])[:-1]
+    for field in ["id_offset", "chrom_offset", "compressed_offset"]:
+        has_string = genes[field] >= 0
+        genes[field][has_string] += string_offsets[:-1][has_string]
+    records = concatenate([zeros(0, dtype=RECORD_DTYPE)] + gene_records)
+    records["text_offset"] += repeat(string_offsets[:-1], genes["num_records"])
+    strings_len = int(string_offsets[-1])
+    chroms, regions = make_regions(genes, gene_chroms)
+
+    genes_offset = pad8(FILE_HEADER.size)
+    records_offset = pad8(genes_offset + genes.nbytes)
+    strings_offset = pad8(records_offset + records.nbytes)
+    chroms_offset = pad8(strings_offset + strings_len)
+    regions_offset = pad8(chroms_offset + chroms.nbytes)
+    # Write to a temporary file first, so that readers never see a
+    # partially written index
+    tmp_filename = "%s.%d" %(index_filename, os.getpid())
+    index_file = open(tmp_filename, "wb")
+    index_file.write(FILE_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                      len(genes), len(records),
+                                      len(chroms), genes_offset,
+                                      records_offset, strings_offset,
+                                      chroms_offset, regions_offset))
+    for offset, table in [(genes_offset, genes),
+                          (records_offset, records)]:
+        index_file.write("\0" * (offset - index_file.tell()))
+        index_file.write(table.tostring())
+    index_file.write("\0" * (strings_offset - index_file.tell()))
+    for s in strings:
+        index_file.write(s)
+    for offset, table in [(chroms_offset, chroms),
+                          (regions_offset, regions)]:
+        index_file.write("\0" * (offset - index_file.tell()))
+        index_file.write(table.tostring())
+    index_file.close()
+    os.rename(tmp_filename, index_filename)
+
+
+class GeneIndex:
+    """
+    A gene index file. Behaves as a read-only dictionary from gene
+    IDs to gene information ({'gene_object': ..., 'hierarchy': ...}),
+    like a loaded pickled index, but genes are decoded from the index
+    as they are looked up.
+    """
+    def __init__(self, index_filename):
+        self.filename = os.path.abspath(index_filename)
+        index_file = open(self.filename, "rb")
+        self.data = mmap.mmap(index_file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        index_file.close()
+        magic, version, num_genes, num_records, num_chroms, genes_offset, \
+            records_offset, self.strings_offset, chroms_offset, \
+            regions_offset = FILE_HEADER.unpack_from(self.data, 0)
+        if magic != INDEX_MAGIC:
+            raise Exception, "%s is not a gene index." %(self.filename)
+        if version != INDEX_VERSION:
+            raise Exception, "Gene index %s has version %d, expected %d. " \
+                  "Please reindex the GFF." %(self.filename, version,
+                                               INDEX_VERSION)
+        self.num_genes = num_genes
+        self.genes = frombuffer(self.data, dtype=GENE_DTYPE,
+                                count=num_genes, offset=genes_offset)
+        self.records = frombuffer(self.data, dtype=RECORD_DTYPE,
+                                  count=num_records, offset=records_offset)
+        chroms = frombuffer(self.data, dtype=CHROM_DTYPE,
+                            count=num_chroms, offset=chroms_offset)
+        self.regions = frombuffer(self.data, dtype=REGION_DTYPE,
+                                  count=num_genes, offset=regions_offset)
+        # Rows of each chromosome in the regions table
+        self.chroms = {}
+        for chrom in chroms:
+            name = self.get_string(chrom["name_offset"], chrom["name_len"])
+            first_region = int(chrom["first_region"])
+            self.chroms[name] = (first_region,
+                                 first_region + int(chrom["num_regions"]))
+
+    def get_string(self, offset, length):
+        offset = int(offset) + self.strings_offset
+        return self.data[offset:offset + int(length)]
+
+    def get_gene_id(self, n):
+        gene = self.genes[n]
+        return self.get_string(gene["id_offset"], gene["id_len"])
+
+    def find_gene(self, gene_id):
+        """
+        Return the row of a gene in the gene directory, or None.
+        """
+        lo, hi = 0, self.num_genes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_gene_id(mid) < gene_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_genes and self.get_gene_id(lo) == gene_id:
+            return lo
+        return None
+
+    def get_gene_row(self, gene_id):
+        n = self.find_gene(gene_id)
+        if n == None:
+            raise KeyError, gene_id
+        return self.genes[n]
+
+    def get_gene_ids(self):
+        """
+        Return the IDs of all genes, sorted.
+        """
+        return [self.get_string(offset, length) \
+                for offset, length in zip(self.genes["id_offset"],
+                                          self.genes["id_len"])]
+
+    def get_gene_bounds(self, gene_id):
+        """
+        Return the (chrom, transcription start, transcription end) of
+        a gene, without decoding it.
+        """
+        gene = self.get_gene_row(gene_id)
+        return self.get_string(gene["chrom_offset"], gene["chrom_len"]), \
+               int(gene["start"]), int(gene["end"])
+
+    def get_chroms(self):
+        """
+        Return the chromosomes of the genes, sorted.
+        """
+        return sorted(self.chroms.keys())
+
+    def query_region(self, chrom, start, end):
+        """
+        Return the IDs of the genes whose transcription start to end
+        overlaps chrom:start-end (inclusive coordinates), sorted by
+        start, without decoding any gene.
+
+        The regions of a chromosome form an implicit interval tree
+        (see make_interval_tree). The tree is walked in order from the
+        root, skipping left subtrees whose genes all end before start
+        and right subtrees whose genes all start after end; small
+        subtrees are scanned.
+        """
+        if chrom not in self.chroms:
+            return []
+        first_region, last_region = self.chroms[chrom]
+        regions = self.regions[first_region:last_region]
+        n = len(regions)
+        if n == 0:
+            return []
+        region_starts = regions["start"]
+        region_ends = regions["end"]
+        region_max_ends = regions["max_end"]
+        found = []
+        root_level = n.bit_length() - 1
+        # Nodes to visit: (row, level, whether the left subtree was
+        # visited)
+        stack = [((1 << root_level) - 1, root_level, False)]
+        while stack:
+            row, level, left_visited = stack.pop()
+            if level <= SCAN_TREE_LEVEL:
+                first_row = row >> level << level
+                last_row = min(first_row + (1 << (level + 1)) - 1, n)
+                for i in xrange(first_row, last_row):
+                    if region_starts[i] > end:
+                        break
+                    if region_ends[i] >= start:
+                        found.append(i)
+            elif not left_visited:
+                stack.append((row, level, True))
+                left_row = row - (1 << (level - 1))
+                if left_row >= n or region_max_ends[left_row] >= start:
+                    stack.append((left_row, level - 1, False))
+            elif row < n and region_starts[row] <= end:
+                if region_ends[row] >= start:
+                    found.append(row)
+                stack.append((row + (1 << (level - 1)), level - 1, False))
+        return [self.get_gene_id(n) for n in regions["gene"][found]]
+
+    def iter_packed_genes(self):
+        """
+        Yield the genes of the index packed as by pack_gene, without
+        decoding them.
+        """
+        for n in range(self.num_genes):
+            gene = self.genes[n].copy()
+            chrom = self.get_string(gene["chrom_offset"], gene["chrom_len"])
+            records = self.records[gene["first_record"]:gene["first_record"] + \
+                                   gene["num_records"]].copy()
+            # The strings of a gene follow each other, from its ID
+            strings_start = gene["id_offset"]
+            strings_end = max([gene["id_offset"] + gene["id_len"],
+                               gene["chrom_offset"] + gene["chrom_len"],
+                               gene["compressed_offset"] + \
+                               gene["compressed_len"]] + \
+                              list(records["text_offset"] + \
+                                   records["text_len"]))
+            for field in ["id_offset", "chrom_offset", "compressed_offset"]:
+                if gene[field] >= 0:
+                    gene[field] -= strings_start
+            gene["first_record"] = 0
+            records["text_offset"] -= strings_start
+            yield self.get_gene_id(n), chrom, gene.tolist(), records, \
+                  self.get_string(strings_start, strings_end - strings_start)
+
+    def get_gene_checksum(self, gene_id):
+        """
+        Return a checksum of a gene's records. It only changes if
+        the gene changes, not when other genes of the index do.
+        """
+        gene = self.get_gene_row(gene_id)
+        rows = self.records[gene["first_record"]:gene["first_record"] + \
+                            gene["num_records"]]
+        md5 = hashlib.md5()
+        for field in ["kind", "parent", "start", "end"]:
+            md5.update(ascontiguousarray(rows[field]).tostring())
+        for row in rows:
+            md5.update(self.get_string(row["text_offset"], row["text_len"]))
+        return md5.hexdigest()
+
+    def get_gene(self, gene_id):
+        """
+        Decode a gene: return {'gene_object': ..., 'hierarchy': ...},
+        and the 'compressed_id' of the gene if it has one.
+        """
+        gene = self.get_gene_row(gene_id)
+        rows = self.records[gene["first_record"]:gene["first_record"] + \
+                            gene["num_records"]]
+        gene_hierarchy = {'mRNAs': defaultdict(dict)}
+        # The node of each row in the hierarchy
+        nodes = []
+        gene_records = []
+        for row in rows:
+            rec = parse_record_text(self.get_string(row["text_offset"],
+                                                    row["text_len"]),
+                                    int(row["start"]), int(row["end"]))
+            kind = row["kind"]
+            if kind == GENE_RECORD:
+                gene_hierarchy['gene'] = rec
+                node = gene_hierarchy
+            elif kind == MRNA_RECORD:
+                node = {'exons': defaultdict(dict), 'record': rec}
+                gene_hierarchy['mRNAs'][rec.get_id()] = node
+                gene_records.append(rec)
+            elif kind == EXON_RECORD:
+                node = {'cdss': defaultdict(list), 'record': rec}
+                nodes[row["parent"]]['exons'][rec.get_id()] = node
+            else:
+                node = {'record': rec}
+                nodes[row["parent"]]['cdss'][rec.get_id()] = node
+            nodes.append(node)
+        gene_obj = gene_utils.make_gene_from_gff_records(gene_id,
+                                                         gene_hierarchy,
+                                                         gene_records)
+        gene_info = {'gene_object': gene_obj,
+                     'hierarchy': {gene_id: gene_hierarchy}}
+        if gene["compressed_offset"] >= 0:
+            gene_info['compressed_id'] = \
+                self.get_string(gene["compressed_offset"],
+                                gene["compressed_len"])
+        return gene_info
+
+    def __getitem__(self, gene_id):
+        return self.get_gene(gene_id)
+
+    def __contains__(self, gene_id):
+        return self.find_gene(gene_id) != None
+
+    def has_key(self, gene_id):
+        return gene_id in self
+
+    def get(self, gene_id, default=None):
+        if gene_id not in self:
+            return default
+        return self.get_gene(gene_id)
+
+    def __len__(self):
+        return self.num_genes
+
+    def keys(self):
+        return self.get_gene_ids()
+
+    def __iter__(self):
+        return iter(self.get_gene_ids())
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        for gene_id in self.get_gene_ids():
+            yield gene_id, self.get_gene(gene_id)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def get_compressed_ids(self):
+        """
+        Return the mapping from compressed IDs to gene IDs.
+        """
+        compressed_ids = {}
+        for n in range(self.num_genes):
+            gene = self.genes[n]
+            if gene["compressed_offset"] >= 0:
+                compressed_id = self.get_string(gene["compressed_offset"],
+                                                gene["compressed_len"])
+                compressed_ids[compressed_id] = self.get_gene_id(n)
+        return compressed_ids
+
+
+def get_gene_index(index_filename):
+    """
+    Return the open gene index of this process for a filename.
+    """
+    index_filename = os.path.abspath(index_filename)
+    if index_filename not in gene_indexes:
+        gene_indexes[index_filename] = GeneIndex(index_filename)
+    return gene_indexes[index_filename]
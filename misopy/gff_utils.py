@@ -50,8 +50,15 @@ from collections import defaultdict
 
 def load_indexed_gff_file(indexed_gff_filename):
     """
-    Load indexed representation of a set of genes.
+    Load indexed representation of a set of genes. For a gene index
+    (see gene_index), the genes are decoded as they are looked up.
     """
+    # Imported here since gene_index itself uses this module
+    import misopy.gene_index as gene_index
+    if gene_index.is_gene_index(indexed_gff_filename):
+        if not os.path.isfile(indexed_gff_filename):
+            return None
+        return gene_index.get_gene_index(indexed_gff_filename)
     indexed_gff = pickle_utils.load_pickled_file(indexed_gff_filename)
     return indexed_gff
 
@@ -70,6 +77,12 @@ def get_gene_ids_to_gff_index(indexed_gff_dir):
     """
     print "Mapping genes to their indexed GFF representation, using %s" \
           %(indexed_gff_dir)
+    import misopy.gene_index as gene_index
+    index_filename = gene_index.find_gene_index(indexed_gff_dir)
+    if index_filename != None:
+        # All genes are in one gene index file
+        return dict.fromkeys(gene_index.get_gene_index(index_filename).keys(),
+                             index_filename)
     gff_chrom_dirs = os.listdir(indexed_gff_dir)
 
     gene_ids_to_gff_index = {}
@@ -120,6 +133,39 @@ def get_gene_ids_to_gff_index(indexed_gff_dir):
                 gene_ids_to_gff_index[gene_id] = chrom_indexed_filename
 
     return gene_ids_to_gff_index
+
+
+def query_region(indexed_gff_dir, chrom, start, end):
+    """
+    Return the IDs of the genes of an indexed GFF directory whose
+    transcription start to end overlaps chrom:start-end (inclusive
+    coordinates), sorted by start.
+
+    A gene index answers this by binary search, without decoding any
+    gene. A pickled index has to unpickle every gene of the chromosome.
+    """
+    import misopy.gene_index as gene_index
+    index_filename = gene_index.find_gene_index(indexed_gff_dir)
+    if index_filename != None:
+        return gene_index.get_gene_index(index_filename).query_region(chrom,
+                                                                      start,
+                                                                      end)
+    chrom_dir_path = os.path.join(indexed_gff_dir, chrom)
+    if not os.path.isdir(chrom_dir_path):
+        return []
+    overlapping_genes = []
+    for gene_index_filename in os.listdir(chrom_dir_path):
+        if not gene_index_filename.endswith(".pickle"):
+            continue
+        indexed_genes = \
+            load_indexed_gff_chrom(os.path.join(chrom_dir_path,
+                                                gene_index_filename))
+        for gene_id, gene_info in indexed_genes.iteritems():
+            tx_start, tx_end = \
+                get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
+            if tx_start <= end and tx_end >= start:
+                overlapping_genes.append((tx_start, tx_end, gene_id))
+    return [gene_id for tx_start, tx_end, gene_id in sorted(overlapping_genes)]
                 
         
 class GFFDatabase:
@@ -153,24 +199,27 @@ class GFFDatabase:
         FILE = open(filename, "r")
         reader = Reader(FILE, version)
         for record in reader.read_recs(reverse_recs=reverse_recs):
-	    if record.type == "gene":
-		self.genes.append(record)
-            # Allow "transcript" 
-	    elif record.type == "mRNA" or record.type == "transcript":
-		self.mRNAs.append(record)
-                self.mRNAs_by_gene[record.get_parent()].append(record)
-	    elif record.type == "exon":
-		self.exons.append(record)
-                self.exons_by_mRNA[record.get_parent()].append(record)
-	    elif record.type == "CDS":
-		self.cdss.append(record)
-                self.cdss_by_exon[record.get_parent()].append(record)
-	    # is there a need to store all entries separately? Probably not but
-	    # leaving it in for now
-            self.__entries.append(record)
+            self.add_record(record)
 	self.from_filename = filename
         FILE.close()
 
+    def add_record(self, record):
+        if record.type == "gene":
+            self.genes.append(record)
+        # Allow "transcript" 
+        elif record.type == "mRNA" or record.type == "transcript":
+            self.mRNAs.append(record)
+            self.mRNAs_by_gene[record.get_parent()].append(record)
+        elif record.type == "exon":
+            self.exons.append(record)
+            self.exons_by_mRNA[record.get_parent()].append(record)
+        elif record.type == "CDS":
+            self.cdss.append(record)
+            self.cdss_by_exon[record.get_parent()].append(record)
+        # is there a need to store all entries separately? Probably not but
+        # leaving it in for now
+        self.__entries.append(record)
+
     def get_genes_records(self, genes):
 	"""
 	Return all the relevant records for a set of genes.
@@ -260,7 +309,288 @@ class GFFDatabase:
     def __iter__(self):
 	return self
 
-class GFF:
+
+##
+## Streaming the genes of a GFF file
+##
+## GFFDatabase keeps every record of a file in memory. The functions
+## below read a file one gene at a time instead, which needs the file
+## to be sorted by gene: each gene's record comes before those of its
+## mRNAs, and each mRNA's before those of its exons and their CDSs,
+## all before the next gene. Files that are not are sorted by gene
+## into a temporary file first, in chunks merged from disk.
+##
+
+## Types of the records that make up a gene, in the order sorted
+## files give them
+GENE_RECORD_RANKS = {"gene": 0, "mRNA": 1, "transcript": 1, "exon": 2,
+                     "CDS": 3}
+
+
+def iter_gff_record_lines(gff_file):
+    """
+    Yield the (line, fields, type, ID, parent ID) of the records of a
+    GFF3 file that make up genes. The IDs are parsed the way GFF
+    records parse them, without parsing the rest of the record. Lines
+    are yielded newline-terminated, even the last line of a file that
+    does not end with a newline.
+    """
+    for line in gff_file:
+        if line.startswith("##FASTA") or line.startswith(">"):
+            break
+        if line.startswith("#") or line == "\n":
+            continue
+        line = line.rstrip("\r\n")
+        fields = line.split("\t")
+        line += "\n"
+        if len(fields) != 9:
+            raise FormatError, "Invalid number of fields (should be 9):\n" + line
+        rec_type = url_unquote(fields[2])
+        if rec_type not in GENE_RECORD_RANKS:
+            continue
+        rec_id, parent_id = "", ""
+        for pair_string in fields[8].split(";"):
+            if pair_string.startswith("ID="):
+                rec_id = url_unquote(pair_string[3:].split(",")[0]).rstrip()
+            elif pair_string.startswith("Parent="):
+                parent_id = url_unquote(pair_string[7:].split(",")[0]).rstrip()
+        if rec_type == "exon" and rec_id == "":
+            # Default exon ID, as set by GFF records
+            start, end = sorted([int(fields[3]), int(fields[4])])
+            rec_id = "%s@%s@%s@%s" %(parent_id, start, end,
+                                     parse_maybe_empty(fields[6]))
+        yield line, fields, rec_type, rec_id, parent_id
+
+
+def is_sorted_by_gene(gff_filename):
+    """
+    Return True if a GFF3 file is sorted by gene (see above), so that
+    its genes can be streamed.
+    """
+    gff_file = open(gff_filename)
+    gene_ids = set()
+    # IDs of the current gene, its mRNAs and exons
+    gene_rec_ids = set()
+    is_sorted = True
+    for line, fields, rec_type, rec_id, parent_id in \
+        iter_gff_record_lines(gff_file):
+        if rec_type == "gene":
+            if rec_id in gene_ids:
+                is_sorted = False
+                break
+            gene_ids.add(rec_id)
+            gene_rec_ids = set([rec_id])
+        elif parent_id not in gene_rec_ids:
+            is_sorted = False
+            break
+        elif rec_type != "CDS":
+            gene_rec_ids.add(rec_id)
+    gff_file.close()
+    return is_sorted
+
+
+def sort_gff_by_gene(gff_filename, sorted_filename,
+                     chunk_size=500000):
+    """
+    Sort the gene records of a GFF3 file by gene (see above) into
+    sorted_filename. Genes come sorted by ID, and the records of a
+    gene of the same type in the order of the file.
+
+    At most chunk_size records are kept in memory; they are sorted
+    and written to temporary files, which are then merged. Only the
+    parent of each mRNA and exon is kept for all of the file, to find
+    the gene of each record.
+    """
+    import heapq
+    import tempfile
+    # Parents of mRNAs and exons
+    parents = {}
+    gff_file = open(gff_filename)
+    for line, fields, rec_type, rec_id, parent_id in \
+        iter_gff_record_lines(gff_file):
+        if rec_type != "gene" and rec_type != "CDS":
+            parents[rec_id] = parent_id
+    gff_file.close()
+
+    def get_gene_id(rec_type, rec_id, parent_id):
+        if rec_type == "gene":
+            return rec_id
+        for level in range(GENE_RECORD_RANKS[rec_type] - 1):
+            parent_id = parents.get(parent_id)
+        return parent_id
+
+    chunk_filenames = []
+    try:
+        chunk = []
+
+        def write_chunk():
+            chunk.sort()
+            chunk_fd, chunk_filename = tempfile.mkstemp(suffix=".gff")
+            chunk_filenames.append(chunk_filename)
+            chunk_file = os.fdopen(chunk_fd, "w")
+            chunk_file.writelines(chunk)
+            chunk_file.close()
+            del chunk[:]
+
+        gff_file = open(gff_filename)
+        for line_num, (line, fields, rec_type, rec_id, parent_id) in \
+            enumerate(iter_gff_record_lines(gff_file)):
+            gene_id = get_gene_id(rec_type, rec_id, parent_id)
+            if gene_id == None:
+                # Not part of any gene
+                continue
+            # Sort key: gene, type and line, each free of tabs
+            chunk.append("%s\t%d\t%012d\t%s" %(url_quote(gene_id),
+                                                GENE_RECORD_RANKS[rec_type],
+                                                line_num, line))
+            if len(chunk) >= chunk_size:
+                write_chunk()
+        gff_file.close()
+        if len(chunk) > 0:
+            write_chunk()
+
+        chunk_files = [open(chunk_filename) \
+                       for chunk_filename in chunk_filenames]
+        sorted_file = open(sorted_filename, "w")
+        sorted_file.write("##gff-version 3\n")
+        for line in heapq.merge(*chunk_files):
+            sorted_file.write(line.split("\t", 3)[3])
+        sorted_file.close()
+        for chunk_file in chunk_files:
+            chunk_file.close()
+    finally:
+        for chunk_filename in chunk_filenames:
+            os.remove(chunk_filename)
+
+
+def iter_sorted_gff_genes(gff_filename, version="3"):
+    """
+    Yield (gene record, gene's records, gene hierarchy) for each gene
+    of a GFF file that is sorted by gene, as GFFDatabase's
+    get_genes_records does. Only the records of one gene are kept in
+    memory at a time.
+    """
+    gff_file = open(gff_filename, "r")
+    reader = Reader(gff_file, version)
+    gene_db = None
+
+    def get_gene():
+        gene = gene_db.genes[0]
+        gene_records, gene_hierarchy = \
+            gene_db.get_genes_records([gene.get_id()])
+        return gene, gene_records, gene_hierarchy
+
+    for record in reader:
+        if record.type not in GENE_RECORD_RANKS:
+            continue
+        if record.type == "gene":
+            if gene_db != None:
+                yield get_gene()
+            gene_db = GFFDatabase()
+            gene_db.from_filename = gff_filename
+        elif gene_db == None:
+            # Not part of any gene
+            continue
+        gene_db.add_record(record)
+    if gene_db != None:
+        yield get_gene()
+    gff_file.close()
+
+
+def split_gff_by_chrom(gff_filename, output_dir,
+                       buffer_size=100000):
+    """
+    Split the gene records of a GFF3 file into a file per chromosome
+    in output_dir, keeping their order. Return the (chromosome, GFF
+    filename) of each chromosome. Each record goes with the chromosome
+    (seqid) it is on.
+    """
+    chrom_filenames = {}
+    chrom_lines = defaultdict(list)
+
+    def flush_lines():
+        for chrom, lines in chrom_lines.iteritems():
+            if chrom not in chrom_filenames:
+                chrom_filenames[chrom] = \
+                    os.path.join(output_dir, "%d.gff" %(len(chrom_filenames)))
+                chrom_file = open(chrom_filenames[chrom], "w")
+                chrom_file.write("##gff-version 3\n")
+            else:
+                chrom_file = open(chrom_filenames[chrom], "a")
+            chrom_file.writelines(lines)
+            chrom_file.close()
+        chrom_lines.clear()
+
+    gff_file = open(gff_filename)
+    num_lines = 0
+    for line, fields, rec_type, rec_id, parent_id in \
+        iter_gff_record_lines(gff_file):
+        chrom_lines[url_unquote(fields[0])].append(line)
+        num_lines += 1
+        if num_lines % buffer_size == 0:
+            flush_lines()
+    gff_file.close()
+    flush_lines()
+    return sorted(chrom_filenames.items())
+
+
+def iter_gff_genes(gff_filename, version="3"):
+    """
+    Yield (gene record, gene's records, gene hierarchy) for each gene
+    of a GFF file, reading the file one gene at a time. If the file
+    is not sorted by gene, it is sorted into a temporary file first.
+    """
+    if version != "3" or is_sorted_by_gene(gff_filename):
+        for gene in iter_sorted_gff_genes(gff_filename, version):
+            yield gene
+        return
+    import tempfile
+    print "%s is not sorted by gene, sorting it..." %(gff_filename)
+    sorted_fd, sorted_filename = tempfile.mkstemp(suffix=".gff")
+    os.close(sorted_fd)
+    try:
+        sort_gff_by_gene(gff_filename, sorted_filename)
+        for gene in iter_sorted_gff_genes(sorted_filename, version):
+            yield gene
+    finally:
+        os.remove(sorted_filename)
+
+
+def benchmark_reader(gff_filename, version="3", num_repeats=3):
+    """
+    Time reading the records of a GFF file and their ID and Parent,
+    as GFFDatabase does, with the legacy reader (LegacyReader), which
+    decodes every field and attribute of each record, and with Reader,
+    decoding the attributes all at once and lazily. Print and return
+    the best records per second of each.
+    """
+    import time
+    readers = [("Legacy reader", LegacyReader, {}),
+               ("Eager attributes", Reader, {"lazy_attributes": False}),
+               ("Lazy attributes", Reader, {"lazy_attributes": True})]
+    records_per_sec = []
+    for reader_name, reader_class, reader_args in readers:
+        best_time = None
+        for repeat in range(num_repeats):
+            gff_file = open(gff_filename, "r")
+            t1 = time.time()
+            num_records = 0
+            for record in reader_class(gff_file, version, **reader_args):
+                record.get_id()
+                record.get_parent()
+                num_records += 1
+            t2 = time.time()
+            gff_file.close()
+            if best_time == None or t2 - t1 < best_time:
+                best_time = t2 - t1
+        records_per_sec.append(num_records / max(best_time, 1e-9))
+        print "%s: %d records, %.0f records per second (%.2fx legacy)" \
+              %(reader_name, num_records, records_per_sec[-1],
+                records_per_sec[-1] / records_per_sec[0])
+    return tuple(records_per_sec)
+
+
+class GFF(object):
     """A record from a GFF file.
 
     Fields:
@@ -273,10 +603,19 @@ class GFF:
        strand
        phase
        attributes
-    """
 
-    def __init__(self, seqid, source, type, start, end,
-                 score=None, strand=None, phase=None, attributes=None):
+    The attributes can be given undecoded, as the attributes string of
+    a GFF3 line (attributes_text). They are then decoded when first
+    used, except for the ID and Parent, which are decoded right away.
+    """
+    __slots__ = ["seqid", "source", "type", "start", "end", "score",
+                 "strand", "phase", "_attributes", "_attributes_text"]
+
+    def __init__(self, seqid=None, source=None, type=None, start=None,
+                 end=None, score=None, strand=None, phase=None,
+                 attributes=None, attributes_text=None):
+        # The arguments have defaults so that records pickled before
+        # GFF had slots can be unpickled
         self.seqid = seqid
         self.source = source
         self.type = type
@@ -286,10 +625,14 @@ class GFF:
         self.strand = strand
         self.phase = phase
 
-        if attributes:
-            self.attributes = attributes
+        self._attributes_text = None
+        if attributes_text is not None:
+            self._attributes = parse_id_attributes_v3(attributes_text)
+            self._attributes_text = attributes_text
+        elif attributes:
+            self._attributes = attributes
         else:
-            self.attributes = {}
+            self._attributes = {}
 
         # sanitize: require that start <= end
         if self.start > self.end:
@@ -306,6 +649,32 @@ class GFF:
         self._filter_exon_id()
         
 
+    def _get_attributes(self):
+        if self._attributes_text is not None:
+            attributes = parse_attributes_v3(self._attributes_text)
+            # Attributes set before decoding (e.g. a default exon ID)
+            attributes.update(self._attributes)
+            self._attributes = attributes
+            self._attributes_text = None
+        return self._attributes
+
+    def _set_attributes(self, attributes):
+        self._attributes = attributes
+        self._attributes_text = None
+
+    attributes = property(_get_attributes, _set_attributes)
+
+    def __getstate__(self):
+        # The same state as records pickled before GFF had slots
+        state = dict([(name, getattr(self, name)) \
+                      for name in self.__slots__ if not name.startswith("_")])
+        state["attributes"] = self.attributes
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     def _set_default_exon_id(self):
         """
         If exon records are missing an ID, automatically compute an ID of the form:
@@ -314,13 +683,13 @@ class GFF:
 
         This function is dedicated to Robert K. Bradley.
         """
-        if self.type == "exon" and "ID" not in self.attributes:
+        if self.type == "exon" and "ID" not in self._attributes:
             parent_id = self.get_parent()
             exon_id = "%s@%s@%s@%s" %(parent_id,
                                       self.start,
                                       self.end,
                                       self.strand)
-            self.attributes['ID'] = [exon_id]
+            self._attributes['ID'] = [exon_id]
 
     def _filter_exon_id(self, replace_char='@'):
         """
@@ -411,9 +780,13 @@ class GFF:
         """Get the value of a particular key.  If multiple values, return the first value.
         If no such key, return the empty list."""
 
-        if key in self.attributes:
+        attributes = self._attributes
+        if key not in attributes and self._attributes_text is not None \
+           and key not in _id_attribute_tags:
+            attributes = self.attributes
+        if key in attributes:
             # Ensure that trailing whitespace is removed
-            return self.attributes[key][0].rstrip()
+            return attributes[key][0].rstrip()
         return ""
  
     def get_id (self):
@@ -456,9 +829,11 @@ class FormatError(Exception):
 class Reader:
     """Reads a GFF formatted file"""
 
-    def __init__(self, stream, version="3"):
+    def __init__(self, stream, version="3", lazy_attributes=True):
         self._stream = stream
         self._default_version = version
+        # Decode GFF3 attributes other than ID and Parent only when used
+        self._lazy_attributes = lazy_attributes
 
         # Directives
         self._version = None
@@ -545,9 +920,15 @@ class Reader:
     def _stage_rec(self):
         while self._next_rec is None:
             line = self._stream.readline()
+            # The last line of a file may have no newline
+            if line[-1:] != "\n" and line != "":
+                line += "\n"
 
+            # Most lines are records
+            if line[:1] not in _non_record_starts:
+                self._next_rec = self._record_parser(line)
             # Stop when EOF reached
-            if line == "":
+            elif line == "":
                 return
             # Check for pragma line
             elif line.startswith("##"):
@@ -654,6 +1035,91 @@ class Reader:
         except ValueError, e:
             raise FormatError, "GFF field format error: " + e.message
 
+    def _parse_record_v3(self, line):
+        self._references_resolved = False
+
+        fields = line[:-1].split('\t')
+
+        if len(fields) != 9:
+            raise FormatError, "Invalid number of fields (should be 9):\n" + line
+
+        seqid, source, rec_type, start, end, score, strand, phase, \
+            attributes_text = fields
+        try:
+            if self._lazy_attributes:
+                attributes = None
+            else:
+                attributes, attributes_text = \
+                    self._parse_attributes_v3(attributes_text), None
+            # Field parsing inlined, this runs for every record
+            return GFF(seqid if "%" not in seqid else url_unquote(seqid),
+                       source if "%" not in source else url_unquote(source),
+                       rec_type if "%" not in rec_type else url_unquote(rec_type),
+                       int(start),
+                       int(end),
+                       float(score) if score != "." else None,
+                       strand if strand != "." else None,
+                       int(phase) if phase != "." else None,
+                       attributes,
+                       attributes_text)
+        except ValueError, e:
+            raise FormatError, "GFF field format error: " + e.message
+
+    def _parse_attributes_v3(self, s):
+        return parse_attributes_v3(s)
+
+    def _parse_attributes_v2(self, s):
+        attributes = {}
+        currentTag = None
+        for token in AttributeIterator(s):
+            if currentTag is None:
+                if isinstance(token, IdentifierToken):
+                    currentTag = token.value
+                    attributes[currentTag] = []
+                else:
+                    raise FormatError, "Invalid attributes string: " + s
+            elif isinstance(token, SeparatorToken):
+                currentTag = None
+            elif isinstance(token, CommentToken):
+                break
+            elif isinstance(token, IdentifierToken):
+                attributes[currentTag].append(token.value)
+            elif isinstance(token, ValueToken):
+                attributes[currentTag].append(token.value)
+            else:
+                raise FormatError, "Invalid attributes string: " + s
+        return attributes
+
+class LegacyReader(Reader):
+    """
+    Reads a GFF formatted file the way Reader did before GFF3
+    attributes were decoded lazily: every field and attribute of a
+    record is URL-unquoted and decoded as the record is read. Kept as
+    the baseline of benchmark_reader.
+    """
+
+    def _stage_rec(self):
+        while self._next_rec is None:
+            line = self._stream.readline()
+
+            # Stop when EOF reached
+            if line == "":
+                return
+            # Check for pragma line
+            elif line.startswith("##"):
+                self._parse_directive(line)
+            # Check for comment line
+            elif line.startswith("#"):
+                self._parse_comment(line)
+            # Skip over blank lines
+            elif line == "\n":
+                pass
+            # Check for beginning of FASTA region for v3 formats
+            elif line.startswith(">") and self._version == "3":
+                self._fasta_string = line + self._stream.read()
+            else:
+                self._next_rec = self._record_parser(line)
+
     def _parse_record_v3(self, line):
         self._references_resolved = False
 
@@ -690,27 +1156,6 @@ class Reader:
 #                raise FormatError("Invalid attributes string: " + s)
         return attributes
 
-    def _parse_attributes_v2(self, s):
-        attributes = {}
-        currentTag = None
-        for token in AttributeIterator(s):
-            if currentTag is None:
-                if isinstance(token, IdentifierToken):
-                    currentTag = token.value
-                    attributes[currentTag] = []
-                else:
-                    raise FormatError, "Invalid attributes string: " + s
-            elif isinstance(token, SeparatorToken):
-                currentTag = None
-            elif isinstance(token, CommentToken):
-                break
-            elif isinstance(token, IdentifierToken):
-                attributes[currentTag].append(token.value)
-            elif isinstance(token, ValueToken):
-                attributes[currentTag].append(token.value)
-            else:
-                raise FormatError, "Invalid attributes string: " + s
-        return attributes
 
 class IdentifierToken:
     pass
@@ -772,6 +1217,47 @@ def format_maybe_empty(value, empty_str='.'):
     else:
         return str(value)
 
+def fast_url_unquote(s):
+    """
+    URL-unquote a string, skipping the strings with nothing to unquote.
+    """
+    if "%" in s:
+        return url_unquote(s)
+    return s
+
+def parse_attributes_v3(s):
+    """
+    Parse the attributes of a GFF3 record into a dictionary from tags
+    to lists of values.
+    """
+    attributes = {}
+
+    for pair_string in s.split(";"):
+        if (len (pair_string) == 0):
+            continue
+        try:
+            tag, value = pair_string.split("=")
+            attributes[fast_url_unquote(tag)] = \
+                [fast_url_unquote(v) for v in value.split(",")]
+        except ValueError:
+            print >>sys.stderr, "WARNING: Invalid attributes string: ", s
+#            raise FormatError("Invalid attributes string: " + s)
+    return attributes
+
+def parse_id_attributes_v3(s):
+    """
+    Parse only the ID and Parent attributes of a GFF3 record, as
+    parse_attributes_v3 would.
+    """
+    attributes = {}
+    # The last value of a tag wins, as in parse_attributes_v3
+    for tag, value in _id_attributes_pat.findall(s):
+        if "%" in value:
+            attributes[tag] = map(url_unquote, value.split(","))
+        else:
+            attributes[tag] = value.split(",")
+    return attributes
+
 def quote(s):
     return '"%s"' % str(s)
 
@@ -785,6 +1271,11 @@ _source_pat = re.compile(r'[^a-zA-Z0-9./\(\): ^*$@!+_?-]')
 _type_pat = _source_pat
 _tag_pat = re.compile(r'[\t\n\r\f\v;=%&,]')
 _value_pat = _tag_pat
+# Valid ID and Parent attributes (see parse_id_attributes_v3)
+_id_attribute_tags = ("ID", "Parent")
+# First characters of lines that are not records (see Reader._stage_rec)
+_non_record_starts = frozenset(["", "#", "\n", ">"])
+_id_attributes_pat = re.compile(r'(?:^|;)(ID|Parent)=([^;=]*)(?=;|$)')
 
 class Writer:
     """Writes a GFF formatted file"""
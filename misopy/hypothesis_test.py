@@ -3,17 +3,55 @@
 ##
 from numpy import *
 import os
+import time
+import scipy.special
+import itertools
+import multiprocessing
 import scipy
 from scipy import stats
 from scipy.stats import gaussian_kde
 from decimal import Decimal
+from collections import defaultdict
 import misopy
 from misopy.samples_utils import *
+import misopy.samples_store as samples_store
 from misopy.credible_intervals import *
 
 #load_samples, format_credible_intervals, \
 #     get_samples_dir_filenames, get_isoforms_from_header
 
+## Fields of a Bayes factors (.miso_bf) file
+BF_HEADER_FIELDS = ['event_name',
+                    'sample1_posterior_mean',
+                    'sample1_ci_low',
+                    'sample1_ci_high',
+                    'sample2_posterior_mean',
+                    'sample2_ci_low',
+                    'sample2_ci_high',
+                    'diff',
+                    'bayes_factor',
+                    'isoforms',
+                    'sample1_counts',
+                    'sample1_assigned_counts',
+                    'sample2_counts',
+                    'sample2_assigned_counts',
+                    'chrom',
+                    'strand',
+                    'mRNA_starts',
+                    'mRNA_ends']
+
+## Ways of writing the delta posteriors of a comparison
+DELTA_POSTERIORS_FORMATS = ["none", "text", "binary"]
+DELTA_POSTERIORS_STORE = "delta_posteriors%s" %(samples_store.STORE_EXT)
+
+## Number of events compared per task of a many-samples comparison
+COMPARISON_CHUNK_SIZE = 500
+
+## Posterior samples of all samples in a many-samples comparison,
+## loaded once by the parent process and shared with the workers
+## it forks
+comparison_state = {}
+
 #import matplotlib
 #import matplotlib.pyplot as plt
 #from matplotlib import rc
@@ -100,21 +138,44 @@ def compute_prior_proportion_diff(num_samples):
 
 
 def compute_delta_densities(samples1_filename, samples2_filename, diff_range,
-                            smoothing_param=0.3):
+                            smoothing_param=0.3,
+                            fit_densities=True):
     """
     Compute the Gaussian kernel density fitted distributions over delta for
     the two sets of posterior samples filenames given.  Returns the posterior density
     and prior density as well, assuming a uniform prior over the Psi of the samples
     in the two conditions.
+
+    If fit_densities is False, no densities are fitted and the Bayes
+    factors are None; compute them for many events at once with
+    compute_batch_bayes_factors.
+    """
+    # Load posterior samples from files
+    samples1_results = load_samples(samples1_filename)
+    samples2_results = load_samples(samples2_filename)
+    return compute_results_delta_densities(samples1_results, samples2_results,
+                                           diff_range,
+                                           smoothing_param=smoothing_param,
+                                           labels=(samples1_filename,
+                                                   samples2_filename),
+                                           fit_densities=fit_densities)
+
+
+def compute_results_delta_densities(samples1_results, samples2_results,
+                                    diff_range, smoothing_param=0.3,
+                                    labels=("sample1", "sample2"),
+                                    fit_densities=True):
+    """
+    Like compute_delta_densities, for two sets of posterior samples
+    already loaded by load_samples. labels name the samples in
+    warnings.
     """
     densities = {}
     # Compute analytic prior density
     prior_density_fn = lambda x: 1 + x if x <= 0 else 1 - x
-    analytic_prior_density = map(prior_density_fn, diff_range)
-    # Load posterior samples from files
-    samples1_results = load_samples(samples1_filename)
+    if fit_densities:
+        analytic_prior_density = map(prior_density_fn, diff_range)
     posterior_samples1 = samples1_results[0]
-    samples2_results = load_samples(samples2_filename)
     posterior_samples2 = samples2_results[0]
 
     num_samples, num_isoforms = shape(posterior_samples1)
@@ -144,6 +205,8 @@ def compute_delta_densities(samples1_filename, samples2_filename, diff_range,
 
     # Collection of Bayes factors (only 1 in two-isoform case)
     densities['bayes_factor'] = []
+    if not fit_densities:
+        densities['bayes_factor'] = None
     
     # For each isoform, compute its Bayes factor and delta posterior
     warning_outputted = False
@@ -161,9 +224,12 @@ def compute_delta_densities(samples1_filename, samples2_filename, diff_range,
 
         if all_same_diff and not warning_outputted:
             print "Warning: %s or %s were not properly sampled." \
-                  %(samples1_filename, samples2_filename)
+                  %(labels[0], labels[1])
             warning_outputted = True
 
+        if not fit_densities:
+            continue
+
         if mean_abs_posterior_diff <= .009 or all_same_diff:
             posterior_density = NullPeakedDensity(posterior_diff)
         else:
@@ -181,16 +247,81 @@ def compute_delta_densities(samples1_filename, samples2_filename, diff_range,
     return densities
 
 
+def index_samples_filenames(samples_filenames, use_compressed_map=None):
+    """
+    Return a mapping from event names to samples filenames. If an
+    event has several files, the first one is used.
+    """
+    filenames_by_event = {}
+    for samples_filename in samples_filenames:
+        event_name = get_event_name(samples_filename,
+                                    use_compressed_map=use_compressed_map)
+        if event_name not in filenames_by_event:
+            filenames_by_event[event_name] = samples_filename
+    return filenames_by_event
+
+
+def pair_samples_filenames(sample1_filenames, sample2_filenames,
+                           use_compressed_map=None,
+                           join="hash"):
+    """
+    Pair the samples filenames of the same events in two samples.
+    Yields (event name, sample 1 filename, sample 2 filename).
+
+    With the 'hash' join, the events of sample 2 are indexed by name
+    and the pairs come in the order of sample1_filenames. With the
+    'sorted' join, both samples are sorted by event name and merged,
+    so the pairs come in order of event name.
+    """
+    if join == "hash":
+        sample2_index = index_samples_filenames(sample2_filenames,
+                                                use_compressed_map=use_compressed_map)
+        for sample1_filename in sample1_filenames:
+            event_name = get_event_name(sample1_filename,
+                                        use_compressed_map=use_compressed_map)
+            if event_name in sample2_index:
+                yield event_name, sample1_filename, sample2_index[event_name]
+    elif join == "sorted":
+        # Sorts are stable, so the first file of an event in sample 2
+        # comes first, as with the hash join
+        sample1_events = sorted([(get_event_name(f, use_compressed_map=use_compressed_map), f) \
+                                 for f in sample1_filenames], key=lambda e: e[0])
+        sample2_events = sorted([(get_event_name(f, use_compressed_map=use_compressed_map), f) \
+                                 for f in sample2_filenames], key=lambda e: e[0])
+        sample2_num = 0
+        for event_name, sample1_filename in sample1_events:
+            while sample2_num < len(sample2_events) and \
+                  sample2_events[sample2_num][0] < event_name:
+                sample2_num += 1
+            if sample2_num == len(sample2_events):
+                break
+            if sample2_events[sample2_num][0] == event_name:
+                yield event_name, sample1_filename, sample2_events[sample2_num][1]
+    else:
+        raise Exception, "Unknown join %s, must be hash or sorted." %(join)
+
+
 def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
                               alpha=.95,
                               sample_labels=None,
-                              use_compressed=None):
+                              use_compressed=None,
+                              join="hash",
+                              bf_method="kde",
+                              delta_posteriors="text"):
     """
     Compute the bayes factors, posterior means, and other statistics
     between the two samples and output them to a directory.
 
     Expects two directories with samples from a MISO run, where corresponding
     events in the two samples' directories begin with the same event name.
+    Events are paired by join (see pair_samples_filenames.) Bayes
+    factors are computed with bf_method (see compute_batch_bayes_factors.)
+
+    The delta posteriors (samples of sample 1's Psi minus sample 2's)
+    are written as one text .miso_dp file per event with
+    delta_posteriors 'text', to one samples store
+    (delta-posteriors/delta_posteriors.miso_store, read it with
+    samples_store) with 'binary', or not at all with 'none'.
     """
     print "Given output dir: ", output_dir
     # Retrieve only the files that are in the two given directories
@@ -224,30 +355,24 @@ def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
     if not os.path.isdir(bf_output_dir):
 	os.mkdir(bf_output_dir)
 	
+    if delta_posteriors not in DELTA_POSTERIORS_FORMATS:
+        raise Exception, "Unknown delta posteriors format %s, must be one " \
+              "of: %s." %(delta_posteriors, ", ".join(DELTA_POSTERIORS_FORMATS))
+
     # Create directory for raw delta posteriors
     dp_output_dir = os.path.join(output_dir, 'delta-posteriors/')
-    if not os.path.isdir(dp_output_dir):
+    if delta_posteriors != "none" and not os.path.isdir(dp_output_dir):
 	os.makedirs(dp_output_dir)
+    dp_store = None
+    if delta_posteriors == "binary":
+        dp_store_filename = os.path.join(dp_output_dir, DELTA_POSTERIORS_STORE)
+        print "Outputting delta posteriors to: %s" %(dp_store_filename)
+        if os.path.isfile(dp_store_filename):
+            os.remove(dp_store_filename)
+        dp_store = samples_store.SamplesStoreWriter(dp_store_filename,
+                                                    log_scores=False)
     
-    header_fields = ['event_name',
-		     'sample1_posterior_mean',
-		     'sample1_ci_low',
-		     'sample1_ci_high',
-		     'sample2_posterior_mean',
-		     'sample2_ci_low',
-		     'sample2_ci_high',
-		     'diff',
-		     'bayes_factor',
-                     'isoforms',
-                     'sample1_counts',
-                     'sample1_assigned_counts',
-                     'sample2_counts',
-                     'sample2_assigned_counts',
-                     'chrom',
-                     'strand',
-                     'mRNA_starts',
-                     'mRNA_ends']
-    header_line = "\t".join(header_fields) + "\n"
+    header_line = "\t".join(BF_HEADER_FIELDS) + "\n"
     output_filename = os.path.join(bf_output_dir, "%s_vs_%s.miso_bf" %(sample1_label,
                                                                        sample2_label))
     output_file = open(output_filename, 'w')
@@ -267,39 +392,132 @@ def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
         print "  - Loading compressed IDs mapping from: %s" %(use_compressed)        
         compressed_ids_to_genes = index_gff.load_compressed_ids_to_genes(use_compressed)
 
-    # Compute the Bayes factors for each file
-    for sample1_filename in sample1_filenames:
-        sample1_event_name = get_event_name(sample1_filename,
-                                            use_compressed_map=compressed_ids_to_genes)
+    compared_events = []
 
+    # Compute the Bayes factors for each event in both samples
+    for sample1_event_name, sample1_filename, sample2_filename in \
+        pair_samples_filenames(sample1_filenames, sample2_filenames,
+                               use_compressed_map=compressed_ids_to_genes,
+                               join=join):
         # Parameters from raw MISO samples file
         params = parse_sampler_params(sample1_filename)
         # Extract gene information if available
         gene_info = get_gene_info_from_params(params)
         
-	# Find corresponding event filename in sample 2
-        sample2_filename = filter(lambda filename:
-                                  get_event_name(filename,
-                                                 use_compressed_map=compressed_ids_to_genes) == sample1_event_name,
-                                  sample2_filenames)
-	if len(sample2_filename) == 0:
-            continue
-        sample2_filename = sample2_filename[0]
-        
         num_events_compared += 1
 	
 	# Compute delta of posterior samples and Bayes factors
 	diff_range = arange(-1, 1, 0.001)
 	delta_densities = compute_delta_densities(sample1_filename, sample2_filename,
-                                                  diff_range)
-	bf = delta_densities['bayes_factor']
-        
+                                                  diff_range,
+                                                  fit_densities=False)
         num_isoforms = shape(delta_densities['samples1'])[1]
+
+        # Credible intervals are computed for a batch of events at once
+        compared_events.append((sample1_event_name, delta_densities,
+                                gene_info))
+        if len(compared_events) >= batch_size:
+            output_comparison_batch(output_file, compared_events, alpha,
+                                    bf_method=bf_method)
+            compared_events = []
         
+	# Output raw delta posteriors
+        if delta_posteriors == "none":
+            continue
+        delta_posterior_samples = delta_densities['samples1'] - \
+                                  delta_densities['samples2']
+        if num_isoforms == 2:
+            delta_posterior_samples = delta_posterior_samples[:, 0:-1]
+        if delta_posteriors == "binary":
+            dp_store.add(sample1_event_name, "delta_posteriors",
+                         delta_posterior_samples, None)
+            continue
+
+	dp_header = "delta_posteriors\n"
+
+        # Move to next batch if needed
+        if file_num % batch_size == 0:
+            curr_batch += 1
+            print "Outputting batch number %d (batch size = %d)..." \
+                  %(curr_batch, batch_size)
+
+            # Make output dir for the current batch
+            batch_dir_name = "batch_%d_%d" %(batch_size, curr_batch)
+            curr_dp_dir = os.path.join(dp_output_dir, batch_dir_name)
+            
+            if not os.path.isdir(curr_dp_dir):
+                print "Making output directory: %s" %(curr_dp_dir)
+                os.makedirs(curr_dp_dir)
+            
+        file_num += 1
+
+        # File name for delta posterior file
+        dp_filename = os.path.join(curr_dp_dir,
+                                   sample1_event_name + '.miso_dp')
+
+        # Output the raw delta posteriors
+	dp_file = open(dp_filename, 'w')
+	dp_file.write(dp_header)
+
+	for delta_posterior in delta_posterior_samples:
+            dp_output_line = "%s\n" %(",".join(["%.4f" %(v) for v in delta_posterior]))
+	    dp_file.write(dp_output_line)
+	dp_file.close()
+                                 
+    output_comparison_batch(output_file, compared_events, alpha,
+                            bf_method=bf_method)
+    if dp_store is not None:
+        dp_store.close()
+
+    print "Compared a total of %d events." %(num_events_compared)
+    output_file.close()
+    
+
+def output_comparison_batch(output_file, compared_events, alpha,
+                            bf_method="kde"):
+    """
+    Write the comparison lines of a batch of events, given as
+    (event name, delta densities, gene information) tuples.
+    """
+    for output_line in format_comparison_batch(compared_events, alpha,
+                                               bf_method=bf_method):
+        output_file.write(output_line)
+
+
+def format_comparison_batch(compared_events, alpha, bf_method="kde"):
+    """
+    Return the comparison lines of a batch of events (see
+    output_comparison_batch.) The posterior means and credible
+    intervals of the batch are computed together, as are the Bayes
+    factors of events that have none yet (with bf_method, see
+    compute_batch_bayes_factors.)
+    """
+    output_lines = []
+    event_names = [event[0] for event in compared_events]
+    unfitted_events = [event for event in compared_events \
+                       if event[1]['bayes_factor'] is None]
+    batch_bayes_factors = \
+        compute_batch_bayes_factors([event[1]['samples1'] for event in unfitted_events],
+                                    [event[1]['samples2'] for event in unfitted_events],
+                                    method=bf_method)
+    for event, bayes_factors in zip(unfitted_events, batch_bayes_factors):
+        event[1]['bayes_factor'] = list(bayes_factors)
+    sample1_batch_intervals = \
+        format_batch_credible_intervals(event_names,
+                                        [event[1]['samples1'] for event in compared_events],
+                                        confidence_level=alpha)
+    sample2_batch_intervals = \
+        format_batch_credible_intervals(event_names,
+                                        [event[1]['samples2'] for event in compared_events],
+                                        confidence_level=alpha)
+    for event_num, compared_event in enumerate(compared_events):
+        sample1_event_name, delta_densities, gene_info = compared_event
+	bf = delta_densities['bayes_factor']
+        num_isoforms = shape(delta_densities['samples1'])[1]
+
 	sample1_posterior_mean = mean(delta_densities['samples1'], 0)
 	sample2_posterior_mean = mean(delta_densities['samples2'], 0)
 
-
         # Get the labels of the isoforms
         isoforms_field = delta_densities['isoforms']
 
@@ -307,17 +525,13 @@ def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
         sample1_counts_info = delta_densities['sample1_counts']
         sample2_counts_info = delta_densities['sample2_counts']
 
-	# Compute posterior mean and credible intervals for sample 1
-        sample1_cred_intervals = format_credible_intervals(sample1_event_name,
-                                                           delta_densities['samples1'],
-                                                           confidence_level=alpha)
+	# Posterior mean and credible intervals for sample 1
+        sample1_cred_intervals = sample1_batch_intervals[event_num]
         sample1_ci_low = sample1_cred_intervals[2]
         sample1_ci_high = sample1_cred_intervals[3]
 
-        # Compute posterior mean and credible intervals for sample 2
-        sample2_cred_intervals = format_credible_intervals(sample1_event_name,
-                                                           delta_densities['samples2'],
-                                                           confidence_level=alpha)
+        # Posterior mean and credible intervals for sample 2
+        sample2_cred_intervals = sample2_batch_intervals[event_num]
         sample2_ci_low = sample2_cred_intervals[2]
         sample2_ci_high = sample2_cred_intervals[3]
         
@@ -363,49 +577,243 @@ def output_samples_comparison(sample1_dir, sample2_dir, output_dir,
                          gene_info["mRNA_starts"],
                          gene_info["mRNA_ends"]]
 	output_line = "%s\n" %("\t".join(output_fields))
-	output_file.write(output_line)
-        
-	# Output raw delta posteriors
-	dp_header = "delta_posteriors\n"
+        output_lines.append(output_line)
+    return output_lines
 
-        # Move to next batch if needed
-        if file_num % batch_size == 0:
-            curr_batch += 1
-            print "Outputting batch number %d (batch size = %d)..." \
-                  %(curr_batch, batch_size)
 
-            # Make output dir for the current batch
-            batch_dir_name = "batch_%d_%d" %(batch_size, curr_batch)
-            curr_dp_dir = os.path.join(dp_output_dir, batch_dir_name)
-            
-            if not os.path.isdir(curr_dp_dir):
-                print "Making output directory: %s" %(curr_dp_dir)
-                os.makedirs(curr_dp_dir)
-            
-        file_num += 1
+def load_sample_posteriors(sample_dir, use_compressed_map=None):
+    """
+    Load the posterior samples of all events of a sample into memory.
+    Return the event names (in the order of the sample's files) and
+    a mapping from event names to their load_samples results. If an
+    event has several files, the first one is used.
+    """
+    event_names = []
+    posteriors = {}
+    for samples_filename in get_samples_dir_filenames(sample_dir):
+        event_name = get_event_name(samples_filename,
+                                    use_compressed_map=use_compressed_map)
+        if event_name in posteriors:
+            continue
+        event_names.append(event_name)
+        posteriors[event_name] = load_samples(samples_filename)
+    return event_names, posteriors
 
-        # File name for delta posterior file
-        dp_filename = os.path.join(curr_dp_dir,
-                                   sample1_event_name + '.miso_dp')
 
-        # Output the raw delta posteriors
-	dp_file = open(dp_filename, 'w')
-	dp_file.write(dp_header)
+def compare_events_worker(comparison_task):
+    """
+    Compare a chunk of events between two samples of a many-samples
+    comparison. Return the comparison lines of the events.
+    """
+    sample1_num, sample2_num, event_names = comparison_task
+    posteriors1 = comparison_state["posteriors"][sample1_num]
+    posteriors2 = comparison_state["posteriors"][sample2_num]
+    labels = comparison_state["labels"]
+    diff_range = arange(-1, 1, 0.001)
+    compared_events = []
+    for event_name in event_names:
+        samples1_results = posteriors1[event_name]
+        samples2_results = posteriors2[event_name]
+        delta_densities = \
+            compute_results_delta_densities(samples1_results, samples2_results,
+                                            diff_range,
+                                            labels=("%s in %s" %(event_name,
+                                                                 labels[sample1_num]),
+                                                    "%s in %s" %(event_name,
+                                                                 labels[sample2_num])),
+                                            fit_densities=False)
+        params = parse_header_params(samples1_results[1][0])
+        gene_info = get_gene_info_from_params(params)
+        compared_events.append((event_name, delta_densities, gene_info))
+    return sample1_num, sample2_num, \
+           format_comparison_batch(compared_events, comparison_state["alpha"],
+                                   bf_method=comparison_state["bf_method"])
+
+
+def output_many_samples_comparison(sample_dirs, output_dir,
+                                   alpha=.95,
+                                   sample_labels=None,
+                                   use_compressed=None,
+                                   num_processors=1,
+                                   bf_method="kde"):
+    """
+    Compare every pair of the given samples and output a Bayes factors
+    file for each pair, laid out like output_samples_comparison's
+    (without delta posteriors.)
 
-        delta_posteriors = delta_densities['samples1'] - \
-                           delta_densities['samples2']
+    The posteriors of each sample are loaded once. The events of all
+    pairs are then compared in chunks, on a pool of num_processors
+    worker processes.
+    """
+    if sample_labels == None:
+        sample_labels = [os.path.basename(os.path.normpath(sample_dir)) \
+                         for sample_dir in sample_dirs]
+    if len(sample_labels) != len(sample_dirs):
+        raise Exception, "Need one label per sample to compare."
+    if len(set(sample_labels)) != len(sample_labels):
+        raise Exception, "Sample labels %s are not unique." \
+              %(", ".join(sample_labels))
 
-	for delta_posterior in delta_posteriors:
-            if num_isoforms == 2:
-                delta_posterior = delta_posterior[0:-1]
-            dp_output_line = "%s\n" %(",".join(["%.4f" %(v) for v in delta_posterior]))
-	    dp_file.write(dp_output_line)
-	dp_file.close()
-                                 
+    compressed_ids_to_genes = None
+    if use_compressed is not None:
+        print "  - Loading compressed IDs mapping from: %s" %(use_compressed)
+        compressed_ids_to_genes = index_gff.load_compressed_ids_to_genes(use_compressed)
+
+    t1 = time.time()
+    all_event_names = []
+    all_posteriors = []
+    for sample_dir in sample_dirs:
+        print "Loading posteriors of %s..." %(sample_dir)
+        event_names, posteriors = \
+            load_sample_posteriors(sample_dir,
+                                   use_compressed_map=compressed_ids_to_genes)
+        print "  - Loaded %d events." %(len(event_names))
+        all_event_names.append(event_names)
+        all_posteriors.append(posteriors)
+    comparison_state["posteriors"] = all_posteriors
+    comparison_state["labels"] = sample_labels
+    comparison_state["alpha"] = alpha
+    comparison_state["bf_method"] = bf_method
+
+    # Chunks of events to compare, pair by pair. Events are compared
+    # in the order of the first sample of the pair.
+    num_samples = len(sample_dirs)
+    comparison_tasks = []
+    output_files = {}
+    for sample1_num in range(num_samples):
+        for sample2_num in range(sample1_num + 1, num_samples):
+            pair_events = [event_name for event_name in all_event_names[sample1_num] \
+                           if event_name in all_posteriors[sample2_num]]
+            for chunk_start in range(0, len(pair_events), COMPARISON_CHUNK_SIZE):
+                comparison_tasks.append((sample1_num, sample2_num,
+                                         pair_events[chunk_start:chunk_start + \
+                                                     COMPARISON_CHUNK_SIZE]))
+            pair_label = "%s_vs_%s" %(sample_labels[sample1_num],
+                                      sample_labels[sample2_num])
+            bf_output_dir = os.path.join(output_dir, pair_label, "bayes-factors")
+            if not os.path.isdir(bf_output_dir):
+                os.makedirs(bf_output_dir)
+            output_filename = os.path.join(bf_output_dir,
+                                           "%s.miso_bf" %(pair_label))
+            output_file = open(output_filename, 'w')
+            output_file.write("\t".join(BF_HEADER_FIELDS) + "\n")
+            output_files[(sample1_num, sample2_num)] = output_file
+    print "Comparing %d pairs of samples in %d chunks of events..." \
+          %(len(output_files), len(comparison_tasks))
+
+    if num_processors <= 1:
+        results = itertools.imap(compare_events_worker, comparison_tasks)
+        pool = None
+    else:
+        # Workers are forked after the posteriors are loaded, so
+        # they share them with the parent
+        pool = multiprocessing.Pool(processes=num_processors)
+        results = pool.imap(compare_events_worker, comparison_tasks)
+    num_events_compared = 0
+    try:
+        for sample1_num, sample2_num, output_lines in results:
+            output_file = output_files[(sample1_num, sample2_num)]
+            for output_line in output_lines:
+                output_file.write(output_line)
+            num_events_compared += len(output_lines)
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        for output_file in output_files.values():
+            output_file.close()
+        comparison_state.clear()
+    t2 = time.time()
+    print "Compared a total of %d events in %.2f seconds." \
+          %(num_events_compared, t2 - t1)
+
+
+def compute_batch_bayes_factors(samples1_list, samples2_list, method="kde",
+                                smoothing_param=0.3):
+    """
+    Compute the Bayes factors (at delta Psi = 0) of many events at
+    once, given their posterior samples in the two conditions.
+    Returns an array of Bayes factors (one per isoform) for each event.
+
+    Events whose samples have the same shape are stacked and computed
+    together by compute_delta_bayes_factors.
+    """
+    events_by_shape = defaultdict(list)
+    for event_num, samples1 in enumerate(samples1_list):
+        events_by_shape[shape(samples1)].append(event_num)
+    bayes_factors = [None] * len(samples1_list)
+    for event_nums in events_by_shape.itervalues():
+        delta_samples = array([samples1_list[event_num] - samples2_list[event_num] \
+                               for event_num in event_nums])
+        batch_bayes_factors = compute_delta_bayes_factors(delta_samples,
+                                                          method=method,
+                                                          smoothing_param=smoothing_param)
+        for n, event_num in enumerate(event_nums):
+            bayes_factors[event_num] = batch_bayes_factors[n]
+    return bayes_factors
+
+
+def compute_delta_bayes_factors(delta_samples, method="kde",
+                                smoothing_param=0.3):
+    """
+    Compute the Bayes factors at delta Psi = 0, given an events x
+    samples x isoforms array of posterior samples of delta Psi.
+    Returns an events x isoforms array.
+
+    The prior density of delta Psi at 0 is 1, so the Bayes factor is
+    1 over the posterior density at 0, estimated by method:
+
+      - 'kde': the Gaussian kernel density estimate that
+        compute_delta_densities fits (gaussian_kde_covfact with
+        smoothing_param), evaluated at 0 directly as the mean of
+        the kernels there
+      - 'beta': a Beta distribution fitted to (delta Psi + 1) / 2
+        by the method of moments
+
+    As in compute_delta_densities, deltas that are nearly 0 or
+    constant give a Bayes factor of 0.
+    """
+    max_bf = 1e12
+    num_events, num_samples, num_isoforms = shape(delta_samples)
+    mean_abs_diff = mean(abs(delta_samples), 1)
+    all_same_diff = alltrue(delta_samples == delta_samples[:, 0:1, :], 1)
+    null_peaked = (mean_abs_diff <= .009) | all_same_diff
+    with errstate(all='ignore'):
+        if method == "kde":
+            # Kernel variance: the variance of the deltas scaled by
+            # the smoothing factor, as in gaussian_kde
+            kernel_var = var(delta_samples, 1, ddof=1) * smoothing_param**2
+            kernel_var[null_peaked] = 1
+            posterior_density = \
+                mean(exp(-delta_samples**2 / (2 * kernel_var[:, newaxis, :])), 1) \
+                / sqrt(2 * pi * kernel_var)
+        elif method == "beta":
+            psi_diff = (delta_samples + 1) / 2.
+            diff_mean = mean(psi_diff, 1)
+            diff_var = var(psi_diff, 1, ddof=1)
+            diff_var[null_peaked] = 1
+            # Method of moments; keep the parameters valid when the
+            # deltas are too spread out for a Beta
+            common = maximum(diff_mean * (1 - diff_mean) / diff_var - 1, 1e-6)
+            a = maximum(diff_mean * common, 1e-6)
+            b = maximum((1 - diff_mean) * common, 1e-6)
+            # Density of the Beta at 1/2, over 2 for the change of
+            # variable back to delta Psi
+            posterior_density = exp((a + b - 2) * log(0.5) - \
+                                    scipy.special.betaln(a, b)) / 2
+        else:
+            raise Exception, "Unknown Bayes factor method %s, must be " \
+                  "kde or beta." %(method)
+        bayes_factors = where(posterior_density == 0, max_bf,
+                              1 / posterior_density)
+    bayes_factors[null_peaked] = 0
+    return bayes_factors
 
-    print "Compared a total of %d events." %(num_events_compared)
-    output_file.close()
-    
 
 def compute_bayes_factor(prior_density, posterior_density, at_point=0, print_bayes=False):
     """
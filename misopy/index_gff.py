@@ -7,7 +7,10 @@ import os
 import sys
 import time
 import glob
+import shutil
 import shelve
+import tempfile
+import multiprocessing
 
 from collections import defaultdict
 
@@ -15,13 +18,18 @@ import misopy
 import misopy.gff_utils as gff_utils
 import misopy.pickle_utils as pickle_utils
 import misopy.Gene as gene_utils
+import misopy.gene_index as gene_index
 
 COMPRESS_PREFIX = "misocomp"
 
 def load_compressed_ids_to_genes(compressed_filename):
     """
-    Load mapping from compressed IDs to genes.
+    Load mapping from compressed IDs to genes. Takes either the
+    compressed IDs shelve of a pickled index or a gene index.
     """
+    index_filename = gene_index.find_gene_index(compressed_filename)
+    if index_filename != None:
+        return gene_index.get_gene_index(index_filename).get_compressed_ids()
     if not os.path.exists(compressed_filename):
         print "Error: %s does not exist." %(compressed_filename)
         sys.exit(1)
@@ -60,6 +68,19 @@ def serialize_genes(gff_genes, output_dir,
 
     If asked, use compressed IDs (hashes) of the 'ID=' field in the GFF.
     """
+    gene_id_to_filename, compressed_id_to_gene_id = \
+        write_gene_pickles(gff_genes, output_dir, compress_id=compress_id)
+    shelve_gene_filenames(output_dir, gene_id_to_filename,
+                          compressed_id_to_gene_id)
+
+
+def write_gene_pickles(gff_genes, output_dir,
+                       compress_id=False):
+    """
+    Output genes into pickle files by chromosome, by gene. Return the
+    mappings from gene IDs to their pickle filenames and from
+    compressed IDs to gene IDs.
+    """
     genes_by_chrom = defaultdict(dict)
 
     # Split up genes by chromosome 
@@ -90,7 +111,12 @@ def serialize_genes(gff_genes, output_dir,
         chrom_dir = os.path.join(output_dir, chrom_dir_name)
         if not os.path.isdir(chrom_dir):
             print "Making directory: %s" %(chrom_dir)
-            os.makedirs(chrom_dir)
+            try:
+                os.makedirs(chrom_dir)
+            except OSError:
+                # Made by another worker meanwhile (e.g. for "1" and
+                # "chr1")
+                pass
 
         t1 = time.time()
         # Serialize each gene into a separate file
@@ -116,7 +142,11 @@ def serialize_genes(gff_genes, output_dir,
  
         t2 = time.time()
         print "  - Chromosome serialization took %.2f seconds" %(t2 - t1)
+    return gene_id_to_filename, compressed_id_to_gene_id
+
 
+def shelve_gene_filenames(output_dir, gene_id_to_filename,
+                          compressed_id_to_gene_id):
     # Shelve the mapping from gene ids to filenames
     shelved_filename = os.path.join(output_dir, "genes_to_filenames.shelve")
     shelved_data = shelve.open(shelved_filename)
@@ -131,35 +161,163 @@ def serialize_genes(gff_genes, output_dir,
         shelved_data[k] = v
     shelved_data.close()
     
+
+def iter_index_genes(gff_filename, compress_id=False):
+    """
+    Yield (gene ID, gene information) for each gene of a GFF file, as
+    they are read, for writing a gene index.
+    """
+    for gene_id, gene_obj, gene_hierarchy in \
+        gene_utils.iter_genes_from_gff(gff_filename):
+        gene_info = {'gene_object': gene_obj,
+                     'hierarchy': gene_hierarchy}
+        if compress_id:
+            gene_info['compressed_id'] = compress_event_name(gene_id)
+        yield gene_id, gene_info
+
+
+def index_chrom_worker(args):
+    """
+    Index the genes of a chromosome's GFF file, into a gene index file
+    or into pickle files in the output directory. Return the number
+    of genes and, for pickles, their filename mappings.
+    """
+    chrom, chrom_gff_filename, index_filename, output_dir, \
+        compress_id, pickle_index = args
+    print "Indexing chromosome %s..." %(chrom)
+    if pickle_index:
+        gff_genes = gene_utils.load_genes_from_gff(chrom_gff_filename)
+        return len(gff_genes), write_gene_pickles(gff_genes, output_dir,
+                                                  compress_id=compress_id)
+    gene_index.write_gene_index(iter_index_genes(chrom_gff_filename,
+                                                 compress_id=compress_id),
+                                index_filename)
+    return len(gene_index.GeneIndex(index_filename)), None
+
+
+def index_gff_parallel(gff_filename, output_dir,
+                       compress_id=False,
+                       pickle_index=False,
+                       num_processors=2):
+    """
+    Index a GFF on num_processors processes. The GFF is first split by
+    chromosome, then each chromosome is indexed by its own worker. The
+    workers' gene indexes are merged into one, which is the same as
+    the one indexing the GFF serially gives.
+    """
+    parts_dir = tempfile.mkdtemp(prefix="index_gff.")
+    try:
+        t1 = time.time()
+        chrom_gffs = gff_utils.split_gff_by_chrom(gff_filename, parts_dir)
+        t2 = time.time()
+        print "  - Splitting GFF into %d chromosomes took %.2f seconds" \
+              %(len(chrom_gffs), t2 - t1)
+        chrom_jobs = []
+        for chrom_num, (chrom, chrom_gff_filename) in enumerate(chrom_gffs):
+            index_filename = os.path.join(parts_dir, "%d.%s" \
+                                          %(chrom_num,
+                                            gene_index.INDEX_FILENAME))
+            chrom_jobs.append((chrom, chrom_gff_filename, index_filename,
+                               output_dir, compress_id, pickle_index))
+        # Start with the largest chromosomes
+        chrom_jobs.sort(key=lambda job: os.path.getsize(job[1]),
+                        reverse=True)
+
+        t1 = time.time()
+        pool = multiprocessing.Pool(processes=num_processors)
+        try:
+            results = pool.map(index_chrom_worker, chrom_jobs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        num_genes = sum([result[0] for result in results])
+        t2 = time.time()
+        print "  - Indexing %d genes on %d processors took %.2f seconds" \
+              %(num_genes, num_processors, t2 - t1)
+
+        if pickle_index:
+            gene_id_to_filename = {}
+            compressed_id_to_gene_id = {}
+            for chrom_num_genes, chrom_filenames in results:
+                gene_id_to_filename.update(chrom_filenames[0])
+                compressed_id_to_gene_id.update(chrom_filenames[1])
+            shelve_gene_filenames(output_dir, gene_id_to_filename,
+                                  compressed_id_to_gene_id)
+        else:
+            index_filename = os.path.join(output_dir,
+                                          gene_index.INDEX_FILENAME)
+            gene_index.merge_gene_indexes([job[2] for job in chrom_jobs],
+                                          index_filename)
+            print "  - Wrote %d genes to %s" %(num_genes, index_filename)
+    finally:
+        shutil.rmtree(parts_dir)
+
+
+def write_gene_index(gff_filename, output_dir,
+                     compress_id=False):
+    """
+    Output the genes of a GFF file into a single gene index file (see
+    gene_index.) The genes are indexed as they are read from the GFF.
+
+    If asked, use compressed IDs (hashes) of the 'ID=' field in the GFF.
+    """
+    index_filename = os.path.join(output_dir, gene_index.INDEX_FILENAME)
+    gene_index.write_gene_index(iter_index_genes(gff_filename,
+                                                 compress_id=compress_id),
+                                index_filename)
+    print "  - Wrote %d genes to %s" %(len(gene_index.GeneIndex(index_filename)),
+                                       index_filename)
+
         
 def index_gff(gff_filename, output_dir,
-              compress_id=False):
+              compress_id=False,
+              pickle_index=False,
+              num_processors=1):
     """
     Index the given GFF and placed the indexed representation
-    in the output directory.
+    in the output directory: a gene index file, or if asked a
+    pickle file per gene. With more than one processor, the
+    chromosomes are indexed in parallel.
     """
     print "Indexing GFF..."
     if compress_id:
         print "  - Using compressed IDs to create indexed filenames."
     # First check that the GFF is not already indexed
-    indexed_files = glob.glob(os.path.join(output_dir, "chr*"))
+    indexed_files = glob.glob(os.path.join(output_dir, "chr*")) + \
+                    glob.glob(os.path.join(output_dir,
+                                           gene_index.INDEX_FILENAME))
     if len(indexed_files) >= 1:
         print "%s appears to already be indexed. Aborting." %(gff_filename)
         return
     
     print "  - GFF: %s" %(gff_filename)
     print "  - Outputting to: %s" %(output_dir)
+    if not os.path.isdir(output_dir):
+        print "Making directory: %s" %(output_dir)
+        os.makedirs(output_dir)
     overall_t1 = time.time()
-    t1 = time.time()
-    gff_genes = gene_utils.load_genes_from_gff(gff_filename)
-    t2 = time.time()
-    print "  - Loading of genes from GFF took %.2f seconds" %(t2 - t1)
-
-    t1 = time.time()
-    serialize_genes(gff_genes, output_dir,
-                    compress_id=compress_id)
-    t2 = time.time()
-    print "  - Serialization of genes from GFF took %.2f seconds" %(t2 - t1)
+    if num_processors > 1:
+        index_gff_parallel(gff_filename, output_dir,
+                           compress_id=compress_id,
+                           pickle_index=pickle_index,
+                           num_processors=num_processors)
+    elif pickle_index:
+        t1 = time.time()
+        gff_genes = gene_utils.load_genes_from_gff(gff_filename)
+        t2 = time.time()
+        print "  - Loading of genes from GFF took %.2f seconds" %(t2 - t1)
+
+        t1 = time.time()
+        serialize_genes(gff_genes, output_dir,
+                        compress_id=compress_id)
+        t2 = time.time()
+        print "  - Serialization of genes from GFF took %.2f seconds" %(t2 - t1)
+    else:
+        write_gene_index(gff_filename, output_dir,
+                         compress_id=compress_id)
     overall_t2 = time.time()
     print "Indexing of GFF took %.2f seconds." %(overall_t2 - overall_t1)
 
@@ -173,8 +331,22 @@ def main():
     parser.add_option("--compress-id", dest="compress_id", default=False, action="store_true",
                       help="Use the compressed version of the GFF \'ID=\' field rather than the ID itself "
                       "when creating .miso output filenames.")
+    parser.add_option("--pickle-index", dest="pickle_index", default=False,
+                      action="store_true",
+                      help="Write the old index layout, a pickle file per gene in a directory "
+                      "per chromosome, instead of a single gene index file.")
+    parser.add_option("--num-processors", dest="num_processors", type="int", default=1,
+                      help="Number of processors to index the GFF on. Each chromosome "
+                      "is indexed by its own process. Default is 1.")
+    parser.add_option("--benchmark-parsing", dest="benchmark_parsing", default=None,
+                      help="Time parsing the records of the given GFF with the "
+                      "legacy parser and with the current one, with attributes decoded "
+                      "all at once and lazily, and print the records parsed per second.")
     (options, args) = parser.parse_args()
 
+    if options.benchmark_parsing != None:
+        gff_utils.benchmark_reader(os.path.abspath(os.path.expanduser(options.benchmark_parsing)))
+
     if options.index_gff != None:
         gff_filename = os.path.abspath(os.path.expanduser(options.index_gff[0]))
         output_dir = os.path.abspath(os.path.expanduser(options.index_gff[1]))
@@ -183,7 +355,9 @@ def main():
             os.makedirs(output_dir)
 
         index_gff(gff_filename, output_dir,
-                  compress_id=options.compress_id)
+                  compress_id=options.compress_id,
+                  pickle_index=options.pickle_index,
+                  num_processors=options.num_processors)
 
 
 if __name__ == '__main__':
@@ -12,6 +12,8 @@ from misopy.reads_utils import count_aligned_reads, count_isoform_assignments
 from misopy.read_simulator import simulate_reads, print_reads_summary, read_counts_to_read_list, \
      get_reads_summary
 import misopy.hypothesis_test as ht
+import misopy.samples_store as samples_store
+import misopy.samples_utils as samples_utils
 from misopy.Gene import Gene, Exon
 from misopy.py2c_gene import *
 
@@ -29,9 +31,13 @@ import os
 import sys
 from collections import defaultdict
 import glob
+import hashlib
 import logging
 import logging.handlers
 
+# Ways of proposing new Psi values in the C sampler
+proposal_types = {"drift": pysplicing.MISO_PROPOSAL_DRIFT,
+                  "gibbs": pysplicing.MISO_PROPOSAL_GIBBS}
 
 ##
 ## Helper statistics/linear algebra functions
@@ -86,6 +92,54 @@ def float_array_to_str(array_of_floats):
     return str_float_array
 
 
+def get_gene_seed(gene_label, base_seed=0):
+    """
+    Return the random seed for a gene, derived from its label.
+
+    The same gene always gets the same seed (for a given base seed),
+    independently of the order in which genes are run, so that
+    single genes can be rerun exactly.
+    """
+    seed_str = "%s:%d" %(gene_label, base_seed)
+    return long(hashlib.md5(seed_str).hexdigest()[:8], 16)
+
+
+def split_miso_batch_results(batch_results):
+    """
+    Split the results of pysplicing.MISOBatch into one tuple per gene.
+
+    Each tuple has the Psi samples (a samples x isoforms array), the
+    log scores of the samples, the read classes and their counts, the
+    assignments of reads to isoforms and the run statistics. The
+    arrays are views into the contiguous arrays returned by MISOBatch.
+    Genes that failed have their error message instead of a tuple.
+    """
+    samples, log_scores, assignments, index, read_classes, \
+        read_class_counts, run_stats, errors = batch_results
+    samples = frombuffer(samples, dtype=float64)
+    log_scores = frombuffer(log_scores, dtype=float64)
+    assignments = frombuffer(assignments, dtype=int32)
+    genes_results = []
+    for gene_num, gene_index in enumerate(index):
+        if errors[gene_num] != None:
+            genes_results.append(errors[gene_num])
+            continue
+        num_isoforms, num_samples, samples_offset, log_scores_offset, \
+            assignments_offset, num_reads = gene_index
+        psi_vectors = samples[samples_offset:samples_offset + \
+                              num_samples * num_isoforms]
+        psi_vectors = psi_vectors.reshape((num_samples, num_isoforms))
+        genes_results.append((psi_vectors,
+                              log_scores[log_scores_offset:log_scores_offset + \
+                                         num_samples],
+                              read_classes[gene_num],
+                              read_class_counts[gene_num],
+                              assignments[assignments_offset:assignments_offset + \
+                                          num_reads],
+                              run_stats[gene_num]))
+    return genes_results
+
+
 def get_paired_end_sampler_params(num_isoforms,
                                   mean_frag_len,
                                   frag_variance,
@@ -185,27 +239,90 @@ class MISOSampler:
                     prior_params=None, 
                     start_cond=pysplicing.MISO_START_AUTO,
                     stop_cond=pysplicing.MISO_STOP_CONVERGENT_MEAN,
-                    verbose=True):
+                    verbose=True,
+                    seed=None,
+                    proposal="drift",
+                    fast_estimate=False,
+                    early_stop=False,
+                    check_every=100,
+                    min_ess=200,
+                    max_rhat=1.05,
+                    chain_threads=1,
+                    samples_format="text",
+                    read_classes=None,
+                    batch=None):
         """
         Fast version of MISO MCMC sampler.
 
-        Calls C version and returns results.
+        Calls C version and returns results. The random seed
+        defaults to one derived from the gene's label (see get_gene_seed.)
+
+        reads are the (positions, CIGAR pairs, CIGAR offsets) int32
+        arrays returned by sam_utils.sam_parse_reads; they are passed
+        to the C sampler as they are.
+
+        proposal is either 'drift' (Metropolis-Hastings with a logistic
+        normal drift proposal) or 'gibbs' (Psi drawn from its Dirichlet
+        conditional given the isoform counts; single-end only.)
+
+        If fast_estimate is True, the posterior is approximated with
+        variational Bayes instead of MCMC, and the same number of Psi
+        values are drawn from the approximation (single-end only.)
+
+        If early_stop is True, num_iters is only an upper limit: every
+        check_every iterations after burn-in the split R-hat and the
+        effective sample size (ESS) of the samples are computed, and
+        sampling stops once R-hat <= max_rhat and ESS >= min_ess.
+
+        chain_threads is the number of threads the chains are run on
+        (single-end only.) The chains then use separate random number
+        streams, so the samples differ from a single threaded run.
+
+        samples_format is 'text' (a .miso file per event) or 'binary'
+        (the samples are added to this process's samples store in
+        the output directory, see samples_store.)
+
+        read_classes are the (class templates, class counts) of the
+        reads, e.g. from classes_cache. If given, reads is ignored and
+        the sampler runs on the classes (single-end MCMC only.) The
+        read classes of the last run are kept in self.read_classes.
+
+        batch is a SamplerBatch. If given, a gene sampled with MCMC
+        from its reads, with the chains on one thread, is added to the
+        batch and only sampled when the batch is flushed. Returns True
+        if the gene was added to the batch.
         """
         num_isoforms = len(gene.isoforms)
         self.num_isoforms = num_isoforms
+        self.read_classes = None
 
         if prior_params == None:
             prior_params = (1.0,) * num_isoforms
 
-        read_positions = reads[0]
-        read_cigars = reads[1]
-
-        self.num_reads = len(read_positions)
+        if read_classes != None:
+            if self.paired_end or fast_estimate:
+                raise Exception, "Can only sample from read classes with " \
+                      "single-end MCMC."
+            self.num_reads = int(sum(read_classes[1]))
+        else:
+            read_positions, read_cigars, cigar_idx = reads
+            self.num_reads = len(read_positions)
 
         if self.num_reads == 0:
             print "No reads for gene: %s" %(gene.label)
             return
 
+        if samples_format not in ("text", "binary"):
+            raise Exception, "Unknown samples format %s, must be text " \
+                  "or binary." %(samples_format)
+        if samples_format == "binary":
+            # If the event is in a samples store already, don't run sampler
+            samples_path = samples_store.find_event(os.path.dirname(output_file),
+                                                    os.path.basename(output_file))
+            if samples_path != None:
+                print "Samples of %s exist in %s, not running MISO." \
+                      %(os.path.basename(output_file), samples_path)
+                return None
         output_file = output_file + ".miso"
 	# If output filename exists, don't run sampler
 	if os.path.isfile(os.path.normpath(output_file)):
@@ -242,6 +359,29 @@ class MISOSampler:
             self.miso_logger.debug("Non-uniform proposal being used.")
             self.miso_logger.debug("  - sigma_proposal: " + str(params['sigma_proposal']))
 	    proposal_type = "drift"	    
+        if proposal not in proposal_types:
+            raise Exception, "Unknown proposal %s, must be one of: %s" \
+                  %(proposal, ", ".join(sorted(proposal_types.keys())))
+        if proposal == "gibbs" and self.paired_end:
+            self.miso_logger.warning("Gibbs proposal is not available for "
+                                     "paired-end reads, using drift.")
+            proposal = "drift"
+        if proposal == "gibbs":
+            proposal_type = "gibbs"
+        if fast_estimate and self.paired_end:
+            self.miso_logger.warning("Fast estimates are not available for "
+                                     "paired-end reads, using MCMC.")
+            fast_estimate = False
+        if fast_estimate:
+            proposal_type = "vb"
+        else:
+            self.miso_logger.info("  - proposal: " + proposal)
+        self.miso_logger.info("  - fast estimate? " + str(fast_estimate))
+        if early_stop and not fast_estimate:
+            stop_cond = pysplicing.MISO_STOP_RHAT_ESS
+            self.miso_logger.info("  - early stop: every %d iterations, "
+                                  "ESS >= %s, R-hat <= %s" \
+                                  %(check_every, min_ess, max_rhat))
         init_psi = ones(num_isoforms)/float(num_isoforms)
         # Do not process genes with one isoform
         if num_isoforms == 1:
@@ -254,11 +394,78 @@ class MISOSampler:
         # Convert Python Gene object to C
         c_gene = py2c_gene(gene)
 
+        if seed == None:
+            seed = get_gene_seed(gene.label)
+        self.miso_logger.info("  - seed: " + str(seed))
+
+        run = {"gene": gene, "c_gene": c_gene, "reads": reads,
+               "read_classes": read_classes, "prior_params": prior_params,
+               "output_file": output_file, "num_iters": num_iters,
+               "burn_in": burn_in, "lag": lag, "num_chains": num_chains,
+               "start_cond": start_cond, "stop_cond": stop_cond,
+               "seed": seed, "proposal": proposal,
+               "proposal_type": proposal_type,
+               "fast_estimate": fast_estimate,
+               "check_every": check_every, "min_ess": min_ess,
+               "max_rhat": max_rhat, "chain_threads": chain_threads,
+               "samples_format": samples_format, "t1": t1}
+        if batch != None and read_classes == None and \
+           not fast_estimate and chain_threads == 1:
+            # Sampled with the other genes of the batch
+            run["t1"] = None
+            batch.add(self, run)
+            return True
+        self.finish_run(run, self.call_sampler(run))
+        return False
+
+
+    def call_sampler(self, run):
+        """
+        Run the C sampler on the gene of a run (see run_sampler.)
+
+        Returns the Psi samples (a samples x isoforms array), the log
+        scores of the samples, the read classes and their counts, the
+        assignments of reads to isoforms and the run statistics.
+        """
+        c_gene = run["c_gene"]
+        read_classes = run["read_classes"]
+        prior_params = run["prior_params"]
+        num_iters, burn_in, lag = run["num_iters"], run["burn_in"], run["lag"]
+        num_chains = run["num_chains"]
+        start_cond, stop_cond = run["start_cond"], run["stop_cond"]
+        seed, proposal = run["seed"], run["proposal"]
+        check_every, min_ess, max_rhat = run["check_every"], \
+            run["min_ess"], run["max_rhat"]
+        chain_threads = run["chain_threads"]
+        if read_classes == None:
+            read_positions, read_cigars, cigar_idx = run["reads"]
+
         ##
         ## Run C MISO
         ##
-        read_positions = tuple([r+1 for r in read_positions])
-        if self.paired_end:
+        if read_classes != None:
+            # Run single-end on the read classes; the classes are
+            # returned as MISO() returns them
+            class_results = pysplicing.MISOClasses(c_gene, 0L,
+                                                   read_classes[0],
+                                                   read_classes[1],
+                                                   long(self.read_len),
+                                                   long(num_iters),
+                                                   long(burn_in),
+                                                   long(lag),
+                                                   prior_params, 
+                                                   long(self.overhang_len),
+                                                   long(num_chains),
+                                                   start_cond, stop_cond,
+                                                   seed=seed,
+                                                   proposal=proposal_types[proposal],
+                                                   checkEvery=long(check_every),
+                                                   minEss=float(min_ess),
+                                                   maxRhat=float(max_rhat),
+                                                   noThreads=long(chain_threads))
+            miso_results = class_results[0:2] + tuple(read_classes) + \
+                           class_results[2:4]
+        elif self.paired_end:
             # Number of standard deviations in insert length
             # distribution to consider when assigning reads
             # to isoforms
@@ -278,7 +485,25 @@ class MISOSampler:
                                                  prior_params, 
                                                  long(self.overhang_len),
                                                  long(num_chains),
-                                                 start_cond, stop_cond)
+                                                 start_cond, stop_cond,
+                                                 seed=seed,
+                                                 checkEvery=long(check_every),
+                                                 minEss=float(min_ess),
+                                                 maxRhat=float(max_rhat),
+                                                 cigarIdx=cigar_idx)
+        elif run["fast_estimate"]:
+            # Approximate the posterior, and draw as many samples
+            # as MCMC would keep
+            num_samples = num_chains * ((num_iters - burn_in) / lag)
+            miso_results = pysplicing.MISOVB(c_gene, 0L,
+                                             read_positions,
+                                             read_cigars,
+                                             long(self.read_len),
+                                             long(num_samples),
+                                             prior_params,
+                                             long(self.overhang_len),
+                                             seed=seed,
+                                             cigarIdx=cigar_idx)
         else:
             # Run single-end
             miso_results = pysplicing.MISO(c_gene, 0L,
@@ -291,13 +516,35 @@ class MISOSampler:
                                            prior_params, 
                                            long(self.overhang_len),
                                            long(num_chains),
-                                           start_cond, stop_cond)
+                                           start_cond, stop_cond,
+                                           seed=seed,
+                                           proposal=proposal_types[proposal],
+                                           checkEvery=long(check_every),
+                                           minEss=float(min_ess),
+                                           maxRhat=float(max_rhat),
+                                           noThreads=long(chain_threads),
+                                           cigarIdx=cigar_idx)
+
+        return (transpose(array(miso_results[0])),
+                transpose(array(miso_results[1])),
+                miso_results[2], miso_results[3],
+                miso_results[4], miso_results[5])
+
+
+    def finish_run(self, run, miso_results):
+        """
+        Write the results of the C sampler for a run (see
+        call_sampler) to its output file.
+        """
+        gene = run["gene"]
+        output_file = run["output_file"]
+        num_iters, burn_in, lag = run["num_iters"], run["burn_in"], run["lag"]
 
         # Psi samples
-        psi_vectors = transpose(array(miso_results[0]))
+        psi_vectors = miso_results[0]
 
         # Log scores of accepted samples
-        kept_log_scores = transpose(array(miso_results[1]))
+        kept_log_scores = miso_results[1]
 
         # Read classes 
         read_classes = miso_results[2]
@@ -315,6 +562,7 @@ class MISOSampler:
         # read_classes[n] represents the read class that has
         # read_assignments[n]-many reads.
         reads_data = (read_classes, read_class_data)
+        self.read_classes = reads_data
 
         assignments = array(assignments)
 
@@ -331,26 +579,43 @@ class MISOSampler:
                                                          rejected_proposals)) * 100
         self.miso_logger.info("Percent acceptance (including burn-in): %.4f" %(percent_acceptance))
         self.miso_logger.info("Number of iterations recorded: %d" %(len(psi_vectors)))
+
+        # Convergence diagnostics of the kept samples
+        rhat, ess = run_stats[6], run_stats[7]
+        self.miso_logger.info("Split R-hat: %.3f, ESS: %.1f" %(rhat, ess))
+        if run["stop_cond"] == pysplicing.MISO_STOP_RHAT_ESS:
+            # Record the number of iterations that were actually run
+            num_iters = run_stats[1]
         
         # Write MISO output to file
 	print "Outputting samples to: %s..." %(output_file)
         self.miso_logger.info("Outputting samples to: %s" %(output_file))
         self.output_miso_results(output_file, gene, reads_data, assignments, psi_vectors,
                                  kept_log_scores, num_iters, burn_in,
-                                 lag, percent_acceptance, proposal_type)
-        if verbose:
+                                 lag, percent_acceptance, run["proposal_type"],
+                                 rhat=rhat, ess=ess,
+                                 samples_format=run["samples_format"])
+        if run["t1"]:
             t2 = time.time()
-            print "Event took %.2f seconds" %(t2 - t1)
+            print "Event took %.2f seconds" %(t2 - run["t1"])
         
 
     def output_miso_results(self, output_file, gene, reads_data, assignments,
                             psi_vectors, kept_log_scores, num_iters, burn_in, lag,
-                            percent_acceptance, proposal_type):
+                            percent_acceptance, proposal_type,
+                            rhat=None, ess=None, samples_format="text"):
         """
         Output results of MISO to a file.
+
+        rhat and ess are the split R-hat and effective sample size
+        of the samples (NA if not given.) With the 'binary' samples
+        format, the samples go to a samples store in the directory
+        of output_file instead.
+
+        A summary line of the event is also added to this process's
+        summary shard (see samples_utils.write_summary_row.)
         """
-        output = open(output_file, 'w')
-        
+
         # Get a string representation of the isoforms - use '_'
         # in the delimiter regardless
         iso_delim = '_'
@@ -411,31 +676,203 @@ class MISOSampler:
         strand = gene.strand
         if strand == None:
             strand = "NA"
+        rhat_str = "NA"
+        if rhat != None:
+            rhat_str = "%.3f" %(rhat)
+        ess_str = "NA"
+        if ess != None:
+            ess_str = "%.1f" %(ess)
         header = "#isoforms=%s\texon_lens=%s\titers=%d\tburn_in=%d\tlag=%d\t" \
-                 "percent_accept=%.2f\tproposal_type=%s\t" \
+                 "percent_accept=%.2f\tproposal_type=%s\trhat=%s\tess=%s\t" \
                  "counts=%s\tassigned_counts=%s\tchrom=%s\tstrand=%s\tmRNA_starts=%s\tmRNA_ends=%s\n" \
                  %(str_isoforms, exon_lens, num_iters, burn_in, lag,
-                   percent_acceptance, proposal_type, read_counts_str,
+                   percent_acceptance, proposal_type, rhat_str, ess_str,
+                   read_counts_str,
                    assigned_counts_str,
                    # Fields related to gene/event
                    chrom,
                    strand,               
                    mRNA_start_coords,
                    mRNA_end_coords)
+
+        output_dir = os.path.dirname(output_file)
+        event_name = os.path.basename(output_file).split(".miso")[0]
+        if samples_format == "binary":
+            samples_path = samples_store.write_samples(output_dir,
+                                                       event_name,
+                                                       header[1:].rstrip("\n"),
+                                                       psi_vectors,
+                                                       kept_log_scores)
+            # Summarize the samples as they are read back from the store
+            samples_utils.write_summary_row(output_dir, event_name,
+                                            array(psi_vectors, dtype=float32).astype(float64),
+                                            header)
+            print "Completed outputting to: %s" %(samples_path)
+            return
+
+        output = open(output_file, 'w')
         output.write(header)
             
         # Output samples and their associated log scores, as well as read counts
         results_fields = ["sampled_psi", "log_score"]
         results_header = "%s\n" %("\t".join(results_fields))
         output.write(results_header)
+        written_samples = []
         for psi_sample, curr_log_score in zip(psi_vectors, kept_log_scores):
-            psi_sample_str = ",".join(["%.4f" %(psi) for psi in psi_sample])
+            psi_sample_strs = ["%.4f" %(psi) for psi in psi_sample]
+            written_samples.append([float(psi) for psi in psi_sample_strs])
+            psi_sample_str = ",".join(psi_sample_strs)
             output_line = "%s\t%.4f\n" %(psi_sample_str, curr_log_score)
             output.write(output_line)
         output.close()
+        # Summarize the samples as they are read back from the file
+        samples_utils.write_summary_row(output_dir, event_name,
+                                        array(written_samples), header)
         print "Completed outputting."
 #        return [percent_acceptance, array(psi_vectors), array(kept_log_scores)]
 
+
+def get_batch_key(sampler, run):
+    """
+    Return the sampler settings a gene must share with the other
+    genes of a pysplicing.MISOBatch call.
+    """
+    frag_len_params = None
+    if sampler.paired_end:
+        frag_len_params = (sampler.mean_frag_len, sampler.frag_variance)
+    return (sampler.read_len, sampler.overhang_len, frag_len_params,
+            run["num_iters"], run["burn_in"], run["lag"],
+            run["num_chains"], run["start_cond"], run["stop_cond"],
+            run["proposal"], run["check_every"], run["min_ess"],
+            run["max_rhat"])
+
+
+def call_sampler_batch(key_runs, num_threads=1):
+    """
+    Sample the genes of (sampler, run) pairs that share their sampler
+    settings (see get_batch_key) in one call to pysplicing.MISOBatch.
+    Return the results of each gene (see split_miso_batch_results).
+    """
+    sampler, run = key_runs[0]
+    frag_len_args = {}
+    if sampler.paired_end:
+        # Number of standard deviations in insert length
+        # distribution to consider when assigning reads
+        # to isoforms
+        frag_len_args = {"normalMean": float(sampler.mean_frag_len),
+                         "normalVar": float(sampler.frag_variance),
+                         "numDevs": 4.0}
+    t1 = time.time()
+    batch_results = \
+        pysplicing.MISOBatch(tuple([r["c_gene"] for s, r in key_runs]),
+                             tuple([r["reads"][0] for s, r in key_runs]),
+                             tuple([r["reads"][1] for s, r in key_runs]),
+                             long(sampler.read_len),
+                             noIterations=long(run["num_iters"]),
+                             noBurnIn=long(run["burn_in"]),
+                             noLag=long(run["lag"]),
+                             hyperp=tuple([r["prior_params"]
+                                           for s, r in key_runs]),
+                             overhang=long(sampler.overhang_len),
+                             noChains=long(run["num_chains"]),
+                             start=run["start_cond"],
+                             stop=run["stop_cond"],
+                             seeds=tuple([r["seed"] for s, r in key_runs]),
+                             noThreads=long(num_threads),
+                             proposal=proposal_types[run["proposal"]],
+                             checkEvery=long(run["check_every"]),
+                             minEss=float(run["min_ess"]),
+                             maxRhat=float(run["max_rhat"]),
+                             cigarIdx=tuple([r["reads"][2]
+                                             for s, r in key_runs]),
+                             **frag_len_args)
+    t2 = time.time()
+    print "Sampled %d genes in %.2f seconds" %(len(key_runs), t2 - t1)
+    return split_miso_batch_results(batch_results)
+
+
+def run_sampler_batch(sampler_runs, num_threads=1):
+    """
+    Sample the genes of (sampler, run) pairs, as added to a batch by
+    MISOSampler.run_sampler, and output their results.
+
+    Genes with the same sampler settings are sampled in one call to
+    pysplicing.MISOBatch, on num_threads threads. Each gene uses its
+    own seed, so the samples are the same as when the genes are
+    sampled one at a time.
+
+    A gene that fails is logged and skipped; the others are still
+    output. Return the labels of the genes that failed.
+    """
+    failed_genes = []
+    runs_by_key = defaultdict(list)
+    keys = []
+    for sampler, run in sampler_runs:
+        key = get_batch_key(sampler, run)
+        if key not in runs_by_key:
+            keys.append(key)
+        runs_by_key[key].append((sampler, run))
+    for key in keys:
+        key_runs = runs_by_key[key]
+        if len(key_runs) == 1:
+            sampler, run = key_runs[0]
+            try:
+                gene_results = sampler.call_sampler(run)
+            except pysplicing.InternalError, e:
+                gene_results = str(e)
+            key_runs_results = [gene_results]
+        else:
+            key_runs_results = call_sampler_batch(key_runs, num_threads)
+        for (sampler, run), gene_results in zip(key_runs, key_runs_results):
+            if isinstance(gene_results, basestring):
+                sampler.miso_logger.error("MISO failed on gene %s: %s" \
+                                          %(run["gene"].label, gene_results))
+                failed_genes.append(run["gene"].label)
+                continue
+            sampler.finish_run(run, gene_results)
+    return failed_genes
+
+
+class SamplerBatch:
+    """
+    Genes to be sampled together (see run_sampler_batch), so that
+    the conversion and call overheads of the C sampler are paid per
+    batch rather than per gene. Genes are added by
+    MISOSampler.run_sampler, and sampled when the batch is flushed.
+    """
+    def __init__(self, max_genes=50, num_threads=1):
+        self.max_genes = max_genes
+        self.num_threads = num_threads
+        self.sampler_runs = []
+        # Functions to call once the genes are sampled
+        self.callbacks = []
+
+    def add(self, sampler, run):
+        self.sampler_runs.append((sampler, run))
+
+    def add_callback(self, func, *args):
+        self.callbacks.append((func, args))
+
+    def is_full(self):
+        return len(self.sampler_runs) >= self.max_genes
+
+    def get_gene_labels(self):
+        return [run["gene"].label for sampler, run in self.sampler_runs]
+
+    def flush(self):
+        """
+        Sample the genes of the batch and output their results.
+        Return the labels of the genes that failed.
+        """
+        sampler_runs, callbacks = self.sampler_runs, self.callbacks
+        self.sampler_runs, self.callbacks = [], []
+        failed_genes = run_sampler_batch(sampler_runs,
+                                         num_threads=self.num_threads)
+        for func, args in callbacks:
+            func(*args)
+        return failed_genes
+
+
 def run_sampler_on_event(gene, ni, ne, nb, read_len, overhang_len, num_iters,
                          output_dir, confidence_level=.95):
     """
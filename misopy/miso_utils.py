@@ -4,6 +4,8 @@
 import os
 import glob
 
+import misopy.samples_store as samples_store
+
 def get_miso_files_from_dir(dirname):
     """
     Return MISO output files from a directory.
@@ -19,6 +21,18 @@ def get_miso_files_from_dir(dirname):
     return miso_basename_files
 
 
+def find_event_samples(dirname, event_name):
+    """
+    Return the samples path of an event in a directory: its
+    .miso file, or its samples in a samples store. Return
+    None if the event is not there.
+    """
+    event_filename = os.path.join(dirname, "%s.miso" %(event_name))
+    if os.path.isfile(event_filename):
+        return event_filename
+    return samples_store.find_event(dirname, event_name)
+
+
 def get_miso_output_files(event_name, chrom, settings):
     """
     Get MISO output files, in order of 'miso_files'
@@ -45,19 +59,16 @@ def get_miso_output_files(event_name, chrom, settings):
     miso_sample_paths = [os.path.abspath(os.path.expanduser(os.path.join(miso_prefix, f))) \
                          for f in miso_files]
 
-    event_with_miso_ext = "%s.miso" %(event_name)
-
     for curr_sample_path in miso_sample_paths:
         event_found = False
         print "Searching for MISO files in: %s" %(curr_sample_path)
         print "  - Looking for chromosome %s directories" %(chrom)
 
-        if event_with_miso_ext in get_miso_files_from_dir(curr_sample_path):
+        event_filename = find_event_samples(curr_sample_path, event_name)
+        if event_filename != None:
             # Allow the event to be in a top-level directory outside of a
             # chromosome folder
             event_found = True
-            event_filename = os.path.join(curr_sample_path,
-                                          event_with_miso_ext)
             miso_filenames.append(event_filename)
             print "Found %s MISO file in top-level directory." %(event_name)
             print "  - Location: %s" %(event_filename)
@@ -74,16 +85,13 @@ def get_miso_output_files(event_name, chrom, settings):
             if chrom in dirs:
                 chrom_dirname = os.path.abspath(os.path.join(root, chrom))
                 print "Looking for MISO files in: %s" %(chrom_dirname)
-                # Fetch MISO files, if any
-                curr_miso_files = get_miso_files_from_dir(chrom_dirname)
-
-                # Is the event in there?
-                if event_with_miso_ext in curr_miso_files:
+                # Is the event in there, as a MISO file or in
+                # a samples store?
+                event_filename = find_event_samples(chrom_dirname,
+                                                    event_name)
+                if event_filename != None:
                     # Found relevant event
                     event_found = True
-                    # Add to list
-                    event_filename = os.path.join(root, chrom,
-                                                  event_with_miso_ext)
                     print "Found %s MISO file." %(event_name)
                     print "  - Location: %s" %(event_filename)
                     miso_filenames.append(event_filename)
@@ -19,29 +19,31 @@ def parseGene(pickle_filename, event):
     exon_ends = []
     mRNAs = []
     chrom = None
-    for gene_id, gene_info in gff_genes.iteritems():
-        if event == gene_id:
-            gene_obj = gene_info['gene_object']
-            gene_hierarchy = gene_info['hierarchy']
-            tx_start, tx_end = gff_utils.get_inclusive_txn_bounds(\
-                gene_hierarchy[gene_id])
-            chrom = gene_obj.chrom
-
-            for mRNA_id, mRNA_info in gene_hierarchy[gene_id]['mRNAs'].iteritems():
-                mRNA = []
-                for exon_id, exon_info in gene_hierarchy[gene_id]['mRNAs']\
-                    [mRNA_id]['exons'].\
-                    iteritems():
-
-                    exon_rec = gene_hierarchy[gene_id]['mRNAs']\
-                        [mRNA_id]['exons'][exon_id]['record']
-                    strand = exon_rec.strand
-                    exon_starts.append(exon_rec.start)
-                    exon_ends.append(exon_rec.end)
-                    mRNA.append(sorted([exon_rec.start, exon_rec.end]))
-
-                mRNAs.append(mRNA)
-            break
+    # Look the gene up, rather than going through all genes of a
+    # gene index
+    if event in gff_genes:
+        gene_id = event
+        gene_info = gff_genes[gene_id]
+        gene_obj = gene_info['gene_object']
+        gene_hierarchy = gene_info['hierarchy']
+        tx_start, tx_end = gff_utils.get_inclusive_txn_bounds(\
+            gene_hierarchy[gene_id])
+        chrom = gene_obj.chrom
+
+        for mRNA_id, mRNA_info in gene_hierarchy[gene_id]['mRNAs'].iteritems():
+            mRNA = []
+            for exon_id, exon_info in gene_hierarchy[gene_id]['mRNAs']\
+                [mRNA_id]['exons'].\
+                iteritems():
+
+                exon_rec = gene_hierarchy[gene_id]['mRNAs']\
+                    [mRNA_id]['exons'][exon_id]['record']
+                strand = exon_rec.strand
+                exon_starts.append(exon_rec.start)
+                exon_ends.append(exon_rec.end)
+                mRNA.append(sorted([exon_rec.start, exon_rec.end]))
+
+            mRNAs.append(mRNA)
 
     mRNAs.sort(key=len)
     return tx_start, tx_end, exon_starts, exon_ends, gene_obj, \
@@ -6,25 +6,283 @@
 import os
 import csv
 import sys
+import time
+import traceback
+import multiprocessing
 from collections import defaultdict
 
 import misopy.gff_utils as gff_utils
+import misopy.gene_index as gene_index
 import misopy.as_events as as_events
 import misopy.run_miso as run_miso
+import misopy.miso_sampler as miso
+import misopy.classes_cache as classes_cache
 from misopy.parse_csv import *
 from misopy.settings import Settings, load_settings
 from misopy.settings import miso_path as miso_settings_path
 import misopy.cluster_utils as cluster_utils
+import misopy.sam_utils as sam_utils
 
 miso_path = os.path.dirname(os.path.abspath(__file__))
 
+##
+## State held by each local gene-level worker process: the settings
+## and the BAM handle are loaded once per worker, not once per gene.
+##
+worker_state = {}
+
+## Blocks of genes per local worker process
+BLOCKS_PER_WORKER = 4
+
+def init_gene_psi_worker(settings_filename, bam_filename, read_len,
+                         output_dir, overhang_len, paired_end,
+                         fast_estimate=False, bam_checksum=None):
+    """
+    Initialize a gene-level Psi worker: load the settings file and
+    open the BAM file. bam_checksum is the checksum of the BAM file
+    for the read classes cache, if the parent computed it.
+    """
+    Settings.load(settings_filename)
+    if bam_checksum != None:
+        classes_cache.set_bam_checksum(bam_filename, bam_checksum)
+    settings = Settings.get()
+    template = None
+    if "sam_template" in settings:
+        template = settings["sam_template"]
+    worker_state["bamfile"] = sam_utils.load_bam_reads(bam_filename,
+                                                       template=template)
+    worker_state["bam_filename"] = bam_filename
+    worker_state["read_len"] = read_len
+    worker_state["output_dir"] = output_dir
+    worker_state["overhang_len"] = overhang_len
+    worker_state["paired_end"] = paired_end
+    worker_state["fast_estimate"] = fast_estimate
+
+
+def compute_gene_psi_worker(gene_job):
+    """
+    Compute Psi for a single (gene_id, gff_index_filename) pair using
+    the worker's already loaded settings and BAM file.
+    """
+    gene_id, gff_index_filename = gene_job
+    run_miso.compute_gene_psi([gene_id], gff_index_filename,
+                              worker_state["bam_filename"],
+                              worker_state["output_dir"],
+                              worker_state["read_len"],
+                              worker_state["overhang_len"],
+                              paired_end=worker_state["paired_end"],
+                              bamfile=worker_state["bamfile"],
+                              fast_estimate=worker_state["fast_estimate"])
+    return gene_id
+
+
+def log_failed_genes(gene_ids):
+    """
+    Log genes for which Psi could not be computed, with the traceback
+    of the exception being handled.
+    """
+    print >> sys.stderr, "Error: failed to compute Psi for %s:\n%s" \
+          %(", ".join(gene_ids), traceback.format_exc())
+
+
+def flush_sampler_batch(sampler_batch, failed_genes):
+    """
+    Sample the genes of a batch, adding the IDs of the genes that
+    failed to failed_genes.
+    """
+    batch_genes = sampler_batch.get_gene_labels()
+    try:
+        failed_genes.extend(sampler_batch.flush())
+    except Exception:
+        log_failed_genes(batch_genes)
+        failed_genes.extend(batch_genes)
+
+
+def compute_block_genes_psi_worker(block_job):
+    """
+    Compute Psi for a block of genes that are contiguous on a
+    chromosome (see get_gene_block_jobs), given as a list of
+    (gene_id, gff_index_filename) pairs. The reads of all the genes
+    are fetched in one pass over the block's region of the BAM file
+    (see sam_utils.sweep_bam_reads), and each gene is run as soon
+    as the pass is past its end.
+
+    A gene that fails is logged and skipped, so that one gene does
+    not stop the run. Return the IDs of the genes that failed.
+    """
+    failed_genes = []
+    genes_classes = run_miso.get_classes_cache(worker_state["bam_filename"],
+                                               worker_state["read_len"],
+                                               worker_state["overhang_len"],
+                                               paired_end=worker_state["paired_end"],
+                                               fast_estimate=worker_state["fast_estimate"])
+    # Several genes can share an index file
+    gff_index = {}
+    # The genes of the job, decoded once
+    chrom_genes = {}
+    sweep_genes = []
+    for gene_id, gff_index_filename in block_job:
+        try:
+            if gff_index_filename not in gff_index:
+                gff_index[gff_index_filename] = \
+                    gff_utils.load_indexed_gff_file(gff_index_filename)
+            if genes_classes != None and \
+               genes_classes.get(gene_id, gff_index_filename) != None:
+                # The reads of the gene are not needed
+                compute_gene_psi_worker((gene_id, gff_index_filename))
+                continue
+            gene_info = gff_index[gff_index_filename][gene_id]
+            tx_start, tx_end = \
+                gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
+        except Exception:
+            log_failed_genes([gene_id])
+            failed_genes.append(gene_id)
+            continue
+        chrom_genes[gene_id] = gene_info
+        sweep_genes.append(((gene_id, gff_index_filename),
+                            gene_info['gene_object'].chrom,
+                            tx_start, tx_end))
+    # Genes are sampled in batches, see miso_sampler.SamplerBatch
+    sampler_params = Settings.get_sampler_params()
+    sampler_batch = miso.SamplerBatch(sampler_params["batch_genes"],
+                                      sampler_params["batch_threads"])
+    try:
+        for gene_job, gene_reads in sam_utils.sweep_bam_reads(worker_state["bamfile"],
+                                                              sweep_genes):
+            gene_id, gff_index_filename = gene_job
+            try:
+                run_miso.compute_gene_psi([gene_id], gff_index_filename,
+                                          worker_state["bam_filename"],
+                                          worker_state["output_dir"],
+                                          worker_state["read_len"],
+                                          worker_state["overhang_len"],
+                                          paired_end=worker_state["paired_end"],
+                                          bamfile=worker_state["bamfile"],
+                                          fast_estimate=worker_state["fast_estimate"],
+                                          gff_genes={gene_id: chrom_genes.pop(gene_id)},
+                                          gene_reads={gene_id: gene_reads},
+                                          sampler_batch=sampler_batch)
+            except Exception:
+                log_failed_genes([gene_id])
+                failed_genes.append(gene_id)
+            if sampler_batch.is_full():
+                flush_sampler_batch(sampler_batch, failed_genes)
+    except Exception:
+        # Reading the BAM file failed: the genes whose reads were not
+        # read yet fail too
+        log_failed_genes(chrom_genes.keys())
+        failed_genes.extend(chrom_genes.keys())
+    flush_sampler_batch(sampler_batch, failed_genes)
+    return failed_genes
+
+
+def get_gene_job_bounds(gene_id, gff_index_filename):
+    """
+    Return the chromosome, start and end of a gene. For a gene index
+    these are read from the index; a pickled gene is loaded.
+    """
+    if gene_index.is_gene_index(gff_index_filename):
+        return gene_index.get_gene_index(gff_index_filename).get_gene_bounds(gene_id)
+    gene_info = gff_utils.load_indexed_gff_file(gff_index_filename)[gene_id]
+    tx_start, tx_end = \
+        gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
+    return gene_info['gene_object'].chrom, tx_start, tx_end
+
+
+def get_gene_block_jobs(gene_jobs, num_blocks):
+    """
+    Split (gene_id, gff_index_filename) pairs into blocks of genes
+    that are contiguous on a chromosome, so that the reads of each
+    block are fetched in one pass over a region of the BAM file.
+
+    Blocks have at most len(gene_jobs) / num_blocks genes (rounded
+    up), so that a chromosome with many genes is split among several
+    workers rather than setting the running time. Larger blocks come
+    first.
+    """
+    genes_by_chrom = defaultdict(list)
+    for gene_id, gff_index_filename in gene_jobs:
+        chrom, start, end = get_gene_job_bounds(gene_id, gff_index_filename)
+        genes_by_chrom[chrom].append((start, end, gene_id, gff_index_filename))
+    block_size = max(1, (len(gene_jobs) + num_blocks - 1) / num_blocks)
+    block_jobs = []
+    for chrom in sorted(genes_by_chrom.keys()):
+        chrom_genes = sorted(genes_by_chrom[chrom])
+        for block_start in range(0, len(chrom_genes), block_size):
+            block_jobs.append([(gene_id, gff_index_filename)
+                               for start, end, gene_id, gff_index_filename
+                               in chrom_genes[block_start:block_start + block_size]])
+    return sorted(block_jobs, key=len, reverse=True)
+
+
+def run_genes_locally(gene_jobs, bam_filename, read_len, output_dir,
+                      overhang_len=1, paired_end=None, settings=None,
+                      num_processors=1, fast_estimate=False):
+    """
+    Run gene-level Psi in-process on the local machine, using a pool of
+    num_processors workers. Each worker runs a block of genes that are
+    contiguous on a chromosome at a time, reading the block's region
+    from the BAM file once. There are several blocks per worker, so
+    that the workers finish at about the same time.
+
+    Genes that fail are skipped (see compute_block_genes_psi_worker)
+    and reported at the end. Return their IDs.
+    """
+    # Checksum the BAM file for the read classes cache once, here,
+    # rather than in every worker
+    bam_checksum = None
+    genes_classes = run_miso.get_classes_cache(bam_filename, read_len,
+                                               overhang_len,
+                                               paired_end=paired_end,
+                                               fast_estimate=fast_estimate)
+    if genes_classes != None:
+        bam_checksum = genes_classes.bam_checksum
+    worker_args = (settings, bam_filename, read_len, output_dir,
+                   overhang_len, paired_end, fast_estimate, bam_checksum)
+    num_genes = len(gene_jobs)
+    block_jobs = get_gene_block_jobs(gene_jobs,
+                                     max(num_processors, 1) * BLOCKS_PER_WORKER)
+    failed_genes = []
+    t1 = time.time()
+    if num_processors <= 1:
+        init_gene_psi_worker(*worker_args)
+        for block_job in block_jobs:
+            failed_genes.extend(compute_block_genes_psi_worker(block_job))
+    else:
+        print "Running %d genes on %d processors..." %(num_genes,
+                                                       num_processors)
+        pool = multiprocessing.Pool(processes=num_processors,
+                                    initializer=init_gene_psi_worker,
+                                    initargs=worker_args)
+        try:
+            for block_failed_genes in pool.imap_unordered(compute_block_genes_psi_worker,
+                                                          block_jobs):
+                failed_genes.extend(block_failed_genes)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    t2 = time.time()
+    print "Computed Psi for %d genes in %.2f seconds." %(num_genes - len(failed_genes),
+                                                       t2 - t1)
+    if len(failed_genes) > 0:
+        print >> sys.stderr, "Error: failed to compute Psi for %d genes: %s" \
+              %(len(failed_genes), ", ".join(sorted(failed_genes)))
+    return failed_genes
+
 def compute_all_genes_psi(gff_dir, bam_filename, read_len, output_dir,
                           use_cluster=False, SGEarray=False, chunk_jobs=200,
                           overhang_len=1, paired_end=None,
-                          settings=None, job_name="misojob"):
+                          settings=None, job_name="misojob",
+                          num_processors=1, fast_estimate=False):
     """
     Compute Psi values for genes using a GFF and a BAM filename.
 
+    When not using the cluster, genes are run in-process using
+    num_processors worker processes.
+
     SGE functionality contributed by Michael Lovci.
     """
     gene_ids_to_gff_index = gff_utils.get_gene_ids_to_gff_index(gff_dir)
@@ -43,6 +301,16 @@ def compute_all_genes_psi(gff_dir, bam_filename, read_len, output_dir,
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
     
+    if not use_cluster:
+        gene_jobs = gene_ids_to_gff_index.items()
+        run_genes_locally(gene_jobs, bam_filename, read_len, output_dir,
+                          overhang_len=overhang_len,
+                          paired_end=paired_end,
+                          settings=settings,
+                          num_processors=num_processors,
+                          fast_estimate=fast_estimate)
+        return
+
     # All commands to run
     all_miso_cmds = []
 
@@ -62,13 +330,11 @@ def compute_all_genes_psi(gff_dir, bam_filename, read_len, output_dir,
         if settings != None:
             miso_cmd += " --settings-filename %s" %(settings)
 
-        if use_cluster:
-            # If asked to use cluster, accumulate the MISO commands
-            # but do not run them
-            all_miso_cmds.append(miso_cmd)
-        else:
-            print "  - Executing: %s" %(miso_cmd)
-            os.system(miso_cmd)
+        if fast_estimate:
+            miso_cmd += " --fast-estimate"
+
+        # Accumulate the MISO commands for the cluster but do not run them
+        all_miso_cmds.append(miso_cmd)
 
     if use_cluster:
         if SGEarray:
@@ -251,6 +517,15 @@ def main():
     parser.add_option("--SGEarray", dest="SGEarray", action="store_true", default=False,
                       help="Use MISO on cluster with Sun Grid Engine. To be used in "
                       "conjunction with --use-cluster option.")
+    parser.add_option("--num-processors", dest="num_processors", default=1, type="int",
+                      help="Number of processors to use when computing gene-level "
+                      "Psi locally (i.e. without --use-cluster). Default is 1.")
+    parser.add_option("--fast-estimate", dest="fast_estimate", action="store_true",
+                      default=False,
+                      help="Approximate the posterior of gene-level Psi with variational "
+                      "Bayes instead of sampling it. Much faster, with approximate "
+                      "confidence intervals; meant for screening many samples. "
+                      "Single-end reads only.")
     (options, args) = parser.parse_args()
 
     ##
@@ -358,6 +633,11 @@ def main():
 
         if options.overhang_len != None:
             overhang_len = options.overhang_len
+
+        paired_end = None
+        if options.paired_end != None:
+            paired_end = float(options.paired_end[0]), \
+                         float(options.paired_end[1])
         
         compute_all_genes_psi(gff_filename, bam_filename, options.read_len, output_dir,
                               overhang_len=overhang_len,
@@ -365,8 +645,10 @@ def main():
                               SGEarray=options.SGEarray,
                               job_name=options.job_name,
                               chunk_jobs=options.chunk_jobs,
-                              paired_end=options.paired_end,
-                              settings=settings_filename)
+                              paired_end=paired_end,
+                              settings=settings_filename,
+                              num_processors=options.num_processors,
+                              fast_estimate=options.fast_estimate)
             
 		    
 if __name__ == '__main__':
@@ -20,6 +20,8 @@ import misopy.Gene as gene_utils
 import misopy.gff_utils as gff_utils
 
 import misopy.index_gff as index_gff
+import misopy.gene_index as gene_index
+import misopy.classes_cache as classes_cache
 from index_gff import is_compressed_index
 
 from misopy.parse_csv import *
@@ -217,9 +219,37 @@ def get_psi_info_by_sample(event_comparison_data, sample1_or_sample2):
 ##
 ## Multi-isoform interface
 ##
+def get_classes_cache(bam_filename, read_len, overhang_len, paired_end=None,
+                      fast_estimate=False):
+    """
+    Return the cache of the read classes of genes of a BAM file, if
+    one is set in the settings (classes_cache_dir), otherwise None.
+    Only single-end MCMC runs use the cache.
+    """
+    settings = Settings.get()
+    if not settings.get("classes_cache_dir") or paired_end or fast_estimate:
+        return None
+    return classes_cache.ClassesCache(settings["classes_cache_dir"],
+                                      bam_filename, read_len, overhang_len)
+
+
+def cache_read_classes(sampler, genes_classes, gene_id, gff_index_filename,
+                       num_raw_reads):
+    """
+    Add the read classes of the last run of a sampler to the cache of
+    read classes.
+    """
+    if sampler.read_classes != None:
+        genes_classes.put(gene_id, gff_index_filename,
+                          sampler.read_classes[0],
+                          sampler.read_classes[1],
+                          num_raw_reads)
+
+
 def compute_gene_psi(gene_ids, gff_index_filename, bam_filename, output_dir,
                      read_len, overhang_len, paired_end=None, event_type=None,
-                     verbose=True):
+                     verbose=True, bamfile=None, fast_estimate=False,
+                     gff_genes=None, gene_reads=None, sampler_batch=None):
     """
     Run Psi at the Gene-level (for multi-isoform inference.)
 
@@ -231,6 +261,15 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename, output_dir,
     - Output directory
     - Optional: Run in paired-end mode. Gives mean and standard deviation
       of fragment length distribution.
+    - Optional: an already opened BAM file (e.g. one held by a worker
+      process), in which case bam_filename is not reopened.
+    - Optional: the genes of the indexed GFF file, if already loaded.
+    - Optional: the reads of genes by gene ID, if already fetched
+      (e.g. by sam_utils.sweep_bam_reads); the reads of other genes
+      are fetched from the BAM file.
+    - Optional: a miso_sampler.SamplerBatch to add the genes to, which
+      the caller flushes. Otherwise the genes are batched within this
+      call (see the batch_genes setting.)
     """
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
@@ -257,6 +296,26 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename, output_dir,
     lag = settings_params["lag"]
     num_iters = settings_params["num_iters"]
     num_chains = settings_params["num_chains"]
+    # Base for the per-gene random seeds
+    base_seed = settings_params.get("seed", 0)
+    # How the sampler proposes new Psi values
+    proposal = settings_params.get("proposal", "drift")
+    # Convergence based early stopping
+    early_stop = settings_params.get("early_stop", False)
+    check_every = settings_params.get("check_every", 100)
+    min_ess = settings_params.get("min_ess", 200)
+    max_rhat = settings_params.get("max_rhat", 1.05)
+    # Threads to run the chains of a gene on
+    chain_threads = settings_params.get("chain_threads", 1)
+    # Write samples as text .miso files or to binary samples stores
+    samples_format = settings_params.get("samples_format", "text")
+    # Sample this many genes in one call to the C sampler, on
+    # batch_threads threads
+    flush_batch = False
+    if sampler_batch == None and settings_params["batch_genes"] > 1:
+        sampler_batch = miso.SamplerBatch(settings_params["batch_genes"],
+                                          settings_params["batch_threads"])
+        flush_batch = True
 
     min_event_reads = Settings.get_min_event_reads()
 
@@ -270,13 +329,14 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename, output_dir,
 
     # Load the genes from the GFF
     t1, t2 = 0, 0
-    if verbose:
-        t1 = time.time()
-        print "Loading genes from indexed GFF..."
-    gff_genes = gff_utils.load_indexed_gff_file(gff_index_filename)
-    if verbose:
-        t2 = time.time()
-        print "  - Loading took: %.2f seconds" %(t2 - t1)
+    if gff_genes is None:
+        if verbose:
+            t1 = time.time()
+            print "Loading genes from indexed GFF..."
+        gff_genes = gff_utils.load_indexed_gff_file(gff_index_filename)
+        if verbose:
+            t2 = time.time()
+            print "  - Loading took: %.2f seconds" %(t2 - t1)
 
     # If given a template for the SAM file, use it
     template = None
@@ -289,34 +349,60 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename, output_dir,
     else:
         filter_reads = settings["filter_reads"]
         
-    # Load the BAM file upfront
-    bamfile = sam_utils.load_bam_reads(bam_filename,
-                                       template=template)
+    # Cache of the read classes of genes, so that reruns on the same
+    # BAM file skip reading it (single-end MCMC only)
+    genes_classes = get_classes_cache(bam_filename, read_len, overhang_len,
+                                      paired_end=paired_end,
+                                      fast_estimate=fast_estimate)
+    if genes_classes != None:
+        print "  - Read classes cache: %s" %(genes_classes.dirname)
+        
     # Check if we're in compressed mode
     compressed_mode = is_compressed_index(gff_index_filename)
     
-    for gene_id, gene_info in gff_genes.iteritems():
-        lookup_id = gene_id
-        # Skip genes that we were not asked to run on
-        if lookup_id not in gene_ids:
+    for gene_id in gene_ids:
+        # Skip genes that are not in the index; genes of a gene index
+        # are only decoded here
+        if gene_id not in gff_genes:
             continue
+        gene_info = gff_genes[gene_id]
         gene_obj = gene_info['gene_object']
         gene_hierarchy = gene_info['hierarchy']
         
-        # Find the most inclusive transcription start and end sites for each gene
-        tx_start, tx_end = gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
-
-        # Fetch reads aligning to the gene boundaries
-        gene_reads = sam_utils.fetch_bam_reads_in_gene(bamfile, gene_obj.chrom,
-                                                       tx_start, tx_end,
-                                                       gene_obj)
-
-        # Align the reads to the isoforms
-        #reads = sam_utils.sam_reads_to_isoforms(gene_reads, gene_obj, read_len,
-        #                                        overhang_len,
-        #                                        paired_end=paired_end)
-        reads, num_raw_reads = sam_utils.sam_parse_reads(gene_reads,
-                                                         paired_end=paired_end)
+        read_classes = None
+        if genes_classes != None:
+            cached_classes = genes_classes.get(gene_id, gff_index_filename)
+            if cached_classes != None:
+                print "Read classes of %s found in cache" %(gene_id)
+                read_classes = cached_classes[0:2]
+                reads, num_raw_reads = None, cached_classes[2]
+
+        if read_classes == None and gene_reads != None and \
+           gene_id in gene_reads:
+            # Reads fetched by the caller
+            reads, num_raw_reads = sam_utils.sam_parse_reads(gene_reads[gene_id],
+                                                             paired_end=paired_end)
+        elif read_classes == None:
+            # Load the BAM file when it is first needed, unless we
+            # were handed one
+            if bamfile is None:
+                bamfile = sam_utils.load_bam_reads(bam_filename,
+                                                   template=template)
+
+            # Find the most inclusive transcription start and end sites for each gene
+            tx_start, tx_end = gff_utils.get_inclusive_txn_bounds(gene_info['hierarchy'][gene_id])
+
+            # Fetch reads aligning to the gene boundaries
+            fetched_reads = sam_utils.fetch_bam_reads_in_gene(bamfile, gene_obj.chrom,
+                                                              tx_start, tx_end,
+                                                              gene_obj)
+
+            # Align the reads to the isoforms
+            #reads = sam_utils.sam_reads_to_isoforms(gene_reads, gene_obj, read_len,
+            #                                        overhang_len,
+            #                                        paired_end=paired_end)
+            reads, num_raw_reads = sam_utils.sam_parse_reads(fetched_reads,
+                                                             paired_end=paired_end)
                                    
         # Skip gene if none of the reads align to gene boundaries
         if filter_reads:
@@ -365,19 +451,49 @@ def compute_gene_psi(gene_ids, gff_index_filename, bam_filename, output_dir,
             os.makedirs(chrom_dir)
 
 #        output_filename = os.path.join(chrom_dir, gene_obj.label)
-        # Pick .miso output filename based on the pickle filename
-        miso_basename = os.path.basename(gff_index_filename)
-        if not miso_basename.endswith(".pickle"):
-            print "Error: Invalid index file %s" %(gff_index_filename)
-            sys.exit(1)
-        miso_basename = miso_basename.replace(".pickle", "")
+        # Pick .miso output filename based on the pickle filename,
+        # or for a gene index the (compressed) gene ID
+        if gene_index.is_gene_index(gff_index_filename):
+            miso_basename = gene_info.get('compressed_id', gene_id)
+        else:
+            miso_basename = os.path.basename(gff_index_filename)
+            if not miso_basename.endswith(".pickle"):
+                print "Error: Invalid index file %s" %(gff_index_filename)
+                sys.exit(1)
+            miso_basename = miso_basename.replace(".pickle", "")
         output_filename = os.path.join(chrom_dir, "%s" %(miso_basename))
         
-        sampler.run_sampler(num_iters, reads, gene_obj, hyperparameters,
-                            sampler_params, output_filename,
-                            num_chains=num_chains,
-                            burn_in=burn_in,
-                            lag=lag)
+        batched = sampler.run_sampler(num_iters, reads, gene_obj,
+                                      hyperparameters, sampler_params,
+                                      output_filename,
+                                      num_chains=num_chains,
+                                      burn_in=burn_in,
+                                      lag=lag,
+                                      seed=miso.get_gene_seed(gene_id, base_seed),
+                                      proposal=proposal,
+                                      fast_estimate=fast_estimate,
+                                      early_stop=early_stop,
+                                      check_every=check_every,
+                                      min_ess=min_ess,
+                                      max_rhat=max_rhat,
+                                      chain_threads=chain_threads,
+                                      samples_format=samples_format,
+                                      read_classes=read_classes,
+                                      batch=sampler_batch)
+
+        if genes_classes != None and read_classes == None:
+            cache_args = (sampler, genes_classes, gene_id,
+                          gff_index_filename, num_raw_reads)
+            if batched:
+                # The read classes are known once the batch is sampled
+                sampler_batch.add_callback(cache_read_classes, *cache_args)
+            else:
+                cache_read_classes(*cache_args)
+        if flush_batch and sampler_batch.is_full():
+            sampler_batch.flush()
+
+    if flush_batch:
+        sampler_batch.flush()
         
 	    
 def main():
@@ -408,6 +524,11 @@ def main():
                       help="Run in paired-end mode.  Takes a mean and standard deviation "
                       "for the fragment length distribution (assumed to have discretized "
                       "normal form.)")
+    parser.add_option("--fast-estimate", dest="fast_estimate", action="store_true",
+                      default=False,
+                      help="Approximate the posterior with variational Bayes instead of "
+                      "sampling it. Much faster, with approximate confidence intervals; "
+                      "meant for screening many samples. Single-end reads only.")
 
     ##
     ## Psi utilities
@@ -422,6 +543,31 @@ def main():
                       "Takes two arguments: the label for sample 1 and the label for sample 2, "
                       "where sample 1 and sample 2 correspond to the order of samples given "
                       "to --compare-samples.")
+    parser.add_option("--comparison-join", dest="comparison_join", default="hash",
+                      choices=["hash", "sorted"],
+                      help="How --compare-samples pairs the events of the two samples: "
+                      "hash (index sample 2 by event name; output in the order of sample 1) "
+                      "or sorted (merge both samples sorted by event name; output sorted "
+                      "by event name). Default is hash.")
+    parser.add_option("--bayes-factor-method", dest="bf_method", default="kde",
+                      choices=["kde", "beta"],
+                      help="How the comparisons estimate the density of delta Psi at 0 for "
+                      "Bayes factors: kde (Gaussian kernel density) or beta (a Beta "
+                      "distribution fitted by moments; faster, less exact). Default is kde.")
+    parser.add_option("--delta-posteriors", dest="delta_posteriors", default="text",
+                      choices=["none", "text", "binary"],
+                      help="How --compare-samples outputs the delta posteriors of events: "
+                      "text (a .miso_dp file per event), binary (one samples store, "
+                      "delta-posteriors/delta_posteriors.miso_store) or none. Default is text.")
+    parser.add_option("--compare-many-samples", dest="many_samples_to_compare", nargs=2,
+                      default=None,
+                      help="Compute comparison statistics between every pair of the given "
+                      "samples. Expects two arguments: a comma-separated (no spaces) list of "
+                      "MISO output directories, and the directory where the results of the "
+                      "comparisons will be outputted. Delta posteriors are not outputted.")
+    parser.add_option("--num-processors", dest="num_processors", type="int", default=1,
+                      help="Number of processes to use for --compare-many-samples. "
+                      "Default is 1.")
     parser.add_option("--run-two-iso-event", dest="run_two_iso_event", nargs=3, default=None,
 		      help="Run MISO on two isoform event, given an event name, an events file "
                       "(in JSON/Pickle format) and an output directory.")
@@ -448,13 +594,13 @@ def main():
 		      help="Event type of two-isoform events (e.g. 'SE', 'RI', 'A3SS', ...)")
     parser.add_option("--use-compressed", dest="use_compressed", nargs=1, default=None,
                       help="Use compressed event IDs. Takes as input a genes_to_filenames.shelve file "
-                      "produced by the index_gff.py script.")
+                      "or a genes.miso_index file produced by the index_gff.py script.")
     ##
     ## Gene utilities
     ##
     parser.add_option("--view-gene", dest="view_gene", nargs=1, default=None,
                       help="View the contents of a gene/event that has been indexed. "\
-                      "Takes as input an indexed (.pickle) filename.")
+                      "Takes as input an indexed (.pickle or genes.miso_index) filename.")
     (options, args) = parser.parse_args()
 
     ##
@@ -482,7 +628,25 @@ def main():
 	ht.output_samples_comparison(sample1_dirname, sample2_dirname,
                                      output_dirname,
                                      sample_labels=options.comparison_labels,
-                                     use_compressed=use_compressed)
+                                     use_compressed=use_compressed,
+                                     join=options.comparison_join,
+                                     bf_method=options.bf_method,
+                                     delta_posteriors=options.delta_posteriors)
+
+    if options.many_samples_to_compare:
+        sample_dirnames = [os.path.abspath(os.path.expanduser(d)) for d in \
+                           options.many_samples_to_compare[0].split(",")]
+	output_dirname = os.path.abspath(os.path.expanduser(options.many_samples_to_compare[1]))
+        if len(sample_dirnames) < 2:
+            print "Error: need at least two samples to compare."
+            sys.exit(1)
+	if not os.path.isdir(output_dirname):
+            print "Making comparisons directory: %s" %(output_dirname)
+	    os.makedirs(output_dirname)
+        ht.output_many_samples_comparison(sample_dirnames, output_dirname,
+                                          use_compressed=use_compressed,
+                                          num_processors=options.num_processors,
+                                          bf_method=options.bf_method)
 	
     if options.run_two_iso_event:
 	if options.read_len == None or options.overhang_len == None:
@@ -563,7 +727,8 @@ def main():
 
         compute_gene_psi(gene_ids, gff_filename, bam_filename, output_dir,
                          options.read_len, overhang_len, paired_end=paired_end,
-                         event_type=options.event_type)
+                         event_type=options.event_type,
+                         fast_estimate=options.fast_estimate)
 
 
     ##
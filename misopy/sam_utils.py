@@ -13,7 +13,7 @@ import pysam
 import binascii
 import ctypes
 
-from numpy import array
+from numpy import array, int32
 from scipy import *
 
 # def read_to_isoforms(alignment, gene):
@@ -224,6 +224,81 @@ def fetch_bam_reads_in_gene(bamfile, chrom, start, end, gene=None):
     return gene_reads
 
 
+def get_read_end(read):
+    """
+    Return the end coordinate of a read on the reference, as used
+    by BAM fetches (reads without one cover their start only.)
+    """
+    end = read.aend
+    if end is None or end <= read.pos:
+        end = read.pos + 1
+    return end
+
+
+def sweep_bam_reads(bamfile, genes):
+    """
+    Fetch the reads of many genes in one sequential pass over each
+    chromosome of a sorted, indexed BAM file, instead of one fetch
+    (and seek) per gene.
+
+    genes is a list of (gene key, chrom, start, end). Yields
+    (gene key, reads) for every gene, as soon as the pass is past
+    the gene's end. The reads of a gene are the ones
+    fetch_bam_reads_in_gene returns for it, in the same order;
+    reads that overlap several genes are given to each of them.
+    """
+    genes_by_chrom = defaultdict(list)
+    for gene_key, chrom, start, end in genes:
+        genes_by_chrom[chrom].append((start, end, gene_key))
+
+    for chrom, chrom_genes in genes_by_chrom.iteritems():
+        chrom_genes.sort()
+        bam_chrom = chrom
+        if bam_chrom not in bamfile.references:
+            bam_chrom = bam_chrom.split("chr")[-1]
+        if bam_chrom not in bamfile.references:
+            print "Cannot fetch reads in chromosome: %s" %(chrom)
+            for start, end, gene_key in chrom_genes:
+                yield gene_key, []
+            continue
+
+        region_start = chrom_genes[0][0]
+        region_end = max([end for start, end, gene_key in chrom_genes])
+        # Genes that reads can still overlap, as [start, end, key, reads]
+        active_genes = []
+        next_gene = 0
+        num_genes = len(chrom_genes)
+        for read in bamfile.fetch(bam_chrom, region_start, region_end):
+            read_start = read.pos
+            read_end = get_read_end(read)
+            # Reads are sorted by start, so genes that end before this
+            # read get no more reads
+            if active_genes and active_genes[0][1] <= read_start:
+                for gene in active_genes:
+                    if gene[1] <= read_start:
+                        yield gene[2], gene[3]
+                active_genes = [gene for gene in active_genes \
+                                if gene[1] > read_start]
+            while next_gene < num_genes and \
+                  chrom_genes[next_gene][0] < read_end:
+                start, end, gene_key = chrom_genes[next_gene]
+                next_gene += 1
+                if end <= read_start:
+                    # No read overlaps the gene
+                    yield gene_key, []
+                    continue
+                active_genes.append([start, end, gene_key, []])
+                # Keep the genes that end first in front
+                active_genes.sort(key=lambda gene: gene[1])
+            for gene in active_genes:
+                if gene[0] < read_end and gene[1] > read_start:
+                    gene[3].append(read)
+        for gene in active_genes:
+            yield gene[2], gene[3]
+        for start, end, gene_key in chrom_genes[next_gene:]:
+            yield gene_key, []
+
+
 def flag_to_strand(flag):
     """
     Takes integer flag as argument.
@@ -311,8 +386,16 @@ def sam_cigar_to_str(sam_cigar):
     return cigar_str
     
 def sam_parse_reads(samfile, paired_end=False):
+    """
+    Return the reads of a SAM/BAM file as int32 arrays, which the MISO
+    C engine uses in place: the (1-based) read positions, the
+    (operation, length) pairs of the reads' CIGARs, flattened, and
+    the offsets of each read's pairs. The pairs of read i are
+    cigar_idx[i] to cigar_idx[i+1]-1.
+    """
     read_positions = []
-    read_cigars = []
+    cigar_pairs = []
+    cigar_idx = [0]
     num_reads = 0
     
     if paired_end:
@@ -324,19 +407,24 @@ def sam_parse_reads(samfile, paired_end=False):
         # Unpaired reads are not supported.
         for read_id, read_info in paired_reads.iteritems():
             read1, read2 = read_info
-            read_positions.extend([int(read1.pos), int(read2.pos)])
-            read_cigars.extend([sam_cigar_to_str(read1.cigar),
-                                sam_cigar_to_str(read2.cigar)])
+            for read in (read1, read2):
+                read_positions.append(read.pos + 1)
+                for cigar_part in read.cigar:
+                    cigar_pairs.extend(cigar_part)
+                cigar_idx.append(len(cigar_pairs) / 2)
             num_reads += 1
     else:
         # Single-end
         for read in samfile:
-            read_positions.append(int(read.pos))
-            read_cigars.append(sam_cigar_to_str(read.cigar))
+            read_positions.append(read.pos + 1)
+            for cigar_part in read.cigar:
+                cigar_pairs.extend(cigar_part)
+            cigar_idx.append(len(cigar_pairs) / 2)
             num_reads += 1
 
-    reads = (tuple(read_positions),
-             tuple(read_cigars))
+    reads = (array(read_positions, dtype=int32),
+             array(cigar_pairs, dtype=int32),
+             array(cigar_idx, dtype=int32))
 
     return reads, num_reads
 
@@ -0,0 +1,367 @@
+##
+## Binary store of MISO posterior samples
+##
+## Instead of one text .miso file per event, the samples of many events
+## can be kept in one binary file (per chromosome directory and
+## process), which avoids creating tens of thousands of small files
+## and parsing them back as text.
+##
+## File layout (little-endian):
+##
+##   file header:  magic, version, flags, offset and length of the index
+##   records:      one per event: record header, event name, .miso
+##                 header line, float32 samples (samples x isoforms)
+##                 and float64 log scores (unless the store is flagged
+##                 as having none, e.g. for delta posteriors)
+##   index:        JSON mapping event names to record offsets,
+##                 written when the store is closed
+##
+## If a writer did not close its store (e.g. it was killed), the
+## records are still readable: the index is rebuilt by scanning them.
+##
+import os
+import sys
+import glob
+import json
+import struct
+import socket
+import atexit
+import multiprocessing.util
+
+from numpy import *
+
+STORE_EXT = ".miso_store"
+STORE_MAGIC = "MISOSTR1"
+STORE_VERSION = 1
+RECORD_MAGIC = "MSRC"
+
+## magic, version, flags, index offset, index length
+FILE_HEADER = struct.Struct("<8sIIQQ")
+## Flag of stores whose records have no log scores
+NO_LOG_SCORES = 1
+## magic, name length, header length, number of samples, isoforms
+RECORD_HEADER = struct.Struct("<4sIIII")
+
+## Separator between a store filename and an event name in a
+## samples path, e.g. chr1/samples.host.123.miso_store::EVENT
+PATH_SEP = "::"
+
+
+def pad8(n):
+    return (n + 7) & ~7
+
+
+def make_samples_path(store_filename, event_name):
+    """
+    Return the path of an event's samples in a store.
+    """
+    return "%s%s%s" %(store_filename, PATH_SEP, event_name)
+
+
+def split_samples_path(samples_path):
+    """
+    Split a samples path into (store filename, event name).
+    Return None if the path is not in a store.
+    """
+    if PATH_SEP not in samples_path:
+        return None
+    store_filename, event_name = samples_path.split(PATH_SEP, 1)
+    if not store_filename.endswith(STORE_EXT):
+        return None
+    return store_filename, event_name
+
+
+def is_samples_path(samples_path):
+    """
+    Return True if the samples path points into a store.
+    """
+    return split_samples_path(samples_path) != None
+
+
+def get_store_filename(output_dir):
+    """
+    Return the store filename that the current process writes to
+    in the given directory. Each process (or cluster job) writes
+    its own store, so no locking is needed.
+    """
+    return os.path.join(output_dir,
+                        "samples.%s.%d%s" %(socket.gethostname(),
+                                            os.getpid(),
+                                            STORE_EXT))
+
+
+class SamplesStoreWriter:
+    """
+    Append the samples of events to a store. Reopening an existing
+    store continues it. If log_scores is False, the store keeps no
+    log scores.
+    """
+    def __init__(self, filename, log_scores=True):
+        self.filename = filename
+        self.index = {}
+        self.flags = 0
+        if not log_scores:
+            self.flags |= NO_LOG_SCORES
+        if os.path.isfile(filename):
+            store = SamplesStore(filename)
+            self.index = dict(store.index)
+            self.flags = store.flags
+            end = store.data_end
+            store.close()
+            self.f = open(filename, "r+b")
+            self.f.seek(end)
+            self.f.truncate()
+        else:
+            self.f = open(filename, "w+b")
+            self.f.write(FILE_HEADER.pack(STORE_MAGIC, STORE_VERSION,
+                                          self.flags, 0, 0))
+        # Mark the index as missing until the store is closed
+        self.write_file_header(0, 0)
+
+    def write_file_header(self, index_offset, index_len):
+        pos = self.f.tell()
+        self.f.seek(0)
+        self.f.write(FILE_HEADER.pack(STORE_MAGIC, STORE_VERSION, self.flags,
+                                      index_offset, index_len))
+        self.f.seek(pos)
+
+    def __contains__(self, event_name):
+        return event_name in self.index
+
+    def add(self, event_name, header, samples, log_scores):
+        """
+        Add the samples (samples x isoforms) and log scores of
+        an event. header is the .miso header line, without the
+        leading '#'. log_scores is None for stores without log
+        scores.
+        """
+        samples = ascontiguousarray(samples, dtype='<f4')
+        num_samples, num_isoforms = samples.shape
+        if self.flags & NO_LOG_SCORES:
+            if log_scores is not None:
+                raise Exception, "Store %s has no log scores." %(self.filename)
+            log_scores = zeros(0, dtype='<f8')
+        else:
+            log_scores = ascontiguousarray(log_scores, dtype='<f8')
+            if len(log_scores) != num_samples:
+                raise Exception, "Need one log score per sample for %s." \
+                      %(event_name)
+        offset = self.f.tell()
+        f = self.f
+        f.write(RECORD_HEADER.pack(RECORD_MAGIC, len(event_name),
+                                   len(header), num_samples,
+                                   num_isoforms))
+        text = event_name + header
+        f.write(text)
+        text_end = RECORD_HEADER.size + len(text)
+        f.write("\0" * (pad8(text_end) - text_end))
+        f.write(samples.tostring())
+        nbytes = samples.nbytes
+        f.write("\0" * (pad8(nbytes) - nbytes))
+        f.write(log_scores.tostring())
+        # Worker processes may exit without closing the store; the
+        # records written so far can then still be recovered
+        f.flush()
+        self.index[event_name] = offset
+
+    def close(self):
+        if self.f is None:
+            return
+        index_offset = self.f.tell()
+        index = json.dumps(self.index)
+        self.f.write(index)
+        self.write_file_header(index_offset, len(index))
+        self.f.close()
+        self.f = None
+
+
+class SamplesStore:
+    """
+    Read a store of samples. The samples are memory mapped, not
+    read into memory.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = memmap(filename, dtype=uint8, mode='r')
+        if len(self.data) < FILE_HEADER.size:
+            raise Exception, "%s is not a MISO samples store." %(filename)
+        magic, version, self.flags, index_offset, index_len = \
+            FILE_HEADER.unpack(self.data[0:FILE_HEADER.size].tostring())
+        if magic != STORE_MAGIC:
+            raise Exception, "%s is not a MISO samples store." %(filename)
+        if version > STORE_VERSION:
+            raise Exception, "%s was written by a newer version of MISO." \
+                  %(filename)
+        self.has_log_scores = not (self.flags & NO_LOG_SCORES)
+        if index_offset > 0:
+            index = self.data[index_offset:index_offset + index_len]
+            self.index = dict([(str(event_name), offset) for \
+                               event_name, offset in \
+                               json.loads(index.tostring()).iteritems()])
+            self.data_end = index_offset
+        else:
+            self.index, self.data_end = self.scan_records()
+
+    def scan_records(self):
+        """
+        Rebuild the index of a store that was not closed. A
+        partially written last record is dropped.
+        """
+        index = {}
+        offset = FILE_HEADER.size
+        size = len(self.data)
+        while offset + RECORD_HEADER.size <= size:
+            magic, name_len, header_len, num_samples, num_isoforms = \
+                RECORD_HEADER.unpack(self.data[offset:offset + \
+                                               RECORD_HEADER.size].tostring())
+            if magic != RECORD_MAGIC:
+                break
+            end = self.record_end(offset, name_len, header_len,
+                                  num_samples, num_isoforms)
+            if end > size:
+                break
+            name_start = offset + RECORD_HEADER.size
+            event_name = self.data[name_start:name_start + name_len].tostring()
+            index[event_name] = offset
+            offset = end
+        return index, offset
+
+    def record_end(self, offset, name_len, header_len, num_samples,
+                   num_isoforms):
+        samples_start = offset + pad8(RECORD_HEADER.size + name_len + \
+                                      header_len)
+        scores_start = samples_start + pad8(4 * num_samples * num_isoforms)
+        if not self.has_log_scores:
+            return scores_start
+        return scores_start + 8 * num_samples
+
+    def events(self):
+        return self.index.keys()
+
+    def __contains__(self, event_name):
+        return event_name in self.index
+
+    def read_record(self, event_name):
+        """
+        Return the header, samples and log scores (None if the
+        store has none) of an event.
+        """
+        if event_name not in self.index:
+            raise Exception, "Event %s not in samples store %s." \
+                  %(event_name, self.filename)
+        offset = self.index[event_name]
+        magic, name_len, header_len, num_samples, num_isoforms = \
+            RECORD_HEADER.unpack(self.data[offset:offset + \
+                                           RECORD_HEADER.size].tostring())
+        text_start = offset + RECORD_HEADER.size + name_len
+        header = self.data[text_start:text_start + header_len].tostring()
+        samples_start = offset + pad8(RECORD_HEADER.size + name_len + \
+                                      header_len)
+        samples_end = samples_start + 4 * num_samples * num_isoforms
+        samples = self.data[samples_start:samples_end].view('<f4')
+        samples = samples.reshape((num_samples, num_isoforms))
+        if not self.has_log_scores:
+            return header, samples, None
+        scores_start = samples_start + pad8(4 * num_samples * num_isoforms)
+        log_scores = self.data[scores_start:scores_start + \
+                               8 * num_samples].view('<f8')
+        return header, samples, log_scores
+
+    def get_header(self, event_name):
+        return self.read_record(event_name)[0]
+
+    def close(self):
+        self.data = None
+
+
+##
+## Open stores, shared by all readers and writers of a process
+##
+open_stores = {}
+open_writers = {}
+
+
+def get_store(store_filename):
+    """
+    Return the (cached) reader of a store.
+    """
+    if store_filename not in open_stores:
+        open_stores[store_filename] = SamplesStore(store_filename)
+    return open_stores[store_filename]
+
+
+def get_writer(store_filename):
+    """
+    Return the (cached) writer of a store. Writers are closed
+    when the process exits, or by close_writers().
+    """
+    if store_filename not in open_writers:
+        if len(open_writers) == 0:
+            # Processes of a multiprocessing pool do not run atexit
+            # handlers, but they do run these finalizers
+            multiprocessing.util.Finalize(None, close_writers,
+                                          exitpriority=10)
+        open_writers[store_filename] = SamplesStoreWriter(store_filename)
+    return open_writers[store_filename]
+
+
+def close_writers():
+    for store_filename, writer in open_writers.items():
+        writer.close()
+        # Readers of this store are out of date
+        if store_filename in open_stores:
+            del open_stores[store_filename]
+    open_writers.clear()
+
+atexit.register(close_writers)
+
+
+def get_dir_stores(dirname):
+    """
+    Return the store filenames in a directory.
+    """
+    return sorted(glob.glob(os.path.join(dirname, "*%s" %(STORE_EXT))))
+
+
+def get_store_samples_paths(store_filename):
+    """
+    Return the samples paths of all the events in a store.
+    """
+    store = get_store(store_filename)
+    return [make_samples_path(store_filename, event_name) \
+            for event_name in sorted(store.events())]
+
+
+def find_event(dirname, event_name):
+    """
+    Return the samples path of an event if it is in one of the
+    stores of a directory (including stores being written),
+    otherwise None.
+    """
+    for store_filename in get_dir_stores(dirname):
+        if store_filename in open_writers:
+            found = event_name in open_writers[store_filename]
+        else:
+            found = event_name in get_store(store_filename)
+        if found:
+            return make_samples_path(store_filename, event_name)
+    return None
+
+
+def write_samples(output_dir, event_name, header, samples, log_scores):
+    """
+    Write the samples of an event to this process's store in
+    output_dir. Return the samples path.
+    """
+    store_filename = get_store_filename(output_dir)
+    get_writer(store_filename).add(event_name, header, samples, log_scores)
+    return make_samples_path(store_filename, event_name)
+
+
+def read_samples(samples_path):
+    """
+    Return the header (without '#'), samples (samples x isoforms,
+    memory mapped float32) and log scores of an event in a store.
+    """
+    store_filename, event_name = split_samples_path(samples_path)
+    return get_store(store_filename).read_record(event_name)
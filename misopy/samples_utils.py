@@ -10,12 +10,29 @@ from collections import defaultdict
 import os
 import sys
 import glob
+import socket
 import misopy
 
 from misopy.parse_csv import *
 from misopy.credible_intervals import *
 
 import misopy.index_gff as index_gff
+import misopy.samples_store as samples_store
+
+## Fields of a MISO summary file
+SUMMARY_HEADER_FIELDS = ["event_name", "miso_posterior_mean", "ci_low", "ci_high",
+                         "isoforms", "counts", "assigned_counts",
+                         # Fields related to gene/event
+                         "chrom",
+                         "strand",
+                         "mRNA_starts",
+                         "mRNA_ends"]
+
+## Summary rows written by each process as it samples events
+SUMMARY_SHARD_EXT = ".miso_summary_shard"
+
+## Number of events whose credible intervals are computed together
+SUMMARY_BATCH_SIZE = 500
 
 def maxi(l):
     m = max(l)
@@ -27,7 +44,12 @@ def load_samples(samples_file):
     """
     Load a file with samples.  Return the samples, header from the file, the sampled MAP estimate,
     and the sampled MAP's log score.
+
+    samples_file can also be the path of an event in a binary
+    samples store (see samples_store.)
     """
+    if samples_store.is_samples_path(samples_file):
+        return load_store_samples(samples_file)
     data, h = csv2array(samples_file, skiprows=1, raw_header=True)
     sampled_map_indx = maxi(data['sampled_psi'])
     sampled_map = [float(v) for v in data['sampled_psi'][sampled_map_indx].split(',')]
@@ -47,14 +69,42 @@ def load_samples(samples_file):
             sampled_map_log_score, counts_info)
 
 
+def load_store_samples(samples_path):
+    """
+    Load the samples of an event from a binary samples store, in the
+    same form as load_samples.
+    """
+    header, store_samples, log_scores = samples_store.read_samples(samples_path)
+    samples = array(store_samples, dtype=float64)
+    # Like the text files, pick the largest Psi sample (compared as
+    # the text of its values) as the sampled MAP
+    rounded = around(samples, 4)
+    sampled_map_indx = maxi([tuple(row) for row in rounded])
+    sampled_map = list(rounded[sampled_map_indx])
+    sampled_map_log_score = log_scores[sampled_map_indx]
+    h = ["#" + header]
+    counts_info = get_counts_from_header(h[0])
+    return (samples, h, array(log_scores), sampled_map,
+            sampled_map_log_score, counts_info)
+
+
 def parse_sampler_params(miso_filename):
     """
     Parse parameters that were used to produce a set of samples.  
     """
-    miso_file = open(miso_filename, 'r')
-    header = miso_file.readline().strip()
-    miso_file.close()
-    
+    if samples_store.is_samples_path(miso_filename):
+        header = samples_store.read_samples(miso_filename)[0]
+    else:
+        miso_file = open(miso_filename, 'r')
+        header = miso_file.readline().strip()
+        miso_file.close()
+    return parse_header_params(header)
+
+
+def parse_header_params(header):
+    """
+    Parse the parameters in the header of a set of samples.
+    """
     if header[0] == '#':
 	# strip header start
 	header = header[1:]
@@ -127,13 +177,18 @@ def get_event_name(miso_filename,
     """
     Get event name from MISO filename.
 
-    Now supports compressed event names.
+    Now supports compressed event names, and events in
+    binary samples stores.
     """
-    basename = os.path.basename(miso_filename)
-    if not basename.endswith(".miso"):
-        # Not a MISO filename
-        return None
-    event_name = basename.split(".miso")[0]
+    store_path = samples_store.split_samples_path(miso_filename)
+    if store_path != None:
+        event_name = store_path[1]
+    else:
+        basename = os.path.basename(miso_filename)
+        if not basename.endswith(".miso"):
+            # Not a MISO filename
+            return None
+        event_name = basename.split(".miso")[0]
     if use_compressed_map is not None:
         if event_name not in use_compressed_map:
             print "WARNING: Cannot find compressed id %s in given mapping." \
@@ -154,25 +209,133 @@ def get_event_name(miso_filename,
 #     return event_name
     
     
+def get_summary_fields(event_name, samples, header):
+    """
+    Return the fields of the summary line of an event, given its
+    samples and the header of its samples file.
+    """
+    output_fields = format_credible_intervals(event_name, samples)
+    output_fields.extend(get_summary_header_fields(header))
+    return output_fields
+
+
+def get_summary_header_fields(header):
+    """
+    Return the fields of the summary line of an event that come
+    from the header of its samples file (isoforms, counts and gene
+    information.)
+    """
+    header = header.strip()
+    params = parse_header_params(header)
+    counts_info = get_counts_from_header(header)
+    output_fields = []
+
+    # Add isoforms information to output fields
+    isoforms_field = get_isoforms_from_header(header)
+    output_fields.append(isoforms_field)
+
+    # Add counts information to output fields
+    output_fields.append(counts_info['counts'])
+    output_fields.append(counts_info['assigned_counts'])
+
+    gene_info = get_gene_info_from_params(params)
+    output_fields.append(gene_info["chrom"])
+    output_fields.append(gene_info["strand"])
+    output_fields.append(gene_info["mRNA_starts"])
+    output_fields.append(gene_info["mRNA_ends"])
+    return output_fields
+
+
+def get_summary_shard_filename(dirname):
+    """
+    Return the summary shard that the current process writes to in
+    the given directory.
+    """
+    return os.path.join(dirname,
+                        "summary.%s.%d%s" %(socket.gethostname(),
+                                            os.getpid(),
+                                            SUMMARY_SHARD_EXT))
+
+
+def write_summary_row(dirname, event_name, samples, header):
+    """
+    Append the summary line of an event to this process's summary
+    shard in dirname. Called by the sampler once the event's samples
+    are written, so that summarize_sampler_results does not have to
+    load them again.
+    """
+    output_fields = get_summary_fields(event_name, samples, header)
+    shard_file = open(get_summary_shard_filename(dirname), 'a')
+    shard_file.write("%s\n" %("\t".join(output_fields)))
+    shard_file.close()
+
+
+def load_summary_shards(samples_dir):
+    """
+    Load the summary lines in the summary shards of a samples
+    directory and its chromosome directories. Return a mapping from
+    event names to their summary fields (without the event name.)
+
+    Shards are read oldest first, so lines written by later runs
+    take precedence.
+    """
+    shard_filenames = glob.glob(os.path.join(samples_dir,
+                                             "*%s" %(SUMMARY_SHARD_EXT)))
+    shard_filenames.extend(glob.glob(os.path.join(samples_dir, "*",
+                                                  "*%s" %(SUMMARY_SHARD_EXT))))
+    shard_filenames.sort(key=lambda f: os.path.getmtime(f))
+    summary_rows = {}
+    for shard_filename in shard_filenames:
+        for line in open(shard_filename):
+            fields = line.rstrip("\n").split("\t")
+            # Skip lines cut short by a process that was killed
+            if not line.endswith("\n") or \
+               len(fields) != len(SUMMARY_HEADER_FIELDS):
+                continue
+            summary_rows[fields[0]] = fields[1:]
+    return summary_rows
+
+
+def output_summary_batch(summary_file, batch):
+    """
+    Write the summary lines of a batch of events, in order. The
+    credible intervals of the events that were loaded are computed
+    together. Return the number of events written.
+    """
+    loaded = [(output_fields[0], samples) for output_fields, samples, header \
+              in batch if samples is not None]
+    cred_intervals = format_batch_credible_intervals([l[0] for l in loaded],
+                                                     [l[1] for l in loaded])
+    cred_intervals.reverse()
+    for output_fields, samples, header in batch:
+        if samples is not None:
+            output_fields = cred_intervals.pop()
+            output_fields.extend(get_summary_header_fields(header))
+        output_line = "%s\n" %("\t".join(output_fields))
+        summary_file.write(output_line)
+    return len(batch)
+
+
 def summarize_sampler_results(samples_dir, summary_filename,
-                              use_compressed=None):
+                              use_compressed=None,
+                              use_shards=True):
     """
     Given a set of samples from MISO, output a summary file.
+
+    Events that have a line in a summary shard (written at sampling
+    time) are not loaded again, unless use_shards is False.
     """
     summary_file = open(summary_filename, 'w')
-    header_fields = ["event_name", "miso_posterior_mean", "ci_low", "ci_high",
-                     "isoforms", "counts", "assigned_counts",
-                     # Fields related to gene/event
-                     "chrom",
-                     "strand",
-                     "mRNA_starts",
-                     "mRNA_ends"]
-    summary_header = "%s\n" %("\t".join(header_fields))
+    summary_header = "%s\n" %("\t".join(SUMMARY_HEADER_FIELDS))
     summary_file.write(summary_header)
     print "Loading events from: %s" %(samples_dir)
     print "Writing summary to: %s" %(summary_filename)
     all_filenames = get_samples_dir_filenames(samples_dir)
     num_events = 0
+    summary_rows = {}
+    if use_shards:
+        summary_rows = load_summary_shards(samples_dir)
+        print "  - Loaded %d summary lines from shards." %(len(summary_rows))
 
     compressed_ids_to_genes = {}
     if use_compressed is not None:
@@ -180,14 +343,16 @@ def summarize_sampler_results(samples_dir, summary_filename,
         # Load mapping from gene IDs to their hashes
         compressed_ids_to_genes = index_gff.load_compressed_ids_to_genes(use_compressed)
     
+    # Events waiting to be written: their summary fields, or for
+    # events without a summary line, their samples and header
+    batch = []
     for samples_filename in all_filenames:
-        # Parse sampler parameters
-        params = parse_sampler_params(samples_filename)
         event_name = get_event_name(samples_filename)
         
         if event_name == None:
             print "Skipping %s" %(samples_filename)
             continue
+        summary_row = summary_rows.get(event_name)
         # If using compressed event IDs, convert event
         # to its real event ID
         if use_compressed is not None:
@@ -203,42 +368,27 @@ def summarize_sampler_results(samples_dir, summary_filename,
                 print "WARNING: %s looks like a compressed id, but no mapping file " \
                     "from compressed IDs to event IDs was given! Try: --use-compressed" %(event_name)
             
-        # Load samples and header information
-	samples_results = load_samples(samples_filename)
-	samples = samples_results[0]
-        header = samples_results[1]
-        header = header[0]
-
-        # Get counts information from header
-        counts_info = samples_results[5]
-        
-        num_samples, num_isoforms = shape(samples)
-        output_fields = format_credible_intervals(event_name, samples)
-            
-        # Add isoforms information to output fields
-        isoforms_field = get_isoforms_from_header(header)
-        output_fields.append(isoforms_field)
-
-        # Add counts information to output fields
-        output_fields.append(counts_info['counts'])
-        output_fields.append(counts_info['assigned_counts'])
-
-        gene_info = get_gene_info_from_params(params)
-        output_fields.append(gene_info["chrom"])
-        output_fields.append(gene_info["strand"])
-        output_fields.append(gene_info["mRNA_starts"])
-        output_fields.append(gene_info["mRNA_ends"])
-        
-        output_line = "%s\n" %("\t".join(output_fields))
-	summary_file.write(output_line)
-	num_events += 1
+        if summary_row != None:
+            # Summarized at sampling time
+            batch.append(([event_name] + summary_row, None, None))
+        else:
+            # Load samples and header information
+            samples_results = load_samples(samples_filename)
+            samples = samples_results[0]
+            header = samples_results[1][0]
+            batch.append(([event_name], samples, header))
+        if len(batch) >= SUMMARY_BATCH_SIZE:
+            num_events += output_summary_batch(summary_file, batch)
+            batch = []
+    num_events += output_summary_batch(summary_file, batch)
     print "  - Summarized a total of %d events." %(num_events)
     summary_file.close()
 
     
 def is_miso_chrom_dir(dirname):
     """
-    Return True if a directory contains *.miso files.
+    Return True if a directory contains *.miso files
+    (or samples stores.)
     """
     if not os.path.isdir(dirname):
         return False
@@ -252,6 +402,8 @@ def is_miso_chrom_dir(dirname):
     fnames = glob.glob(os.path.join(dirname, "*.miso"))
     if len(fnames) >= 1:
         return True
+    if len(samples_store.get_dir_stores(dirname)) >= 1:
+        return True
     return False
     
     
@@ -268,6 +420,10 @@ def get_samples_dir_filenames(samples_dir):
         - chrN
 
     Also collect files in samples_dir for backwards compatibility.
+
+    Events in binary samples stores are returned as samples paths
+    (see samples_store.make_samples_path), which can be used like
+    filenames by the functions in this module.
     """
     directories = glob.glob(os.path.join(samples_dir, "*"))
     directories = filter(is_miso_chrom_dir, directories)
@@ -295,9 +451,15 @@ def get_samples_dir_filenames(samples_dir):
     filenames = filter(lambda f: not os.path.basename(f).startswith("."),
                        filenames)
 
+    # Events in samples stores
+    store_filenames = filter(lambda f: f.endswith(samples_store.STORE_EXT),
+                             filenames)
+    
     # Remove files that do not end with proper extension
     filenames = filter(lambda f: os.path.basename(f).endswith(".miso"),
                        filenames)
+    for store_filename in sorted(store_filenames):
+        filenames.extend(samples_store.get_store_samples_paths(store_filename))
     return filenames
 
 
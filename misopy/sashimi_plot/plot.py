@@ -19,10 +19,12 @@ import shelve
 
 import misopy
 import misopy.gff_utils as gff_utils
+import misopy.gene_index as gene_index
 import misopy.pe_utils as pe_utils
 from misopy.parse_csv import csv2dictlist_raw
 
-from misopy.samples_utils import load_samples, parse_sampler_params
+from misopy.samples_utils import load_samples, parse_sampler_params, \
+     get_event_name
 from misopy.sashimi_plot.Sashimi import Sashimi
 from misopy.sashimi_plot.plot_utils.samples_plotter import SamplesPlotter
 from misopy.sashimi_plot.plot_utils.plotting import *
@@ -122,20 +124,29 @@ def plot_event(event_name, pickle_dir, settings_filename,
     # Retrieve the full pickle filename
     genes_filename = os.path.join(pickle_dir,
                                   "genes_to_filenames.shelve")
-
-    # Check that file basename exists 
-    if len(glob.glob("%s*" %(genes_filename))) == 0:
-        raise Exception, "Cannot find file %s. Are you sure the events " \
-              "were indexed with the latest version of index_gff.py?" \
-              %(genes_filename)
+    index_filename = gene_index.find_gene_index(pickle_dir)
+
+    if index_filename != None:
+        # Events indexed into a gene index
+        if event_name not in gene_index.get_gene_index(index_filename):
+            raise Exception, "Event %s not found in gene index %s. " \
+                  "Are you sure this is the right directory for the event?" \
+                  %(event_name, index_filename)
+        pickle_filename = index_filename
+    else:
+        # Check that file basename exists 
+        if len(glob.glob("%s*" %(genes_filename))) == 0:
+            raise Exception, "Cannot find file %s. Are you sure the events " \
+                  "were indexed with the latest version of index_gff.py?" \
+                  %(genes_filename)
     
-    event_to_filenames = shelve.open(genes_filename)
-    if event_name not in event_to_filenames:
-        raise Exception, "Event %s not found in pickled directory %s. " \
-              "Are you sure this is the right directory for the event?" \
-              %(event_name, pickle_dir)
+        event_to_filenames = shelve.open(genes_filename)
+        if event_name not in event_to_filenames:
+            raise Exception, "Event %s not found in pickled directory %s. " \
+                  "Are you sure this is the right directory for the event?" \
+                  %(event_name, pickle_dir)
     
-    pickle_filename = event_to_filenames[event_name]
+        pickle_filename = event_to_filenames[event_name]
 
     if no_posteriors:
         print "Asked to not plot MISO posteriors."
@@ -209,7 +220,7 @@ def plot_posterior(miso_filename, settings_filename, output_dir,
              sampled_map_log_score, counts_info = load_samples(miso_filename)
     params = parse_sampler_params(miso_filename)
 
-    plot_name = os.path.basename(miso_filename).replace(".miso", "")
+    plot_name = get_event_name(miso_filename)
 
     sashimi_obj = Sashimi(plot_name, output_dir,
                           settings_filename=settings_filename)
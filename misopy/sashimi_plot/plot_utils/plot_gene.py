@@ -12,6 +12,7 @@ from matplotlib.path import Path
 import misopy
 import misopy.gff_utils as gff_utils
 import misopy.sam_utils as sam_utils
+import misopy.samples_store as samples_store
 
 from misopy.sashimi_plot.Sashimi import Sashimi
 import misopy.sashimi_plot.plot_utils.plotting as plotting
@@ -241,7 +242,8 @@ def plot_density(sashimi_obj, pickle_filename, event):
                 ax2 = subplot2grid((nfiles + 3, gene_posterior_ratio),\
                     (i, gene_posterior_ratio - 1))
 
-                if not os.path.isfile(miso_file):
+                if not (os.path.isfile(miso_file) or \
+                        samples_store.is_samples_path(miso_file)):
                     print "Warning: MISO file %s not found" %(miso_file)
 
                 print "Loading MISO file: %s" %(miso_file)
@@ -511,10 +513,14 @@ def plot_posterior_single(miso_f, axvar, posterior_bins,
     """
     posterior_bins = int(posterior_bins) 
     psis = [] 
-    for line in open(miso_f):
-        if not line.startswith("#") and not line.startswith("sampled"):
-            psi, logodds = line.strip().split("\t")
-            psis.append(float(psi.split(",")[0]))
+    if samples_store.is_samples_path(miso_f):
+        header, samples, log_scores = samples_store.read_samples(miso_f)
+        psis = [float(psi) for psi in samples[:, 0]]
+    else:
+        for line in open(miso_f):
+            if not line.startswith("#") and not line.startswith("sampled"):
+                psi, logodds = line.strip().split("\t")
+                psis.append(float(psi.split(",")[0]))
   
     ci = .95 
     alpha = 1 - ci
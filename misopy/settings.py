@@ -57,10 +57,16 @@ class Settings(object):
         Return sampler parameters.
         """
         param_names = ['burn_in', 'lag', 'num_iters']
-        opt_param_names = ['num_chains']
-
-        # Default number of chains is 6
-        sampler_params = {'num_chains': 6}
+        opt_param_names = ['num_chains', 'seed', 'proposal',
+                           'early_stop', 'check_every', 'min_ess',
+                           'max_rhat', 'chain_threads', 'samples_format',
+                           'batch_genes', 'batch_threads']
+
+        # Default number of chains is 6; genes are sampled in batches
+        # of 50 genes, on one thread
+        sampler_params = {'num_chains': 6,
+                          'batch_genes': 50,
+                          'batch_threads': 1}
 
         for name in param_names:
             if name not in cls.global_settings:
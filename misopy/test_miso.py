@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import unittest
 import os
+import shutil
+import tempfile
 from misopy.settings import Settings
 
 class TestMISO(unittest.TestCase):
@@ -21,6 +23,13 @@ class TestMISO(unittest.TestCase):
         self.gff_events_dir = os.path.join(self.miso_path, "gff-events")
         self.sam_to_bam_script = os.path.join(self.miso_path, "sam_to_bam.py")
         self.index_gff_script = os.path.join(self.miso_path, "index_gff.py")
+        # Scratch directory of a test, removed after the test
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import misopy.samples_store as samples_store
+        samples_store.close_writers()
+        shutil.rmtree(self.tmp_dir)
 
     def test_a_sam_to_bam(self):
         """
@@ -42,7 +51,639 @@ class TestMISO(unittest.TestCase):
         assert(os.path.exists(os.path.join(output_dir,
                                            "c2c12.Atp2b1.sorted.bam")))
 
-        
+
+    def test_samples_store(self):
+        """
+        Test writing samples to a binary samples store and reading
+        them back, also from a store that was not closed.
+        """
+        import numpy
+        import misopy.samples_store as samples_store
+        import misopy.samples_utils as samples_utils
+
+        print "Testing binary samples store..."
+        output_dir = self.tmp_dir
+        header = "isoforms=['A','B']\texon_lens=('A',100)\titers=5000\t" \
+                 "burn_in=500\tlag=10\tpercent_accept=90.00\t" \
+                 "proposal_type=drift\tcounts=(1,0):5\t" \
+                 "assigned_counts=0:5\tchrom=chr1\tstrand=+\t" \
+                 "mRNA_starts=1,1\tmRNA_ends=100,100"
+        samples = numpy.random.dirichlet([1, 1], size=20)
+        log_scores = numpy.random.uniform(-100, 0, size=20)
+        samples_path = samples_store.write_samples(output_dir, "EV1",
+                                                   header, samples,
+                                                   log_scores)
+        samples_store.write_samples(output_dir, "EV2", header,
+                                    samples[0:7], log_scores[0:7])
+        store_filename = samples_store.get_store_filename(output_dir)
+
+        # Records are readable before the store is closed
+        store = samples_store.SamplesStore(store_filename)
+        self.assertEqual(sorted(store.events()), ["EV1", "EV2"])
+        store.close()
+        samples_store.close_writers()
+
+        self.assertEqual(samples_utils.get_event_name(samples_path), "EV1")
+        paths = samples_utils.get_samples_dir_filenames(output_dir)
+        self.assertEqual(len(paths), 2)
+        loaded = samples_utils.load_samples(samples_path)
+        self.assertTrue(numpy.allclose(loaded[0], samples, atol=1e-6))
+        self.assertTrue(numpy.allclose(loaded[2], log_scores))
+        params = samples_utils.parse_sampler_params(samples_path)
+        self.assertEqual(params['chrom'], 'chr1')
+        self.assertEqual(samples_store.read_samples(paths[1])[1].shape,
+                         (7, 2))
+
+        # A store without log scores, as for delta posteriors
+        dp_filename = os.path.join(output_dir, "dp%s" %(samples_store.STORE_EXT))
+        dp_store = samples_store.SamplesStoreWriter(dp_filename,
+                                                    log_scores=False)
+        dp_store.add("EV1", "delta_posteriors", samples[:, 0:1], None)
+        dp_store.add("EV2", "delta_posteriors", samples[0:5], None)
+        dp_store.close()
+        header, dp_samples, dp_log_scores = \
+            samples_store.read_samples(samples_store.make_samples_path(dp_filename,
+                                                                       "EV2"))
+        self.assertEqual(dp_samples.shape, (5, 2))
+        self.assertEqual(dp_log_scores, None)
+
+    def test_summary_shards(self):
+        """
+        Test that summary lines written at sampling time are
+        used by the summary.
+        """
+        import numpy
+        import misopy.samples_utils as samples_utils
+
+        print "Testing summary shards..."
+        output_dir = self.tmp_dir
+        header = "#isoforms=['A','B']\texon_lens=('A',100)\titers=5000\t" \
+                 "counts=(1,0):5\tassigned_counts=0:5\tchrom=chr1\t" \
+                 "strand=+\tmRNA_starts=1,1\tmRNA_ends=100,100"
+        samples = numpy.random.dirichlet([1, 1], size=100)
+        samples_utils.write_summary_row(output_dir, "EV1", samples, header)
+        fields = samples_utils.get_summary_fields("EV1", samples, header)
+        # A line cut short is ignored
+        shard_filename = samples_utils.get_summary_shard_filename(output_dir)
+        shard_file = open(shard_filename, 'a')
+        shard_file.write("EV2\t0.50")
+        shard_file.close()
+        rows = samples_utils.load_summary_shards(output_dir)
+        self.assertEqual(rows.keys(), ["EV1"])
+        self.assertEqual(["EV1"] + rows["EV1"], fields)
+        self.assertEqual(fields[7], "chr1")
+
+    def test_batch_credible_intervals(self):
+        """
+        Test that credible intervals computed for many events at
+        once match those computed one event at a time.
+        """
+        import numpy
+        from misopy.credible_intervals import format_credible_intervals, \
+             format_batch_credible_intervals
+
+        print "Testing batch credible intervals..."
+        samples_list = [numpy.random.dirichlet(numpy.ones(num_isoforms),
+                                               size=num_samples) \
+                        for num_isoforms, num_samples in \
+                        [(2, 900), (3, 900), (2, 900), (4, 500), (2, 100)]]
+        event_names = ["EV%d" %(n) for n in range(len(samples_list))]
+        batch_fields = format_batch_credible_intervals(event_names,
+                                                       samples_list)
+        for event_name, samples, fields in zip(event_names, samples_list,
+                                               batch_fields):
+            self.assertEqual(format_credible_intervals(event_name,
+                                                       samples.copy()),
+                             fields)
+
+    def test_pair_samples_filenames(self):
+        """
+        Test pairing the events of two samples.
+        """
+        import misopy.hypothesis_test as ht
+
+        print "Testing pairing of events..."
+        sample1_filenames = ["s1/chr1/C.miso", "s1/chr1/A.miso",
+                             "s1/chr2/B.miso", "s1/chr2/D.miso"]
+        sample2_filenames = ["s2/chr2/B.miso", "s2/chr1/A.miso",
+                             "s2/chr3/B.miso", "s2/chr1/C.miso",
+                             "s2/chr1/E.miso"]
+        hash_pairs = list(ht.pair_samples_filenames(sample1_filenames,
+                                                    sample2_filenames))
+        self.assertEqual(hash_pairs,
+                         [("C", "s1/chr1/C.miso", "s2/chr1/C.miso"),
+                          ("A", "s1/chr1/A.miso", "s2/chr1/A.miso"),
+                          ("B", "s1/chr2/B.miso", "s2/chr2/B.miso")])
+        sorted_pairs = list(ht.pair_samples_filenames(sample1_filenames,
+                                                      sample2_filenames,
+                                                      join="sorted"))
+        self.assertEqual(sorted_pairs, sorted(hash_pairs))
+
+    def test_many_samples_comparison(self):
+        """
+        Test comparing every pair of several samples.
+        """
+        import numpy
+        import misopy.samples_store as samples_store
+        import misopy.hypothesis_test as ht
+
+        print "Testing many samples comparison..."
+        output_dir = self.tmp_dir
+        header = "isoforms=['A','B']\texon_lens=('A',100)\titers=5000\t" \
+                 "counts=(1,0):5\tassigned_counts=0:5\tchrom=chr1\t" \
+                 "strand=+\tmRNA_starts=1,1\tmRNA_ends=100,100"
+        sample_dirs = []
+        for sample_num, psi in enumerate([0.2, 0.5, 0.8]):
+            sample_dir = os.path.join(output_dir, "sample%d" %(sample_num))
+            os.makedirs(os.path.join(sample_dir, "chr1"))
+            # The last sample misses an event
+            for event_num in range(4 - sample_num / 2):
+                samples = numpy.random.dirichlet([psi * 50, (1 - psi) * 50],
+                                                 size=200)
+                samples_store.write_samples(os.path.join(sample_dir, "chr1"),
+                                            "EV%d" %(event_num), header,
+                                            samples, numpy.zeros(200))
+            samples_store.close_writers()
+            sample_dirs.append(sample_dir)
+        comparisons_dir = os.path.join(output_dir, "comparisons")
+        ht.output_many_samples_comparison(sample_dirs, comparisons_dir,
+                                          num_processors=2)
+        ht.output_samples_comparison(sample_dirs[0], sample_dirs[2],
+                                     os.path.join(output_dir, "pair"))
+        bf_filename = os.path.join("sample0_vs_sample2", "bayes-factors",
+                                   "sample0_vs_sample2.miso_bf")
+        bf_lines = open(os.path.join(comparisons_dir, bf_filename)).readlines()
+        self.assertEqual(len(bf_lines), 4)
+        self.assertEqual(bf_lines,
+                         open(os.path.join(output_dir, "pair",
+                                           bf_filename)).readlines())
+        self.assertTrue(os.path.isfile(os.path.join(comparisons_dir,
+                                                    "sample0_vs_sample1",
+                                                    "bayes-factors",
+                                                    "sample0_vs_sample1.miso_bf")))
+
+    def test_batch_bayes_factors(self):
+        """
+        Test that Bayes factors computed for many events at once
+        match those of fitted kernel densities.
+        """
+        import numpy
+        import misopy.hypothesis_test as ht
+
+        print "Testing batch Bayes factors..."
+        samples1_list = [numpy.random.dirichlet([alpha, 5, 3], size=500) \
+                         for alpha in [1, 5, 10, 20]]
+        samples2_list = [numpy.random.dirichlet([5, 5, 3], size=500) \
+                         for alpha in [1, 5, 10, 20]]
+        # Identical samples have a Bayes factor of 0
+        samples2_list[1] = samples1_list[1]
+        batch_bayes_factors = ht.compute_batch_bayes_factors(samples1_list,
+                                                             samples2_list)
+        diff_range = numpy.arange(-1, 1, 0.001)
+        for samples1, samples2, bayes_factors in zip(samples1_list,
+                                                     samples2_list,
+                                                     batch_bayes_factors):
+            header = ["#isoforms=['A','B','C']"]
+            # As returned by load_samples
+            samples1_results = (samples1, header, None, None, None, {})
+            samples2_results = (samples2, header, None, None, None, {})
+            densities = ht.compute_results_delta_densities(samples1_results,
+                                                           samples2_results,
+                                                           diff_range)
+            for bf, kde_bf in zip(bayes_factors, densities['bayes_factor']):
+                self.assertTrue(abs(bf - kde_bf) <= 1e-9 * abs(kde_bf))
+        self.assertEqual(list(batch_bayes_factors[1]), [0, 0, 0])
+
+    def test_sampler_batch(self):
+        """
+        Test that genes sampled in one batch get the samples they get
+        when sampled one at a time.
+        """
+        import re
+        import misopy.miso_sampler as miso
+        import misopy.run_miso as run_miso
+        import misopy.index_gff as index_gff
+        import misopy.gene_index as gene_index
+
+        print "Testing sampler batches..."
+        Settings.load(os.path.join(self.miso_path, "settings",
+                                   "miso_settings.txt"))
+        bam_filename = os.path.join(self.tests_output_dir, "sam-output",
+                                    "c2c12.Atp2b1.sorted.bam")
+        # Copies of a gene, with their own IDs
+        gff_filename = os.path.join(self.tmp_dir, "genes.gff")
+        gff_file = open(gff_filename, "w")
+        for copy_num in range(3):
+            for line in open(os.path.join(self.gff_events_dir, "mm9", "genes",
+                                          "Atp2b1.mm9.gff")):
+                if not line.startswith("#"):
+                    gff_file.write(re.sub(r"(ID|Parent)=(\w+)",
+                                          r"\1=\2_%d" %(copy_num), line))
+        gff_file.close()
+        index_dir = os.path.join(self.tmp_dir, "index")
+        index_gff.index_gff(gff_filename, index_dir)
+        index_filename = os.path.join(index_dir, gene_index.INDEX_FILENAME)
+        gene_ids = gene_index.GeneIndex(index_filename).keys()
+        one_dir = os.path.join(self.tmp_dir, "one")
+        for gene_id in gene_ids:
+            run_miso.compute_gene_psi([gene_id], index_filename, bam_filename,
+                                      one_dir, 35, 1)
+        batch_dir = os.path.join(self.tmp_dir, "batch")
+        sampler_batch = miso.SamplerBatch(num_threads=2)
+        run_miso.compute_gene_psi(gene_ids, index_filename, bam_filename,
+                                  batch_dir, 35, 1,
+                                  sampler_batch=sampler_batch)
+        self.assertEqual(len(sampler_batch.sampler_runs), 3)
+        sampler_batch.flush()
+        for gene_id in gene_ids:
+            miso_filename = os.path.join("10", "%s.miso" %(gene_id))
+            self.assertEqual(open(os.path.join(one_dir, miso_filename)).read(),
+                             open(os.path.join(batch_dir, miso_filename)).read())
+
+    def test_run_genes_failed_gene(self):
+        """
+        Test that a gene that fails does not stop the other genes of
+        a run.
+        """
+        import re
+        import misopy.run_miso as run_miso
+        import misopy.index_gff as index_gff
+        import misopy.gene_index as gene_index
+        import misopy.run_events_analysis as run_events_analysis
+
+        print "Testing runs with a failed gene..."
+        settings_filename = os.path.join(self.miso_path, "settings",
+                                         "miso_settings.txt")
+        Settings.load(settings_filename)
+        bam_filename = os.path.join(self.tests_output_dir, "sam-output",
+                                    "c2c12.Atp2b1.sorted.bam")
+        gff_filename = os.path.join(self.tmp_dir, "genes.gff")
+        gff_file = open(gff_filename, "w")
+        for copy_num in range(3):
+            for line in open(os.path.join(self.gff_events_dir, "mm9", "genes",
+                                          "Atp2b1.mm9.gff")):
+                if not line.startswith("#"):
+                    gff_file.write(re.sub(r"(ID|Parent)=(\w+)",
+                                          r"\1=\2_%d" %(copy_num), line))
+        gff_file.close()
+        index_dir = os.path.join(self.tmp_dir, "index")
+        index_gff.index_gff(gff_filename, index_dir)
+        index_filename = os.path.join(index_dir, gene_index.INDEX_FILENAME)
+        gene_ids = sorted(gene_index.GeneIndex(index_filename).keys())
+        bad_gene_id = gene_ids[1]
+        compute_gene_psi = run_miso.compute_gene_psi
+        def failing_compute_gene_psi(gene_ids, *args, **kwargs):
+            if bad_gene_id in gene_ids:
+                raise ValueError("Bad gene")
+            return compute_gene_psi(gene_ids, *args, **kwargs)
+        output_dir = os.path.join(self.tmp_dir, "output")
+        run_miso.compute_gene_psi = failing_compute_gene_psi
+        try:
+            failed_genes = \
+                run_events_analysis.run_genes_locally([(gene_id, index_filename)
+                                                       for gene_id in gene_ids],
+                                                      bam_filename, 35,
+                                                      output_dir,
+                                                      settings=settings_filename)
+        finally:
+            run_miso.compute_gene_psi = compute_gene_psi
+        self.assertEqual(failed_genes, [bad_gene_id])
+        for gene_id in gene_ids:
+            miso_filename = os.path.join(output_dir, "10", "%s.miso" %(gene_id))
+            self.assertEqual(os.path.isfile(miso_filename),
+                             gene_id != bad_gene_id)
+
+    def test_gene_block_jobs(self):
+        """
+        Test splitting genes into blocks of genes that are contiguous
+        on a chromosome.
+        """
+        import misopy.index_gff as index_gff
+        import misopy.gene_index as gene_index
+        import misopy.run_events_analysis as run_events_analysis
+
+        print "Testing blocks of genes..."
+        # Copies of a gene one after another on chr10, and a gene
+        # on chr17
+        gff_filename = os.path.join(self.tmp_dir, "genes.gff")
+        gff_file = open(gff_filename, "w")
+        for copy_num in range(7):
+            for line in open(os.path.join(self.gff_events_dir, "mm9", "genes",
+                                          "Atp2b1.mm9.gff")):
+                if line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                fields[3] = str(int(fields[3]) + copy_num * 200000)
+                fields[4] = str(int(fields[4]) + copy_num * 200000)
+                fields[8] = fields[8].replace("ENSMUS", "C%d_" %(copy_num))
+                gff_file.write("\t".join(fields))
+        gff_file.writelines([line for line in \
+                             open(os.path.join(self.miso_path, "sashimi_plot",
+                                               "test-data", "events.gff")) \
+                             if not line.startswith("#")])
+        gff_file.close()
+        index_dir = os.path.join(self.tmp_dir, "index")
+        index_gff.index_gff(gff_filename, index_dir)
+        index_filename = os.path.join(index_dir, gene_index.INDEX_FILENAME)
+        gff_genes = gene_index.GeneIndex(index_filename)
+        gene_jobs = [(gene_id, index_filename) for gene_id in gff_genes.keys()]
+        block_jobs = run_events_analysis.get_gene_block_jobs(gene_jobs, 3)
+        self.assertEqual(map(len, block_jobs), [3, 3, 1, 1])
+        self.assertEqual(sorted(sum(block_jobs, [])), sorted(gene_jobs))
+        chr10_genes = []
+        for block_job in block_jobs:
+            bounds = [gff_genes.get_gene_bounds(gene_id) \
+                      for gene_id, gff_index_filename in block_job]
+            self.assertEqual(len(set([chrom for chrom, start, end in bounds])), 1)
+            self.assertEqual(bounds, sorted(bounds))
+            if bounds[0][0] == "10":
+                chr10_genes.append(bounds)
+        # The blocks of chr10 are runs of consecutive genes
+        chr10_genes = sum(sorted(chr10_genes), [])
+        self.assertEqual(chr10_genes, sorted(chr10_genes))
+        self.assertEqual(len(chr10_genes), 7)
+
+    def test_sweep_bam_reads(self):
+        """
+        Test that one pass over a BAM file gives each gene the reads
+        a fetch of the gene gives.
+        """
+        import misopy.sam_utils as sam_utils
+
+        print "Testing BAM sweep..."
+        bam_filename = os.path.join(self.tests_output_dir, "sam-output",
+                                    "c2c12.Atp2b1.sorted.bam")
+        bamfile = sam_utils.load_bam_reads(bam_filename)
+        # Overlapping and nested genes, one without reads and one on
+        # a chromosome without reads
+        genes = [("A", "chr10", 98380000, 98400000),
+                 ("B", "chr10", 98390000, 98395000),
+                 ("C", "chr10", 98394000, 98460000),
+                 ("D", "chr10", 10000, 20000),
+                 ("E", "chrX", 10000, 20000)]
+        read_key = lambda read: (read.qname, read.pos, read.flag)
+        swept_reads = dict(sam_utils.sweep_bam_reads(bamfile, genes))
+        self.assertEqual(sorted(swept_reads.keys()), ["A", "B", "C", "D", "E"])
+        for gene_key, chrom, start, end in genes:
+            fetched_reads = sam_utils.fetch_bam_reads_in_gene(bamfile, chrom,
+                                                              start, end)
+            self.assertEqual(map(read_key, swept_reads[gene_key]),
+                             map(read_key, fetched_reads))
+        self.assertTrue(len(swept_reads["C"]) > 0)
+
+    def test_gene_index(self):
+        """
+        Test that genes read back from a gene index are the genes
+        that were indexed.
+        """
+        import misopy.Gene as gene_utils
+        import misopy.gff_utils as gff_utils
+        import misopy.gene_index as gene_index
+
+        print "Testing gene index..."
+        gff_filename = os.path.join(self.gff_events_dir, "mm9", "genes",
+                                    "Atp2b1.mm9.gff")
+        gff_genes = gene_utils.load_genes_from_gff(gff_filename)
+        output_dir = self.tmp_dir
+        index_filename = os.path.join(output_dir,
+                                      gene_index.INDEX_FILENAME)
+        gff_genes["ENSMUSG00000019943"]['compressed_id'] = "1"
+        gene_index.write_gene_index(gff_genes, index_filename)
+        self.assertEqual(gene_index.find_gene_index(output_dir),
+                         index_filename)
+        indexed_genes = gene_index.GeneIndex(index_filename)
+        self.assertEqual(indexed_genes.keys(), sorted(gff_genes.keys()))
+        self.assertFalse("ENSMUSG00000000000" in indexed_genes)
+        for gene_id, gene_info in gff_genes.iteritems():
+            gene_obj = gene_info['gene_object']
+            indexed_gene = indexed_genes[gene_id]
+            indexed_obj = indexed_gene['gene_object']
+            start, end = gff_utils.get_inclusive_txn_bounds(
+                gene_info['hierarchy'][gene_id])
+            self.assertEqual(indexed_genes.get_gene_bounds(gene_id),
+                             (gene_obj.chrom, start, end))
+            self.assertEqual(indexed_obj.isoform_desc,
+                             gene_obj.isoform_desc)
+            self.assertEqual([(p.start, p.end) for p in indexed_obj.parts],
+                             [(p.start, p.end) for p in gene_obj.parts])
+            self.assertEqual(indexed_gene['compressed_id'], "1")
+
+    def test_stream_gff_genes(self):
+        """
+        Test streaming the genes of a GFF file that is not sorted by
+        gene.
+        """
+        import misopy.Gene as gene_utils
+        import misopy.gff_utils as gff_utils
+
+        print "Testing streaming of GFF genes..."
+        gff_filename = os.path.join(self.gff_events_dir, "mm9", "genes",
+                                    "Atp2b1.mm9.gff")
+        self.assertTrue(gff_utils.is_sorted_by_gene(gff_filename))
+        output_dir = self.tmp_dir
+        # The same records, children before their parents
+        unsorted_filename = os.path.join(output_dir, "unsorted.gff")
+        unsorted_file = open(unsorted_filename, "w")
+        unsorted_file.writelines(reversed(open(gff_filename).readlines()))
+        unsorted_file.close()
+        self.assertFalse(gff_utils.is_sorted_by_gene(unsorted_filename))
+        gff_genes = gene_utils.load_genes_from_gff(gff_filename)
+        streamed_genes = \
+            list(gene_utils.iter_genes_from_gff(unsorted_filename))
+        self.assertEqual([gene[0] for gene in streamed_genes],
+                         gff_genes.keys())
+        for gene_id, gene_obj, gene_hierarchy in streamed_genes:
+            self.assertEqual(sorted(gene_obj.isoform_desc),
+                             sorted(gff_genes[gene_id]['gene_object'].isoform_desc))
+            self.assertEqual(sorted(gene_hierarchy[gene_id]['mRNAs'].keys()),
+                             sorted(gff_genes[gene_id]['hierarchy'][gene_id]['mRNAs'].keys()))
+
+    def test_gff_no_trailing_newline(self):
+        """
+        Test streaming, sorting and splitting a GFF file whose last
+        line has no newline.
+        """
+        import misopy.gff_utils as gff_utils
+
+        print "Testing GFF without a trailing newline..."
+        gff_filename = os.path.join(self.tmp_dir, "no_newline.gff")
+        gff_file = open(gff_filename, "w")
+        gff_file.write("chr1\tsrc\tgene\t100\t900\t.\t+\t.\tID=g1\n"
+                       "chr1\tsrc\tmRNA\t100\t900\t.\t+\t.\tID=t1;Parent=g1\n"
+                       "chr1\tsrc\texon\t100\t200\t.\t+\t.\tID=e1;Parent=t1\n"
+                       "chr1\tsrc\texon\t800\t900\t.\t+\t.\tID=e2;Parent=t1")
+        gff_file.close()
+        self.assertTrue(gff_utils.is_sorted_by_gene(gff_filename))
+        genes = list(gff_utils.iter_gff_genes(gff_filename))
+        self.assertEqual(len(genes), 1)
+        gene, gene_records, gene_hierarchy = genes[0]
+        # The mRNA and both exons
+        self.assertEqual(len(gene_records), 3)
+        self.assertEqual(sorted(gene_hierarchy["g1"]["mRNAs"]["t1"]["exons"].keys()),
+                         ["e1", "e2"])
+        sorted_filename = os.path.join(self.tmp_dir, "sorted.gff")
+        gff_utils.sort_gff_by_gene(gff_filename, sorted_filename)
+        sorted_lines = open(sorted_filename).readlines()
+        self.assertEqual(len(sorted_lines), 5)
+        self.assertEqual(sorted_lines[-1],
+                         "chr1\tsrc\texon\t800\t900\t.\t+\t.\tID=e2;Parent=t1\n")
+        chrom_filenames = gff_utils.split_gff_by_chrom(gff_filename,
+                                                       self.tmp_dir)
+        self.assertEqual(open(chrom_filenames[0][1]).readlines(),
+                         sorted_lines)
+
+    def test_index_gff_parallel(self):
+        """
+        Test that indexing a GFF by chromosome on several processors
+        gives the same gene index as indexing it serially.
+        """
+        import misopy.index_gff as index_gff
+        import misopy.gene_index as gene_index
+
+        print "Testing parallel GFF indexing..."
+        output_dir = self.tmp_dir
+        # Genes on two chromosomes
+        gff_filename = os.path.join(output_dir, "genes.gff")
+        gff_file = open(gff_filename, "w")
+        for filename in [os.path.join(self.gff_events_dir, "mm9", "genes",
+                                      "Atp2b1.mm9.gff"),
+                         os.path.join(self.miso_path, "sashimi_plot",
+                                      "test-data", "events.gff")]:
+            gff_file.writelines([line for line in open(filename) \
+                                 if not line.startswith("#")])
+        gff_file.close()
+        index_filenames = []
+        for num_processors in [1, 2]:
+            index_dir = os.path.join(output_dir, "index%d" %(num_processors))
+            index_gff.index_gff(gff_filename, index_dir,
+                                compress_id=True,
+                                num_processors=num_processors)
+            index_filenames.append(os.path.join(index_dir,
+                                                gene_index.INDEX_FILENAME))
+        self.assertEqual(len(gene_index.GeneIndex(index_filenames[1])), 2)
+        self.assertEqual(open(index_filenames[0], "rb").read(),
+                         open(index_filenames[1], "rb").read())
+
+    def test_gff_lazy_attributes(self):
+        """
+        Test that GFF records decode their attributes lazily as they
+        would all at once, and as the legacy reader does, and that
+        records pickled before they had slots still load.
+        """
+        import cPickle
+        from StringIO import StringIO
+        import misopy.gff_utils as gff_utils
+
+        print "Testing lazy GFF attributes..."
+        gff_text = "chr1\tsrc\texon\t200\t100\t.\t-\t.\t" \
+                   "Parent=t%3B1,t2;Note=a%2Cb;Bad=x=y;Parent=t3\n" \
+                   "chr1\tsrc\tmRNA\t100\t900\t0.5\t-\t.\tID=t3;Parent=g1\n"
+        lazy_recs = list(gff_utils.Reader(StringIO(gff_text)))
+        eager_recs = list(gff_utils.Reader(StringIO(gff_text),
+                                           lazy_attributes=False))
+        legacy_recs = list(gff_utils.LegacyReader(StringIO(gff_text)))
+        self.assertEqual(map(repr, legacy_recs), map(repr, eager_recs))
+        for lazy_rec, eager_rec in zip(lazy_recs, eager_recs):
+            self.assertEqual(lazy_rec.get_id(), eager_rec.get_id())
+            self.assertEqual(lazy_rec.get_parent(), eager_rec.get_parent())
+            self.assertEqual(lazy_rec.get_note(), eager_rec.get_note())
+            self.assertEqual(lazy_rec.attributes, eager_rec.attributes)
+            unpickled_rec = cPickle.loads(cPickle.dumps(lazy_rec, -1))
+            self.assertEqual(repr(unpickled_rec), repr(eager_rec))
+        exon_rec = lazy_recs[0]
+        self.assertEqual(exon_rec.get_id(), "t3@100@200@-")
+        self.assertEqual(exon_rec.get_values("Parent"), ["t3"])
+        self.assertEqual(exon_rec.get_note(), "a,b")
+        self.assertFalse("Bad" in exon_rec.attributes)
+
+        # A record pickled when GFF records had no slots
+        old_pickle = "(imisopy.gff_utils\nGFF\n(dp0\nS'seqid'\nS'chr1'\n" \
+                     "sS'source'\nS'src'\nsS'type'\nS'exon'\nsS'start'\nI1\n" \
+                     "sS'end'\nI100\nsS'score'\nNsS'strand'\nS'+'\n" \
+                     "sS'phase'\nNsS'attributes'\n(dp1\nS'ID'\n(lp2\n" \
+                     "S'e1'\nasS'Parent'\n(lp3\nS't1'\nassb."
+        old_rec = cPickle.loads(old_pickle)
+        self.assertEqual((old_rec.get_id(), old_rec.get_parent()),
+                         ("e1", "t1"))
+        self.assertEqual((old_rec.start, old_rec.end), (1, 100))
+
+    def test_query_region(self):
+        """
+        Test finding the genes overlapping a region, with a gene index
+        and with a pickled index.
+        """
+        import misopy.gff_utils as gff_utils
+        import misopy.index_gff as index_gff
+
+        print "Testing region queries..."
+        gff_filename = os.path.join(self.miso_path, "sashimi_plot",
+                                    "test-data", "events.gff")
+        gene_id = "chr17:45816186:45816265:-@chr17:45815912:45815950:-@" \
+                  "chr17:45814875:45814965:-"
+        output_dir = self.tmp_dir
+        index_dirs = [os.path.join(output_dir, "index"),
+                      os.path.join(output_dir, "pickle")]
+        index_gff.index_gff(gff_filename, index_dirs[0])
+        index_gff.index_gff(gff_filename, index_dirs[1],
+                            pickle_index=True)
+        for index_dir in index_dirs:
+            query = lambda chrom, start, end: \
+                    gff_utils.query_region(index_dir, chrom, start, end)
+            self.assertEqual(query("chr17", 45816265, 45900000), [gene_id])
+            self.assertEqual(query("chr17", 45000000, 45814875), [gene_id])
+            self.assertEqual(query("chr17", 45815000, 45815001), [gene_id])
+            self.assertEqual(query("chr17", 45816266, 45900000), [])
+            self.assertEqual(query("chr17", 1, 45814874), [])
+            self.assertEqual(query("chr1", 1, 100000000), [])
+
+    def test_query_region_long_gene(self):
+        """
+        Test region queries of a gene index with a gene that spans the
+        chromosome, which overlaps every region.
+        """
+        import random
+        import misopy.index_gff as index_gff
+        import misopy.gene_index as gene_index
+
+        print "Testing region queries with a long gene..."
+        gff_filename = os.path.join(self.tmp_dir, "genes.gff")
+        gff_file = open(gff_filename, "w")
+        gene_bounds = [("long", 1, 1000000)]
+        random.seed(1)
+        for gene_num in range(100):
+            start = random.randint(1, 990000)
+            gene_bounds.append(("g%d" %(gene_num), start,
+                                start + random.randint(0, 10000)))
+        for gene_id, start, end in gene_bounds:
+            gff_file.write("chr1\tsrc\tgene\t%d\t%d\t.\t+\t.\tID=%s\n" \
+                           %(start, end, gene_id))
+            # Genes need two isoforms
+            for mRNA_num in range(2):
+                mRNA_id = "%s.%d" %(gene_id, mRNA_num)
+                gff_file.write("chr1\tsrc\tmRNA\t%d\t%d\t.\t+\t.\t"
+                               "ID=%s;Parent=%s\n" %(start, end, mRNA_id,
+                                                      gene_id))
+                gff_file.write("chr1\tsrc\texon\t%d\t%d\t.\t+\t.\t"
+                               "ID=%s.e;Parent=%s\n" %(start, end, mRNA_id,
+                                                        mRNA_id))
+        gff_file.close()
+        index_dir = os.path.join(self.tmp_dir, "index")
+        index_gff.index_gff(gff_filename, index_dir)
+        gff_genes = gene_index.GeneIndex(os.path.join(index_dir,
+                                                      gene_index.INDEX_FILENAME))
+        self.assertEqual(len(gff_genes), len(gene_bounds))
+        for query_num in range(200):
+            start = random.randint(-1000, 1001000)
+            end = start + random.randint(0, 20000)
+            overlapping_genes = sorted([(gene_start, gene_end, gene_id)
+                                        for gene_id, gene_start, gene_end
+                                        in gene_bounds
+                                        if gene_start <= end and
+                                        gene_end >= start])
+            self.assertEqual(gff_genes.query_region("chr1", start, end),
+                             [gene_id for gene_start, gene_end, gene_id
+                              in overlapping_genes])
+
     def test_z_gene_psi(self):
         """
         Test gene-level Psi inferences using SAM/BAM reads.
@@ -90,6 +731,21 @@ class TestMISO(unittest.TestCase):
         print "Executing: %s" %(miso_cmd)
         os.system(miso_cmd)
 
+        # Run the same genes in-process with a pool of workers
+        multi_output_dir = os.path.join(self.tests_output_dir,
+                                        "gene-psi-output-multi")
+        miso_cmd = "%s --compute-genes-psi %s %s --output-dir %s --read-len %d " \
+                   "--num-processors 2" \
+                   %(self.events_analysis_cmd,
+                     gff_index_dir,
+                     bam_filename,
+                     multi_output_dir,
+                     read_len)
+        print "Executing: %s" %(miso_cmd)
+        os.system(miso_cmd)
+        assert(os.path.exists(os.path.join(multi_output_dir, "chr10",
+                                           "ENSMUSG00000019943.miso")))
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -6,11 +6,29 @@
 
 #include "splicing.h"
 
+/* The reads of a gene. The positions and CIGARs are either tuples (of
+   positions and CIGAR strings), or int32 buffers, e.g. NumPy arrays:
+   the positions, the CIGAR (operation, length) pairs and the offsets
+   of the reads' pairs. Buffers are used in place, without copying. */
+
+typedef struct pysplicing_reads_t {
+  splicing_vector_int_t position;
+  splicing_cigar_t cigar;
+  int buffers;
+  splicing_strvector_t cigarstr;
+  Py_buffer posbuf, pairsbuf, idxbuf;
+} pysplicing_reads_t;
+
 int pysplicing_to_vector_int(PyObject *pv, splicing_vector_int_t *v);
 int pysplicing_to_vector(PyObject *pv, splicing_vector_t *v);
+int pysplicing_to_matrix_transposed(PyObject *pm, splicing_matrix_t *m);
 int pysplicing_to_strvector(PyObject *pv, splicing_strvector_t *v);
+int pysplicing_to_reads(PyObject *readpos, PyObject *readcigar,
+			PyObject *cigaridx, pysplicing_reads_t *reads);
+void pysplicing_reads_destroy(pysplicing_reads_t *reads);
 int pysplicing_to_exons(PyObject *pex, splicing_vector_int_t *ex);
 int pysplicing_to_isoforms(PyObject *piso, splicing_vector_int_t *iso);
+int pysplicing_to_seed(PyObject *pseed, unsigned long int *seed);
 
 PyObject *pysplicing_from_vector(const splicing_vector_t *v);
 PyObject *pysplicing_from_vector_int(const splicing_vector_int_t *v);
@@ -13,3 +13,11 @@ MISO_STOP_CONVERGENT_MEAN=1L
 # original
 #MISO_STOP_FIXEDNO=0L
 #MISO_STOP_CONVERGENT_MEAN=1L
+
+# stop once the split R-hat and the effective sample size reach
+# their targets (see the checkEvery, minEss and maxRhat arguments)
+MISO_STOP_RHAT_ESS=2L
+
+# how new PSI values are proposed
+MISO_PROPOSAL_DRIFT=0L
+MISO_PROPOSAL_GIBBS=1L
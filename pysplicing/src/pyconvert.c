@@ -37,6 +37,37 @@ int pysplicing_to_vector(PyObject *pv, splicing_vector_t *v) {
   return 0;
 }
 
+/* A tuple of rows, e.g. the class templates returned by MISO, each
+   row becomes a column of the matrix */
+
+int pysplicing_to_matrix_transposed(PyObject *pm, splicing_matrix_t *m) {
+  int i, j, nrow, ncol=0;
+
+  if (!PyTuple_Check(pm)) {
+    PyErr_SetString(PyExc_TypeError, "Need a tuple");
+    return 1;
+  }
+
+  nrow=PyTuple_Size(pm);
+  for (i=0; i<nrow; i++) {
+    PyObject *r=PyTuple_GetItem(pm, i);
+    if (!PyTuple_Check(r) || (i > 0 && PyTuple_Size(r) != ncol)) {
+      PyErr_SetString(PyExc_TypeError, "Need a tuple of equal length tuples");
+      return 1;
+    }
+    ncol=PyTuple_Size(r);
+  }
+  splicing_matrix_init(m, ncol, nrow);
+  for (i=0; i<nrow; i++) {
+    PyObject *r=PyTuple_GetItem(pm, i);
+    for (j=0; j<ncol; j++) {
+      MATRIX(*m, j, i)=PyFloat_AsDouble(PyTuple_GetItem(r, j));
+    }
+  }
+
+  return 0;
+}
+
 int pysplicing_to_strvector(PyObject *pv, splicing_strvector_t *v) {
   int i, n;
 
@@ -56,6 +87,91 @@ int pysplicing_to_strvector(PyObject *pv, splicing_strvector_t *v) {
   return 0;
 }
 
+static int pysplicing_i_get_int_buffer(PyObject *obj, Py_buffer *buf,
+				       const char *what) {
+  const char *format;
+
+  if (PyObject_GetBuffer(obj, buf, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT)) {
+    return 1;
+  }
+  format = buf->format ? buf->format + strlen(buf->format) - 1 : "B";
+  if (buf->itemsize != sizeof(int) || (*format != 'i' && *format != 'l')) {
+    PyErr_Format(PyExc_TypeError, "Need an int32 array for %s", what);
+    PyBuffer_Release(buf);
+    return 1;
+  }
+  return 0;
+}
+
+int pysplicing_to_reads(PyObject *readpos, PyObject *readcigar,
+			PyObject *cigaridx, pysplicing_reads_t *reads) {
+  int i, noreads, nopairs;
+  const int *idx;
+
+  /* Destroying works after a failed conversion, too */
+  memset(reads, 0, sizeof(pysplicing_reads_t));
+  reads->buffers = cigaridx && cigaridx != Py_None;
+
+  if (!reads->buffers) {
+    if (pysplicing_to_vector_int(readpos, &reads->position)) { return 1; }
+    if (pysplicing_to_strvector(readcigar, &reads->cigarstr)) {
+      splicing_vector_int_destroy(&reads->position);
+      return 1;
+    }
+    splicing_cigar_str(&reads->cigar, (const char**) reads->cigarstr.table);
+    return 0;
+  }
+
+  /* The buffers are used in place, they are released in
+     pysplicing_reads_destroy() */
+  if (pysplicing_i_get_int_buffer(readpos, &reads->posbuf, "readpos")) {
+    return 1;
+  }
+  if (pysplicing_i_get_int_buffer(readcigar, &reads->pairsbuf, "readcigar")) {
+    pysplicing_reads_destroy(reads);
+    return 1;
+  }
+  if (pysplicing_i_get_int_buffer(cigaridx, &reads->idxbuf, "cigarIdx")) {
+    pysplicing_reads_destroy(reads);
+    return 1;
+  }
+
+  noreads = reads->posbuf.len / sizeof(int);
+  nopairs = reads->pairsbuf.len / sizeof(int) / 2;
+  idx = reads->idxbuf.buf;
+  if (reads->pairsbuf.len % (2 * sizeof(int)) != 0 ||
+      reads->idxbuf.len / sizeof(int) != noreads + 1 || idx[0] != 0 ||
+      idx[noreads] != nopairs) {
+    PyErr_SetString(PyExc_ValueError, "Need (operation, length) pairs and "
+		    "one CIGAR offset per read, plus one");
+    pysplicing_reads_destroy(reads);
+    return 1;
+  }
+  for (i=0; i<noreads; i++) {
+    if (idx[i] > idx[i+1]) {
+      PyErr_SetString(PyExc_ValueError, "CIGAR offsets must be increasing");
+      pysplicing_reads_destroy(reads);
+      return 1;
+    }
+  }
+
+  splicing_vector_int_view(&reads->position, reads->posbuf.buf, noreads);
+  splicing_cigar_pairs(&reads->cigar, reads->pairsbuf.buf, idx);
+
+  return 0;
+}
+
+void pysplicing_reads_destroy(pysplicing_reads_t *reads) {
+  if (reads->buffers) {
+    PyBuffer_Release(&reads->posbuf);
+    PyBuffer_Release(&reads->pairsbuf);
+    PyBuffer_Release(&reads->idxbuf);
+  } else {
+    splicing_vector_int_destroy(&reads->position);
+    splicing_strvector_destroy(&reads->cigarstr);
+  }
+}
+
 int pysplicing_to_exons(PyObject *pex, splicing_vector_int_t *ex) {
   int i, p, noexons=PyTuple_Size(pex);
   splicing_vector_int_init(ex, noexons*2);
@@ -88,6 +204,26 @@ int pysplicing_to_isoforms(PyObject *piso, splicing_vector_int_t *iso) {
   return 0;
 }
 
+int pysplicing_to_seed(PyObject *pseed, unsigned long int *seed) {
+  
+  /* No seed, draw one from the default (i.e. Python's) RNG */
+  if (!pseed || pseed == Py_None) {
+    *seed = RNG_INT31();
+    return 0;
+  }
+
+  if (PyInt_Check(pseed)) {
+    *seed = PyInt_AsUnsignedLongMask(pseed);
+  } else if (PyLong_Check(pseed)) {
+    *seed = PyLong_AsUnsignedLongMask(pseed);
+  } else {
+    PyErr_SetString(PyExc_TypeError, "Need an integer seed or None");
+    return 1;
+  }
+
+  return 0;
+}
+
 PyObject *pysplicing_from_vector(const splicing_vector_t *v) {
   int i, n=splicing_vector_size(v);
   PyObject *o=PyTuple_New(n);
@@ -172,12 +308,14 @@ PyObject *pysplicing_from_vector_int_index(const splicing_vector_int_t *v,
 }
 
 PyObject *pysplicing_from_miso_rundata(const splicing_miso_rundata_t *data) {
-  PyObject *o=PyTuple_New(6);
+  PyObject *o=PyTuple_New(8);
   PyTuple_SetItem(o, 0, PyInt_FromLong(data->noIso));
   PyTuple_SetItem(o, 1, PyInt_FromLong(data->noIters));
   PyTuple_SetItem(o, 2, PyInt_FromLong(data->noBurnIn));
   PyTuple_SetItem(o, 3, PyInt_FromLong(data->noLag));
   PyTuple_SetItem(o, 4, PyInt_FromLong(data->noAccepted));
   PyTuple_SetItem(o, 5, PyInt_FromLong(data->noRejected));
+  PyTuple_SetItem(o, 6, PyFloat_FromDouble(data->rhat));
+  PyTuple_SetItem(o, 7, PyFloat_FromDouble(data->ess));
   return o;
 }
@@ -18,15 +18,20 @@ void splicingmodule_splicing_warning_hook(const char *reason,
 					  const char *file,
 					  int line, int splicing_errno) {
   char buf[4096];
+  PyGILState_STATE gstate;
   snprintf(buf, sizeof(buf)/sizeof(char)-1, 
 	   "%s at %s:%i", reason, file, line);
+  /* We might be called from a sampler that released the GIL */
+  gstate = PyGILState_Ensure();
   PyErr_Warn(PyExc_RuntimeWarning, buf);
+  PyGILState_Release(gstate);
 }
 
 void splicingmodule_splicing_error_hook(const char *reason, const char *file,
 					int line, int splicing_errno) {
   char buf[4096];
   PyObject *exc = splicingmodule_InternalError;
+  PyGILState_STATE gstate;
 
   if (splicing_errno == SPLICING_UNIMPLEMENTED)
       exc = PyExc_NotImplementedError;
@@ -40,6 +45,8 @@ void splicingmodule_splicing_error_hook(const char *reason, const char *file,
   SPLICING_FINALLY_FREE();
 
   /* make sure we are not masking already thrown exceptions */
+  gstate = PyGILState_Ensure();
   if (!PyErr_Occurred())
     PyErr_SetString(exc, buf);
+  PyGILState_Release(gstate);
 }
@@ -3,6 +3,8 @@
 #include <structmember.h>
 
 #include <stdio.h>
+#include <string.h>
+#include <pthread.h>
 
 #include "splicing.h"
 #include "pysplicing.h"
@@ -38,17 +40,27 @@ static PyObject* pysplicing_read_gff(PyObject *self, PyObject *args) {
   return PyCObject_FromVoidPtr(gff, splicing_gff_destroy2);
 }
 
-static PyObject* pysplicing_miso(PyObject *self, PyObject *args) {
-  PyObject *gff, *readpos, *readcigar, *hyperp=0;
+static PyObject* pysplicing_miso(PyObject *self, PyObject *args,
+				 PyObject *kwds) {
+  static char *kwlist[] = { "gff", "gene", "readpos", "readcigar", 
+			    "readLength", "noIterations", "noBurnIn", 
+			    "noLag", "hyperp", "overhang", "noChains",
+			    "start", "stop", "seed", "proposal", 
+			    "checkEvery", "minEss", "maxRhat", "noThreads",
+			    "cigarIdx", NULL };
+  PyObject *gff, *readpos, *readcigar, *cigaridx=0, *hyperp=0, *seed=0;
   int gene, readLength, noIterations=5000, maxIterations=100000, 
     noBurnIn=500, noLag=10;
   int overhang=1;
   int no_chains=6;
   splicing_miso_start_t start=SPLICING_MISO_START_AUTO;
   splicing_miso_stop_t stop=SPLICING_MISO_STOP_CONVERGENT_MEAN;
+  splicing_miso_proposal_t proposal=SPLICING_MISO_PROPOSAL_DRIFT;
+  int checkEvery=100;
+  double minEss=200.0, maxRhat=1.05;
+  int noThreads=1;
   splicing_gff_t *mygff;
-  splicing_strvector_t myreadcigar;
-  splicing_vector_int_t myreadpos;
+  pysplicing_reads_t myreads;
   splicing_vector_t myhyperp;
   splicing_matrix_t samples;
   splicing_vector_t logLik;
@@ -56,14 +68,21 @@ static PyObject* pysplicing_miso(PyObject *self, PyObject *args) {
   splicing_vector_t class_counts;
   splicing_vector_int_t assignment;
   splicing_miso_rundata_t rundata;
+  splicing_rng_t rng;
+  unsigned long int myseed;
+  int ret;
   PyObject *r1, *r2, *r3, *r4, *r5, *r6;
   
-  if (!PyArg_ParseTuple(args, "OiOOi|iiiOiiii", 
-			&gff, &gene, &readpos, &readcigar,
-			&readLength, &noIterations, &noBurnIn, &noLag, 
-			&hyperp, &overhang, &no_chains, &start, &stop)) { 
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OiOOi|iiiOiiiiOiiddiO", 
+				   kwlist, &gff, &gene, &readpos, &readcigar,
+				   &readLength, &noIterations, &noBurnIn, 
+				   &noLag, &hyperp, &overhang, &no_chains,
+				   &start, &stop, &seed, &proposal,
+				   &checkEvery, &minEss, &maxRhat, 
+				   &noThreads, &cigaridx)) { 
     return NULL; 
   }
+  if (pysplicing_to_seed(seed, &myseed)) { return NULL; }
   
   mygff=PyCObject_AsVoidPtr(gff);
 
@@ -77,8 +96,10 @@ static PyObject* pysplicing_miso(PyObject *self, PyObject *args) {
   SPLICING_FINALLY(splicing_vector_destroy, &class_counts);
   SPLICING_PYCHECK(splicing_vector_int_init(&assignment, 0));
   SPLICING_FINALLY(splicing_vector_int_destroy, &assignment);
-  if (pysplicing_to_vector_int(readpos, &myreadpos)) { return NULL; }
-  SPLICING_FINALLY(splicing_vector_int_destroy, &myreadpos);
+  if (pysplicing_to_reads(readpos, readcigar, cigaridx, &myreads)) {
+    return NULL;
+  }
+  SPLICING_FINALLY(pysplicing_reads_destroy, &myreads);
   if (hyperp) { 
     if (pysplicing_to_vector(hyperp, &myhyperp)) { return NULL; }
     SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
@@ -89,22 +110,242 @@ static PyObject* pysplicing_miso(PyObject *self, PyObject *args) {
     SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
     for (i=0; i<noiso; i++) { VECTOR(myhyperp)[i] = 1.0; }
   }
-  if (pysplicing_to_strvector(readcigar, &myreadcigar)) { return NULL; };
-  SPLICING_FINALLY(splicing_strvector_destroy, &myreadcigar);
+
+  /* Each call samples from its own RNG. Unless a seed was given, it
+     is seeded from the Python RNG. */
+  SPLICING_PYCHECK(splicing_rng_init(&rng, &splicing_rngtype_mt19937));
+  SPLICING_FINALLY(splicing_rng_destroy, &rng);
+  SPLICING_PYCHECK(splicing_rng_seed(&rng, myseed));
+
+  /* The sampler does not touch Python objects, so other Python
+     threads can run meanwhile */
+  Py_BEGIN_ALLOW_THREADS
+  ret = splicing_miso(mygff, gene, &myreads.position, &myreads.cigar,
+		      readLength, overhang, no_chains,
+		      noIterations, maxIterations, 
+		      noBurnIn, noLag,
+		      &myhyperp, start, stop, checkEvery, minEss, maxRhat,
+		      proposal, noThreads, 0, &rng,
+		      &samples, &logLik, 
+		      /*match_matrix=*/ 0, &class_templates,
+		      &class_counts, &assignment, &rundata);
+  Py_END_ALLOW_THREADS
+  SPLICING_PYCHECK(ret);
+
+  splicing_rng_destroy(&rng);
+  splicing_vector_destroy(&myhyperp);
+  pysplicing_reads_destroy(&myreads);
+  SPLICING_FINALLY_CLEAN(3);
+  
+  r6=pysplicing_from_miso_rundata(&rundata);
+
+  r5=pysplicing_from_vector_int(&assignment);
+  splicing_vector_int_destroy(&assignment); SPLICING_FINALLY_CLEAN(1);
+
+  r4=pysplicing_from_vector(&class_counts);
+  splicing_vector_destroy(&class_counts); SPLICING_FINALLY_CLEAN(1);
+
+  splicing_matrix_transpose(&class_templates);
+  r3=pysplicing_from_matrix(&class_templates);
+  splicing_matrix_destroy(&class_templates); SPLICING_FINALLY_CLEAN(1);
+
+  r2=pysplicing_from_vector(&logLik);
+  splicing_vector_destroy(&logLik); SPLICING_FINALLY_CLEAN(1);
+
+  r1=pysplicing_from_matrix(&samples);
+  splicing_matrix_destroy(&samples); SPLICING_FINALLY_CLEAN(1);
   
-  SPLICING_PYCHECK(splicing_miso(mygff, gene, &myreadpos, 
-				 (const char**) myreadcigar.table, 
-				 readLength, overhang, no_chains,
-				 noIterations, maxIterations, 
-				 noBurnIn, noLag,
-				 &myhyperp, start, stop, 0,
-				 &samples, &logLik, 
-				 /*match_matrix=*/ 0, &class_templates,
-				 &class_counts, &assignment, &rundata));
+  return Py_BuildValue("OOOOOO", r1, r2, r3, r4, r5, r6);
+}
+
+/* MISO on the read classes of a gene, as returned by MISO() */
+
+static PyObject* pysplicing_miso_classes(PyObject *self, PyObject *args,
+					 PyObject *kwds) {
+  static char *kwlist[] = { "gff", "gene", "classTemplates", 
+			    "classCounts", "readLength", "noIterations", 
+			    "noBurnIn", "noLag", "hyperp", "overhang", 
+			    "noChains", "start", "stop", "seed", "proposal", 
+			    "checkEvery", "minEss", "maxRhat", "noThreads",
+			    NULL };
+  PyObject *gff, *classtempl, *classcounts, *hyperp=0, *seed=0;
+  int gene, readLength, noIterations=5000, maxIterations=100000, 
+    noBurnIn=500, noLag=10;
+  int overhang=1;
+  int no_chains=6;
+  splicing_miso_start_t start=SPLICING_MISO_START_AUTO;
+  splicing_miso_stop_t stop=SPLICING_MISO_STOP_CONVERGENT_MEAN;
+  splicing_miso_proposal_t proposal=SPLICING_MISO_PROPOSAL_DRIFT;
+  int checkEvery=100;
+  double minEss=200.0, maxRhat=1.05;
+  int noThreads=1;
+  splicing_gff_t *mygff;
+  splicing_matrix_t myclasstempl;
+  splicing_vector_t myclasscounts;
+  splicing_vector_t myhyperp;
+  splicing_matrix_t samples;
+  splicing_vector_t logLik;
+  splicing_vector_int_t assignment;
+  splicing_miso_rundata_t rundata;
+  splicing_rng_t rng;
+  unsigned long int myseed;
+  int ret;
+  PyObject *r1, *r2, *r3, *r4;
+  
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OiOOi|iiiOiiiiOiiddi", 
+				   kwlist, &gff, &gene, &classtempl, 
+				   &classcounts, &readLength, &noIterations,
+				   &noBurnIn, &noLag, &hyperp, &overhang, 
+				   &no_chains, &start, &stop, &seed, 
+				   &proposal, &checkEvery, &minEss, &maxRhat,
+				   &noThreads)) { 
+    return NULL; 
+  }
+  if (pysplicing_to_seed(seed, &myseed)) { return NULL; }
+  
+  mygff=PyCObject_AsVoidPtr(gff);
+
+  SPLICING_PYCHECK(splicing_matrix_init(&samples, 0, 0));
+  SPLICING_FINALLY(splicing_matrix_destroy, &samples);
+  SPLICING_PYCHECK(splicing_vector_init(&logLik, 0));
+  SPLICING_FINALLY(splicing_vector_destroy, &logLik);
+  SPLICING_PYCHECK(splicing_vector_int_init(&assignment, 0));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &assignment);
+  if (pysplicing_to_matrix_transposed(classtempl, &myclasstempl)) { 
+    return NULL; 
+  }
+  SPLICING_FINALLY(splicing_matrix_destroy, &myclasstempl);
+  if (pysplicing_to_vector(classcounts, &myclasscounts)) { return NULL; }
+  SPLICING_FINALLY(splicing_vector_destroy, &myclasscounts);
+  if (hyperp) { 
+    if (pysplicing_to_vector(hyperp, &myhyperp)) { return NULL; }
+    SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
+  } else {
+    size_t i, noiso;
+    SPLICING_PYCHECK(splicing_gff_noiso_one(mygff, gene, &noiso));
+    SPLICING_PYCHECK(splicing_vector_init(&myhyperp, noiso));
+    SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
+    for (i=0; i<noiso; i++) { VECTOR(myhyperp)[i] = 1.0; }
+  }
+  /* A gene without reads has no classes */
+  if (splicing_vector_size(&myclasscounts) == 0) {
+    size_t noiso;
+    SPLICING_PYCHECK(splicing_gff_noiso_one(mygff, gene, &noiso));
+    SPLICING_PYCHECK(splicing_matrix_resize(&myclasstempl, noiso, 0));
+  }
 
+  SPLICING_PYCHECK(splicing_rng_init(&rng, &splicing_rngtype_mt19937));
+  SPLICING_FINALLY(splicing_rng_destroy, &rng);
+  SPLICING_PYCHECK(splicing_rng_seed(&rng, myseed));
+
+  Py_BEGIN_ALLOW_THREADS
+  ret = splicing_miso_classes(mygff, gene, &myclasstempl, &myclasscounts,
+			      readLength, overhang, no_chains,
+			      noIterations, maxIterations, 
+			      noBurnIn, noLag,
+			      &myhyperp, start, stop, checkEvery, minEss, 
+			      maxRhat, proposal, noThreads, 0, &rng,
+			      &samples, &logLik, &assignment, &rundata);
+  Py_END_ALLOW_THREADS
+  SPLICING_PYCHECK(ret);
+
+  splicing_rng_destroy(&rng);
   splicing_vector_destroy(&myhyperp);
-  splicing_vector_int_destroy(&myreadpos);
-  splicing_strvector_destroy(&myreadcigar);
+  splicing_vector_destroy(&myclasscounts);
+  splicing_matrix_destroy(&myclasstempl);
+  SPLICING_FINALLY_CLEAN(4);
+  
+  r4=pysplicing_from_miso_rundata(&rundata);
+
+  r3=pysplicing_from_vector_int(&assignment);
+  splicing_vector_int_destroy(&assignment); SPLICING_FINALLY_CLEAN(1);
+
+  r2=pysplicing_from_vector(&logLik);
+  splicing_vector_destroy(&logLik); SPLICING_FINALLY_CLEAN(1);
+
+  r1=pysplicing_from_matrix(&samples);
+  splicing_matrix_destroy(&samples); SPLICING_FINALLY_CLEAN(1);
+  
+  return Py_BuildValue("OOOO", r1, r2, r3, r4);
+}
+
+static PyObject* pysplicing_miso_vb(PyObject *self, PyObject *args,
+				    PyObject *kwds) {
+  static char *kwlist[] = { "gff", "gene", "readpos", "readcigar", 
+			    "readLength", "noSamples", "hyperp", "overhang",
+			    "maxIterations", "tolerance", "seed", "cigarIdx",
+			    NULL };
+  PyObject *gff, *readpos, *readcigar, *cigaridx=0, *hyperp=0, *seed=0;
+  int gene, readLength, noSamples=1000, maxIterations=1000;
+  int overhang=1;
+  double tolerance=1e-6;
+  splicing_gff_t *mygff;
+  pysplicing_reads_t myreads;
+  splicing_vector_t myhyperp;
+  splicing_matrix_t samples;
+  splicing_vector_t logLik;
+  splicing_matrix_t class_templates;
+  splicing_vector_t class_counts;
+  splicing_vector_int_t assignment;
+  splicing_miso_rundata_t rundata;
+  splicing_rng_t rng;
+  unsigned long int myseed;
+  int ret;
+  PyObject *r1, *r2, *r3, *r4, *r5, *r6;
+  
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OiOOi|iOiidOO", kwlist,
+				   &gff, &gene, &readpos, &readcigar,
+				   &readLength, &noSamples, &hyperp, 
+				   &overhang, &maxIterations, &tolerance,
+				   &seed, &cigaridx)) { 
+    return NULL; 
+  }
+  if (pysplicing_to_seed(seed, &myseed)) { return NULL; }
+  
+  mygff=PyCObject_AsVoidPtr(gff);
+
+  SPLICING_PYCHECK(splicing_matrix_init(&samples, 0, 0));
+  SPLICING_FINALLY(splicing_matrix_destroy, &samples);
+  SPLICING_PYCHECK(splicing_vector_init(&logLik, 0));
+  SPLICING_FINALLY(splicing_vector_destroy, &logLik);
+  SPLICING_PYCHECK(splicing_matrix_init(&class_templates, 0, 0));
+  SPLICING_FINALLY(splicing_matrix_destroy, &class_templates);
+  SPLICING_PYCHECK(splicing_vector_init(&class_counts, 0));
+  SPLICING_FINALLY(splicing_vector_destroy, &class_counts);
+  SPLICING_PYCHECK(splicing_vector_int_init(&assignment, 0));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &assignment);
+  if (pysplicing_to_reads(readpos, readcigar, cigaridx, &myreads)) {
+    return NULL;
+  }
+  SPLICING_FINALLY(pysplicing_reads_destroy, &myreads);
+  if (hyperp) { 
+    if (pysplicing_to_vector(hyperp, &myhyperp)) { return NULL; }
+    SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
+  } else {
+    size_t i, noiso;
+    SPLICING_PYCHECK(splicing_gff_noiso_one(mygff, gene, &noiso));
+    SPLICING_PYCHECK(splicing_vector_init(&myhyperp, noiso));
+    SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
+    for (i=0; i<noiso; i++) { VECTOR(myhyperp)[i] = 1.0; }
+  }
+
+  SPLICING_PYCHECK(splicing_rng_init(&rng, &splicing_rngtype_mt19937));
+  SPLICING_FINALLY(splicing_rng_destroy, &rng);
+  SPLICING_PYCHECK(splicing_rng_seed(&rng, myseed));
+
+  Py_BEGIN_ALLOW_THREADS
+  ret = splicing_miso_vb(mygff, gene, &myreads.position, &myreads.cigar,
+			 readLength, overhang, noSamples, maxIterations,
+			 tolerance, &myhyperp, &rng, &samples, &logLik,
+			 /*resalpha=*/ 0, /*match_matrix=*/ 0, 
+			 &class_templates, &class_counts, &assignment,
+			 &rundata);
+  Py_END_ALLOW_THREADS
+  SPLICING_PYCHECK(ret);
+
+  splicing_rng_destroy(&rng);
+  splicing_vector_destroy(&myhyperp);
+  pysplicing_reads_destroy(&myreads);
   SPLICING_FINALLY_CLEAN(3);
   
   r6=pysplicing_from_miso_rundata(&rundata);
@@ -147,18 +388,26 @@ static PyObject* pysplicing_write_gff(PyObject *self, PyObject *args) {
   Py_RETURN_NONE;
 }
 
-static PyObject* pysplicing_miso_paired(PyObject *self, PyObject*args) {
-  PyObject *gff, *readpos, *readcigar, *hyperp=0;
+static PyObject* pysplicing_miso_paired(PyObject *self, PyObject *args,
+					PyObject *kwds) {
+  static char *kwlist[] = { "gff", "gene", "readpos", "readcigar", 
+			    "readLength", "normalMean", "normalVar", 
+			    "numDevs", "noIterations", "noBurnIn", 
+			    "noLag", "hyperp", "overhang", "noChains",
+			    "start", "stop", "seed", "checkEvery", "minEss",
+			    "maxRhat", "cigarIdx", NULL };
+  PyObject *gff, *readpos, *readcigar, *cigaridx=0, *hyperp=0, *seed=0;
   int gene, readLength, noIterations=5000, maxIterations=100000, 
     noBurnIn=500, noLag=10;
   int overhang=1;
   int no_chains=6;
   splicing_miso_start_t start=SPLICING_MISO_START_AUTO;
   splicing_miso_stop_t stop=SPLICING_MISO_STOP_CONVERGENT_MEAN;
+  int checkEvery=100;
+  double minEss=200.0, maxRhat=1.05;
   double normalMean, normalVar, numDevs;
   splicing_gff_t *mygff;
-  splicing_strvector_t myreadcigar;
-  splicing_vector_int_t myreadpos;
+  pysplicing_reads_t myreads;
   splicing_vector_t myhyperp;
   splicing_matrix_t samples;
   splicing_vector_t logLik;
@@ -166,14 +415,22 @@ static PyObject* pysplicing_miso_paired(PyObject *self, PyObject*args) {
   splicing_vector_t bin_class_counts;
   splicing_vector_int_t assignment;
   splicing_miso_rundata_t rundata;
+  splicing_rng_t rng;
+  unsigned long int myseed;
+  int ret;
   PyObject *r1, *r2, *r3, *r4, *r5, *r6;
   
-  if (!PyArg_ParseTuple(args, "OiOOiddd|iiiOiiii", &gff, &gene, &readpos, 
-			&readcigar, &readLength, &normalMean, &normalVar,
-			&numDevs, &noIterations, &noBurnIn, &noLag,
-			&hyperp, &overhang, &no_chains, &start, &stop)) { 
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OiOOiddd|iiiOiiiiOiddO", 
+				   kwlist, &gff, &gene, &readpos, 
+				   &readcigar, &readLength, &normalMean, 
+				   &normalVar, &numDevs, &noIterations, 
+				   &noBurnIn, &noLag, &hyperp, &overhang,
+				   &no_chains, &start, &stop, &seed,
+				   &checkEvery, &minEss, &maxRhat,
+				   &cigaridx)) { 
     return NULL; 
   }
+  if (pysplicing_to_seed(seed, &myseed)) { return NULL; }
 
   mygff=PyCObject_AsVoidPtr(gff);
   
@@ -188,8 +445,10 @@ static PyObject* pysplicing_miso_paired(PyObject *self, PyObject*args) {
   SPLICING_PYCHECK(splicing_vector_int_init(&assignment, 0));
   SPLICING_FINALLY(splicing_vector_int_destroy, &assignment);
   
-  if (pysplicing_to_vector_int(readpos, &myreadpos)) { return NULL; }
-  SPLICING_FINALLY(splicing_vector_int_destroy, &myreadpos);
+  if (pysplicing_to_reads(readpos, readcigar, cigaridx, &myreads)) {
+    return NULL;
+  }
+  SPLICING_FINALLY(pysplicing_reads_destroy, &myreads);
   
   if (hyperp) { 
     if (pysplicing_to_vector(hyperp, &myhyperp)) { return NULL; }
@@ -201,23 +460,30 @@ static PyObject* pysplicing_miso_paired(PyObject *self, PyObject*args) {
     SPLICING_FINALLY(splicing_vector_destroy, &myhyperp);
     for (i=0; i<noiso; i++) { VECTOR(myhyperp)[i] = 1.0; }
   }
-  if (pysplicing_to_strvector(readcigar, &myreadcigar)) { return NULL; }
-  SPLICING_FINALLY(splicing_strvector_destroy, &myreadcigar);
-  
-  splicing_miso_paired(mygff, gene, &myreadpos,
-		       (const char**) myreadcigar.table, readLength,
-		       overhang, no_chains, noIterations, 
-		       maxIterations, noBurnIn, noLag, &myhyperp, 
-		       start, stop, /*start_psi=*/ 0,
-		       /*insertProb=*/ 0, /*insertStart=*/ 0,
-		       normalMean, normalVar, numDevs, &samples, &logLik,
-		       /*match_matrix=*/ 0, /*class_templates=*/ 0, 
-		       /*class_counts=*/ 0, &bin_class_templates, 
-		       &bin_class_counts, &assignment, &rundata);
-  
+
+  SPLICING_PYCHECK(splicing_rng_init(&rng, &splicing_rngtype_mt19937));
+  SPLICING_FINALLY(splicing_rng_destroy, &rng);
+  SPLICING_PYCHECK(splicing_rng_seed(&rng, myseed));
+  
+  Py_BEGIN_ALLOW_THREADS
+  ret = splicing_miso_paired(mygff, gene, &myreads.position,
+			     &myreads.cigar, readLength,
+			     overhang, no_chains, noIterations, 
+			     maxIterations, noBurnIn, noLag, &myhyperp, 
+			     start, stop, checkEvery, minEss, maxRhat,
+			     /*start_psi=*/ 0,
+			     /*insertProb=*/ 0, /*insertStart=*/ 0,
+			     normalMean, normalVar, numDevs, &rng,
+			     &samples, &logLik,
+			     /*match_matrix=*/ 0, /*class_templates=*/ 0, 
+			     /*class_counts=*/ 0, &bin_class_templates, 
+			     &bin_class_counts, &assignment, &rundata);
+  Py_END_ALLOW_THREADS
+  SPLICING_PYCHECK(ret);
+  
+  splicing_rng_destroy(&rng);
   splicing_vector_destroy(&myhyperp);
-  splicing_vector_int_destroy(&myreadpos);
-  splicing_strvector_destroy(&myreadcigar);
+  pysplicing_reads_destroy(&myreads);
   SPLICING_FINALLY_CLEAN(3);
   
   r6=pysplicing_from_miso_rundata(&rundata);
@@ -401,6 +667,7 @@ static PyObject* pysplicing_solve_gene(PyObject *self, PyObject *args) {
   splicing_gff_t *mygff;
   splicing_vector_int_t myposition;
   splicing_strvector_t myreadcigar;
+  splicing_cigar_t mycigar;
   splicing_matrix_t match_matrix, assignment_matrix;
   splicing_vector_t expression;
   PyObject *r1, *r2, *r3;
@@ -413,6 +680,7 @@ static PyObject* pysplicing_solve_gene(PyObject *self, PyObject *args) {
   SPLICING_FINALLY(splicing_vector_int_destroy, &myposition);
   if (pysplicing_to_strvector(readcigar, &myreadcigar)) { return NULL; }
   SPLICING_FINALLY(splicing_strvector_destroy, &myreadcigar);
+  splicing_cigar_str(&mycigar, (const char **) myreadcigar.table);
 
   SPLICING_PYCHECK(splicing_matrix_init(&match_matrix, 0, 0));
   SPLICING_FINALLY(splicing_matrix_destroy, &match_matrix);
@@ -422,8 +690,7 @@ static PyObject* pysplicing_solve_gene(PyObject *self, PyObject *args) {
   SPLICING_FINALLY(splicing_vector_destroy, &expression);
 
   SPLICING_PYCHECK(splicing_solve_gene(mygff, gene, readLength, overhang,
-				       &myposition, 
-				       (const char **) myreadcigar.table,
+				       &myposition, &mycigar,
 				       &match_matrix, /*nomatch=*/ 0, 
 				       &assignment_matrix,
 				       &expression, /*residuals=*/ 0, 
@@ -654,6 +921,385 @@ static PyObject* pysplicing_to_gff(PyObject *self, PyObject *args) {
   
 /* -------------------------------------------------------------------- */
 
+/* Running MISO on many genes at once. All Python objects are
+   converted up front, then the genes are handed out to worker threads
+   which run without the GIL. A gene that fails does not stop the
+   others: its results are None, and its error message is returned
+   instead. */
+
+typedef struct {
+  splicing_gff_t *gff;
+  int gene;
+  pysplicing_reads_t reads;
+  splicing_vector_t hyperp;
+  unsigned long int seed;
+  splicing_matrix_t samples;
+  splicing_vector_t logLik;
+  splicing_matrix_t class_templates;
+  splicing_vector_t class_counts;
+  splicing_vector_int_t assignment;
+  splicing_miso_rundata_t rundata;
+  int ret;
+  PyObject *error;
+} pysplicing_i_miso_job_t;
+
+typedef struct {
+  pysplicing_i_miso_job_t *jobs;
+  int nojobs, next;
+  pthread_mutex_t mutex;
+  int readLength, overhang, noChains, noIterations, maxIterations;
+  int noBurnIn, noLag, paired;
+  double normalMean, normalVar, numDevs;
+  splicing_miso_start_t start;
+  splicing_miso_stop_t stop;
+  splicing_miso_proposal_t proposal;
+  int checkEvery;
+  double minEss, maxRhat;
+} pysplicing_i_miso_batch_t;
+
+static int pysplicing_i_miso_job(pysplicing_i_miso_batch_t *batch,
+				 pysplicing_i_miso_job_t *job) {
+  splicing_rng_t rng;
+  int ret;
+
+  SPLICING_CHECK(splicing_rng_init(&rng, &splicing_rngtype_mt19937));
+  SPLICING_FINALLY(splicing_rng_destroy, &rng);
+  SPLICING_CHECK(splicing_rng_seed(&rng, job->seed));
+
+  if (batch->paired) {
+    ret = splicing_miso_paired(job->gff, job->gene, &job->reads.position,
+			       &job->reads.cigar,
+			       batch->readLength, batch->overhang, 
+			       batch->noChains, batch->noIterations,
+			       batch->maxIterations, batch->noBurnIn,
+			       batch->noLag, &job->hyperp, batch->start,
+			       batch->stop, batch->checkEvery, batch->minEss,
+			       batch->maxRhat, /*start_psi=*/ 0, 
+			       /*insertProb=*/ 0, /*insertStart=*/ 0,
+			       batch->normalMean, batch->normalVar,
+			       batch->numDevs, &rng, &job->samples,
+			       &job->logLik, /*match_matrix=*/ 0,
+			       /*class_templates=*/ 0, /*class_counts=*/ 0,
+			       &job->class_templates, &job->class_counts,
+			       &job->assignment, &job->rundata);
+  } else {
+    ret = splicing_miso(job->gff, job->gene, &job->reads.position,
+			&job->reads.cigar,
+			batch->readLength, batch->overhang, batch->noChains,
+			batch->noIterations, batch->maxIterations,
+			batch->noBurnIn, batch->noLag, &job->hyperp,
+			batch->start, batch->stop, batch->checkEvery,
+			batch->minEss, batch->maxRhat, batch->proposal,
+			/*noThreads=*/ 1, /*start_psi=*/ 0, &rng,
+			&job->samples, &job->logLik, /*match_matrix=*/ 0,
+			&job->class_templates, &job->class_counts,
+			&job->assignment, &job->rundata);
+  }
+  SPLICING_CHECK(ret);
+
+  splicing_rng_destroy(&rng);
+  SPLICING_FINALLY_CLEAN(1);
+  
+  return 0;
+}
+
+/* Keeps the error of a failed gene, which the error handler set on the
+   thread that ran the gene, as the gene's error message. */
+
+static void pysplicing_i_miso_job_error(pysplicing_i_miso_job_t *job) {
+  PyObject *type, *value, *traceback;
+  PyGILState_STATE gstate = PyGILState_Ensure();
+  PyErr_Fetch(&type, &value, &traceback);
+  if (value) {
+    job->error = PyObject_Str(value);
+  }
+  if (!job->error) {
+    PyErr_Clear();
+    job->error = PyString_FromString("Internal splicing error");
+  }
+  Py_XDECREF(type); Py_XDECREF(value); Py_XDECREF(traceback);
+  PyGILState_Release(gstate);
+}
+
+static void *pysplicing_i_miso_worker(void *arg) {
+  pysplicing_i_miso_batch_t *batch = (pysplicing_i_miso_batch_t*) arg;
+  int j;
+  
+  while (1) {
+    pthread_mutex_lock(&batch->mutex);
+    j = batch->next++;
+    pthread_mutex_unlock(&batch->mutex);
+    if (j >= batch->nojobs) { break; }
+    batch->jobs[j].ret = pysplicing_i_miso_job(batch, &batch->jobs[j]);
+    if (batch->jobs[j].ret) {
+      pysplicing_i_miso_job_error(&batch->jobs[j]);
+    }
+  }
+
+  return 0;
+}
+
+/* Worker threads other than the calling one keep a Python thread state
+   while they run, so that the error the error handler sets for a gene
+   is still there when the gene's error is kept. */
+
+static void *pysplicing_i_miso_thread(void *arg) {
+  PyGILState_STATE gstate = PyGILState_Ensure();
+  Py_BEGIN_ALLOW_THREADS
+  pysplicing_i_miso_worker(arg);
+  Py_END_ALLOW_THREADS
+  PyGILState_Release(gstate);
+  return 0;
+}
+
+static void pysplicing_i_miso_batch_destroy(pysplicing_i_miso_job_t *jobs,
+					    int nojobs) {
+  int j;
+  for (j=0; j<nojobs; j++) {
+    splicing_vector_int_destroy(&jobs[j].assignment);
+    splicing_vector_destroy(&jobs[j].class_counts);
+    splicing_matrix_destroy(&jobs[j].class_templates);
+    splicing_vector_destroy(&jobs[j].logLik);
+    splicing_matrix_destroy(&jobs[j].samples);
+    splicing_vector_destroy(&jobs[j].hyperp);
+    pysplicing_reads_destroy(&jobs[j].reads);
+    Py_XDECREF(jobs[j].error);
+  }
+  free(jobs);
+}
+
+static int pysplicing_i_miso_batch_job_init(pysplicing_i_miso_job_t *job,
+					    PyObject *gff, PyObject *readpos,
+					    PyObject *readcigar,
+					    PyObject *cigaridx,
+					    PyObject *hyperp) {
+  size_t i, noiso;
+
+  if (!PyCObject_Check(gff)) {
+    PyErr_SetString(PyExc_TypeError, "Need a GFF object");
+    return 1;
+  }
+  job->gff = PyCObject_AsVoidPtr(gff);
+  if (pysplicing_to_reads(readpos, readcigar, cigaridx, &job->reads)) {
+    return 1;
+  }
+  if (hyperp && hyperp != Py_None) {
+    if (pysplicing_to_vector(hyperp, &job->hyperp)) { return 1; }
+  } else {
+    SPLICING_CHECK(splicing_gff_noiso_one(job->gff, job->gene, &noiso));
+    SPLICING_CHECK(splicing_vector_init(&job->hyperp, noiso));
+    for (i=0; i<noiso; i++) { VECTOR(job->hyperp)[i] = 1.0; }
+  }
+  SPLICING_CHECK(splicing_matrix_init(&job->samples, 0, 0));
+  SPLICING_CHECK(splicing_vector_init(&job->logLik, 0));
+  SPLICING_CHECK(splicing_matrix_init(&job->class_templates, 0, 0));
+  SPLICING_CHECK(splicing_vector_init(&job->class_counts, 0));
+  SPLICING_CHECK(splicing_vector_int_init(&job->assignment, 0));
+  
+  return 0;
+}
+
+static PyObject* pysplicing_miso_batch(PyObject *self, PyObject *args,
+				       PyObject *kwds) {
+  static char *kwlist[] = { "gff", "readpos", "readcigar", "readLength",
+			    "noIterations", "noBurnIn", "noLag", "hyperp",
+			    "overhang", "noChains", "start", "stop", 
+			    "seeds", "noThreads", "normalMean", "normalVar",
+			    "numDevs", "proposal", "checkEvery", "minEss",
+			    "maxRhat", "cigarIdx", NULL };
+  PyObject *gff, *readpos, *readcigar, *cigaridx=0, *hyperp=0, *seeds=0;
+  int noThreads=1;
+  pysplicing_i_miso_batch_t batch;
+  pysplicing_i_miso_job_t *jobs;
+  pthread_t *threads;
+  int i, j, nojobs;
+  size_t noSamples=0, noReads=0, pos;
+  PyObject *rsamples, *rlogLik, *rassignment, *rindex, *rtemplates,
+    *rcounts, *rrundata, *rerrors;
+  double *psamples, *plogLik;
+  int *passignment;
+
+  batch.readLength=0; batch.noIterations=5000; batch.maxIterations=100000;
+  batch.noBurnIn=500; batch.noLag=10; batch.overhang=1; batch.noChains=6;
+  batch.start=SPLICING_MISO_START_AUTO;
+  batch.stop=SPLICING_MISO_STOP_CONVERGENT_MEAN;
+  batch.proposal=SPLICING_MISO_PROPOSAL_DRIFT;
+  batch.checkEvery=100; batch.minEss=200.0; batch.maxRhat=1.05;
+  batch.normalMean=batch.normalVar=batch.numDevs=0.0;
+  
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOi|iiiOiiiiOidddiiddO", 
+				   kwlist, &gff, &readpos, &readcigar,
+				   &batch.readLength, &batch.noIterations,
+				   &batch.noBurnIn, &batch.noLag, &hyperp,
+				   &batch.overhang, &batch.noChains, 
+				   &batch.start, &batch.stop, &seeds, 
+				   &noThreads, &batch.normalMean,
+				   &batch.normalVar, &batch.numDevs,
+				   &batch.proposal, &batch.checkEvery,
+				   &batch.minEss, &batch.maxRhat, &cigaridx)) {
+    return NULL;
+  }
+
+  if (!PyTuple_Check(gff) || !PyTuple_Check(readpos) || 
+      !PyTuple_Check(readcigar)) {
+    PyErr_SetString(PyExc_TypeError, "Need tuples of genes and reads");
+    return NULL;
+  }
+  nojobs=PyTuple_Size(gff);
+  if (PyTuple_Size(readpos) != nojobs || PyTuple_Size(readcigar) != nojobs ||
+      (hyperp && hyperp != Py_None && 
+       (!PyTuple_Check(hyperp) || PyTuple_Size(hyperp) != nojobs)) ||
+      (seeds && seeds != Py_None && 
+       (!PyTuple_Check(seeds) || PyTuple_Size(seeds) != nojobs)) ||
+      (cigaridx && cigaridx != Py_None &&
+       (!PyTuple_Check(cigaridx) || PyTuple_Size(cigaridx) != nojobs))) {
+    PyErr_SetString(PyExc_ValueError, "Need the same number of genes, "
+		    "read positions, CIGARs, CIGAR offsets, hyperparameters "
+		    "and seeds");
+    return NULL;
+  }
+  batch.paired = batch.normalMean > 0;
+  if (batch.paired && batch.proposal != SPLICING_MISO_PROPOSAL_DRIFT) {
+    PyErr_SetString(PyExc_ValueError, "Paired-end reads can only be "
+		    "sampled with the drift proposal");
+    return NULL;
+  }
+  if (noThreads < 1) { noThreads = 1; }
+  if (noThreads > nojobs) { noThreads = nojobs > 0 ? nojobs : 1; }
+
+  jobs = calloc(nojobs > 0 ? nojobs : 1, sizeof(pysplicing_i_miso_job_t));
+  if (!jobs) { return PyErr_NoMemory(); }
+
+  /* Convert everything while we have the GIL */
+  for (j=0; j<nojobs; j++) {
+    PyObject *g=PyTuple_GetItem(gff, j);
+    PyObject *h=hyperp && hyperp != Py_None ? 
+      PyTuple_GetItem(hyperp, j) : 0;
+    PyObject *s=seeds && seeds != Py_None ? PyTuple_GetItem(seeds, j) : 0;
+    PyObject *c=cigaridx && cigaridx != Py_None ? 
+      PyTuple_GetItem(cigaridx, j) : 0;
+    if (PyTuple_Check(g) && PyTuple_Size(g) == 2) {
+      jobs[j].gene = PyInt_AsLong(PyTuple_GetItem(g, 1));
+      g = PyTuple_GetItem(g, 0);
+    }
+    if (pysplicing_i_miso_batch_job_init(&jobs[j], g, 
+					 PyTuple_GetItem(readpos, j),
+					 PyTuple_GetItem(readcigar, j), c, h) ||
+	pysplicing_to_seed(s, &jobs[j].seed)) {
+      pysplicing_i_miso_batch_destroy(jobs, j+1);
+      if (!PyErr_Occurred()) { splicingmodule_handle_splicing_error(); }
+      return NULL;
+    }
+  }
+
+  batch.jobs = jobs;
+  batch.nojobs = nojobs;
+  batch.next = 0;
+  pthread_mutex_init(&batch.mutex, 0);
+  threads = calloc(noThreads, sizeof(pthread_t));
+  if (!threads) {
+    pysplicing_i_miso_batch_destroy(jobs, nojobs);
+    return PyErr_NoMemory();
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  for (i=1; i<noThreads; i++) {
+    if (pthread_create(&threads[i], 0, pysplicing_i_miso_thread, &batch)) {
+      break;
+    }
+  }
+  /* The calling thread works, too */
+  pysplicing_i_miso_worker(&batch);
+  for (i--; i>0; i--) {
+    pthread_join(threads[i], 0);
+  }
+  Py_END_ALLOW_THREADS
+
+  free(threads);
+  pthread_mutex_destroy(&batch.mutex);
+
+  /* Collect the results into contiguous arrays. A gene that failed
+     has no results, but its error message. */
+  for (j=0; j<nojobs; j++) {
+    if (jobs[j].ret) { continue; }
+    noSamples += splicing_vector_size(&jobs[j].logLik);
+    noReads += splicing_vector_int_size(&jobs[j].assignment);
+  }
+
+  rindex=PyTuple_New(nojobs);
+  rtemplates=PyTuple_New(nojobs);
+  rcounts=PyTuple_New(nojobs);
+  rrundata=PyTuple_New(nojobs);
+  rerrors=PyTuple_New(nojobs);
+  rsamples=PyByteArray_FromStringAndSize(0, 0);
+  rlogLik=PyByteArray_FromStringAndSize(0, 0);
+  rassignment=PyByteArray_FromStringAndSize(0, 0);
+  if (!rindex || !rtemplates || !rcounts || !rrundata || !rerrors ||
+      !rsamples ||
+      !rlogLik || !rassignment || 
+      PyByteArray_Resize(rlogLik, noSamples * sizeof(double)) ||
+      PyByteArray_Resize(rassignment, noReads * sizeof(int))) {
+    goto failure;
+  }
+  for (j=0, pos=0; j<nojobs; j++) {
+    if (jobs[j].ret) { continue; }
+    pos += splicing_matrix_size(&jobs[j].samples);
+  }
+  if (PyByteArray_Resize(rsamples, pos * sizeof(double))) { goto failure; }
+  psamples = (double*) PyByteArray_AsString(rsamples);
+  plogLik = (double*) PyByteArray_AsString(rlogLik);
+  passignment = (int*) PyByteArray_AsString(rassignment);
+
+  for (j=0, noSamples=0, noReads=0, pos=0; j<nojobs; j++) {
+    pysplicing_i_miso_job_t *job=&jobs[j];
+    size_t size, nos, nor;
+    if (job->ret) {
+      Py_INCREF(Py_None); PyTuple_SetItem(rindex, j, Py_None);
+      Py_INCREF(Py_None); PyTuple_SetItem(rtemplates, j, Py_None);
+      Py_INCREF(Py_None); PyTuple_SetItem(rcounts, j, Py_None);
+      Py_INCREF(Py_None); PyTuple_SetItem(rrundata, j, Py_None);
+      PyTuple_SetItem(rerrors, j, job->error);
+      job->error = 0;
+      continue;
+    }
+    size=splicing_matrix_size(&job->samples);
+    nos=splicing_vector_size(&job->logLik);
+    nor=splicing_vector_int_size(&job->assignment);
+    memcpy(psamples + pos, &MATRIX(job->samples, 0, 0), 
+	   size * sizeof(double));
+    memcpy(plogLik + noSamples, VECTOR(job->logLik), nos * sizeof(double));
+    memcpy(passignment + noReads, VECTOR(job->assignment), 
+	   nor * sizeof(int));
+    PyTuple_SetItem(rindex, j, Py_BuildValue("(iiiiii)", 
+					     job->rundata.noIso, (int) nos,
+					     (int) pos, (int) noSamples,
+					     (int) noReads, (int) nor));
+    splicing_matrix_transpose(&job->class_templates);
+    PyTuple_SetItem(rtemplates, j, 
+		    pysplicing_from_matrix(&job->class_templates));
+    PyTuple_SetItem(rcounts, j, pysplicing_from_vector(&job->class_counts));
+    PyTuple_SetItem(rrundata, j, pysplicing_from_miso_rundata(&job->rundata));
+    Py_INCREF(Py_None); PyTuple_SetItem(rerrors, j, Py_None);
+    pos += size;
+    noSamples += nos;
+    noReads += nor;
+  }
+
+  pysplicing_i_miso_batch_destroy(jobs, nojobs);
+  
+  return Py_BuildValue("NNNNNNNN", rsamples, rlogLik, rassignment, rindex,
+		       rtemplates, rcounts, rrundata, rerrors);
+
+ failure:
+  pysplicing_i_miso_batch_destroy(jobs, nojobs);
+  Py_XDECREF(rsamples); Py_XDECREF(rlogLik); Py_XDECREF(rassignment);
+  Py_XDECREF(rindex); Py_XDECREF(rtemplates); Py_XDECREF(rcounts);
+  Py_XDECREF(rrundata); Py_XDECREF(rerrors);
+  return NULL;
+}
+  
+/* -------------------------------------------------------------------- */
+
 static PyMethodDef pysplicing_methods[] = { 
   { "readGFF", pysplicing_read_gff, METH_VARARGS, "Read a GFF3 file." },
   { "writeGFF", pysplicing_write_gff, METH_VARARGS, "Write a GFF3 file." },
@@ -669,9 +1315,19 @@ static PyMethodDef pysplicing_methods[] = {
     "Simple linear deconvolution of isoform expression for a single gene." },
   { "simulatePairedReads", pysplicing_simulate_paired_reads,
     METH_VARARGS, "Simulate paired end reads from a gene." },
-  { "MISO"   , pysplicing_miso    , METH_VARARGS, "Run MISO." },
-  { "MISOPaired", pysplicing_miso_paired, METH_VARARGS, 
-    "MISO on paired-end data" },
+  { "MISO"   , (PyCFunction) pysplicing_miso, METH_VARARGS | METH_KEYWORDS,
+    "Run MISO." },
+  { "MISOClasses", (PyCFunction) pysplicing_miso_classes, 
+    METH_VARARGS | METH_KEYWORDS, 
+    "Run MISO on the read classes of a gene, instead of its reads" },
+  { "MISOVB", (PyCFunction) pysplicing_miso_vb, 
+    METH_VARARGS | METH_KEYWORDS, 
+    "Fast variational approximation of the MISO posterior" },
+  { "MISOPaired", (PyCFunction) pysplicing_miso_paired, 
+    METH_VARARGS | METH_KEYWORDS, "MISO on paired-end data" },
+  { "MISOBatch", (PyCFunction) pysplicing_miso_batch, 
+    METH_VARARGS | METH_KEYWORDS, 
+    "Run MISO on many genes, using several threads" },
   { "geneComplexity", pysplicing_gene_complexity, METH_VARARGS,
     "Gene complexity based on a linear model" },
   { "noGenes", pysplicing_gff_nogenes, METH_VARARGS, 
@@ -692,6 +1348,9 @@ PyMODINIT_FUNC initpysplicing(void) {
   if (m == NULL) { return; }
   Py_INCREF(m);
 
+  /* MISO and MISOPaired release the GIL while sampling */
+  PyEval_InitThreads();
+
   /* New exceptions */
 
   splicingmodule_InternalError =
@@ -1,5 +1,8 @@
 
+import re
 import unittest
+import threading
+import numpy
 import pysplicing
 
 class TestMISO(unittest.TestCase):
@@ -15,6 +18,236 @@ class TestMISO(unittest.TestCase):
                             pysplicing.MISO_STOP_CONVERGENT_MEAN)
         [ sum(e)/len(e) for e in est[0] ]
 
+    def test_miso_seed(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 2000L, 33L)
+        def run(seed):
+            return pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 1000L,
+                                   100L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                                   pysplicing.MISO_START_AUTO,
+                                   pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                   seed=seed)
+        est1=run(42L)
+        est2=run(42L)
+        est3=run(43L)
+        self.assertEqual(est1[0], est2[0])
+        self.assertNotEqual(est1[0], est3[0])
+
+    def test_miso_threads(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 2000L, 33L)
+        results=[]
+        def run():
+            est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 1000L,
+                                100L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                                pysplicing.MISO_START_AUTO,
+                                pysplicing.MISO_STOP_CONVERGENT_MEAN)
+            results.append(est)
+        threads=[ threading.Thread(target=run) for i in range(4) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(len(results), 4)
+        for est in results:
+            self.assertEqual(len(est[0]), 3)
+
+    def test_miso_batch(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads1=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 2000L, 33L)
+        reads2=pysplicing.simulateReads(gene, 0L, (0.6,0.3,0.1), 500L, 33L)
+        est=pysplicing.MISOBatch((gene, gene), (reads1[1], reads2[1]),
+                                 (reads1[2], reads2[2]), 33L,
+                                 noIterations=1000L, noBurnIn=100L,
+                                 noLag=10L, noChains=2L,
+                                 start=pysplicing.MISO_START_AUTO,
+                                 stop=pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                 seeds=(42L, 43L), noThreads=2L)
+        samples, logLik, assignment, index = est[0:4]
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index[1][2], index[0][0] * index[0][1])
+        self.assertEqual(len(logLik), 8 * (index[0][1] + index[1][1]))
+        self.assertEqual(len(assignment), 4 * (2000 + 500))
+        single=pysplicing.MISO(gene, 0L, reads1[1], reads1[2], 33L, 1000L,
+                               100L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                               pysplicing.MISO_START_AUTO,
+                               pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                               seed=42L)
+        self.assertEqual(est[6][0], single[5])
+        self.assertEqual(len(est[4][0]), len(single[2]))
+
+    def test_miso_batch_failed_gene(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 500L, 33L)
+        # The second gene has a read with an invalid CIGAR string
+        est=pysplicing.MISOBatch((gene, gene, gene),
+                                 (reads[1], reads[1][:1], reads[1]),
+                                 (reads[2], ("10M5Z",), reads[2]), 33L,
+                                 noIterations=1000L, noBurnIn=100L,
+                                 noLag=10L, noChains=2L,
+                                 start=pysplicing.MISO_START_AUTO,
+                                 stop=pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                 seeds=(42L, 43L, 42L), noThreads=2L)
+        index, errors = est[3], est[7]
+        self.assertEqual(errors[0], None)
+        self.assertEqual(errors[2], None)
+        self.assertEqual(index[1], None)
+        self.assertTrue("CIGAR" in errors[1])
+        self.assertEqual(est[6][0], est[6][2])
+        self.assertEqual(index[2][3], index[0][1])
+
+    def test_miso_classes(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 5000L, 33L)
+        est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 5000L,
+                            500L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                            pysplicing.MISO_START_AUTO,
+                            pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                            seed=42L)
+        self.assertEqual(sum(est[3]), 5000)
+        self.assertEqual(len(est[4]), 5000)
+        means=[ sum(e)/len(e) for e in est[0] ]
+        for m, psi in zip(means, (0.2,0.3,0.5)):
+            self.assertTrue(abs(m - psi) < 0.1)
+
+    def test_miso_from_classes(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 2000L, 33L)
+        est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 1000L,
+                            100L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                            pysplicing.MISO_START_AUTO,
+                            pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                            seed=42L)
+        cl=pysplicing.MISOClasses(gene, 0L, est[2], est[3], 33L, 1000L,
+                                  100L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                                  pysplicing.MISO_START_AUTO,
+                                  pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                  seed=42L)
+        self.assertEqual(cl[0], est[0])
+        self.assertEqual(cl[1], est[1])
+        self.assertEqual(sorted(cl[2]), sorted(est[4]))
+        self.assertEqual(cl[3], est[5])
+
+    def test_miso_arrays(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 2000L, 33L)
+        ops="MIDNSHP=X"
+        pairs, idx=[], [0]
+        for cigar in reads[2]:
+            for l, op in re.findall("([0-9]+)([A-Z=])", cigar):
+                pairs.extend((ops.index(op), int(l)))
+            idx.append(len(pairs) / 2)
+        readpos=numpy.array(reads[1], dtype=numpy.int32)
+        pairs=numpy.array(pairs, dtype=numpy.int32)
+        idx=numpy.array(idx, dtype=numpy.int32)
+        def run(readpos, readcigar, cigarIdx=None):
+            return pysplicing.MISO(gene, 0L, readpos, readcigar, 33L, 1000L,
+                                   100L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                                   pysplicing.MISO_START_AUTO,
+                                   pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                   seed=42L, cigarIdx=cigarIdx)
+        est1=run(reads[1], reads[2])
+        est2=run(readpos, pairs, idx)
+        self.assertEqual(est1[0], est2[0])
+        self.assertEqual(est1[4], est2[4])
+        self.assertRaises(ValueError, run, readpos, pairs, idx[:-1])
+        self.assertRaises(TypeError, run, readpos, pairs.astype(float), idx)
+
+    def test_miso_gibbs(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 5000L, 33L)
+        def run(proposal):
+            est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 5000L,
+                                500L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                                pysplicing.MISO_START_AUTO,
+                                pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                seed=42L, proposal=proposal)
+            return [ sum(e)/len(e) for e in est[0] ], est[5]
+        drift, rundata1=run(pysplicing.MISO_PROPOSAL_DRIFT)
+        gibbs, rundata2=run(pysplicing.MISO_PROPOSAL_GIBBS)
+        for m1, m2 in zip(drift, gibbs):
+            self.assertTrue(abs(m1 - m2) < 0.02)
+        self.assertTrue(rundata2[4] > rundata1[4])
+
+    def test_miso_early_stop(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 5000L, 33L)
+        est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 20000L,
+                            500L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                            pysplicing.MISO_START_AUTO,
+                            pysplicing.MISO_STOP_RHAT_ESS,
+                            seed=42L, proposal=pysplicing.MISO_PROPOSAL_GIBBS,
+                            checkEvery=50L, minEss=200.0, maxRhat=1.05)
+        rundata=est[5]
+        self.assertTrue(rundata[1] < 20000)
+        self.assertEqual(len(est[0][0]), 2 * (rundata[1] - 500) / 10)
+        self.assertEqual(len(est[1]), len(est[0][0]))
+        self.assertTrue(rundata[6] <= 1.05)
+        self.assertTrue(rundata[7] >= 200)
+
+    def test_miso_chain_threads(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 2000L, 33L)
+        def run(noThreads):
+            return pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 1000L,
+                                   100L, 10L, (1.0,1.0,1.0), 1L, 4L,
+                                   pysplicing.MISO_START_AUTO,
+                                   pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                                   seed=42L, noThreads=noThreads)
+        est1=run(1L)
+        est2=run(2L)
+        est4=run(4L)
+        self.assertEqual(len(est2[0][0]), len(est1[0][0]))
+        self.assertEqual(est2[0], est4[0])
+        self.assertEqual(est2[1], est4[1])
+        for e1, e2 in zip(est1[0], est2[0]):
+            self.assertTrue(abs(sum(e1)/len(e1) - sum(e2)/len(e2)) < 0.05)
+
+    def test_miso_vb(self):
+        gene=pysplicing.createGene( ((1,100), (201,300), (401,500)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 5000L, 33L)
+        est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 5000L,
+                            500L, 10L, (1.0,1.0,1.0), 1L, 2L,
+                            pysplicing.MISO_START_AUTO,
+                            pysplicing.MISO_STOP_CONVERGENT_MEAN,
+                            seed=42L)
+        vb=pysplicing.MISOVB(gene, 0L, reads[1], reads[2], 33L, 900L,
+                             seed=42L)
+        self.assertEqual(len(vb[0]), 3)
+        self.assertEqual(len(vb[0][0]), 900)
+        self.assertEqual(len(vb[1]), 900)
+        self.assertEqual(len(vb[4]), 5000)
+        self.assertEqual(vb[3], est[3])
+        for e, v in zip(est[0], vb[0]):
+            self.assertTrue(abs(sum(e)/len(e) - sum(v)/len(v)) < 0.03)
+
+    def test_miso_vb_unequal_lengths(self):
+        ## Isoforms of unequal lengths are identified unequally well,
+        ## each of them must get its own credible interval
+        gene=pysplicing.createGene( ((1,100), (201,1500), (1601,1700)),
+                                    ((0,1), (0,2), (0,1,2)) )
+        reads=pysplicing.simulateReads(gene, 0L, (0.2,0.3,0.5), 3000L, 33L)
+        est=pysplicing.MISO(gene, 0L, reads[1], reads[2], 33L, 10000L,
+                            500L, 5L, (1.0,1.0,1.0), 1L, 2L,
+                            pysplicing.MISO_START_AUTO,
+                            pysplicing.MISO_STOP_FIXEDNO, seed=42L)
+        vb=pysplicing.MISOVB(gene, 0L, reads[1], reads[2], 33L, 2000L,
+                             seed=42L)
+        for e, v in zip(est[0], vb[0]):
+            self.assertTrue(abs(numpy.mean(e) - numpy.mean(v)) < 0.05)
+            for q in (2.5, 97.5):
+                self.assertTrue(abs(numpy.percentile(e, q) -
+                                    numpy.percentile(v, q)) < 0.05)
+
 if __name__ == '__main__':
     unittest.main()
 
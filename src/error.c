@@ -110,7 +110,8 @@ splicing_set_error_handler (splicing_error_handler_t * new_handler)
   return previous_handler;
 }
 
-struct splicing_i_protectedPtr splicing_i_finally_stack[100];
+SPLICING_THREAD_LOCAL struct splicing_i_protectedPtr 
+splicing_i_finally_stack[100];
 
 /*
  * Adds another element to the free list
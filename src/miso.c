@@ -2,90 +2,292 @@
 #include <math.h>
 #include <stdlib.h>
 #include <string.h>
+#include <pthread.h>
 
 #include "splicing_matrix.h"
 #include "splicing_error.h"
 #include "splicing.h"
 #include "splicing_random.h"
 
-#define CUMSUM() do {							\
-    int j;								\
-    double *cptr = curr;						\
-    for (j=0, noValid=0, sumpsi=0.0; j<noiso; j++, cptr++) {		\
-      if (*cptr != 0) {							\
-	sumpsi += MATRIX(*psi, j, k);					\
-	VECTOR(validIso)[noValid] = j;					\
-	VECTOR(cumsum)[noValid] = sumpsi;				\
-	noValid++;							\
-      }									\
-    }									\
-  } while (0)
-
-
-/* TODO: we could actually speed this up, by storing the 
-   indices where the cumulative sum vector must be updated. 
-   These indices do not change at all. With this we can spare
-   the memcmp operations. */
+/* The reads with the same column in the match matrix are in the same
+   class, these are consecutive in `match_order'. For each class we 
+   store the position of its first read in `match_order' and the 
+   isoforms its reads are compatible with, together with the match 
+   matrix entries. This does not change during sampling, so it is 
+   done once per gene, and then drawing the isoforms of the reads 
+   only needs one cumulative sum per class. */
+
+int splicing_match_classes_init(splicing_match_classes_t *classes) {
+  SPLICING_CHECK(splicing_vector_int_init(&classes->start, 0));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &classes->start);
+  SPLICING_CHECK(splicing_vector_int_init(&classes->isostart, 0));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &classes->isostart);
+  SPLICING_CHECK(splicing_vector_int_init(&classes->iso, 0));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &classes->iso);
+  SPLICING_CHECK(splicing_vector_init(&classes->weight, 0));
+  SPLICING_FINALLY_CLEAN(3);
+  return 0;
+}
 
-int splicing_reassign_samples(const splicing_matrix_t *matches, 
-			      const splicing_vector_int_t *match_order,
-			      const splicing_matrix_t *psi, 
-			      int noiso, int noChains, 
-			      splicing_matrix_int_t *result) {
+void splicing_match_classes_destroy(splicing_match_classes_t *classes) {
+  splicing_vector_destroy(&classes->weight);
+  splicing_vector_int_destroy(&classes->iso);
+  splicing_vector_int_destroy(&classes->isostart);
+  splicing_vector_int_destroy(&classes->start);
+}
 
+int splicing_match_classes(const splicing_matrix_t *matches,
+			   const splicing_vector_int_t *match_order,
+			   splicing_match_classes_t *classes) {
+
+  int noiso = splicing_matrix_nrow(matches);
   int noreads = splicing_matrix_ncol(matches);
-  int i, k, w;
-  double *prev, *curr;
+  int *order = VECTOR(*match_order);
+  double *prev = 0, *curr;
+  int i, j;
+
+  splicing_vector_int_clear(&classes->start);
+  splicing_vector_int_clear(&classes->isostart);
+  splicing_vector_int_clear(&classes->iso);
+  splicing_vector_clear(&classes->weight);
+
+  for (i=0; i<noreads; i++) {
+    curr = &MATRIX(*matches, 0, order[i]);
+    if (prev && memcmp(prev, curr, sizeof(double) * noiso) == 0) { 
+      continue;
+    }
+    SPLICING_CHECK(splicing_vector_int_push_back(&classes->start, i));
+    SPLICING_CHECK(splicing_vector_int_push_back(&classes->isostart, 
+			   splicing_vector_int_size(&classes->iso)));
+    for (j=0; j<noiso; j++) {
+      if (curr[j] != 0) {
+	SPLICING_CHECK(splicing_vector_int_push_back(&classes->iso, j));
+	SPLICING_CHECK(splicing_vector_push_back(&classes->weight, curr[j]));
+      }
+    }
+    prev = curr;
+  }
+  SPLICING_CHECK(splicing_vector_int_push_back(&classes->start, noreads));
+  SPLICING_CHECK(splicing_vector_int_push_back(&classes->isostart, 
+			 splicing_vector_int_size(&classes->iso)));
+
+  return 0;
+}
+
+/* The same, from the class templates and counts, when the match
+   matrix is not available. The reads of the classes come one after
+   the other, so `match_order' is the identity. */
+
+int splicing_template_classes(const splicing_matrix_t *class_templates,
+			      const splicing_vector_t *class_counts,
+			      splicing_match_classes_t *classes,
+			      splicing_vector_int_t *match_order) {
+
+  int noiso = splicing_matrix_nrow(class_templates);
+  int noclasses = splicing_vector_size(class_counts);
+  int i, j, noreads=0;
+
+  if (splicing_matrix_ncol(class_templates) != noclasses) {
+    SPLICING_ERROR("Class templates and counts do not match",
+		   SPLICING_EINVAL);
+  }
+
+  splicing_vector_int_clear(&classes->start);
+  splicing_vector_int_clear(&classes->isostart);
+  splicing_vector_int_clear(&classes->iso);
+  splicing_vector_clear(&classes->weight);
+
+  for (i=0; i<noclasses; i++) {
+    double *templ = &MATRIX(*class_templates, 0, i);
+    SPLICING_CHECK(splicing_vector_int_push_back(&classes->start, noreads));
+    SPLICING_CHECK(splicing_vector_int_push_back(&classes->isostart,
+			   splicing_vector_int_size(&classes->iso)));
+    for (j=0; j<noiso; j++) {
+      if (templ[j] != 0) {
+	SPLICING_CHECK(splicing_vector_int_push_back(&classes->iso, j));
+	SPLICING_CHECK(splicing_vector_push_back(&classes->weight, templ[j]));
+      }
+    }
+    noreads += VECTOR(*class_counts)[i];
+  }
+  SPLICING_CHECK(splicing_vector_int_push_back(&classes->start, noreads));
+  SPLICING_CHECK(splicing_vector_int_push_back(&classes->isostart,
+			 splicing_vector_int_size(&classes->iso)));
+
+  SPLICING_CHECK(splicing_vector_int_resize(match_order, noreads));
+  for (i=0; i<noreads; i++) { VECTOR(*match_order)[i] = i; }
+
+  return 0;
+}
+
+/* Below this many compatible isoforms a linear search is faster 
+   than a binary search */
+
+#define SPLICING_I_LINEAR_DRAW 8
+
+/* Assign every read to an isoform, in each chain. If `weighted' is 
+   true, then the isoform probabilities are multiplied by the match
+   matrix entries. */
+
+int splicing_i_reassign_samples(const splicing_match_classes_t *classes,
+				const splicing_vector_int_t *match_order,
+				const splicing_matrix_t *psi, 
+				int noiso, int noChains, int weighted,
+				splicing_rng_t *rng,
+				splicing_matrix_int_t *result) {
+
+  int noreads = splicing_vector_int_size(match_order);
+  int noclasses = splicing_vector_int_size(&classes->start) - 1;
+  int *order = VECTOR(*match_order);
+  int i, j, c, k, w;
   double rand, sumpsi;
-  int noValid;
-  int *order=VECTOR(*match_order);
   splicing_vector_t cumsum;
-  splicing_vector_int_t validIso;  
-
-  SPLICING_CHECK(splicing_vector_init(&cumsum, noiso));
-  SPLICING_FINALLY(splicing_vector_destroy, &cumsum);
-  SPLICING_CHECK(splicing_vector_int_init(&validIso, noiso));
-  SPLICING_FINALLY(splicing_vector_int_destroy, &validIso);
 
   SPLICING_CHECK(splicing_matrix_int_resize(result, noreads, noChains));
 
   if (noreads == 0) { return 0; }  
 
-  for (k=0; k<noChains; k++) {
-
-    prev = curr = &MATRIX(*matches, 0, order[0]);
-    CUMSUM();
-
-    for (i=0; i<noreads; i++) {
-      curr = &MATRIX(*matches, 0, order[i]);
+  SPLICING_CHECK(splicing_vector_init(&cumsum, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &cumsum);
 
-      /* Maybe we need to update the cumulative sum */
-      if (memcmp(prev, curr, sizeof(double)*noiso) != 0) { CUMSUM(); }
+  for (k=0; k<noChains; k++) {
+    for (c=0; c<noclasses; c++) {
+      int from = VECTOR(classes->start)[c], to = VECTOR(classes->start)[c+1];
+      int *iso = VECTOR(classes->iso) + VECTOR(classes->isostart)[c];
+      double *weight = VECTOR(classes->weight) + 
+	VECTOR(classes->isostart)[c];
+      int noValid = VECTOR(classes->isostart)[c+1] - 
+	VECTOR(classes->isostart)[c];
       
+      for (j=0, sumpsi=0.0; j<noValid; j++) {
+	sumpsi += weighted ? MATRIX(*psi, iso[j], k) * weight[j] :
+	  MATRIX(*psi, iso[j], k);
+	VECTOR(cumsum)[j] = sumpsi;
+      }
+
       if (noValid == 0) {
-	MATRIX(*result, order[i], k) = -1;
+	for (i=from; i<to; i++) { MATRIX(*result, order[i], k) = -1; }
       } else if (noValid == 1) {
-	MATRIX(*result, order[i], k) = VECTOR(validIso)[0];
+	for (i=from; i<to; i++) { MATRIX(*result, order[i], k) = iso[0]; }
       } else if (noValid == 2) { 
-	rand = RNG_UNIF01() * sumpsi;
-	w = (rand < VECTOR(cumsum)[0]) ? VECTOR(validIso)[0] : 
-	  VECTOR(validIso)[1];
-	MATRIX(*result, order[i], k) = w;
+	for (i=from; i<to; i++) {
+	  rand = splicing_rng_get_unif01(rng) * sumpsi;
+	  w = (rand < VECTOR(cumsum)[0]) ? iso[0] : iso[1];
+	  MATRIX(*result, order[i], k) = w;
+	}
+      } else if (noValid < SPLICING_I_LINEAR_DRAW) {
+	for (i=from; i<to; i++) {
+	  rand = splicing_rng_get_unif01(rng) * sumpsi;
+	  for (w=0; rand > VECTOR(cumsum)[w]; w++) ;
+	  MATRIX(*result, order[i], k) = iso[w];
+	}
       } else {
-	/* Draw */
-	rand = RNG_UNIF01() * sumpsi;
-	/* TODO: Binary search for interval, if many classes */
-	for (w=0; rand > VECTOR(cumsum)[w]; w++) ;
-	MATRIX(*result, order[i], k) = VECTOR(validIso)[w];
+	for (i=from; i<to; i++) {
+	  int lo=0, hi=noValid-1;
+	  rand = splicing_rng_get_unif01(rng) * sumpsi;
+	  /* First interval with cumsum >= rand */
+	  while (lo < hi) {
+	    int mid = (lo + hi) / 2;
+	    if (rand > VECTOR(cumsum)[mid]) { lo = mid + 1; } else { hi = mid; }
+	  }
+	  MATRIX(*result, order[i], k) = iso[lo];
+	}
       }
-
-      prev=curr;
     }
   }
 
-  splicing_vector_int_destroy(&validIso);
   splicing_vector_destroy(&cumsum);
-  SPLICING_FINALLY_CLEAN(2);
+  SPLICING_FINALLY_CLEAN(1);
+
+  return 0;
+}
+
+#undef SPLICING_I_LINEAR_DRAW
+
+/* If `classes' is not given, it is calculated from the match matrix,
+   callers that reassign many times should calculate it once, with
+   splicing_match_classes(). */
+
+int splicing_reassign_samples(const splicing_matrix_t *matches, 
+			      const splicing_vector_int_t *match_order,
+			      const splicing_match_classes_t *classes,
+			      const splicing_matrix_t *psi, 
+			      int noiso, int noChains, 
+			      splicing_rng_t *rng,
+			      splicing_matrix_int_t *result) {
+
+  splicing_match_classes_t vclasses;
+
+  if (classes) { 
+    SPLICING_CHECK(splicing_i_reassign_samples(classes, match_order, psi,
+					       noiso, noChains, 
+					       /*weighted=*/ 0, rng, result));
+    return 0;
+  }
+
+  SPLICING_CHECK(splicing_match_classes_init(&vclasses));
+  SPLICING_FINALLY(splicing_match_classes_destroy, &vclasses);
+  SPLICING_CHECK(splicing_match_classes(matches, match_order, &vclasses));
+  SPLICING_CHECK(splicing_i_reassign_samples(&vclasses, match_order, psi,
+					     noiso, noChains, 
+					     /*weighted=*/ 0, rng, result));
+  splicing_match_classes_destroy(&vclasses);
+  SPLICING_FINALLY_CLEAN(1);
+
+  return 0;
+}
+
+/* The reads of a class (i.e. the reads with the same column in the
+   match matrix) are exchangeable, so instead of assigning them to
+   isoforms one by one, we draw the number of reads of the class that
+   go to each isoform, from a multinomial distribution. The result is
+   the number of reads assigned to each isoform, in each chain. */
+
+int splicing_reassign_classes(const splicing_matrix_t *class_templates,
+			      const splicing_vector_t *class_counts,
+			      const splicing_matrix_t *psi, 
+			      int noiso, int noChains, 
+			      splicing_rng_t *rng,
+			      splicing_matrix_t *result) {
+
+  int noclasses = splicing_vector_size(class_counts);
+  int i, c, k;
+
+  SPLICING_CHECK(splicing_matrix_resize(result, noiso, noChains));
+  splicing_matrix_null(result);
+
+  for (k=0; k<noChains; k++) {
+    for (c=0; c<noclasses; c++) {
+      double *templ = &MATRIX(*class_templates, 0, c);
+      double n = VECTOR(*class_counts)[c];
+      double sumpsi = 0.0;
+      int last = -1;
+      for (i=0; i<noiso; i++) {
+	if (templ[i] != 0) { sumpsi += MATRIX(*psi, i, k); last = i; }
+      }
+
+      /* Reads that are not compatible with any isoform */
+      if (last < 0) { continue; }
+
+      /* Multinomial draw, as a sequence of binomial draws */
+      for (i=0; i<last && n > 0; i++) {
+	double p, x;
+	if (templ[i] == 0) { continue; }
+	p = MATRIX(*psi, i, k) / sumpsi;
+	if (p >= 1.0) {
+	  x = n;
+	} else if (p <= 0.0) {
+	  x = 0;
+	} else {
+	  x = splicing_rng_get_binom(rng, n, p);
+	}
+	MATRIX(*result, i, k) += x;
+	n -= x;
+	sumpsi -= MATRIX(*psi, i, k);
+      }
+      MATRIX(*result, last, k) += n;
+    }
+  }
 
   return 0;
 }
@@ -122,7 +324,7 @@ int splicing_mvplogisnorm(const splicing_vector_t *theta,
 }
 
 int splicing_score_iso(const splicing_vector_t *psi, int noiso, 
-		       const splicing_vector_int_t *assignment, int noreads,
+		       const splicing_vector_t *isocounts,
 		       const splicing_vector_int_t *peffisolen, double *res) {
   int *effisolen = VECTOR(*peffisolen);
   double sum, maxpsieff, score;
@@ -148,11 +350,10 @@ int splicing_score_iso(const splicing_vector_t *psi, int noiso,
     VECTOR(logpsi)[i] -= sum;
   }
   
-  /* Calculate score, based on assignments */
-  for (score=0.0, i=0; i<noreads; i++) {
-    if (VECTOR(*assignment)[i] != -1) {
-      score += VECTOR(logpsi)[ VECTOR(*assignment)[i] ];
-    }
+  /* Calculate score, based on the number of reads assigned to
+     each isoform */
+  for (score=0.0, i=0; i<noiso; i++) {
+    score += VECTOR(*isocounts)[i] * VECTOR(logpsi)[i];
   }
 
   splicing_vector_destroy(&logpsi);
@@ -182,7 +383,8 @@ int splicing_ldirichlet(const splicing_vector_t *x,
 }
 
 int splicing_mvrnorm(const splicing_matrix_t *mu, double sigma, 
-		     splicing_matrix_t *resalpha, int len) {
+		     splicing_matrix_t *resalpha, int len,
+		     splicing_rng_t *rng) {
   int i, j;
   int noChains=splicing_matrix_ncol(mu);
   double sqrtsigma = len == 1 ? sigma : sqrt(sigma);
@@ -192,7 +394,7 @@ int splicing_mvrnorm(const splicing_matrix_t *mu, double sigma,
   for (j=0; j<noChains; j++) {
     for (i=0; i<len; i++) {
       MATRIX(*resalpha, i, j) = MATRIX(*mu, i, j) + 
-	sqrtsigma * RNG_NORMAL(0,1);
+	sqrtsigma * splicing_rng_get_normal(rng, 0, 1);
     }
   }
 
@@ -240,8 +442,8 @@ int splicing_logit_inv(const splicing_matrix_t *x,
   return 0;
 }
 
-int splicing_score_joint(const splicing_matrix_int_t *assignment,
-			 int no_reads, int noChains, 
+int splicing_score_joint(const splicing_matrix_t *isocounts,
+			 int noChains, 
 			 const splicing_matrix_t *psi, 
 			 const splicing_vector_t *hyper, 
 			 const splicing_vector_int_t *effisolen,
@@ -254,21 +456,19 @@ int splicing_score_joint(const splicing_matrix_int_t *assignment,
 
   for (j=0; j<noChains; j++) {
     double readProb = 0.0, assProb, psiProb;
-    splicing_vector_t tmp;
-    splicing_vector_int_t tmp2;
+    splicing_vector_t tmp, tmp2;
     splicing_vector_view(&tmp, &MATRIX(*psi, 0, j), noiso);
-    splicing_vector_int_view(&tmp2, &MATRIX(*assignment, 0, j), no_reads);
+    splicing_vector_view(&tmp2, &MATRIX(*isocounts, 0, j), noiso);
 
-    /* Scores the reads */
-    for (i=0; i<no_reads; i++) {
-      if (MATRIX(*assignment, i, j) != -1) {
-	readProb += VECTOR(*isoscores)[ MATRIX(*assignment, i, j) ];
-      }
+    /* Scores the reads, all reads assigned to the same isoform 
+       have the same score */
+    for (i=0; i<noiso; i++) {
+      readProb += MATRIX(*isocounts, i, j) * VECTOR(*isoscores)[i];
     }
     
     /* Score isoforms */
-    SPLICING_CHECK(splicing_score_iso(&tmp, noiso, &tmp2, no_reads, 
-				      effisolen, &assProb));
+    SPLICING_CHECK(splicing_score_iso(&tmp, noiso, &tmp2, effisolen,
+				      &assProb));
     SPLICING_CHECK(splicing_ldirichlet(&tmp, hyper, noiso, &psiProb));
     
     VECTOR(*score)[j] = readProb + assProb + psiProb;
@@ -286,7 +486,7 @@ int splicing_rng_get_dirichlet(splicing_rng_t *rng,
   
   SPLICING_CHECK(splicing_vector_resize(result, l));
   for (i=0; i<l; i++) { 
-    VECTOR(*result)[i] = RNG_GAMMA(VECTOR(*alpha)[i], 1.0);
+    VECTOR(*result)[i] = splicing_rng_get_gamma(rng, VECTOR(*alpha)[i], 1.0);
     sum += VECTOR(*result)[i];
   }
   for (i=0; i<l; i++) {
@@ -307,10 +507,11 @@ int splicing_drift_proposal_init(int noiso, int noChains,
 				 const splicing_gff_t *gff, int gene, 
 				 int readLength, int overHang, 
 				 const splicing_vector_int_t *position,
-				 const char **cigarstr, int paired, 
+				 const splicing_cigar_t *readcigar, int paired, 
 				 const splicing_vector_t *fragmentProb,
 				 int fragmentStart, double normalMean,
-				 double normalVar, double numDevs) {
+				 double normalVar, double numDevs,
+				 splicing_rng_t *rng) {
 
   SPLICING_CHECK(splicing_matrix_resize(respsi, noiso, noChains));
   SPLICING_CHECK(splicing_matrix_resize(resalpha, noiso-1, noChains));
@@ -333,7 +534,7 @@ int splicing_drift_proposal_init(int noiso, int noChains,
     } else {
       int j;
       for (j=0; j<noChains; j++) {
-	MATRIX(*respsi, 0, j) = RNG_UNIF01();
+	MATRIX(*respsi, 0, j) = splicing_rng_get_unif01(rng);
 	MATRIX(*respsi, 1, j) = 1 - MATRIX(*respsi, j, 0);
 	MATRIX(*resalpha, 0, j) = 0.0;
 	MATRIX(*resalpha, 1, j) = 0.0;
@@ -366,8 +567,7 @@ int splicing_drift_proposal_init(int noiso, int noChains,
       for (i=0; i<noiso; i++) { VECTOR(alpha)[i] = 1.0; }
       for (j=0; j<noChains; j++) {
 	splicing_vector_view(&tmp, &MATRIX(*respsi, 0, j), noiso);
-	SPLICING_CHECK(splicing_rng_get_dirichlet(&splicing_rng_default,
-						  &alpha, &tmp));
+	SPLICING_CHECK(splicing_rng_get_dirichlet(rng, &alpha, &tmp));
       }
       SPLICING_CHECK(splicing_logit(respsi, resalpha, noiso-1, noChains));
       splicing_vector_destroy(&alpha);
@@ -387,7 +587,7 @@ int splicing_drift_proposal_init(int noiso, int noChains,
       SPLICING_FINALLY(splicing_vector_destroy, &tmp);
       if (!paired) { 
 	SPLICING_CHECK(splicing_solve_gene(gff, gene, readLength, 
-				       overHang, position, cigarstr,
+				       overHang, position, readcigar,
 				       /*match_matrix=*/ 0, /*nomatch=*/ 0,
 				       /*assignment_matrix=*/ 0,
 				       &tmp, /*residuals=*/ 0,
@@ -395,7 +595,7 @@ int splicing_drift_proposal_init(int noiso, int noChains,
       } else {
 	SPLICING_CHECK(splicing_solve_gene_paired(gff, gene, readLength,
 				       overHang, position,
-				       cigarstr, fragmentProb, fragmentStart,
+				       readcigar, fragmentProb, fragmentStart,
 				       normalMean, normalVar, numDevs,
 				       /*match_matrix=*/ 0, /*nomatch=*/ 0,
 				       /*assignment_matrix=*/ 0, &tmp,
@@ -420,7 +620,7 @@ int splicing_drift_proposal_init(int noiso, int noChains,
 
 int splicing_drift_proposal_propose(int noiso, int noChains, 
 				    const splicing_matrix_t *alpha,
-				    double sigma, 
+				    double sigma, splicing_rng_t *rng,
 				    splicing_matrix_t *respsi,
 				    splicing_matrix_t *resalpha) {
 
@@ -429,7 +629,7 @@ int splicing_drift_proposal_propose(int noiso, int noChains,
   int i;
   
   SPLICING_CHECK(splicing_matrix_resize(respsi, len+1, noChains));
-  SPLICING_CHECK(splicing_mvrnorm(alpha, sigma, resalpha, len));
+  SPLICING_CHECK(splicing_mvrnorm(alpha, sigma, resalpha, len, rng));
   SPLICING_CHECK(splicing_logit_inv(resalpha, respsi, len, noChains));
   for (i=0; i<noChains; i++) {
     splicing_vector_t col;
@@ -462,8 +662,67 @@ int splicing_drift_proposal_score(int noiso, int noChains,
   return 0;
 }
 
-int splicing_metropolis_hastings_ratio(const splicing_matrix_int_t *ass,
-				       int no_reads, int noChains,
+/* Given the number of reads assigned to each isoform, the read-level
+   isoform abundances, phi_i = psi_i * l_i / sum_j psi_j * l_j, have a
+   Dirichlet(hyperp + counts) conditional if the prior is on phi. The
+   prior is on PSI, so we use this as an independence proposal; the
+   acceptance ratio only depends on the mean effective length:
+   (sum_i l_i psi'_i / sum_i l_i psi_i) ^ sum(hyperp). This is one if
+   all isoforms have the same length, and close to one otherwise. */
+
+int splicing_gibbs_proposal(int noiso, int noChains,
+			    const splicing_matrix_t *isocounts,
+			    const splicing_vector_t *hyperp,
+			    const splicing_vector_int_t *effisolen,
+			    const splicing_matrix_t *psi,
+			    splicing_rng_t *rng,
+			    splicing_matrix_t *respsi,
+			    splicing_vector_t *acceptP) {
+
+  int i, j;
+  double alphasum=0.0;
+  splicing_vector_t alpha, phi;
+
+  SPLICING_CHECK(splicing_matrix_resize(respsi, noiso, noChains));
+  SPLICING_CHECK(splicing_vector_resize(acceptP, noChains));
+
+  SPLICING_CHECK(splicing_vector_init(&alpha, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &alpha);
+  SPLICING_CHECK(splicing_vector_init(&phi, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &phi);
+
+  for (i=0; i<noiso; i++) { alphasum += VECTOR(*hyperp)[i]; }
+
+  for (j=0; j<noChains; j++) {
+    double sum=0.0, lenNew=0.0, lenOld=0.0;
+    for (i=0; i<noiso; i++) {
+      VECTOR(alpha)[i] = VECTOR(*hyperp)[i] + MATRIX(*isocounts, i, j);
+    }
+    SPLICING_CHECK(splicing_rng_get_dirichlet(rng, &alpha, &phi));
+    for (i=0; i<noiso; i++) {
+      /* Isoforms shorter than the reads cannot have reads at all */
+      int l=VECTOR(*effisolen)[i] > 0 ? VECTOR(*effisolen)[i] : 1;
+      MATRIX(*respsi, i, j) = VECTOR(phi)[i] / l;
+      sum += MATRIX(*respsi, i, j);
+    }
+    for (i=0; i<noiso; i++) {
+      int l=VECTOR(*effisolen)[i] > 0 ? VECTOR(*effisolen)[i] : 1;
+      MATRIX(*respsi, i, j) /= sum;
+      lenNew += l * MATRIX(*respsi, i, j);
+      lenOld += l * MATRIX(*psi, i, j);
+    }
+    VECTOR(*acceptP)[j] = exp(alphasum * (log(lenNew) - log(lenOld)));
+  }
+
+  splicing_vector_destroy(&phi);
+  splicing_vector_destroy(&alpha);
+  SPLICING_FINALLY_CLEAN(2);
+
+  return 0;
+}
+
+int splicing_metropolis_hastings_ratio(const splicing_matrix_t *isocounts,
+				       int noChains,
 				       const splicing_matrix_t *psiNew,
 				       const splicing_matrix_t *alphaNew,
 				       const splicing_matrix_t *psi, 
@@ -489,9 +748,9 @@ int splicing_metropolis_hastings_ratio(const splicing_matrix_int_t *ass,
   SPLICING_CHECK(splicing_vector_init(&ctoPS, noChains));
   SPLICING_FINALLY(splicing_vector_destroy, &ctoPS);
 
-  SPLICING_CHECK(splicing_score_joint(ass, no_reads, noChains, psiNew, 
+  SPLICING_CHECK(splicing_score_joint(isocounts, noChains, psiNew, 
 				      hyperp, effisolen, isoscores, ppJS));
-  SPLICING_CHECK(splicing_score_joint(ass, no_reads, noChains, psi, hyperp,
+  SPLICING_CHECK(splicing_score_joint(isocounts, noChains, psi, hyperp,
 				      effisolen, isoscores, pcJS));
   
   SPLICING_CHECK(splicing_drift_proposal_score(noiso, noChains, psi, alphaNew,
@@ -601,37 +860,449 @@ int splicing_i_check_convergent_mean(splicing_matrix_t *chainMeans,
   return 0;
 }
 
-int splicing_miso(const splicing_gff_t *gff, size_t gene,
-		  const splicing_vector_int_t *position,
-		  const char **cigarstr, int readLength, int overHang,
-		  int noChains, int noIterations, 
-		  int maxIterations, int noBurnIn, int noLag,
-		  const splicing_vector_t *hyperp, 
-		  splicing_miso_start_t start,
-		  splicing_miso_stop_t stop,
-		  const splicing_matrix_t *start_psi,
-		  splicing_matrix_t *samples, splicing_vector_t *logLik,
-		  splicing_matrix_t *match_matrix, 
-		  splicing_matrix_t *class_templates,
-		  splicing_vector_t *class_counts,
-		  splicing_vector_int_t *assignment,
-		  splicing_miso_rundata_t *rundata) {
+/* Split R-hat and effective sample size, see Gelman et al.: 
+   Bayesian Data Analysis, 3rd edition, pp. 284-287. Every chain is
+   split into two halves, the autocorrelations are estimated from the
+   variogram and summed until the sum of two neighboring ones becomes
+   negative. Sample `i' belongs to chain `i % noChains'. We return 
+   the worst values over the isoforms, isoforms with no variance 
+   are ignored. */
+
+#define SPLICING_I_SPLIT(c, t) \
+  (((t) + ((c) % 2) * (n - h)) * noChains + (c) / 2)
+
+int splicing_i_miso_rhat_ess(const splicing_matrix_t *samples, 
+			     int noSamples, int noChains, 
+			     double *rhat, double *ess) {
+
+  int noiso = splicing_matrix_nrow(samples);
+  int n = noSamples / noChains, h = n / 2, M = 2 * noChains;
+  int i, c, t, k;
+  splicing_vector_t means;
+
+  *rhat = HUGE_VAL;
+  *ess = 0.0;
+
+  if (h < 4) { return 0; }
+
+  SPLICING_CHECK(splicing_vector_init(&means, M));
+  SPLICING_FINALLY(splicing_vector_destroy, &means);
+
+  *rhat = 1.0;
+  *ess = M * h;
+
+  for (i=0; i<noiso; i++) {
+    double mean=0.0, B=0.0, W=0.0, varplus, sum=0.0, r, e;
+
+    for (c=0; c<M; c++) {
+      double m=0.0;
+      for (t=0; t<h; t++) { m += MATRIX(*samples, i, SPLICING_I_SPLIT(c, t)); }
+      VECTOR(means)[c] = m / h;
+      mean += m / h;
+    }
+    mean /= M;
+
+    for (c=0; c<M; c++) {
+      double d=VECTOR(means)[c] - mean, s=0.0;
+      B += d * d;
+      for (t=0; t<h; t++) {
+	double x=MATRIX(*samples, i, SPLICING_I_SPLIT(c, t)) - 
+	  VECTOR(means)[c];
+	s += x * x;
+      }
+      W += s / (h - 1);
+    }
+    B *= h / (M - 1.0);
+    W /= M;
+    if (W <= 0) { continue; }
+    varplus = (h - 1.0) / h * W + B / h;
+    r = sqrt(varplus / W);
+
+    /* Autocorrelations from the variogram, Geyer's initial 
+       positive sequence */
+    for (t=1; t+1<h; t+=2) {
+      double rho[2];
+      for (k=0; k<2; k++) {
+	double V=0.0;
+	int u, l=t+k;
+	for (c=0; c<M; c++) {
+	  for (u=l; u<h; u++) {
+	    double d=MATRIX(*samples, i, SPLICING_I_SPLIT(c, u)) -
+	      MATRIX(*samples, i, SPLICING_I_SPLIT(c, u-l));
+	    V += d * d;
+	  }
+	}
+	V /= M * (h - l);
+	rho[k] = 1.0 - V / 2.0 / varplus;
+      }
+      if (rho[0] + rho[1] < 0) { break; }
+      sum += rho[0] + rho[1];
+    }
+    e = M * h / (1.0 + 2.0 * sum);
+
+    if (r > *rhat) { *rhat = r; }
+    if (e < *ess) { *ess = e; }
+  }
+
+  splicing_vector_destroy(&means);
+  SPLICING_FINALLY_CLEAN(1);
+
+  return 0;
+}
+
+#undef SPLICING_I_SPLIT
+
+/* Effective isoform lengths, i.e. the number of positions a read can
+   start at, and the log probability of a read position, given the 
+   isoform. */
+
+static int splicing_i_miso_effisolen(const splicing_gff_t *gff, size_t gene,
+				     int readLength, int overHang,
+				     splicing_vector_int_t *effisolen,
+				     splicing_vector_t *isoscores) {
+  splicing_vector_int_t noexons;
+  size_t i, noiso;
+
+  SPLICING_CHECK(splicing_gff_noiso_one(gff, gene, &noiso));
+  SPLICING_CHECK(splicing_vector_resize(isoscores, noiso));
+  SPLICING_CHECK(splicing_gff_isolength_one(gff, gene, effisolen));
+  SPLICING_CHECK(splicing_vector_int_init(&noexons, noiso));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &noexons);
+  SPLICING_CHECK(splicing_gff_noexons_one(gff, gene, &noexons));
+  for (i=0; i<noiso; i++) { 
+    int nox=VECTOR(noexons)[i];
+    /* The following is only approximate if there are some short exons
+       and overHang is not one */
+    int l=VECTOR(*effisolen)[i] - readLength+1 - 2*(nox-1)*(overHang-1);
+    VECTOR(*effisolen)[i] = l > 0 ? l : 0;
+    VECTOR(*isoscores)[i] = -log((double) l);
+  }
+  splicing_vector_int_destroy(&noexons);
+  SPLICING_FINALLY_CLEAN(1);
+
+  return 0;
+}
+
+/* A group of chains of splicing_miso(), with their own state. If the
+   chains run on a single thread, all of them are in one group, 
+   otherwise each chain is a group of its own, with its own RNG. */
+
+typedef struct {
+  int first, size;
+  splicing_rng_t *rng;
+  splicing_matrix_t *psi, *psiNew, *alpha, *alphaNew, *isocounts;
+  splicing_vector_t *acceptP, *cJS, *pJS;
+  int noAccepted, noRejected;
+} splicing_i_miso_chains_t;
+
+/* The data that is shared by all groups, the groups only write
+   their own columns of `samples' and their own elements of
+   `logLik'. */
+
+typedef struct {
+  int noiso, noChains, noBurnIn, noLag, from, to;
+  splicing_miso_proposal_t proposal;
+  double sigma;
+  const splicing_vector_t *hyperp;
+  const splicing_vector_int_t *effisolen;
+  const splicing_vector_t *isoscores;
+  const splicing_matrix_t *class_templates;
+  const splicing_vector_t *class_counts;
+  splicing_matrix_t *samples;
+  splicing_vector_t *logLik;
+  splicing_i_miso_chains_t *groups;
+  int noGroups, next, ret;
+  pthread_mutex_t mutex;
+} splicing_i_miso_sampler_t;
+
+/* Run iterations `from' to `to' (not including) of a group of 
+   chains. */
+
+static int splicing_i_miso_iterate(const splicing_i_miso_sampler_t *sampler,
+				   splicing_i_miso_chains_t *chains) {
+  int noiso=sampler->noiso, noChains=chains->size, noLag=sampler->noLag;
+  int noBurnIn=sampler->noBurnIn, m, j;
+  splicing_rng_t *rng=chains->rng;
+  splicing_matrix_t *psi=chains->psi, *psiNew=chains->psiNew, 
+    *alpha=chains->alpha, *alphaNew=chains->alphaNew;
+
+  for (m=sampler->from; m<sampler->to; m++) {
+
+    if (sampler->proposal == SPLICING_MISO_PROPOSAL_GIBBS) {
+      SPLICING_CHECK(splicing_gibbs_proposal(noiso, noChains, 
+					     chains->isocounts,
+					     sampler->hyperp, 
+					     sampler->effisolen, psi, rng,
+					     psiNew, chains->acceptP));
+      SPLICING_CHECK(splicing_score_joint(chains->isocounts, noChains, 
+					  psiNew, sampler->hyperp, 
+					  sampler->effisolen, 
+					  sampler->isoscores, chains->pJS));
+      SPLICING_CHECK(splicing_score_joint(chains->isocounts, noChains, psi,
+					  sampler->hyperp, 
+					  sampler->effisolen, 
+					  sampler->isoscores, chains->cJS));
+    } else {
+      SPLICING_CHECK(splicing_drift_proposal_propose(noiso, noChains, 
+						     alpha, sampler->sigma, 
+						     rng, psiNew, alphaNew));
+
+      SPLICING_CHECK(splicing_metropolis_hastings_ratio(chains->isocounts,
+							noChains, psiNew,
+							alphaNew, psi, 
+							alpha, sampler->sigma,
+							noiso,
+							sampler->effisolen,
+							sampler->hyperp,
+							sampler->isoscores, 
+							m > 0 ? 1 : 0, 
+							chains->acceptP, 
+							chains->cJS, 
+							chains->pJS));
+    }
+
+    for (j=0; j<noChains; j++) {
+      if (VECTOR(*chains->acceptP)[j] >= 1 || 
+	  splicing_rng_get_unif01(rng) < VECTOR(*chains->acceptP)[j]) {
+	memcpy(&MATRIX(*psi, 0, j), &MATRIX(*psiNew, 0, j), 
+	       noiso * sizeof(double));
+	memcpy(&MATRIX(*alpha, 0, j), &MATRIX(*alphaNew, 0, j),
+	       (noiso - 1) * sizeof(double));
+	VECTOR(*chains->cJS)[j] = VECTOR(*chains->pJS)[j];
+	chains->noAccepted ++;
+      } else {
+	chains->noRejected ++;
+      }
+    }
+
+    /* Every noLag-th sample after the burn-in is kept, the samples
+       of the chains are interleaved */
+    if (m >= noBurnIn && (m - noBurnIn + 1) % noLag == 0) {
+      int s=((m - noBurnIn + 1) / noLag - 1) * sampler->noChains + 
+	chains->first;
+      memcpy(&MATRIX(*sampler->samples, 0, s), &MATRIX(*psi, 0, 0), 
+	     noChains * noiso * sizeof(double));
+      memcpy(VECTOR(*sampler->logLik)+s, VECTOR(*chains->cJS), 
+	     noChains * sizeof(double));
+    }
+    
+    SPLICING_CHECK(splicing_reassign_classes(sampler->class_templates, 
+					     sampler->class_counts, psi, 
+					     noiso, noChains, rng, 
+					     chains->isocounts));
+  }
+
+  return 0;
+}
+
+static void *splicing_i_miso_thread(void *arg) {
+  splicing_i_miso_sampler_t *sampler = (splicing_i_miso_sampler_t*) arg;
+  int g, ret;
+
+  while (1) {
+    pthread_mutex_lock(&sampler->mutex);
+    g = sampler->next++;
+    pthread_mutex_unlock(&sampler->mutex);
+    if (g >= sampler->noGroups) { break; }
+    ret = splicing_i_miso_iterate(sampler, &sampler->groups[g]);
+    if (ret) { 
+      pthread_mutex_lock(&sampler->mutex);
+      sampler->ret = ret;
+      pthread_mutex_unlock(&sampler->mutex);
+    }
+  }
+
+  return 0;
+}
+
+/* Run iterations `from' to `to' of all groups, on `noThreads' 
+   threads. The threads are joined before returning. */
+
+static int splicing_i_miso_run(splicing_i_miso_sampler_t *sampler,
+			       int noThreads) {
+  pthread_t *threads;
+  size_t i, n;
+
+  if (noThreads <= 1 || sampler->noGroups == 1) { 
+    for (i=0; i<sampler->noGroups; i++) {
+      SPLICING_CHECK(splicing_i_miso_iterate(sampler, &sampler->groups[i]));
+    }
+    return 0;
+  }
+
+  if (noThreads > sampler->noGroups) { noThreads = sampler->noGroups; }
+  n = (size_t) noThreads;
+  threads = calloc(n, sizeof(pthread_t));
+  if (!threads) {
+    SPLICING_ERROR("Cannot run MISO chains", SPLICING_ENOMEM);
+  }
+  sampler->next = 0;
+  sampler->ret = 0;
+  for (i=0; i<n; i++) {
+    if (pthread_create(&threads[i], 0, splicing_i_miso_thread, sampler)) {
+      break;
+    }
+  }
+  /* If a thread could not be started, the others do its work */
+  if (i == 0) { splicing_i_miso_thread(sampler); }
+  while (i > 0) { pthread_join(threads[--i], 0); }
+  free(threads);
+
+  if (sampler->ret) {
+    SPLICING_ERROR("MISO chain failed", sampler->ret);
+  }
+
+  return 0;
+}
+
+/* The state of a chain running on its own thread */
+
+typedef struct {
+  splicing_rng_t rng;
+  splicing_matrix_t psi, psiNew, alpha, alphaNew, isocounts;
+  splicing_vector_t acceptP, cJS, pJS;
+} splicing_i_miso_chain_t;
+
+static void splicing_i_miso_chains_destroy(splicing_i_miso_chain_t *chains,
+					   int noChains) {
+  int j;
+  for (j=0; j<noChains; j++) {
+    splicing_vector_destroy(&chains[j].pJS);
+    splicing_vector_destroy(&chains[j].cJS);
+    splicing_vector_destroy(&chains[j].acceptP);
+    splicing_matrix_destroy(&chains[j].isocounts);
+    splicing_matrix_destroy(&chains[j].alphaNew);
+    splicing_matrix_destroy(&chains[j].alpha);
+    splicing_matrix_destroy(&chains[j].psiNew);
+    splicing_matrix_destroy(&chains[j].psi);
+    splicing_rng_destroy(&chains[j].rng);
+  }
+}
+
+/* The chains running on separate threads. Only the first `noInit'
+   chains are set up, so that the cleanup stack destroys exactly
+   these if setting up the others fails. */
+
+typedef struct {
+  splicing_i_miso_chain_t *chains;
+  int noInit;
+} splicing_i_miso_chainset_t;
+
+static void splicing_i_miso_chainset_destroy(splicing_i_miso_chainset_t *set) {
+  splicing_i_miso_chains_destroy(set->chains, set->noInit);
+  free(set->chains);
+  set->chains = 0;
+  set->noInit = 0;
+}
+
+/* Set up the chains to run on separate threads, from the current
+   state of all chains. Each chain gets its own RNG, seeded from
+   `rng'. `set' is on the cleanup stack: a chain counts as set up
+   once all of its parts are, until then its parts are on the
+   cleanup stack themselves. */
+
+static int splicing_i_miso_chains_init(splicing_i_miso_chainset_t *set,
+				       splicing_i_miso_chains_t *groups,
+				       int noiso, int noChains,
+				       const splicing_matrix_t *psi,
+				       const splicing_matrix_t *alpha,
+				       const splicing_matrix_t *isocounts,
+				       splicing_rng_t *rng) {
+  int j;
+  for (j=0; j<noChains; j++) {
+    splicing_i_miso_chain_t *c=&set->chains[j];
+    SPLICING_CHECK(splicing_rng_init(&c->rng, &splicing_rngtype_mt19937));
+    SPLICING_FINALLY(splicing_rng_destroy, &c->rng);
+    SPLICING_CHECK(splicing_rng_seed(&c->rng, 
+				     splicing_rng_get_int31(rng)));
+    SPLICING_CHECK(splicing_matrix_init(&c->psi, noiso, 1));
+    SPLICING_FINALLY(splicing_matrix_destroy, &c->psi);
+    SPLICING_CHECK(splicing_matrix_init(&c->psiNew, noiso, 1));
+    SPLICING_FINALLY(splicing_matrix_destroy, &c->psiNew);
+    SPLICING_CHECK(splicing_matrix_init(&c->alpha, noiso-1, 1));
+    SPLICING_FINALLY(splicing_matrix_destroy, &c->alpha);
+    SPLICING_CHECK(splicing_matrix_init(&c->alphaNew, noiso-1, 1));
+    SPLICING_FINALLY(splicing_matrix_destroy, &c->alphaNew);
+    SPLICING_CHECK(splicing_matrix_init(&c->isocounts, noiso, 1));
+    SPLICING_FINALLY(splicing_matrix_destroy, &c->isocounts);
+    SPLICING_CHECK(splicing_vector_init(&c->acceptP, 1));
+    SPLICING_FINALLY(splicing_vector_destroy, &c->acceptP);
+    SPLICING_CHECK(splicing_vector_init(&c->cJS, 1));
+    SPLICING_FINALLY(splicing_vector_destroy, &c->cJS);
+    SPLICING_CHECK(splicing_vector_init(&c->pJS, 1));
+    SPLICING_FINALLY_CLEAN(8);
+    set->noInit = j + 1;
+    memcpy(&MATRIX(c->psi, 0, 0), &MATRIX(*psi, 0, j), 
+	   noiso * sizeof(double));
+    memcpy(&MATRIX(c->alpha, 0, 0), &MATRIX(*alpha, 0, j), 
+	   (noiso - 1) * sizeof(double));
+    memcpy(&MATRIX(c->isocounts, 0, 0), &MATRIX(*isocounts, 0, j), 
+	   noiso * sizeof(double));
+    groups[j].first = j;
+    groups[j].size = 1;
+    groups[j].rng = &c->rng;
+    groups[j].psi = &c->psi;
+    groups[j].psiNew = &c->psiNew;
+    groups[j].alpha = &c->alpha;
+    groups[j].alphaNew = &c->alphaNew;
+    groups[j].isocounts = &c->isocounts;
+    groups[j].acceptP = &c->acceptP;
+    groups[j].cJS = &c->cJS;
+    groups[j].pJS = &c->pJS;
+  }
+  return 0;
+}
+
+/* If `given_classes' is true, then there are no reads, the sampler
+   runs on the given `class_templates' and `class_counts'. */
+
+static int splicing_i_miso(const splicing_gff_t *gff, size_t gene,
+			   const splicing_vector_int_t *position,
+			   const splicing_cigar_t *readcigar,
+			   int readLength, int overHang,
+			   int noChains, int noIterations, 
+			   int maxIterations, int noBurnIn, int noLag,
+			   const splicing_vector_t *hyperp, 
+			   splicing_miso_start_t start,
+			   splicing_miso_stop_t stop,
+			   int checkEvery, double minEss, double maxRhat,
+			   splicing_miso_proposal_t proposal,
+			   int noThreads,
+			   const splicing_matrix_t *start_psi,
+			   splicing_rng_t *rng,
+			   splicing_matrix_t *samples, splicing_vector_t *logLik,
+			   splicing_matrix_t *match_matrix, 
+			   splicing_matrix_t *class_templates,
+			   splicing_vector_t *class_counts,
+			   splicing_vector_int_t *assignment,
+			   splicing_miso_rundata_t *rundata,
+			   int given_classes) {
   splicing_vector_t acceptP, cJS, pJS;
   double sigma;
-  int noReads = splicing_vector_int_size(position);
-  splicing_matrix_int_t vass;
+  int noReads = given_classes ? 0 : splicing_vector_int_size(position);
+  splicing_matrix_t visocounts;
   size_t noiso;
   splicing_matrix_t vpsi, vpsiNew, valpha, valphaNew, 
     *psi=&vpsi, *psiNew=&vpsiNew, *alpha=&valpha, *alphaNew=&valphaNew;
   int noSamples = noChains * (noIterations - noBurnIn) / noLag;  
-  int i, j, m=0, lagCounter=0, noS=0;
+  int i, j, m=0, noS=0;
   splicing_matrix_t *mymatch_matrix=match_matrix, vmatch_matrix;
   splicing_vector_int_t match_order;
+  splicing_matrix_t *myclass_templates=class_templates, vclass_templates;
+  splicing_vector_t *myclass_counts=class_counts, vclass_counts;
   splicing_vector_int_t effisolen;
   splicing_vector_t isoscores;
-  splicing_vector_int_t noexons;
-  int shouldstop=0;
+  int shouldstop=0, converged=0;
   splicing_matrix_t chainMeans, chainVars;
+  splicing_i_miso_sampler_t sampler;
+  splicing_i_miso_chains_t allchains, *groups=&allchains;
+  splicing_i_miso_chainset_t chainset = { 0, 0 };
+  splicing_i_miso_chain_t *chains=0;
+
+  /* Use the default RNG, unless the caller gave its own. Callers that
+     run several samplers concurrently must give a separate RNG to
+     each one. */
+  if (!rng) { rng = &splicing_rng_default; }
 
   if (start == SPLICING_MISO_START_GIVEN && !start_psi) {
     SPLICING_ERROR("`start_psi' must be given when "
@@ -656,6 +1327,21 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
 		   SPLICING_EINVAL);
   }
 
+  if (given_classes) {
+    if (splicing_matrix_nrow(class_templates) != noiso ||
+	splicing_matrix_ncol(class_templates) != 
+	splicing_vector_size(class_counts)) {
+      SPLICING_ERROR("Class templates have wrong size", SPLICING_EINVAL);
+    }
+    if (start == SPLICING_MISO_START_LINEAR) {
+      SPLICING_ERROR("Cannot start from the linear model without reads",
+		     SPLICING_EINVAL);
+    }
+    for (i=0; i<splicing_vector_size(class_counts); i++) {
+      noReads += VECTOR(*class_counts)[i];
+    }
+  }
+
   if (noChains < 1) { 
     SPLICING_ERROR("Number of chains must be at least one.", 
 		   SPLICING_EINVAL);
@@ -666,6 +1352,11 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
 		   SPLICING_EINVAL);
   }
 
+  if (stop==SPLICING_MISO_STOP_RHAT_ESS && checkEvery < 1) {
+    SPLICING_ERROR("Convergence must be checked at least every "
+		   "iteration", SPLICING_EINVAL);
+  }
+
   if (start_psi && 
       (splicing_matrix_nrow(start_psi) != noiso ||
        splicing_matrix_ncol(start_psi) != noChains)) {
@@ -679,6 +1370,8 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
   rundata->noAccepted = rundata->noRejected = 0;
   rundata->noChains = noChains;
   rundata->noSamples = noSamples;
+  rundata->rhat = HUGE_VAL;
+  rundata->ess = 0.0;
 
   SPLICING_CHECK(splicing_vector_init(&acceptP, noChains));
   SPLICING_FINALLY(splicing_vector_destroy, &acceptP);
@@ -687,8 +1380,8 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
   SPLICING_CHECK(splicing_vector_init(&pJS, noChains));
   SPLICING_FINALLY(splicing_vector_destroy, &pJS);
 
-  SPLICING_CHECK(splicing_matrix_int_init(&vass, noReads, noChains));
-  SPLICING_FINALLY(splicing_matrix_int_destroy, &vass);
+  SPLICING_CHECK(splicing_matrix_init(&visocounts, noiso, noChains));
+  SPLICING_FINALLY(splicing_matrix_destroy, &visocounts);
   SPLICING_CHECK(splicing_matrix_init(&vpsi, noiso, noChains));
   SPLICING_FINALLY(splicing_matrix_destroy, &vpsi);
   SPLICING_CHECK(splicing_matrix_init(&vpsiNew, noiso, noChains));
@@ -698,22 +1391,38 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
   SPLICING_CHECK(splicing_matrix_init(&valphaNew, noiso-1, noChains));
   SPLICING_FINALLY(splicing_matrix_destroy, &valphaNew);
   
+  /* Without reads there is no match matrix */
   if (match_matrix) { 
-    SPLICING_CHECK(splicing_matrix_resize(match_matrix, noiso, noReads));
+    SPLICING_CHECK(splicing_matrix_resize(match_matrix, noiso, 
+					  given_classes ? 0 : noReads));
   } else {
     mymatch_matrix=&vmatch_matrix;
-    SPLICING_CHECK(splicing_matrix_init(mymatch_matrix, noiso, noReads));
+    SPLICING_CHECK(splicing_matrix_init(mymatch_matrix, noiso, 
+					given_classes ? 0 : noReads));
     SPLICING_FINALLY(splicing_matrix_destroy, mymatch_matrix);
   }
-  SPLICING_CHECK(splicing_vector_int_init(&match_order, noReads));
+  SPLICING_CHECK(splicing_vector_int_init(&match_order, 
+					  given_classes ? 0 : noReads));
   SPLICING_FINALLY(splicing_vector_int_destroy, &match_order);
-  SPLICING_CHECK(splicing_matchIso(gff, gene, position, cigarstr, 
-				   overHang, readLength, mymatch_matrix));
-  SPLICING_CHECK(splicing_order_matches(mymatch_matrix, &match_order));
+  if (!given_classes) {
+    SPLICING_CHECK(splicing_matchIso(gff, gene, position, readcigar, 
+				     overHang, readLength, mymatch_matrix));
+    SPLICING_CHECK(splicing_order_matches(mymatch_matrix, &match_order));
+  }
 
-  if (class_templates && class_counts) { 
+  /* The sampler works on the read classes, reads in the same class 
+     are exchangeable, so we only need the number of reads in each. */
+  if (!class_templates) {
+    myclass_templates=&vclass_templates;
+    myclass_counts=&vclass_counts;
+    SPLICING_CHECK(splicing_matrix_init(myclass_templates, 0, 0));
+    SPLICING_FINALLY(splicing_matrix_destroy, myclass_templates);
+    SPLICING_CHECK(splicing_vector_init(myclass_counts, 0));
+    SPLICING_FINALLY(splicing_vector_destroy, myclass_counts);
+  }
+  if (!given_classes) {
     SPLICING_CHECK(splicing_i_miso_classes(mymatch_matrix, &match_order, 
-					   class_templates, class_counts, 
+					   myclass_templates, myclass_counts, 
 					   /*bin_class_templates=*/ 0,
 					   /*bin_class_counts=*/ 0));
   }
@@ -722,20 +1431,8 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
   SPLICING_FINALLY(splicing_vector_int_destroy, &effisolen);
   SPLICING_CHECK(splicing_vector_init(&isoscores, noiso));
   SPLICING_FINALLY(splicing_vector_destroy, &isoscores);
-  SPLICING_CHECK(splicing_gff_isolength_one(gff, gene, &effisolen));
-  SPLICING_CHECK(splicing_vector_int_init(&noexons, noiso));
-  SPLICING_FINALLY(splicing_vector_int_destroy, &noexons);
-  SPLICING_CHECK(splicing_gff_noexons_one(gff, gene, &noexons));
-  for (i=0; i<noiso; i++) { 
-    int nox=VECTOR(noexons)[i];
-    /* The following is only approximate if there are some short exons
-       and overHang is not one */
-    int l=VECTOR(effisolen)[i] - readLength+1 - 2*(nox-1)*(overHang-1);
-    VECTOR(effisolen)[i] = l > 0 ? l : 0;
-    VECTOR(isoscores)[i] = -log((double) l);
-  }
-  splicing_vector_int_destroy(&noexons);
-  SPLICING_FINALLY_CLEAN(1);
+  SPLICING_CHECK(splicing_i_miso_effisolen(gff, gene, readLength, overHang,
+					   &effisolen, &isoscores));
 
   SPLICING_CHECK(splicing_matrix_init(&chainMeans, noiso, noChains));
   SPLICING_FINALLY(splicing_matrix_destroy, &chainMeans);
@@ -751,68 +1448,107 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
 					      psi, alpha, &sigma,
 					      start, start_psi,
 					      gff, gene, readLength,
-					      overHang, position, cigarstr,
-					      /*paired=*/ 0, 0, 0, 0, 0, 0));
+					      overHang, position, readcigar,
+					      /*paired=*/ 0, 0, 0, 0, 0, 0,
+					      rng));
 
   SPLICING_CHECK(splicing_drift_proposal_propose(noiso, noChains, 
-						 alpha, sigma, psi, alpha));
+						 alpha, sigma, rng,
+						 psi, alpha));
   
   /* Initialize assignments of reads */  
   printf("no chains: %d\n", noChains);
 
   
-  SPLICING_CHECK(splicing_reassign_samples(mymatch_matrix, &match_order,
-					   psi, noiso, noChains, &vass));
+  SPLICING_CHECK(splicing_reassign_classes(myclass_templates, 
+					   myclass_counts, psi, noiso, 
+					   noChains, rng, &visocounts));
+
+  allchains.first = 0;
+  allchains.size = noChains;
+  allchains.rng = rng;
+  allchains.psi = psi;
+  allchains.psiNew = psiNew;
+  allchains.alpha = alpha;
+  allchains.alphaNew = alphaNew;
+  allchains.isocounts = &visocounts;
+  allchains.acceptP = &acceptP;
+  allchains.cJS = &cJS;
+  allchains.pJS = &pJS;
+
+  sampler.noiso = noiso;
+  sampler.noChains = noChains;
+  sampler.proposal = proposal;
+  sampler.sigma = sigma;
+  sampler.hyperp = hyperp;
+  sampler.effisolen = &effisolen;
+  sampler.isoscores = &isoscores;
+  sampler.class_templates = myclass_templates;
+  sampler.class_counts = myclass_counts;
+  sampler.samples = samples;
+  sampler.logLik = logLik;
+  sampler.groups = groups;
+  sampler.noGroups = 1;
+
+  /* The chains are independent, so they can run on separate threads
+     between the convergence checks. */
+  if (noThreads > 1 && noChains > 1) {
+    groups = calloc((size_t) noChains, sizeof(splicing_i_miso_chains_t));
+    if (!groups) {
+      SPLICING_ERROR("Cannot run MISO chains", SPLICING_ENOMEM);
+    }
+    SPLICING_FINALLY(free, groups);
+    chains = calloc((size_t) noChains, sizeof(splicing_i_miso_chain_t));
+    if (!chains) {
+      SPLICING_ERROR("Cannot run MISO chains", SPLICING_ENOMEM);
+    }
+    chainset.chains = chains;
+    SPLICING_FINALLY(splicing_i_miso_chainset_destroy, &chainset);
+    SPLICING_CHECK(splicing_i_miso_chains_init(&chainset, groups, noiso, 
+					       noChains, psi, alpha, 
+					       &visocounts, rng));
+    sampler.groups = groups;
+    sampler.noGroups = noChains;
+    pthread_mutex_init(&sampler.mutex, 0);
+  }
 
   while (1) {
 
     for (m=0, rundata->noAccepted=0, rundata->noRejected=0; 
-	 m < noIterations; 
-	 m++) {
-      
-      SPLICING_CHECK(splicing_drift_proposal_propose(noiso, noChains, 
-						     alpha, sigma, 
-						     psiNew, alphaNew));
+	 m < noIterations; ) {
 
-      SPLICING_CHECK(splicing_metropolis_hastings_ratio(&vass, noReads, 
-							noChains, psiNew,
-							alphaNew, psi, alpha,
-							sigma, noiso, 
-							&effisolen, hyperp,
-							&isoscores, 
-							m > 0 ? 1 : 0, 
-							&acceptP, &cJS, 
-							&pJS));
+      int to = noIterations;
+      if (stop == SPLICING_MISO_STOP_RHAT_ESS) {
+	to = m < noBurnIn ? noBurnIn + checkEvery : m + checkEvery;
+	if (to > noIterations) { to = noIterations; }
+      }
 
-      for (j=0; j<noChains; j++) {
-	if (VECTOR(acceptP)[j] >= 1 || RNG_UNIF01() < VECTOR(acceptP)[j]) {
-	  memcpy(&MATRIX(*psi, 0, j), &MATRIX(*psiNew, 0, j), 
-		 noiso * sizeof(double));
-	  memcpy(&MATRIX(*alpha, 0, j), &MATRIX(*alphaNew, 0, j),
-		 (noiso - 1) * sizeof(double));
-	  VECTOR(cJS)[j] = VECTOR(pJS)[j];
-	  rundata->noAccepted ++;
-	} else {
-	  rundata->noRejected ++;
-	}
+      sampler.noBurnIn = noBurnIn;
+      sampler.noLag = noLag;
+      sampler.from = m;
+      sampler.to = to;
+      for (i=0; i<sampler.noGroups; i++) {
+	groups[i].noAccepted = groups[i].noRejected = 0;
       }
-      
-      if (m >= noBurnIn) {
-	if (lagCounter == noLag - 1) {
-	  memcpy(&MATRIX(*samples, 0, noS), &MATRIX(*psi, 0, 0), 
-		 noChains * noiso * sizeof(double));
-	  memcpy(VECTOR(*logLik)+noS, VECTOR(cJS), 
-		 noChains * sizeof(double));
-	  noS += noChains;
-	  lagCounter = 0;
-	} else {
-	  lagCounter ++;
+      SPLICING_CHECK(splicing_i_miso_run(&sampler, noThreads));
+      for (i=0; i<sampler.noGroups; i++) {
+	rundata->noAccepted += groups[i].noAccepted;
+	rundata->noRejected += groups[i].noRejected;
+      }
+      m = to;
+      noS = m > noBurnIn ? noChains * ((m - noBurnIn) / noLag) : 0;
+
+      if (stop == SPLICING_MISO_STOP_RHAT_ESS && m > noBurnIn &&
+	  (m - noBurnIn) % checkEvery == 0) {
+	SPLICING_CHECK(splicing_i_miso_rhat_ess(samples, noS, noChains,
+						&rundata->rhat, 
+						&rundata->ess));
+	if (rundata->rhat <= maxRhat && rundata->ess >= minEss) {
+	  converged = 1;
+	  break;
 	}
       }
       
-      SPLICING_CHECK(splicing_reassign_samples(mymatch_matrix, &match_order, 
-					       psi, noiso, noChains, &vass));
-      
     } /* for m < noIterations */
     
     /* Should we stop? */
@@ -830,6 +1566,9 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
 							&shouldstop));
       }
       break;
+    case SPLICING_MISO_STOP_RHAT_ESS:
+      shouldstop = 1;
+      break;
     }
     
     if (shouldstop) { break; }
@@ -838,27 +1577,79 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
     noIterations = 3*noIterations - 2*noBurnIn;
     noBurnIn = m;
     noSamples = noChains * (noIterations - noBurnIn) / noLag;
-    lagCounter = 0;
 
     SPLICING_CHECK(splicing_matrix_resize(samples, noiso, noSamples));
     SPLICING_CHECK(splicing_vector_resize(logLik, noSamples));
   }
+
+  if (chains) {
+    /* The last PSI of the chains, for the assignment below */
+    for (j=0; j<noChains; j++) {
+      memcpy(&MATRIX(*psi, 0, j), &MATRIX(chains[j].psi, 0, 0),
+	     noiso * sizeof(double));
+    }
+    pthread_mutex_destroy(&sampler.mutex);
+    splicing_i_miso_chainset_destroy(&chainset);
+    free(groups);
+    SPLICING_FINALLY_CLEAN(2);
+  }
   
+  /* Stopped early, only keep the samples we have */
+  if (converged) {
+    rundata->noIters = m;
+    rundata->noSamples = noSamples = noS;
+    SPLICING_CHECK(splicing_matrix_resize(samples, noiso, noSamples));
+    SPLICING_CHECK(splicing_vector_resize(logLik, noSamples));
+  }
+
   splicing_matrix_destroy(&chainVars);
   splicing_matrix_destroy(&chainMeans);
   SPLICING_FINALLY_CLEAN(2);
 
+  /* The individual reads are only assigned to isoforms if the 
+     caller wants to see it, based on the last PSI of the first chain */
   if (assignment) {
+    splicing_matrix_int_t vass;
+    SPLICING_CHECK(splicing_matrix_int_init(&vass, noReads, 1));
+    SPLICING_FINALLY(splicing_matrix_int_destroy, &vass);
+    if (given_classes) {
+      /* The reads are listed class by class */
+      splicing_match_classes_t classes;
+      SPLICING_CHECK(splicing_match_classes_init(&classes));
+      SPLICING_FINALLY(splicing_match_classes_destroy, &classes);
+      SPLICING_CHECK(splicing_template_classes(myclass_templates, 
+					       myclass_counts, &classes,
+					       &match_order));
+      SPLICING_CHECK(splicing_i_reassign_samples(&classes, &match_order,
+						 psi, noiso, 
+						 /*noChains=*/ 1, 
+						 /*weighted=*/ 0, rng, &vass));
+      splicing_match_classes_destroy(&classes);
+      SPLICING_FINALLY_CLEAN(1);
+    } else {
+      SPLICING_CHECK(splicing_reassign_samples(mymatch_matrix, &match_order,
+					       /*classes=*/ 0, psi, noiso, 
+					       /*noChains=*/ 1, 
+					       rng, &vass));
+    }
     SPLICING_CHECK(splicing_vector_int_resize(assignment, noReads));
     for (i=0; i<noReads; i++) {
       VECTOR(*assignment)[i] = MATRIX(vass, i, 0);
     }
+    splicing_matrix_int_destroy(&vass);
+    SPLICING_FINALLY_CLEAN(1);
   }
 
   splicing_vector_destroy(&isoscores);
   splicing_vector_int_destroy(&effisolen);
+  SPLICING_FINALLY_CLEAN(2);
+  if (!class_templates) {
+    splicing_vector_destroy(myclass_counts);
+    splicing_matrix_destroy(myclass_templates);
+    SPLICING_FINALLY_CLEAN(2);
+  }
   splicing_vector_int_destroy(&match_order);
-  SPLICING_FINALLY_CLEAN(3);
+  SPLICING_FINALLY_CLEAN(1);
   if (!match_matrix) {
     splicing_matrix_destroy(mymatch_matrix);
     SPLICING_FINALLY_CLEAN(1);
@@ -867,7 +1658,7 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
   splicing_matrix_destroy(&valpha);
   splicing_matrix_destroy(&vpsiNew);
   splicing_matrix_destroy(&vpsi);
-  splicing_matrix_int_destroy(&vass);
+  splicing_matrix_destroy(&visocounts);
   splicing_vector_destroy(&cJS);
   splicing_vector_destroy(&pJS);
   splicing_vector_destroy(&acceptP);
@@ -880,10 +1671,565 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
     splicing_matrix_remove_cols_section(samples, 0,
 					noSamples-rundata->noSamples);
   }
+
+  SPLICING_CHECK(splicing_i_miso_rhat_ess(samples, rundata->noSamples, 
+					  noChains, &rundata->rhat, 
+					  &rundata->ess));
   
   return 0;
 }
 
+int splicing_miso(const splicing_gff_t *gff, size_t gene,
+		  const splicing_vector_int_t *position,
+		  const splicing_cigar_t *readcigar,
+		  int readLength, int overHang,
+		  int noChains, int noIterations, 
+		  int maxIterations, int noBurnIn, int noLag,
+		  const splicing_vector_t *hyperp, 
+		  splicing_miso_start_t start,
+		  splicing_miso_stop_t stop,
+		  int checkEvery, double minEss, double maxRhat,
+		  splicing_miso_proposal_t proposal,
+		  int noThreads,
+		  const splicing_matrix_t *start_psi,
+		  splicing_rng_t *rng,
+		  splicing_matrix_t *samples, splicing_vector_t *logLik,
+		  splicing_matrix_t *match_matrix, 
+		  splicing_matrix_t *class_templates,
+		  splicing_vector_t *class_counts,
+		  splicing_vector_int_t *assignment,
+		  splicing_miso_rundata_t *rundata) {
+
+  return splicing_i_miso(gff, gene, position, readcigar, readLength, 
+			 overHang, noChains, noIterations, maxIterations,
+			 noBurnIn, noLag, hyperp, start, stop, checkEvery,
+			 minEss, maxRhat, proposal, noThreads, start_psi, 
+			 rng, samples, logLik, match_matrix, class_templates,
+			 class_counts, assignment, rundata, 
+			 /*given_classes=*/ 0);
+}
+
+/* Run MISO on the read classes of a gene (as returned by
+   splicing_miso() in `class_templates' and `class_counts'), instead
+   of the reads. This gives the same samples as running on the reads,
+   with the same RNG state, but the reads do not need to be read and
+   matched to the isoforms again. The assignment lists the reads
+   class by class. */
+
+int splicing_miso_classes(const splicing_gff_t *gff, size_t gene,
+			  const splicing_matrix_t *class_templates,
+			  const splicing_vector_t *class_counts,
+			  int readLength, int overHang,
+			  int noChains, int noIterations, 
+			  int maxIterations, int noBurnIn, int noLag,
+			  const splicing_vector_t *hyperp, 
+			  splicing_miso_start_t start,
+			  splicing_miso_stop_t stop,
+			  int checkEvery, double minEss, double maxRhat,
+			  splicing_miso_proposal_t proposal,
+			  int noThreads,
+			  const splicing_matrix_t *start_psi,
+			  splicing_rng_t *rng,
+			  splicing_matrix_t *samples, 
+			  splicing_vector_t *logLik,
+			  splicing_vector_int_t *assignment,
+			  splicing_miso_rundata_t *rundata) {
+
+  /* The classes are only read */
+  return splicing_i_miso(gff, gene, /*position=*/ 0, /*readcigar=*/ 0,
+			 readLength, overHang, noChains, noIterations, 
+			 maxIterations, noBurnIn, noLag, hyperp, start, stop,
+			 checkEvery, minEss, maxRhat, proposal, noThreads,
+			 start_psi, rng, samples, logLik, 
+			 /*match_matrix=*/ 0,
+			 (splicing_matrix_t*) class_templates,
+			 (splicing_vector_t*) class_counts,
+			 assignment, rundata, /*given_classes=*/ 1);
+}
+
+static double splicing_i_digamma(double x) {
+  double r=0.0, f;
+  while (x < 6) { r -= 1/x; x += 1; }
+  f = 1/(x*x);
+  return r + log(x) - 0.5/x - 
+    f * (1.0/12 - f * (1.0/120 - f * (1.0/252 - f * (1.0/240 - f/132))));
+}
+
+/* One term w * log(b'u) of the log posterior of the isoforms in
+   logistic coordinates, see below. Adds the gradient and the negative
+   Hessian of the term, in the first noiso-1 coordinates, if they are
+   requested. `r' is workspace. */
+
+static double splicing_i_miso_vb_term(int noiso, double w, const double *b,
+				      const double *u, double *r,
+				      double *grad, splicing_matrix_t *negH) {
+  int i, j, n=noiso-1;
+  double B=0.0;
+
+  if (w == 0) { return 0.0; }
+  for (i=0; i<noiso; i++) { B += b[i] * u[i]; }
+  for (i=0; i<n; i++) { r[i] = b[i] * u[i] / B; }
+  if (grad) {
+    for (i=0; i<n; i++) { grad[i] += w * r[i]; }
+  }
+  if (negH) {
+    for (i=0; i<n; i++) {
+      for (j=0; j<n; j++) { MATRIX(*negH, i, j) += w * r[i] * r[j]; }
+      MATRIX(*negH, i, i) -= w * r[i];
+    }
+  }
+  return w * log(B);
+}
+
+/* The log posterior of PSI (up to a constant), in the logistic
+   coordinates y_i = log(PSI_i / PSI_n), with the reads not assigned.
+   In these coordinates it is a sum of w * log(b'u) terms, where 
+   u_i = exp(y_i): a_i * y_i from the prior (the Jacobian adds one to 
+   the Dirichlet exponents), one term for each read class, one for the
+   effective isoform lengths, and one for the normalization of PSI.
+   `u', `b' and `r' are workspace of length noiso. */
+
+static double splicing_i_miso_vb_score(const splicing_matrix_t *templates,
+				       const splicing_vector_t *counts,
+				       const splicing_vector_int_t *effisolen,
+				       const splicing_vector_t *hyperp,
+				       const double *y, double *u, double *b,
+				       double *r, double *grad, 
+				       splicing_matrix_t *negH) {
+  int noiso=splicing_vector_size(hyperp), n=noiso-1;
+  int noclasses=splicing_vector_size(counts);
+  int i, c;
+  double ymax=0.0, hypersum=0.0, noReads=0.0, score=0.0;
+
+  /* Shifting y does not change the score, but avoids overflow */
+  for (i=0; i<n; i++) { if (y[i] > ymax) { ymax=y[i]; } }
+  for (i=0; i<n; i++) { u[i] = exp(y[i] - ymax); }
+  u[n] = exp(-ymax);
+  if (grad) { memset(grad, 0, n * sizeof(double)); }
+  if (negH) { splicing_matrix_null(negH); }
+
+  for (i=0; i<noiso; i++) { 
+    hypersum += VECTOR(*hyperp)[i];
+    if (i < n) {
+      score += VECTOR(*hyperp)[i] * y[i];
+      if (grad) { grad[i] += VECTOR(*hyperp)[i]; }
+    }
+  }
+  for (c=0; c<noclasses; c++) {
+    int nonzero=0;
+    for (i=0; i<noiso; i++) {
+      b[i] = MATRIX(*templates, i, c) != 0 && VECTOR(*effisolen)[i] > 0 ?
+	1.0 : 0.0;
+      nonzero = nonzero || b[i] != 0;
+    }
+    if (!nonzero) { continue; }
+    noReads += VECTOR(*counts)[c];
+    score += splicing_i_miso_vb_term(noiso, VECTOR(*counts)[c], b, u, r,
+				     grad, negH);
+  }
+  for (i=0; i<noiso; i++) { b[i] = VECTOR(*effisolen)[i]; }
+  score += splicing_i_miso_vb_term(noiso, -noReads, b, u, r, grad, negH);
+  for (i=0; i<noiso; i++) { b[i] = 1.0; }
+  score += splicing_i_miso_vb_term(noiso, -hypersum, b, u, r, grad, negH);
+
+  return score - hypersum * ymax;
+}
+
+/* Cholesky decomposition of a positive definite matrix, in the lower
+   triangle of L. Returns zero if the matrix is not positive definite. */
+
+static int splicing_i_miso_vb_cholesky(const splicing_matrix_t *A,
+				       splicing_matrix_t *L) {
+  int n=splicing_matrix_nrow(A);
+  int i, j, k;
+  for (j=0; j<n; j++) {
+    double d=MATRIX(*A, j, j);
+    for (k=0; k<j; k++) { d -= MATRIX(*L, j, k) * MATRIX(*L, j, k); }
+    if (!(d > 0)) { return 0; }
+    MATRIX(*L, j, j) = sqrt(d);
+    for (i=j+1; i<n; i++) {
+      double e=MATRIX(*A, i, j);
+      for (k=0; k<j; k++) { e -= MATRIX(*L, i, k) * MATRIX(*L, j, k); }
+      MATRIX(*L, i, j) = e / MATRIX(*L, j, j);
+    }
+  }
+  return 1;
+}
+
+/* Mean-field posteriors are too narrow if many reads are compatible
+   with several isoforms, and a Dirichlet has a single precision for
+   all isoforms. So the samples are drawn from the Laplace
+   approximation of the marginal posterior (reads not assigned) in
+   logistic coordinates instead, i.e. from a logistic normal
+   distribution with its own variance for each isoform. The mode is
+   found with Newton's method, starting from the variational mean
+   `alpha'. The draws are used as independence proposals, with the
+   exact marginal posterior as the target, so the tails are right,
+   too. */
+
+static int splicing_i_miso_vb_sample(const splicing_matrix_t *templates,
+				     const splicing_vector_t *counts,
+				     const splicing_vector_int_t *effisolen,
+				     const splicing_vector_t *hyperp,
+				     const splicing_vector_t *alpha,
+				     int noSamples, splicing_rng_t *rng,
+				     splicing_matrix_t *samples,
+				     splicing_miso_rundata_t *rundata) {
+  int noiso=splicing_vector_size(alpha), n=noiso-1;
+  int i, j, c, it;
+  double score, ridge=0.0, oldweight=0.0;
+  splicing_vector_t y, ynew, u, b, r, grad, step;
+  splicing_matrix_t negH, L;
+
+  SPLICING_CHECK(splicing_matrix_resize(samples, noiso, noSamples));
+  rundata->noAccepted = rundata->noRejected = 0;
+  if (noiso < 2) {
+    splicing_matrix_fill(samples, 1.0);
+    rundata->noAccepted = noSamples;
+    return 0;
+  }
+
+  SPLICING_CHECK(splicing_vector_init(&y, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &y);
+  SPLICING_CHECK(splicing_vector_init(&ynew, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &ynew);
+  SPLICING_CHECK(splicing_vector_init(&u, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &u);
+  SPLICING_CHECK(splicing_vector_init(&b, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &b);
+  SPLICING_CHECK(splicing_vector_init(&r, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &r);
+  SPLICING_CHECK(splicing_vector_init(&grad, n));
+  SPLICING_FINALLY(splicing_vector_destroy, &grad);
+  SPLICING_CHECK(splicing_vector_init(&step, n));
+  SPLICING_FINALLY(splicing_vector_destroy, &step);
+  SPLICING_CHECK(splicing_matrix_init(&negH, n, n));
+  SPLICING_FINALLY(splicing_matrix_destroy, &negH);
+  SPLICING_CHECK(splicing_matrix_init(&L, n, n));
+  SPLICING_FINALLY(splicing_matrix_destroy, &L);
+
+  /* Start from the variational mean, converted to PSI */
+  for (i=0; i<noiso; i++) {
+    int l=VECTOR(*effisolen)[i] > 0 ? VECTOR(*effisolen)[i] : 1;
+    VECTOR(y)[i] = log(VECTOR(*alpha)[i] / l);
+  }
+  for (i=0; i<n; i++) { VECTOR(y)[i] -= VECTOR(y)[n]; }
+  VECTOR(y)[n] = 0.0;
+
+  /* Newton's method, with a ridge added to the negative Hessian if
+     it is not positive definite, and step halving */
+  score = splicing_i_miso_vb_score(templates, counts, effisolen, hyperp,
+				   VECTOR(y), VECTOR(u), VECTOR(b), 
+				   VECTOR(r), VECTOR(grad), &negH);
+  for (it=0; it<100; it++) {
+    double decr=0.0, t, newscore=score;
+    for (i=0; i<n; i++) { MATRIX(negH, i, i) += ridge; }
+    if (!splicing_i_miso_vb_cholesky(&negH, &L)) {
+      for (i=0; i<n; i++) { MATRIX(negH, i, i) -= ridge; }
+      ridge = ridge == 0 ? 1e-6 + 1e-3 * fabs(MATRIX(negH, 0, 0)) : 
+	ridge * 10;
+      continue;
+    }
+    for (i=0; i<n; i++) {
+      double e=VECTOR(grad)[i];
+      for (j=0; j<i; j++) { e -= MATRIX(L, i, j) * VECTOR(step)[j]; }
+      VECTOR(step)[i] = e / MATRIX(L, i, i);
+    }
+    for (i=n-1; i>=0; i--) {
+      double e=VECTOR(step)[i];
+      for (j=i+1; j<n; j++) { e -= MATRIX(L, j, i) * VECTOR(step)[j]; }
+      VECTOR(step)[i] = e / MATRIX(L, i, i);
+    }
+    for (i=0; i<n; i++) { decr += VECTOR(grad)[i] * VECTOR(step)[i]; }
+    if (decr < 1e-10) { break; }
+    for (t=1.0; t>1e-10; t/=2) {
+      for (i=0; i<n; i++) {
+	VECTOR(ynew)[i] = VECTOR(y)[i] + t * VECTOR(step)[i];
+      }
+      newscore = splicing_i_miso_vb_score(templates, counts, effisolen, 
+					  hyperp, VECTOR(ynew), VECTOR(u),
+					  VECTOR(b), VECTOR(r), 0, 0);
+      if (newscore >= score) { break; }
+    }
+    if (!(newscore >= score)) { break; }
+    memcpy(VECTOR(y), VECTOR(ynew), n * sizeof(double));
+    score = splicing_i_miso_vb_score(templates, counts, effisolen, hyperp,
+				     VECTOR(y), VECTOR(u), VECTOR(b), 
+				     VECTOR(r), VECTOR(grad), &negH);
+    ridge = 0.0;
+  }
+
+  /* Covariance at the mode */
+  score = splicing_i_miso_vb_score(templates, counts, effisolen, hyperp,
+				   VECTOR(y), VECTOR(u), VECTOR(b), 
+				   VECTOR(r), VECTOR(grad), &negH);
+  for (ridge=0.0; !splicing_i_miso_vb_cholesky(&negH, &L); ) {
+    double add = ridge == 0 ? 1e-6 + 1e-3 * fabs(MATRIX(negH, 0, 0)) : 
+      ridge * 9;
+    for (i=0; i<n; i++) { MATRIX(negH, i, i) += add; }
+    ridge += add;
+  }
+
+  for (c=0; c<noSamples; c++) {
+    double zz=0.0, weight, sum=0.0;
+    /* y = mode + L^-T z, so that its covariance is the inverse of the
+       negative Hessian */
+    for (i=0; i<n; i++) {
+      VECTOR(step)[i] = splicing_rng_get_normal(rng, 0.0, 1.0);
+      zz += VECTOR(step)[i] * VECTOR(step)[i];
+    }
+    for (i=n-1; i>=0; i--) {
+      double e=VECTOR(step)[i];
+      for (j=i+1; j<n; j++) { e -= MATRIX(L, j, i) * VECTOR(step)[j]; }
+      VECTOR(step)[i] = e / MATRIX(L, i, i);
+      VECTOR(ynew)[i] = VECTOR(y)[i] + VECTOR(step)[i];
+    }
+    weight = splicing_i_miso_vb_score(templates, counts, effisolen, 
+				      hyperp, VECTOR(ynew), VECTOR(u), 
+				      VECTOR(b), VECTOR(r), 0, 0) + zz / 2;
+    if (c == 0 || 
+	splicing_rng_get_unif01(rng) < exp(weight - oldweight)) {
+      oldweight = weight;
+      for (i=0; i<noiso; i++) { sum += VECTOR(u)[i]; }
+      for (i=0; i<noiso; i++) { MATRIX(*samples, i, c) = VECTOR(u)[i] / sum; }
+      rundata->noAccepted ++;
+    } else {
+      memcpy(&MATRIX(*samples, 0, c), &MATRIX(*samples, 0, c-1), 
+	     noiso * sizeof(double));
+      rundata->noRejected ++;
+    }
+  }
+
+  splicing_matrix_destroy(&L);
+  splicing_matrix_destroy(&negH);
+  splicing_vector_destroy(&step);
+  splicing_vector_destroy(&grad);
+  splicing_vector_destroy(&r);
+  splicing_vector_destroy(&b);
+  splicing_vector_destroy(&u);
+  splicing_vector_destroy(&ynew);
+  splicing_vector_destroy(&y);
+  SPLICING_FINALLY_CLEAN(9);
+
+  return 0;
+}
+
+/* Mean-field variational Bayes, a fast alternative to the sampler,
+   for single-end reads. The read-level isoform abundances (PSI 
+   weighted by the effective isoform lengths) get a Dirichlet
+   posterior, and the reads of each class are split among the 
+   isoforms in expectation. After convergence, `noSamples' PSI
+   values are drawn from the Laplace approximation of the marginal
+   posterior around its mode, see above, so the results
+   can be summarized the same way as the samples of splicing_miso().
+   `logLik' is the joint score of each PSI sample, with the expected
+   number of reads for each isoform. `assignment' is an isoform drawn
+   for each read, from its variational distribution. */
+
+int splicing_miso_vb(const splicing_gff_t *gff, size_t gene,
+		     const splicing_vector_int_t *position,
+		     const splicing_cigar_t *readcigar,
+		     int readLength, int overHang,
+		     int noSamples, int maxIterations, double tolerance,
+		     const splicing_vector_t *hyperp, 
+		     splicing_rng_t *rng,
+		     splicing_matrix_t *samples, splicing_vector_t *logLik,
+		     splicing_vector_t *resalpha,
+		     splicing_matrix_t *match_matrix, 
+		     splicing_matrix_t *class_templates,
+		     splicing_vector_t *class_counts,
+		     splicing_vector_int_t *assignment,
+		     splicing_miso_rundata_t *rundata) {
+
+  int noReads = splicing_vector_int_size(position);
+  size_t noiso;
+  int i, c, it, noclasses;
+  double maxdiff;
+  splicing_matrix_t *mymatch_matrix=match_matrix, vmatch_matrix;
+  splicing_vector_int_t match_order;
+  splicing_matrix_t *myclass_templates=class_templates, vclass_templates;
+  splicing_vector_t *myclass_counts=class_counts, vclass_counts;
+  splicing_vector_t *alpha=resalpha, valpha;
+  splicing_vector_int_t effisolen;
+  splicing_vector_t isoscores, elogphi, counts, weights, phi;
+  splicing_matrix_t expcounts;
+
+  if (!rng) { rng = &splicing_rng_default; }
+
+  if ( (class_templates ? 1 : 0) + (class_counts ? 1 : 0) == 1) {
+    SPLICING_ERROR("Only one of `class_templates' and `class_counts' is "
+		   "given", SPLICING_EINVAL);
+  }
+
+  if (overHang==0) { overHang=1; }
+  if (overHang < 1 || overHang >= readLength / 2) {
+    SPLICING_ERROR("Overhang length invalid. Must be between 0 and "
+		   "readLength/2", SPLICING_EINVAL);
+  }
+
+  SPLICING_CHECK(splicing_gff_noiso_one(gff, gene, &noiso));
+
+  if (splicing_vector_size(hyperp) != noiso) { 
+    SPLICING_ERROR("Invalid hyperparameter vector length", 
+		   SPLICING_EINVAL);
+  }
+
+  if (match_matrix) { 
+    SPLICING_CHECK(splicing_matrix_resize(match_matrix, noiso, noReads));
+  } else {
+    mymatch_matrix=&vmatch_matrix;
+    SPLICING_CHECK(splicing_matrix_init(mymatch_matrix, noiso, noReads));
+    SPLICING_FINALLY(splicing_matrix_destroy, mymatch_matrix);
+  }
+  SPLICING_CHECK(splicing_vector_int_init(&match_order, noReads));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &match_order);
+  if (!class_templates) {
+    myclass_templates=&vclass_templates;
+    myclass_counts=&vclass_counts;
+    SPLICING_CHECK(splicing_matrix_init(myclass_templates, 0, 0));
+    SPLICING_FINALLY(splicing_matrix_destroy, myclass_templates);
+    SPLICING_CHECK(splicing_vector_init(myclass_counts, 0));
+    SPLICING_FINALLY(splicing_vector_destroy, myclass_counts);
+  }
+  if (!resalpha) {
+    alpha=&valpha;
+    SPLICING_CHECK(splicing_vector_init(alpha, noiso));
+    SPLICING_FINALLY(splicing_vector_destroy, alpha);
+  }
+  SPLICING_CHECK(splicing_vector_int_init(&effisolen, noiso));
+  SPLICING_FINALLY(splicing_vector_int_destroy, &effisolen);
+  SPLICING_CHECK(splicing_vector_init(&isoscores, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &isoscores);
+  SPLICING_CHECK(splicing_vector_init(&elogphi, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &elogphi);
+  SPLICING_CHECK(splicing_vector_init(&counts, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &counts);
+  SPLICING_CHECK(splicing_vector_init(&weights, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &weights);
+  SPLICING_CHECK(splicing_vector_init(&phi, noiso));
+  SPLICING_FINALLY(splicing_vector_destroy, &phi);
+
+  SPLICING_CHECK(splicing_matchIso(gff, gene, position, readcigar, 
+				   overHang, readLength, mymatch_matrix));
+  SPLICING_CHECK(splicing_order_matches(mymatch_matrix, &match_order));
+  SPLICING_CHECK(splicing_i_miso_classes(mymatch_matrix, &match_order, 
+					 myclass_templates, myclass_counts, 
+					 /*bin_class_templates=*/ 0,
+					 /*bin_class_counts=*/ 0));
+  noclasses = splicing_vector_size(myclass_counts);
+  SPLICING_CHECK(splicing_i_miso_effisolen(gff, gene, readLength, overHang,
+					   &effisolen, &isoscores));
+
+  /* Start from the prior, with the reads split evenly */
+  SPLICING_CHECK(splicing_vector_resize(alpha, noiso));
+  for (i=0; i<noiso; i++) { 
+    VECTOR(*alpha)[i] = VECTOR(*hyperp)[i] + (double) noReads / noiso;
+  }
+
+  for (it=0, maxdiff=tolerance+1; it<maxIterations && maxdiff>tolerance;
+       it++) {
+    double alphasum=0.0, dsum;
+    for (i=0; i<noiso; i++) { alphasum += VECTOR(*alpha)[i]; }
+    dsum=splicing_i_digamma(alphasum);
+    for (i=0; i<noiso; i++) {
+      VECTOR(elogphi)[i] = splicing_i_digamma(VECTOR(*alpha)[i]) - dsum;
+    }
+    splicing_vector_null(&counts);
+    for (c=0; c<noclasses; c++) {
+      double *templ=&MATRIX(*myclass_templates, 0, c), sumw=0.0;
+      for (i=0; i<noiso; i++) {
+	if (templ[i] != 0 && VECTOR(effisolen)[i] > 0) {
+	  VECTOR(weights)[i] = exp(VECTOR(elogphi)[i] + VECTOR(isoscores)[i]);
+	} else {
+	  VECTOR(weights)[i] = 0.0;
+	}
+	sumw += VECTOR(weights)[i];
+      }
+      if (sumw == 0) { continue; }
+      for (i=0; i<noiso; i++) {
+	VECTOR(counts)[i] += 
+	  VECTOR(*myclass_counts)[c] * VECTOR(weights)[i] / sumw;
+      }
+    }
+    for (i=0, maxdiff=0.0; i<noiso; i++) {
+      double a=VECTOR(*hyperp)[i] + VECTOR(counts)[i];
+      double d=fabs(a - VECTOR(*alpha)[i]);
+      if (d > maxdiff) { maxdiff=d; }
+      VECTOR(*alpha)[i] = a;
+    }
+  }
+
+  /* Draw PSI from the approximate posterior */
+  SPLICING_CHECK(splicing_i_miso_vb_sample(myclass_templates, 
+					   myclass_counts, &effisolen, hyperp,
+					   alpha, noSamples, rng, samples,
+					   rundata));
+  SPLICING_CHECK(splicing_matrix_init(&expcounts, noiso, noSamples));
+  SPLICING_FINALLY(splicing_matrix_destroy, &expcounts);
+  for (c=0; c<noSamples; c++) {
+    memcpy(&MATRIX(expcounts, 0, c), VECTOR(counts), noiso*sizeof(double));
+  }
+  SPLICING_CHECK(splicing_score_joint(&expcounts, noSamples, samples, hyperp,
+				      &effisolen, &isoscores, logLik));
+  splicing_matrix_destroy(&expcounts);
+  SPLICING_FINALLY_CLEAN(1);
+
+  if (assignment) {
+    SPLICING_CHECK(splicing_vector_int_resize(assignment, noReads));
+    for (c=0; c<noReads; c++) {
+      double sumw=0.0, rand;
+      for (i=0; i<noiso; i++) {
+	if (MATRIX(*mymatch_matrix, i, c) != 0 && VECTOR(effisolen)[i] > 0) {
+	  sumw += exp(VECTOR(elogphi)[i] + VECTOR(isoscores)[i]);
+	}
+	VECTOR(weights)[i] = sumw;
+      }
+      if (sumw == 0) { 
+	VECTOR(*assignment)[c] = -1;
+	continue;
+      }
+      rand = splicing_rng_get_unif01(rng) * sumw;
+      for (i=0; rand > VECTOR(weights)[i]; i++) ;
+      VECTOR(*assignment)[c] = i;
+    }
+  }
+
+  rundata->noIso=noiso;
+  rundata->noIters=it;
+  rundata->maxIters=maxIterations;
+  rundata->noBurnIn=0;
+  rundata->noLag=1;
+  rundata->noChains=1;
+  rundata->noSamples=noSamples;
+  SPLICING_CHECK(splicing_i_miso_rhat_ess(samples, noSamples, 1,
+					  &rundata->rhat, &rundata->ess));
+
+  splicing_vector_destroy(&phi);
+  splicing_vector_destroy(&weights);
+  splicing_vector_destroy(&counts);
+  splicing_vector_destroy(&elogphi);
+  splicing_vector_destroy(&isoscores);
+  splicing_vector_int_destroy(&effisolen);
+  SPLICING_FINALLY_CLEAN(6);
+  if (!resalpha) {
+    splicing_vector_destroy(alpha);
+    SPLICING_FINALLY_CLEAN(1);
+  }
+  if (!class_templates) {
+    splicing_vector_destroy(myclass_counts);
+    splicing_matrix_destroy(myclass_templates);
+    SPLICING_FINALLY_CLEAN(2);
+  }
+  splicing_vector_int_destroy(&match_order);
+  SPLICING_FINALLY_CLEAN(1);
+  if (!match_matrix) {
+    splicing_matrix_destroy(mymatch_matrix);
+    SPLICING_FINALLY_CLEAN(1);
+  }
+
+  return 0;
+}
+
 int splicing_order_matches(const splicing_matrix_t *matches,
 			   splicing_vector_int_t *order) {
 
@@ -8,79 +8,35 @@
 #include "splicing.h"
 #include "splicing_random.h"
 
-#define CUMSUM() do {							\
-    int j;								\
-    double *cptr = curr;						\
-    for (j=0, noValid=0, sumpsi=0.0; j<noiso; j++, cptr++) {		\
-      if (*cptr != 0) {							\
-	sumpsi += MATRIX(*psi, j, k) * (*cptr);				\
-	VECTOR(validIso)[noValid] = j;					\
-	VECTOR(cumsum)[noValid] = sumpsi;				\
-	noValid++;							\
-      }									\
-    }									\
-  } while (0)
+/* Like splicing_reassign_samples(), but the isoform probabilities 
+   are weighted by the match matrix entries. */
 
 int splicing_reassign_samples_paired(
 			     const splicing_matrix_t *matches, 
 			     const splicing_vector_int_t *match_order,
+			     const splicing_match_classes_t *classes,
 			     const splicing_matrix_t *psi, 
 			     int noiso, int noChains, int fragmentStart, 
+			     splicing_rng_t *rng,
 			     splicing_matrix_int_t *result) {
 
-  int noreads = splicing_matrix_ncol(matches);
-  int i, k, w;
-  double *prev, *curr;
-  double rand, sumpsi;
-  int noValid;
-  int *order=VECTOR(*match_order);
-  splicing_vector_t cumsum;
-  splicing_vector_int_t validIso;  
+  splicing_match_classes_t vclasses;
 
-  SPLICING_CHECK(splicing_vector_init(&cumsum, noiso));
-  SPLICING_FINALLY(splicing_vector_destroy, &cumsum);
-  SPLICING_CHECK(splicing_vector_int_init(&validIso, noiso));
-  SPLICING_FINALLY(splicing_vector_int_destroy, &validIso);
-
-  SPLICING_CHECK(splicing_matrix_int_resize(result, noreads, noChains));
-
-  if (noreads == 0) { return 0; }  
-
-  for (k=0; k<noChains; k++) {
-
-    prev = curr = &MATRIX(*matches, 0, order[0]);
-    CUMSUM();
-
-    for (i=0; i<noreads; i++) {
-      curr = &MATRIX(*matches, 0, order[i]);
-
-      /* Maybe we need to update the cumulative sum */
-      if (memcmp(prev, curr, sizeof(double)*noiso) != 0) { CUMSUM(); }
-    
-      if (noValid == 0) {
-	MATRIX(*result, order[i], k) = -1;
-      } else if (noValid == 1) {
-	MATRIX(*result, order[i], k) = VECTOR(validIso)[0];
-      } else if (noValid == 2) { 
-	rand = RNG_UNIF01() * sumpsi;
-	w = (rand < VECTOR(cumsum)[0]) ? VECTOR(validIso)[0] : 
-	  VECTOR(validIso)[1];
-	MATRIX(*result, order[i], k) = w;
-      } else {
-	/* Draw */
-	rand = RNG_UNIF01() * sumpsi;
-	/* TODO: Binary search for interval, if many classes */
-	for (w=0; rand > VECTOR(cumsum)[w]; w++) ;
-	MATRIX(*result, order[i], k) = VECTOR(validIso)[w];
-      }
-      
-      prev=curr;
-    }
+  if (classes) { 
+    SPLICING_CHECK(splicing_i_reassign_samples(classes, match_order, psi,
+					       noiso, noChains, 
+					       /*weighted=*/ 1, rng, result));
+    return 0;
   }
 
-  splicing_vector_int_destroy(&validIso);
-  splicing_vector_destroy(&cumsum);
-  SPLICING_FINALLY_CLEAN(2);
+  SPLICING_CHECK(splicing_match_classes_init(&vclasses));
+  SPLICING_FINALLY(splicing_match_classes_destroy, &vclasses);
+  SPLICING_CHECK(splicing_match_classes(matches, match_order, &vclasses));
+  SPLICING_CHECK(splicing_i_reassign_samples(&vclasses, match_order, psi,
+					     noiso, noChains, 
+					     /*weighted=*/ 1, rng, result));
+  splicing_match_classes_destroy(&vclasses);
+  SPLICING_FINALLY_CLEAN(1);
 
   return 0;
 }
@@ -240,16 +196,19 @@ int splicing_metropolis_hastings_ratio_paired(
 
 int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 			 const splicing_vector_int_t *position,
-			 const char **cigarstr, int readLength, int overHang,
+			 const splicing_cigar_t *readcigar,
+			 int readLength, int overHang,
 			 int noChains, int noIterations, 
 			 int maxIterations, int noBurnIn, int noLag,
 			 const splicing_vector_t *hyperp, 
 			 splicing_miso_start_t start, 
 			 splicing_miso_stop_t stop,
+			 int checkEvery, double minEss, double maxRhat,
 			 const splicing_matrix_t *start_psi,
 			 const splicing_vector_t *fragmentProb,
 			 int fragmentStart, double normalMean, 
 			 double normalVar, double numDevs,
+			 splicing_rng_t *rng,
 			 splicing_matrix_t *samples, 
 			 splicing_vector_t *logLik,
 			 splicing_matrix_t *match_matrix, 
@@ -271,6 +230,7 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
   int i, j, m, lagCounter=0, noS=0;
   splicing_matrix_t *mymatch_matrix=match_matrix, vmatch_matrix;
   splicing_vector_int_t match_order;
+  splicing_match_classes_t matchClasses;
   splicing_vector_int_t isolen;
   splicing_matrix_t isoscores;
   splicing_matrix_int_t fragmentLength;
@@ -279,9 +239,12 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
   splicing_vector_t *myfragmentProb=(splicing_vector_t*) fragmentProb,
     vfragmentProb;
   splicing_vector_int_t noexons;
-  int shouldstop=0;
+  int shouldstop=0, converged=0;
   splicing_matrix_t chainMeans, chainVars;
 
+  /* Use the default RNG, unless the caller gave its own */
+  if (!rng) { rng = &splicing_rng_default; }
+
   if (start == SPLICING_MISO_START_GIVEN && !start_psi) {
     SPLICING_ERROR("`start_psi' must be given when "
 		   "starting from a given PSI", SPLICING_EINVAL);
@@ -332,6 +295,11 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 		   SPLICING_EINVAL);
   }
 
+  if (stop==SPLICING_MISO_STOP_RHAT_ESS && checkEvery < 1) {
+    SPLICING_ERROR("Convergence must be checked at least every "
+		   "iteration", SPLICING_EINVAL);
+  }
+
   if (start_psi && 
       (splicing_matrix_nrow(start_psi) != noiso ||
        splicing_matrix_ncol(start_psi) != noChains)) {
@@ -345,6 +313,8 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
   rundata->noAccepted = rundata->noRejected = 0;
   rundata->noChains = noChains;
   rundata->noSamples = noSamples;
+  rundata->rhat = HUGE_VAL;
+  rundata->ess = 0.0;
 
   SPLICING_CHECK(splicing_vector_init(&acceptP, noChains));
   SPLICING_FINALLY(splicing_vector_destroy, &acceptP);
@@ -375,7 +345,7 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
   SPLICING_FINALLY(splicing_vector_int_destroy, &match_order);
   SPLICING_CHECK(splicing_matrix_int_init(&fragmentLength, noiso, noReads));
   SPLICING_FINALLY(splicing_matrix_int_destroy, &fragmentLength);
-  SPLICING_CHECK(splicing_matchIso_paired(gff, gene, position, cigarstr, 
+  SPLICING_CHECK(splicing_matchIso_paired(gff, gene, position, readcigar, 
 					  readLength, overHang, 
 					  myfragmentProb, 
 					  fragmentStart, normalMean, 
@@ -418,6 +388,13 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
     VECTOR(assscores)[i] = log(VECTOR(assscores)[i]);
   }
 
+  /* The reads with the same match matrix column, for the 
+     reassignment of the reads in each iteration */
+  SPLICING_CHECK(splicing_match_classes_init(&matchClasses));
+  SPLICING_FINALLY(splicing_match_classes_destroy, &matchClasses);
+  SPLICING_CHECK(splicing_match_classes(mymatch_matrix, &match_order,
+					&matchClasses));
+
   SPLICING_CHECK(splicing_matrix_resize(samples, noiso, noSamples));
   SPLICING_CHECK(splicing_vector_resize(logLik, noSamples));
 
@@ -431,19 +408,21 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
   SPLICING_CHECK(splicing_drift_proposal_init(noiso, noChains, psi, alpha, &sigma,
 					 start, start_psi, gff,
 					 gene, readLength, overHang, 
-					 position, cigarstr, /*paired=*/ 1, 
+					 position, readcigar, /*paired=*/ 1, 
 					 fragmentProb, fragmentStart,
-					 normalMean, normalVar, numDevs));
+					 normalMean, normalVar, numDevs,
+					 rng));
 
   SPLICING_CHECK(splicing_drift_proposal_propose(noiso, noChains, 
-						 alpha, sigma, psi, alpha));
+						 alpha, sigma, rng,
+						 psi, alpha));
   
   /* Initialize assignments of reads */  
   
   SPLICING_CHECK(splicing_reassign_samples_paired(mymatch_matrix,
-						  &match_order, 
+						  &match_order, &matchClasses,
 						  psi, noiso, noChains, 
-						  fragmentStart,
+						  fragmentStart, rng,
 						  &vass));
   
   /* foreach Iteration m=1, ..., M do */
@@ -453,7 +432,7 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
     for (m=0; m < noIterations; m++) {
       
       SPLICING_CHECK(splicing_drift_proposal_propose(noiso, noChains,
-						     alpha, sigma,
+						     alpha, sigma, rng,
 						     psiNew, alphaNew));
 
       SPLICING_CHECK(splicing_metropolis_hastings_ratio_paired(&vass,
@@ -466,7 +445,8 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 					     &acceptP, &cJS, &pJS));
 
       for (j=0; j<noChains; j++) {
-	if (VECTOR(acceptP)[j] >= 1 || RNG_UNIF01() < VECTOR(acceptP)[j]) {
+	if (VECTOR(acceptP)[j] >= 1 || 
+	    splicing_rng_get_unif01(rng) < VECTOR(acceptP)[j]) {
 	  memcpy(&MATRIX(*psi, 0, j), &MATRIX(*psiNew, 0, j), 
 		 noiso * sizeof(double));
 	  memcpy(&MATRIX(*alpha, 0, j), &MATRIX(*alphaNew, 0, j),
@@ -489,11 +469,24 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 	  lagCounter ++;
 	}
       }
+
+      if (stop == SPLICING_MISO_STOP_RHAT_ESS && m >= noBurnIn &&
+	  (m - noBurnIn + 1) % checkEvery == 0) {
+	SPLICING_CHECK(splicing_i_miso_rhat_ess(samples, noS, noChains,
+						&rundata->rhat, 
+						&rundata->ess));
+	if (rundata->rhat <= maxRhat && rundata->ess >= minEss) {
+	  converged = 1;
+	  break;
+	}
+      }
       
       SPLICING_CHECK(splicing_reassign_samples_paired(mymatch_matrix,
 						      &match_order,
+						      &matchClasses,
 						      psi, noiso, noChains, 
-						      fragmentStart, &vass));
+						      fragmentStart, rng,
+						      &vass));
 
     } /* for m < noIterations */
 
@@ -512,6 +505,9 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 							&shouldstop));
       }
       break;
+    case SPLICING_MISO_STOP_RHAT_ESS:
+      shouldstop = 1;
+      break;
     }
 
     if (shouldstop) { break; }
@@ -526,6 +522,14 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
     SPLICING_CHECK(splicing_vector_resize(logLik, noSamples));
   }
 
+  /* Stopped early, only keep the samples we have */
+  if (converged) {
+    rundata->noIters = m + 1;
+    rundata->noSamples = noSamples = noS;
+    SPLICING_CHECK(splicing_matrix_resize(samples, noiso, noSamples));
+    SPLICING_CHECK(splicing_vector_resize(logLik, noSamples));
+  }
+
   splicing_matrix_destroy(&chainVars);
   splicing_matrix_destroy(&chainMeans);
   SPLICING_FINALLY_CLEAN(2);
@@ -537,12 +541,13 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
     }
   }
 
+  splicing_match_classes_destroy(&matchClasses);
   splicing_vector_destroy(&assscores);
   splicing_matrix_destroy(&isoscores);
   splicing_vector_int_destroy(&isolen);
   splicing_matrix_int_destroy(&fragmentLength);
   splicing_vector_int_destroy(&match_order);
-  SPLICING_FINALLY_CLEAN(5);
+  SPLICING_FINALLY_CLEAN(6);
   if (!match_matrix) {
     splicing_matrix_destroy(mymatch_matrix);
     SPLICING_FINALLY_CLEAN(1);
@@ -570,6 +575,10 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 					noSamples-rundata->noSamples);
   }
 
+  SPLICING_CHECK(splicing_i_miso_rhat_ess(samples, rundata->noSamples, 
+					  noChains, &rundata->rhat, 
+					  &rundata->ess));
+
   return 0;
 }
 
@@ -1704,13 +1704,14 @@ double splicing_rpois(splicing_rng_t *rng, double mu)
 	1., 1., 2., 6., 24., 120., 720., 5040., 40320., 362880.
     };
 
-    /* These are static --- persistent between calls for same mu : */
-    static int l, m;
+    /* These are static --- persistent between calls for same mu, 
+       per thread : */
+    static SPLICING_THREAD_LOCAL int l, m;
 
-    static double b1, b2, c, c0, c1, c2, c3;
-    static double pp[36], p0, p, q, s, d, omega;
-    static double big_l;/* integer "w/o overflow" */
-    static double muprev = 0., muprev2 = 0.;/*, muold	 = 0.*/
+    static SPLICING_THREAD_LOCAL double b1, b2, c, c0, c1, c2, c3;
+    static SPLICING_THREAD_LOCAL double pp[36], p0, p, q, s, d, omega;
+    static SPLICING_THREAD_LOCAL double big_l;/* integer "w/o overflow" */
+    static SPLICING_THREAD_LOCAL double muprev = 0., muprev2 = 0.;/*, muold	 = 0.*/
 
     /* Local Vars  [initialize some for -Wall]: */
     double del, difmuk= 0., E= 0., fk= 0., fx, fy, g, px, py, t, u= 0., v, x;
@@ -1906,14 +1907,14 @@ double splicing_rgeom(splicing_rng_t *rng, double p) {
 
 double splicing_rbinom(splicing_rng_t *rng, long int nin, double pp)
 {
-    /* FIXME: These should become THREAD_specific globals : */
+    /* These are thread specific, samplers may run in parallel : */
 
-    static double c, fm, npq, p1, p2, p3, p4, qn;
-    static double xl, xll, xlr, xm, xr;
+    static SPLICING_THREAD_LOCAL double c, fm, npq, p1, p2, p3, p4, qn;
+    static SPLICING_THREAD_LOCAL double xl, xll, xlr, xm, xr;
 
-    static double psave = -1.0;
-    static int nsave = -1;
-    static int m;
+    static SPLICING_THREAD_LOCAL double psave = -1.0;
+    static SPLICING_THREAD_LOCAL int nsave = -1;
+    static SPLICING_THREAD_LOCAL int m;
 
     double f, f1, f2, u, v, w, w2, x, x1, x2, z, z2;
     double p, q, np, g, r, al, alv, amaxp, ffm, ynorm;
@@ -2138,11 +2139,11 @@ double splicing_rgamma(splicing_rng_t *rng, double a, double scale)
     const static double a6 = -0.1367177;
     const static double a7 = 0.1233795;
 
-    /* State variables [FIXME for threading!] :*/
-    static double aa = 0.;
-    static double aaa = 0.;
-    static double s, s2, d;    /* no. 1 (step 1) */
-    static double q0, b, si, c;/* no. 2 (step 4) */
+    /* State variables, per thread :*/
+    static SPLICING_THREAD_LOCAL double aa = 0.;
+    static SPLICING_THREAD_LOCAL double aaa = 0.;
+    static SPLICING_THREAD_LOCAL double s, s2, d;    /* no. 1 (step 1) */
+    static SPLICING_THREAD_LOCAL double q0, b, si, c;/* no. 2 (step 4) */
 
     double e, p, q, r, t, u, v, w, x, ret_val;
 
@@ -7,7 +7,8 @@
 
 int splicing_matchIso(const splicing_gff_t *gff, int gene, 
 		      const splicing_vector_int_t *position, 
-		      const char **cigarstr, int overHang, int readLength,
+		      const splicing_cigar_t *readcigar,
+		      int overHang, int readLength,
 		      splicing_matrix_t *result) {
 
   int noreads=splicing_vector_int_size(position);
@@ -40,7 +41,7 @@ int splicing_matchIso(const splicing_gff_t *gff, int gene,
   SPLICING_FINALLY(splicing_vector_int_destroy, &cigaridx);
   SPLICING_CHECK(splicing_vector_int_init(&cigarlength, 0));
   SPLICING_FINALLY(splicing_vector_int_destroy, &cigarlength);
-  SPLICING_CHECK(splicing_parse_cigar(cigarstr, noreads, &cigar, &cigaridx, 
+  SPLICING_CHECK(splicing_parse_cigar(readcigar, noreads, &cigar, &cigaridx, 
 				      &cigarlength, readLength));
 
   SPLICING_CHECK(splicing_matrix_resize(result, noiso, noreads));
@@ -111,7 +112,7 @@ int splicing_matchIso(const splicing_gff_t *gff, int gene,
 
 int splicing_matchIso_paired(const splicing_gff_t *gff, int gene,
 			     const splicing_vector_int_t *position,
-			     const char **cigarstr, int readLength, 
+			     const splicing_cigar_t *readcigar, int readLength, 
 			     int overHang,
 			     const splicing_vector_t *fragmentProb,
 			     int fragmentStart, double normalMean,
@@ -147,7 +148,7 @@ int splicing_matchIso_paired(const splicing_gff_t *gff, int gene,
   SPLICING_CHECK(splicing_genomic_to_iso(gff, gene, position,
 					 /*converter=*/ 0, &isopos));
   
-  SPLICING_CHECK(splicing_matchIso(gff, gene, position, cigarstr, overHang,
+  SPLICING_CHECK(splicing_matchIso(gff, gene, position, readcigar, overHang,
 				   readLength, result));
   
   if (fragmentLength) {
@@ -188,12 +189,89 @@ int splicing_matchIso_paired(const splicing_gff_t *gff, int gene,
   return 0;
 }
 
-int splicing_parse_cigar(const char **cigar, size_t noreads,
+void splicing_cigar_str(splicing_cigar_t *cigar, const char **str) {
+  cigar->str = str;
+  cigar->pairs = 0;
+  cigar->idx = 0;
+}
+
+void splicing_cigar_pairs(splicing_cigar_t *cigar, const int *pairs,
+			  const int *idx) {
+  cigar->str = 0;
+  cigar->pairs = pairs;
+  cigar->idx = idx;
+}
+
+static int splicing_i_parse_cigar_op(char op, long l, int *mode, int *len,
+				     size_t *pos,
+				     splicing_vector_int_t *numcigar,
+				     int maxReadLength) {
+
+  if (*mode==0 && op!='S' && op!='H') {
+    *mode=1; 
+  } else if (*mode==1 && (op=='S' || op=='H')) { 
+    *mode=2;
+  } else if (*mode==2 && op != 'S' && op != 'H') {
+    SPLICING_ERROR("Bad CIGAR string: `S' and 'H' may appear only at "
+		   "the beginning and the end", SPLICING_EINVAL);
+  }
+
+  if (op == 'M' || op == '=') { /* MATCHING */
+    if (maxReadLength > 0 && *len + l > maxReadLength) { 
+      l = maxReadLength - *len;
+    }
+    SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
+    *len += l;
+    (*pos)++;
+  } else if (op == 'N') {	/* SKIPPING */
+    SPLICING_CHECK(splicing_vector_int_push_back(numcigar, -l));
+    (*pos)++;
+  } else if (op == 'X') {	/* SEQ MISMATCH */
+    if (l > 4) { SPLICING_WARNING("Long non-matching alignment"); }
+    /* We count this as matching */
+    if (maxReadLength > 0 && *len + l > maxReadLength) { 
+      l = maxReadLength - *len;
+    }
+    SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
+    *len += l;
+    (*pos)++;
+  } else if (op == 'S' || op == 'H') { /* SOFT/HARD CLIPPING */
+    /* We consider these 'matching' */
+    if (maxReadLength > 0 && *len + l > maxReadLength) { 
+      l = maxReadLength - *len;
+    }
+    SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
+    *len += l;
+    (*pos)++;
+  } else if (op == 'D') {	/* DELETION FROM THE REFERENCE */
+    if (l > 4) { SPLICING_WARNING("Long deleted alignment"); }
+    /* We count this as matching */
+    if (maxReadLength > 0 && *len + l > maxReadLength) { 
+      l = maxReadLength - *len;
+    }
+    SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
+    *len += l;
+    (*pos)++;
+  } else if (op == 'I') {	/* INSERTION TO THE REFERENCE */
+    if (l > 4) { SPLICING_WARNING("Long inserted alignment"); }
+    /* We do nothing, just ignore the part that does not appear in 
+       the genome */
+  } else {
+    SPLICING_ERROR("Unsupported CIGAR string (`MNSHDI=X' are supported)", 
+		   SPLICING_EINVAL);
+  }
+
+  return 0;
+}
+
+int splicing_parse_cigar(const splicing_cigar_t *cigar, size_t noreads,
 			 splicing_vector_int_t *numcigar,
 			 splicing_vector_int_t *cigaridx, 
 			 splicing_vector_int_t *cigarlength, 
 			 int maxReadLength) {
   
+  /* The CIGAR operations, by BAM operation code */
+  static const char bam_ops[] = "MIDNSHP=X";
   size_t i, pos=0;
   
   splicing_vector_int_clear(numcigar);
@@ -201,73 +279,29 @@ int splicing_parse_cigar(const char **cigar, size_t noreads,
   SPLICING_CHECK(splicing_vector_int_resize(cigarlength, noreads));
 
   for (i=0; i<noreads; i++) {
-    char *s= (char*) cigar[i];
     int mode=0;			/* 0: begin, 1:middle, 2:end */
     int len=0;
     VECTOR(*cigaridx)[i] = pos;
-    while (*s) {
-      long l = strtol(s, &s, 10L);
-
-      if (mode==0 && *s!='S' && *s!='H') {
-	mode=1; 
-      } else if (mode==1 && (*s=='S' || *s=='H')) { 
-	mode=2;
-      } else if (mode==2 && *s != 'S' && *s != 'H') {
-	SPLICING_ERROR("Bad CIGAR string: `S' and 'H' may appear only at "
-		       "the beginning and the end", SPLICING_EINVAL);
-      }
-
-      if (*s == 'M' || *s == '=') { /* MATCHING */
-	if (maxReadLength > 0 && len + l > maxReadLength) { 
-	  l = maxReadLength - len;
-	}
-	SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
-	len += l;
-	pos++;
-	s++;
-      } else if (*s == 'N') {	/* SKIPPING */
-	SPLICING_CHECK(splicing_vector_int_push_back(numcigar, -l));
-	pos++;
-	s++;
-      } else if (*s == 'X') {	/* SEQ MISMATCH */
-	if (l > 4) { SPLICING_WARNING("Long non-matching alignment"); }
-	/* We count this as matching */
-	if (maxReadLength > 0 && len + l > maxReadLength) { 
-	  l = maxReadLength - len;
-	}
-	SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
-	len += l;
-	pos++;
+    if (cigar->str) {
+      char *s= (char*) cigar->str[i];
+      while (*s) {
+	long l = strtol(s, &s, 10L);
+	SPLICING_CHECK(splicing_i_parse_cigar_op(*s, l, &mode, &len, &pos,
+						 numcigar, maxReadLength));
 	s++;
-      } else if (*s == 'S' || *s == 'H') { /* SOFT/HARD CLIPPING */
-	/* We consider these 'matching' */
-	if (maxReadLength > 0 && len + l > maxReadLength) { 
-	  l = maxReadLength - len;
-	}
-	SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
-	len += l;
-	pos++;
-	s++;
-      } else if (*s == 'D') {	/* DELETION FROM THE REFERENCE */
-	if (l > 4) { SPLICING_WARNING("Long deleted alignment"); }
-	/* We count this as matching */
-	if (maxReadLength > 0 && len + l > maxReadLength) { 
-	  l = maxReadLength - len;
+      }
+    } else {
+      int j;
+      for (j=cigar->idx[i]; j<cigar->idx[i+1]; j++) {
+	int op=cigar->pairs[2*j];
+	if (op < 0 || (size_t) op >= sizeof(bam_ops)-1) {
+	  SPLICING_ERROR("Invalid CIGAR operation code", SPLICING_EINVAL);
 	}
-	SPLICING_CHECK(splicing_vector_int_push_back(numcigar, l));
-	len += l;
-	pos++;
-	s++;
-      } else if (*s == 'I') {	/* INSERTION TO THE REFERENCE */
-	if (l > 4) { SPLICING_WARNING("Long inserted alignment"); }
-	/* We do nothing, just ignore the part that does not appear in 
-	   the genome */
-	s++;
-      } else {
-	SPLICING_ERROR("Unsupported CIGAR string (`MNSHDI=X' are supported)", 
-		       SPLICING_EINVAL);
+	SPLICING_CHECK(splicing_i_parse_cigar_op(bam_ops[op], 
+						 cigar->pairs[2*j+1], 
+						 &mode, &len, &pos, numcigar,
+						 maxReadLength));
       }
-      if (maxReadLength && len == maxReadLength) { continue; }
     }
     VECTOR(*cigarlength)[i] = len;
   }
@@ -279,7 +313,7 @@ int splicing_parse_cigar(const char **cigar, size_t noreads,
 int splicing_solve_gene(const splicing_gff_t *gff, size_t gene, 
 			int readLength, int overHang,
 			const splicing_vector_int_t *position, 
-			const char **cigarstr,
+			const splicing_cigar_t *readcigar,
 			splicing_matrix_t *match_matrix,
 			splicing_vector_t *nomatch,
 			splicing_matrix_t *assignment_matrix, 
@@ -322,7 +356,7 @@ int splicing_solve_gene(const splicing_gff_t *gff, size_t gene,
   noiso=splicing_matrix_nrow(myass_matrix);
 
   /* Calculate match vector from match matrix */
-  SPLICING_CHECK(splicing_matchIso(gff, gene, position, cigarstr, overHang,
+  SPLICING_CHECK(splicing_matchIso(gff, gene, position, readcigar, overHang,
 				   readLength, mymatch_matrix));
   SPLICING_CHECK(splicing_vector_init(&match, no_classes));
   SPLICING_FINALLY(splicing_vector_destroy, &match);
@@ -390,7 +424,7 @@ int splicing_solve_gene(const splicing_gff_t *gff, size_t gene,
 int splicing_solve_gene_paired(const splicing_gff_t *gff, size_t gene,
 			       int readLength, int overHang,
 			       const splicing_vector_int_t *position,
-			       const char **cigarstr,
+			       const splicing_cigar_t *readcigar,
 			       const splicing_vector_t *fragmentProb,
 			       int fragmentStart, double normalMean,
 			       double normalVar, double numDevs,
@@ -441,7 +475,7 @@ int splicing_solve_gene_paired(const splicing_gff_t *gff, size_t gene,
   noiso=splicing_matrix_nrow(myass_matrix);
 
   /* Calculate match vector from match matrix */
-  SPLICING_CHECK(splicing_matchIso_paired(gff, gene, position, cigarstr, 
+  SPLICING_CHECK(splicing_matchIso_paired(gff, gene, position, readcigar, 
 					  readLength, overHang, fragmentProb,
 					  fragmentStart, normalMean, 
 					  normalVar, numDevs, mymatch_matrix, 
@@ -138,6 +138,7 @@ int splicing_gff_print(const splicing_gff_t *gff);
 typedef struct splicing_miso_rundata_t {
   int noIso, noIters, maxIters, noBurnIn, noLag, noAccepted, noRejected,
     noChains, noSamples;
+  double rhat, ess;
 } splicing_miso_rundata_t;
 
 typedef enum splicing_miso_start_t {
@@ -153,17 +154,43 @@ typedef enum splicing_miso_stop_t {
   SPLICING_MISO_STOP_CONVERGENT_MEAN=1,*/
   /* Turn off convergent mean; take fixed no. iterations */
   SPLICING_MISO_STOP_FIXEDNO=1,
-  SPLICING_MISO_STOP_CONVERGENT_MEAN=0
+  SPLICING_MISO_STOP_CONVERGENT_MEAN=0,
+  /* Stop when the split R-hat and the effective sample size 
+     reach their targets, checked regularly */
+  SPLICING_MISO_STOP_RHAT_ESS=2
 } splicing_miso_stop_t;
 
+typedef enum splicing_miso_proposal_t {
+  /* Logistic normal drift proposal, with a Metropolis-Hastings step */
+  SPLICING_MISO_PROPOSAL_DRIFT=0,
+  /* Draw PSI from its Dirichlet conditional, given the isoform counts */
+  SPLICING_MISO_PROPOSAL_GIBBS=1
+} splicing_miso_proposal_t;
+
+/* The CIGARs of the reads. Either `str' is given, a CIGAR string per
+   read, or `pairs' and `idx'. `pairs' holds the CIGARs of all reads as
+   (operation, length) pairs, with the BAM operation codes (0-8 for
+   `MIDNSHP=X'), the pairs of read i are pairs idx[i] ... idx[i+1]-1. */
+
+typedef struct splicing_cigar_t {
+  const char **str;
+  const int *pairs;
+  const int *idx;
+} splicing_cigar_t;
+
+void splicing_cigar_str(splicing_cigar_t *cigar, const char **str);
+void splicing_cigar_pairs(splicing_cigar_t *cigar, const int *pairs,
+			  const int *idx);
+
 int splicing_matchIso(const splicing_gff_t *gff, int gene, 
 		      const splicing_vector_int_t *position,
-		      const char **cigarstr, int overHang, int readLength,
+		      const splicing_cigar_t *readcigar,
+		      int overHang, int readLength,
 		      splicing_matrix_t *result);
 
 int splicing_matchIso_paired(const splicing_gff_t *gff, int gene,
 			     const splicing_vector_int_t *position,
-			     const char **cigarstr, int readLength,
+			     const splicing_cigar_t *readcigar, int readLength,
 			     int overHang, 
 			     const splicing_vector_t *fragmentProb,
 			     int fragmentStart, double normalMean,
@@ -171,7 +198,7 @@ int splicing_matchIso_paired(const splicing_gff_t *gff, int gene,
 			     splicing_matrix_t *result,
 			     splicing_matrix_int_t *fragmentLengths);
 
-int splicing_parse_cigar(const char **cigar, size_t noreads,
+int splicing_parse_cigar(const splicing_cigar_t *cigar, size_t noreads,
 			 splicing_vector_int_t *numcigar,
 			 splicing_vector_int_t *cigaridx, 
 			 splicing_vector_int_t *cigarlength,
@@ -192,13 +219,21 @@ int splicing_i_check_convergent_mean(splicing_matrix_t *chainMeans,
 				     const splicing_matrix_t *samples,
 				     int *shouldstop);
 
+int splicing_i_miso_rhat_ess(const splicing_matrix_t *samples, 
+			     int noSamples, int noChains, 
+			     double *rhat, double *ess);
+
 int splicing_miso(const splicing_gff_t *gff, size_t gene,
 		  const splicing_vector_int_t *position,
-		  const char **cigarstr, int readLength, int overHang,
+		  const splicing_cigar_t *readcigar,
+		  int readLength, int overHang,
 		  int noChains, int noIterations, int maxIterations, 
 		  int noBurnIn, int noLag, const splicing_vector_t *hyperp, 
 		  splicing_miso_start_t start, splicing_miso_stop_t stop,
+		  int checkEvery, double minEss, double maxRhat,
+		  splicing_miso_proposal_t proposal, int noThreads,
 		  const splicing_matrix_t *start_psi,
+		  splicing_rng_t *rng,
 		  splicing_matrix_t *samples, splicing_vector_t *logLik, 
 		  splicing_matrix_t *match_matrix,
 		  splicing_matrix_t *class_templates,
@@ -206,18 +241,54 @@ int splicing_miso(const splicing_gff_t *gff, size_t gene,
 		  splicing_vector_int_t *assignment,
 		  splicing_miso_rundata_t *rundata);
 
+int splicing_miso_classes(const splicing_gff_t *gff, size_t gene,
+			  const splicing_matrix_t *class_templates,
+			  const splicing_vector_t *class_counts,
+			  int readLength, int overHang,
+			  int noChains, int noIterations, int maxIterations, 
+			  int noBurnIn, int noLag, 
+			  const splicing_vector_t *hyperp, 
+			  splicing_miso_start_t start, 
+			  splicing_miso_stop_t stop,
+			  int checkEvery, double minEss, double maxRhat,
+			  splicing_miso_proposal_t proposal, int noThreads,
+			  const splicing_matrix_t *start_psi,
+			  splicing_rng_t *rng,
+			  splicing_matrix_t *samples, 
+			  splicing_vector_t *logLik, 
+			  splicing_vector_int_t *assignment,
+			  splicing_miso_rundata_t *rundata);
+
+int splicing_miso_vb(const splicing_gff_t *gff, size_t gene,
+		     const splicing_vector_int_t *position,
+		     const splicing_cigar_t *readcigar,
+		     int readLength, int overHang,
+		     int noSamples, int maxIterations, double tolerance,
+		     const splicing_vector_t *hyperp, 
+		     splicing_rng_t *rng,
+		     splicing_matrix_t *samples, splicing_vector_t *logLik,
+		     splicing_vector_t *resalpha,
+		     splicing_matrix_t *match_matrix, 
+		     splicing_matrix_t *class_templates,
+		     splicing_vector_t *class_counts,
+		     splicing_vector_int_t *assignment,
+		     splicing_miso_rundata_t *rundata);
+
 int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 			 const splicing_vector_int_t *position,
-			 const char **cigarstr, int readLength, int overHang,
+			 const splicing_cigar_t *readcigar,
+			 int readLength, int overHang,
 			 int noChains, int noIterations, int maxIterations,
 			 int noBurnIn, int noLag, 
 			 const splicing_vector_t *hyperp, 
 			 splicing_miso_start_t start, 
 			 splicing_miso_stop_t stop, 
+			 int checkEvery, double minEss, double maxRhat,
 			 const splicing_matrix_t *start_psi,
 			 const splicing_vector_t *fragmentProb, 
 			 int fragmentStart,
 			 double normalMean, double normalVar, double numDevs,
+			 splicing_rng_t *rng,
 			 splicing_matrix_t *samples, 
 			 splicing_vector_t *logLik, 
 			 splicing_matrix_t *match_matrix,
@@ -228,18 +299,52 @@ int splicing_miso_paired(const splicing_gff_t *gff, size_t gene,
 			 splicing_vector_int_t *assignment,
 			 splicing_miso_rundata_t *rundata);
 
+/* The reads with the same match matrix column, see 
+   splicing_match_classes() */
+
+typedef struct splicing_match_classes_t {
+  splicing_vector_int_t start, isostart, iso;
+  splicing_vector_t weight;
+} splicing_match_classes_t;
+
+int splicing_match_classes_init(splicing_match_classes_t *classes);
+void splicing_match_classes_destroy(splicing_match_classes_t *classes);
+int splicing_match_classes(const splicing_matrix_t *matches,
+			   const splicing_vector_int_t *match_order,
+			   splicing_match_classes_t *classes);
+int splicing_template_classes(const splicing_matrix_t *class_templates,
+			      const splicing_vector_t *class_counts,
+			      splicing_match_classes_t *classes,
+			      splicing_vector_int_t *match_order);
+
+int splicing_i_reassign_samples(const splicing_match_classes_t *classes,
+				const splicing_vector_int_t *match_order,
+				const splicing_matrix_t *psi, 
+				int noiso, int noChains, int weighted,
+				splicing_rng_t *rng,
+				splicing_matrix_int_t *result);
+
 int splicing_reassign_samples(const splicing_matrix_t *matches, 
 			      const splicing_vector_int_t *match_order,
+			      const splicing_match_classes_t *classes,
 			      const splicing_matrix_t *psi, 
 			      int noiso, int noChains, 
+			      splicing_rng_t *rng,
 			      splicing_matrix_int_t *result);
 
+int splicing_reassign_classes(const splicing_matrix_t *class_templates,
+			      const splicing_vector_t *class_counts,
+			      const splicing_matrix_t *psi, 
+			      int noiso, int noChains, 
+			      splicing_rng_t *rng,
+			      splicing_matrix_t *result);
+
 int splicing_mvplogisnorm(const splicing_vector_t *theta, 
 			  const splicing_vector_t *mu, 
 			  double sigma, int len, double *score);
 
 int splicing_score_iso(const splicing_vector_t *psi, int noiso, 
-		       const splicing_vector_int_t *assignment, int noreads,
+		       const splicing_vector_t *isocounts,
 		       const splicing_vector_int_t *peffisolen, double *res);
 
 int splicing_ldirichlet(const splicing_vector_t *x, 
@@ -247,13 +352,14 @@ int splicing_ldirichlet(const splicing_vector_t *x,
 			double *res);
 
 int splicing_mvrnorm(const splicing_matrix_t *mu, double sigma, 
-		     splicing_matrix_t *resalpha, int len);
+		     splicing_matrix_t *resalpha, int len,
+		     splicing_rng_t *rng);
 
 int splicing_logit_inv(const splicing_matrix_t *x, 
 		       splicing_matrix_t *res, int len, int noChains);
 
-int splicing_score_joint(const splicing_matrix_int_t *assignment,
-			 int no_reads, int noChains, 
+int splicing_score_joint(const splicing_matrix_t *isocounts,
+			 int noChains, 
 			 const splicing_matrix_t *psi, 
 			 const splicing_vector_t *hyper, 
 			 const splicing_vector_int_t *effisolen,
@@ -269,14 +375,15 @@ int splicing_drift_proposal_init(int noiso, int noChains,
 				 const splicing_gff_t *gff, int gene, 
 				 int readLength, int overHang, 
 				 const splicing_vector_int_t *position,
-				 const char **cigarstr, int paired, 
+				 const splicing_cigar_t *readcigar, int paired, 
 				 const splicing_vector_t *fragmentProb,
 				 int fragmentStart, double normalMean,
-				 double normalVar, double numDevs);
+				 double normalVar, double numDevs,
+				 splicing_rng_t *rng);
 
 int splicing_drift_proposal_propose(int noiso, int noChains, 
 				    const splicing_matrix_t *alpha,
-				    double sigma, 
+				    double sigma, splicing_rng_t *rng,
 				    splicing_matrix_t *respsi,
 				    splicing_matrix_t *resalpha);
 
@@ -286,8 +393,17 @@ int splicing_drift_proposal_score(int noiso, int noChains,
 				  double sigma,
 				  splicing_vector_t *resscore);
 
-int splicing_metropolis_hastings_ratio(const splicing_matrix_int_t *ass,
-				       int no_reads, int noChains,
+int splicing_gibbs_proposal(int noiso, int noChains,
+			    const splicing_matrix_t *isocounts,
+			    const splicing_vector_t *hyperp,
+			    const splicing_vector_int_t *effisolen,
+			    const splicing_matrix_t *psi,
+			    splicing_rng_t *rng,
+			    splicing_matrix_t *respsi,
+			    splicing_vector_t *acceptP);
+
+int splicing_metropolis_hastings_ratio(const splicing_matrix_t *isocounts,
+				       int noChains,
 				       const splicing_matrix_t *psiNew,
 				       const splicing_matrix_t *alphaNew,
 				       const splicing_matrix_t *psi, 
@@ -352,7 +468,7 @@ int splicing_nnls(splicing_matrix_t *A, splicing_vector_t *B,
 int splicing_solve_gene(const splicing_gff_t *gff, size_t gene, 
 			int readLength, int overHang,
 			const splicing_vector_int_t *position, 
-			const char **cigarstr,
+			const splicing_cigar_t *readcigar,
 			splicing_matrix_t *match_matrix,
 			splicing_vector_t *nomatch,
 			splicing_matrix_t *assignment_matrix, 
@@ -362,7 +478,7 @@ int splicing_solve_gene(const splicing_gff_t *gff, size_t gene,
 int splicing_solve_gene_paired(const splicing_gff_t *gff, size_t gene,
 			       int readLength, int overHang, 
 			       const splicing_vector_int_t *position,
-			       const char **cigarstr,
+			       const splicing_cigar_t *readcigar,
 			       const splicing_vector_t *fragmentProb,
 			       int fragmentStart, double normalMean,
 			       double normalVar, double numDevs,
@@ -429,8 +545,10 @@ int splicing_paired_assignment_matrix_old(const splicing_gff_t *gff,
 int splicing_reassign_samples_paired(
 			     const splicing_matrix_t *matches, 
 			     const splicing_vector_int_t *match_order,
+			     const splicing_match_classes_t *classes,
 			     const splicing_matrix_t *psi, 
 			     int noiso, int noChains, int fragmentStart, 
+			     splicing_rng_t *rng,
 			     splicing_matrix_int_t *result);
 
 int splicing_score_iso_paired(const splicing_vector_t *psi, int noiso, 
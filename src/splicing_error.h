@@ -443,6 +443,18 @@ struct splicing_i_protectedPtr {
 
 typedef void splicing_finally_func_t (void*);
 
+/* The stack of temporarily allocated objects is kept per thread, so
+   that splicing functions can be called from several threads at the
+   same time. */
+
+#if defined(__GNUC__)
+#  define SPLICING_THREAD_LOCAL __thread
+#elif defined(_MSC_VER)
+#  define SPLICING_THREAD_LOCAL __declspec(thread)
+#else
+#  define SPLICING_THREAD_LOCAL
+#endif
+
 void SPLICING_FINALLY_REAL(void (*func)(void*), void* ptr);
 
 /**